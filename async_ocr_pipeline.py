@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio による Vision OCR パイプライン（読み込み・前処理・通信・解析を重ねて実行）
+
+従来のループは「ファイル読み込み → text_detection → 解析」を1枚ずつ順に行うため、
+ディスク・CPU・ネットワークのどれか1つしか動いていない。ここではステージ間を上限つきキューで
+つなぎ、ステージごとに並列数を指定して同時に動かす。
+
+    read  : ファイル読み込み（aiofiles があれば使用、無ければスレッドで読む）
+    prep  : 送信前縮小など（upload_prep.UploadPrep、executor で実行）
+    ocr   : Vision 非同期クライアント（ImageAnnotatorAsyncClient）の batch_annotate_images（TEXT_DETECTION 1件）
+    parse : 解析関数 parse(text, path)（executor で実行、省略可）
+
+キューに上限があるため、通信が詰まっても読み込みが先走ってメモリを使い切ることはない。
+失敗した画像はそこで止め、error つきの結果として返す（他の画像は続行）。
+
+使い方:
+    # 非同期クライアントは作ったイベントループに結び付くので、asyncio.run の中で作る（client_factory）
+    pipeline = AsyncOcrPipeline(client_factory=lambda: fixed_extraction.create_vision_client(async_client=True),
+                                config=PipelineConfig(ocr=8), upload_prep=UploadPrep())
+    results = pipeline.run_sync(paths)        # 入力順の PipelineResult のリスト
+    print('\\n'.join(pipeline.summary_lines()))
+
+    # 通信なしの検証（遅延とエラーを注入する偽クライアント）
+    python async_ocr_pipeline.py bench 画像フォルダ --latency 0.3 --error-rate 0.05
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from filename_params import kbn_from_path
+from stage_profiler import PROFILER
+from tree_walker import list_files
+from vision_quota import BULK, QuotaExhausted, is_rate_limited
+
+STAGES = ('read', 'prep', 'ocr', 'parse')
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+try:
+    import aiofiles
+except ImportError:
+    aiofiles = None
+
+
+class PipelineConfig(NamedTuple):
+    """ステージごとの並列数とキューの上限"""
+    read: int = 4
+    prep: int = 2
+    ocr: int = 8
+    parse: int = 1
+    queue_size: int = 16
+    retries: int = 2            # OCR の再試行回数（通信エラー時）
+    retry_wait: float = 1.0     # 再試行までの待ち（秒、回数ごとに倍）
+    timeout: float = 60.0       # 1リクエストのタイムアウト（秒）
+
+
+_DEFAULTS = PipelineConfig()._asdict()
+
+
+class PipelineResult(NamedTuple):
+    index: int
+    path: str
+    text: str
+    data: Any                   # parse の戻り値（parse 未指定なら None）
+    error: str                  # 失敗したステージとメッセージ（成功時は空）
+    timings: Dict[str, float]   # ステージ別の所要時間（ms）
+    deferred: bool = False      # クォータ不足で送信しなかった（再試行キューへ）
+
+
+class _Item:
+    def __init__(self, index: int, path: str):
+        self.index = index
+        self.path = path
+        self.content: bytes = b''
+        self.text = ''
+        self.data: Any = None
+        self.error = ''
+        self.deferred = False
+        self.timings: Dict[str, float] = {}
+
+    def result(self) -> PipelineResult:
+        return PipelineResult(self.index, self.path, self.text, self.data, self.error, self.timings, self.deferred)
+
+
+def _text_request(content: bytes):
+    """batch_annotate_images に渡す TEXT_DETECTION 1件のリクエスト"""
+    try:
+        from google.cloud import vision
+    except ImportError:
+        return SimpleNamespace(image=SimpleNamespace(content=content), features=[SimpleNamespace(type_='TEXT_DETECTION')])
+    return vision.AnnotateImageRequest(image=vision.Image(content=content),
+                                       features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)])
+
+
+def check_config(config: PipelineConfig):
+    """並列数が 0 以下のステージがあると終了の合図が届かず止まるので受け付けない"""
+    bad = [f'{stage}={getattr(config, stage)}' for stage in STAGES if getattr(config, stage) < 1]
+    if bad:
+        raise ValueError(f'ステージの並列数は1以上にしてください: {", ".join(bad)}')
+    if config.queue_size < 1:
+        raise ValueError(f'queue_size は1以上にしてください: {config.queue_size}')
+
+
+class StageStats:
+    """ステージ別の処理件数・所要時間・失敗数（スレッドセーフ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count: Dict[str, int] = {s: 0 for s in STAGES}
+        self.errors: Dict[str, int] = {s: 0 for s in STAGES}
+        self.busy_ms: Dict[str, float] = {s: 0.0 for s in STAGES}
+        self.retries = 0
+        self.wall_ms = 0.0
+
+    def record(self, stage: str, ms: float, failed: bool = False):
+        with self._lock:
+            self.count[stage] += 1
+            self.busy_ms[stage] += ms
+            if failed:
+                self.errors[stage] += 1
+
+    def summary_lines(self) -> List[str]:
+        total = max(self.count.values()) if self.count else 0
+        if not total:
+            return []
+        serial_ms = sum(self.busy_ms.values())
+        lines = [f'⚡ 非同期パイプライン: {self.count["read"]}件 {self.wall_ms / 1000:.1f}s '
+                 f'(各ステージの合計 {serial_ms / 1000:.1f}s、重なり {serial_ms / max(self.wall_ms, 1e-6):.1f}倍)']
+        for stage in STAGES:
+            n = self.count[stage]
+            if n:
+                err = f' 失敗 {self.errors[stage]}件' if self.errors[stage] else ''
+                lines.append(f'  {stage:<6} {n}件 平均 {self.busy_ms[stage] / n:.0f}ms{err}')
+        if self.retries:
+            lines.append(f'  OCR再試行: {self.retries}回')
+        return lines
+
+
+class AsyncOcrPipeline:
+    """read → prep → ocr → parse を上限つきキューでつないだパイプライン
+
+    client は batch_annotate_images(requests=[...]) をコルーチンとして持つもの（ImageAnnotatorAsyncClient / FakeAsyncVisionClient）。
+    ImageAnnotatorAsyncClient は作成時のイベントループでしか使えないので、client の代わりに
+    client_factory（引数なしで client を返す）を渡すと run() の中で作り、終わったら閉じる。
+    parse(text, path) は OCR テキストの解析（同期関数、executor で実行）。
+    quota（vision_quota.VisionQuota）を渡すと送信前にトークンを取り、不足した画像は deferred として返す。
+    """
+
+    def __init__(self, client=None, config: Optional[PipelineConfig] = None, upload_prep=None,
+                 parse: Optional[Callable[[str, str], Any]] = None, executor=None, quota=None,
+                 priority: int = BULK, client_factory: Optional[Callable[[], Any]] = None):
+        if client is None and client_factory is None:
+            raise ValueError('client か client_factory を指定してください')
+        self.client = client
+        self.client_factory = client_factory
+        self.quota = quota
+        self.priority = priority
+        self.config = config or PipelineConfig()
+        check_config(self.config)
+        self.upload_prep = upload_prep
+        self.parse = parse
+        self._executor = executor
+        self.stats = StageStats()
+
+    # ---- ステージ ----
+
+    async def _read(self, item: _Item):
+        if aiofiles is not None:
+            async with aiofiles.open(item.path, 'rb') as f:
+                item.content = await f.read()
+        else:
+            item.content = await asyncio.to_thread(_read_bytes, item.path)
+
+    async def _prep(self, item: _Item):
+        if self.upload_prep is not None:
+            loop = asyncio.get_running_loop()
+            prepared = await loop.run_in_executor(self._executor, self.upload_prep.prepare, item.content)
+            item.content = prepared.content
+
+    async def _ocr(self, item: _Item):
+        cfg = self.config
+        quota = self.quota
+        for attempt in range(cfg.retries + 1):
+            if quota is not None:
+                await quota.acquire_async(self.priority)
+            try:
+                batch = await asyncio.wait_for(
+                    self.client.batch_annotate_images(requests=[_text_request(item.content)]), cfg.timeout)
+                response = batch.responses[0]
+                if quota is not None:
+                    quota.succeeded()
+                break
+            except Exception as e:
+                if quota is not None:
+                    quota.release(self.priority)   # 受け付けられなかったリクエストは使用量に数えない
+                if quota is not None and is_rate_limited(e):
+                    quota.throttled()
+                    if attempt >= cfg.retries:
+                        raise QuotaExhausted('429', f'429 が続くため保留: {e}') from e
+                    continue
+                if attempt >= cfg.retries:
+                    raise
+                with self.stats._lock:
+                    self.stats.retries += 1
+                await asyncio.sleep(cfg.retry_wait * (2 ** attempt))
+        error = getattr(getattr(response, 'error', None), 'message', '')
+        if error:
+            raise RuntimeError(error)
+        texts = response.text_annotations
+        item.text = texts[0].description if texts else ''
+        item.content = b''   # 以降のステージでは不要
+
+    async def _parse(self, item: _Item):
+        if self.parse is not None and item.text:
+            loop = asyncio.get_running_loop()
+            item.data = await loop.run_in_executor(self._executor, self.parse, item.text, item.path)
+
+    async def _run_stage(self, stage: str, item: _Item):
+        if item.error:
+            return   # 前のステージで失敗済み
+        t0 = time.perf_counter()
+        failed = False
+        try:
+            await getattr(self, '_' + stage)(item)
+        except QuotaExhausted as e:
+            failed = True
+            item.deferred = True
+            item.error = f'{stage}: 保留: {e}'
+        except Exception as e:
+            failed = True
+            item.error = f'{stage}: {e.__class__.__name__}: {e}'
+        ms = (time.perf_counter() - t0) * 1000.0
+        item.timings[stage] = ms
+        self.stats.record(stage, ms, failed)
+        PROFILER.record('async_' + stage, ms, kbn_from_path(item.path))
+
+    # ---- 実行 ----
+
+    async def run(self, paths: Sequence[str]) -> List[PipelineResult]:
+        """全画像を処理し、入力順の結果を返す"""
+        cfg = self.config
+        counts = {'read': cfg.read, 'prep': cfg.prep, 'ocr': cfg.ocr, 'parse': cfg.parse}
+        queues = [asyncio.Queue(maxsize=cfg.queue_size) for _ in STAGES]
+        done: List[_Item] = []
+        t0 = time.perf_counter()
+
+        async def feed():
+            for i, path in enumerate(paths):
+                await queues[0].put(_Item(i, str(path)))
+            for _ in range(counts[STAGES[0]]):
+                await queues[0].put(None)
+
+        async def worker(pos: int):
+            stage = STAGES[pos]
+            inbox = queues[pos]
+            outbox = queues[pos + 1] if pos + 1 < len(STAGES) else None
+            while True:
+                item = await inbox.get()
+                if item is None:
+                    return
+                await self._run_stage(stage, item)
+                if outbox is not None:
+                    await outbox.put(item)
+                else:
+                    done.append(item)
+
+        async def stage_group(pos: int):
+            await asyncio.gather(*(worker(pos) for _ in range(counts[STAGES[pos]])))
+            if pos + 1 < len(STAGES):   # 次のステージの全ワーカーに終了を伝える
+                for _ in range(counts[STAGES[pos + 1]]):
+                    await queues[pos + 1].put(None)
+
+        owns_client = self.client is None
+        if owns_client:
+            self.client = self.client_factory()
+            if self.client is None:
+                raise RuntimeError('Vision 非同期クライアントを作成できません')
+        executor = self._executor
+        owns_executor = executor is None
+        if owns_executor:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, cfg.prep + cfg.parse))
+        try:
+            await asyncio.gather(feed(), *(stage_group(p) for p in range(len(STAGES))))
+        finally:
+            if owns_executor:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if owns_client:
+                await _close_client(self.client)
+                self.client = None
+        self.stats.wall_ms += (time.perf_counter() - t0) * 1000.0
+        return [item.result() for item in sorted(done, key=lambda it: it.index)]
+
+    def run_sync(self, paths: Sequence[str]) -> List[PipelineResult]:
+        return asyncio.run(self.run(paths))
+
+    def summary_lines(self) -> List[str]:
+        return self.stats.summary_lines()
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def _close_client(client):
+    """ImageAnnotatorAsyncClient の gRPC チャネルを閉じる（閉じる手段が無いクライアントは何もしない）"""
+    close = getattr(getattr(client, 'transport', None), 'close', None)
+    if close is None:
+        return
+    try:
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception:
+        pass
+
+
+class FakeAsyncVisionClient:
+    """通信しない検証用の非同期クライアント（遅延とエラーを注入）
+
+    ImageAnnotatorAsyncClient と同じく batch_annotate_images(requests=[...]) に応える。
+    texts: callable(content) -> str。省略時はバイト数を返す。
+    error_rate の確率で例外、empty_rate の確率で空の結果を返す。
+    """
+
+    def __init__(self, latency: float = 0.3, jitter: float = 0.1, error_rate: float = 0.0,
+                 empty_rate: float = 0.0, texts=None, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.texts = texts
+        self._rng = random.Random(seed)
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def batch_annotate_images(self, requests=(), **_kwargs):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter)))
+            roll = self._rng.random()
+            if roll < self.error_rate:
+                raise ConnectionError('fake: 503 Service Unavailable')
+            responses = []
+            for request in requests:
+                content = getattr(getattr(request, 'image', None), 'content', b'') or b''
+                if roll < self.error_rate + self.empty_rate:
+                    text = ''
+                elif callable(self.texts):
+                    text = self.texts(content)
+                else:
+                    text = f'fake {len(content)} bytes'
+                responses.append(SimpleNamespace(text_annotations=[SimpleNamespace(description=text)] if text else [],
+                                                 error=SimpleNamespace(message='')))
+            return SimpleNamespace(responses=responses)
+        finally:
+            self.in_flight -= 1
+
+
+def _positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f'1以上を指定してください: {value}')
+    return n
+
+
+def add_pipeline_arguments(ap):
+    """argparse に非同期パイプラインの引数を追加する"""
+    ap.add_argument('--async-pipeline', action='store_true', help='読み込み・前処理・OCRを asyncio で重ねて実行する')
+    ap.add_argument('--read-workers', type=_positive_int, default=_DEFAULTS['read'])
+    ap.add_argument('--prep-workers', type=_positive_int, default=_DEFAULTS['prep'])
+    ap.add_argument('--ocr-workers', type=_positive_int, default=_DEFAULTS['ocr'], help='同時に送る Vision リクエスト数')
+    ap.add_argument('--parse-workers', type=_positive_int, default=_DEFAULTS['parse'])
+    ap.add_argument('--queue-size', type=_positive_int, default=_DEFAULTS['queue_size'], help='ステージ間キューの上限')
+
+
+def config_from_args(args) -> Optional[PipelineConfig]:
+    if not getattr(args, 'async_pipeline', False):
+        return None
+    return PipelineConfig(read=args.read_workers, prep=args.prep_workers, ocr=args.ocr_workers,
+                          parse=args.parse_workers, queue_size=args.queue_size)
+
+
+# ---- 偽クライアントでの比較 ----
+
+def bench(args) -> int:
+    """同じ画像を逐次処理（1並列）とパイプラインで処理し、所要時間を比較する"""
+    paths = list_files(args.folder, exts=IMAGE_EXTS, recursive=False)
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        print(f'❌ 画像がありません: {args.folder}')
+        return 2
+    prep = None
+    if args.upload_prep:
+        from upload_prep import UploadPrep
+        prep = UploadPrep()
+    parse = None
+    if args.parse:
+        import fixed_extraction as fe
+        parse = lambda text, path: fe.process_image_final_comprehensive(text, os.path.basename(path))
+
+    runs = [('逐次', PipelineConfig(read=1, prep=1, ocr=1, parse=1, queue_size=1, retries=args.retries, retry_wait=0.1)),
+            ('並列', PipelineConfig(read=args.read_workers, prep=args.prep_workers, ocr=args.ocr_workers,
+                                    parse=args.parse_workers, queue_size=args.queue_size,
+                                    retries=args.retries, retry_wait=0.1))]
+    for label, cfg in runs:
+        client = FakeAsyncVisionClient(args.latency, args.jitter, args.error_rate, seed=args.seed)
+        pipeline = AsyncOcrPipeline(client, cfg, upload_prep=prep, parse=parse)
+        t0 = time.perf_counter()
+        results = pipeline.run_sync(paths)
+        failed = sum(1 for r in results if r.error)
+        print(f'{label}: {len(results)}件 {time.perf_counter() - t0:.2f}s 失敗 {failed}件 '
+              f'（同時リクエスト最大 {client.max_in_flight}）')
+        for line in pipeline.summary_lines():
+            print(line)
+    return 0
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description='asyncio OCR パイプラインの検証（偽クライアント）')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('bench', help='逐次処理とパイプラインの所要時間を比較')
+    p.add_argument('folder', help='画像フォルダ')
+    p.add_argument('--limit', type=int, default=None)
+    p.add_argument('--latency', type=float, default=0.3, help='偽クライアントの応答遅延（秒）')
+    p.add_argument('--jitter', type=float, default=0.1)
+    p.add_argument('--error-rate', type=float, default=0.0, help='偽クライアントが例外を返す確率')
+    p.add_argument('--retries', type=int, default=_DEFAULTS['retries'])
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--upload-prep', action='store_true', help='prep ステージで送信前縮小を行う')
+    p.add_argument('--parse', action='store_true', help='parse ステージで fixed_extraction の抽出を行う')
+    add_pipeline_arguments(p)
+    args = ap.parse_args(argv)
+    return bench(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
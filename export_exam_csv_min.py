@@ -1,6 +1,8 @@
 import os, csv, sys
 from pathlib import Path
 
+from filename_params import parse_params
+
 ENC = "utf-8-sig"
 
 # kbn → 短い検査名（要望どおり：FAF/OCTA/OCT/VF など）
@@ -92,32 +94,6 @@ def load_image_root_from_config(folder: str) -> str:
 				continue
 	return r'D:\\画像'
 
-def parse_params_from_filename(file_value: str) -> dict:
-	"""ファイル名の &key=value を辞書化（URLデコード、拡張子除去）。"""
-	import urllib.parse
-	params = {}
-	if not file_value:
-		return params
-	base = os.path.basename(file_value)
-	try:
-		decoded = urllib.parse.unquote(base)
-	except Exception:
-		decoded = base
-	part = decoded
-	amp = part.find('&')
-	if amp >= 0:
-		part = part[amp+1:]
-	lowered = part.lower()
-	for ext in ('.jpg','.jpeg','.png','.tif','.tiff','.bmp','.webp'):
-		if lowered.endswith(ext):
-			part = part[:-(len(ext))]
-			break
-	for seg in part.split('&'):
-		if '=' in seg:
-			k, v = seg.split('=', 1)
-			params[k] = v
-	return params
-
 def load_patient_txt(pid: str, image_root: str) -> dict:
 	"""D:\\画像\\<pid>\\&pidnum=<pid>.txt を読み、pname/pkana/pbirth を返す。"""
 	import codecs
@@ -178,7 +154,7 @@ def main(folder: str, store_root: str = "", out_folder: str = ""):
 			continue
 		kbn = (r.get('kbn','') or '').lower()
 		if kbn == 'hoken':
-			params = parse_params_from_filename(r.get('file',''))
+			params = parse_params(r.get('file',''))
 			if params:
 				entry = pid_to_ins.get(pid, {})
 				if params.get('pbirth'):
@@ -198,7 +174,7 @@ def main(folder: str, store_root: str = "", out_folder: str = ""):
 		vdate = r.get("visit_date","") if str(r.get("date_applicable","1")).lower() in {"1","true"} else ""
 		pr = pmap.get(pid, {})
 		# 追加フォールバック: ファイル名から pname/pkana を拾う
-		params_from_file = parse_params_from_filename(r.get('file',''))
+		params_from_file = parse_params(r.get('file',''))
 
 		fname_from_rec = r.get("pname","")
 		fkana_from_rec = r.get("pkana","")
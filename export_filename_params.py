@@ -13,11 +13,14 @@ import os
 import re
 import csv
 import argparse
-import urllib.parse
 from typing import Dict, List
 
 import json
 
+from filename_params import parse_params
+from staged_output import StagedOutput
+from tree_walker import list_files
+
 def load_paths():
     cfg_path = os.path.join(os.getcwd(), 'path_config.json')
     try:
@@ -54,13 +57,7 @@ def load_patient_txt_metadata(target_dir: str, pid_hint: str) -> Dict[str, str]:
     患者フォルダ直下の `&pidnum=<PID>.txt`（または*.txt）からキー値を抽出。
     対象キー: pkana, pname, psex, pbirth
     """
-    candidates = []
-    try:
-        for name in os.listdir(target_dir):
-            if name.lower().endswith('.txt'):
-                candidates.append(os.path.join(target_dir, name))
-    except Exception:
-        return {}
+    candidates = list_files(target_dir, exts=('.txt',), recursive=False)
 
     # 優先: 厳密に一致するファイル名
     preferred = [p for p in candidates if os.path.basename(p) == f'&pidnum={pid_hint}.txt']
@@ -94,34 +91,11 @@ def merge_patient_metadata(records: List[Dict[str, str]], meta: Dict[str, str])
                 if val:
                     r[k] = val
 
-def parse_params_from_filename(path: str) -> Dict[str, str]:
-    base = os.path.basename(path)
-    decoded = urllib.parse.unquote(base)
-    # 先頭の'&'から始まる想定のため、最初の'&'の後ろを抽出
-    amp_idx = decoded.find('&')
-    query_part = decoded[amp_idx+1:] if amp_idx >= 0 else decoded
-    # 拡張子を除外
-    lower = query_part.lower()
-    for ext in ['.jpg', '.jpeg', '.png', '.tiff', '.bmp']:
-        if lower.endswith(ext):
-            query_part = query_part[:-(len(ext))]
-            break
-    params: Dict[str, str] = {}
-    for part in query_part.split('&'):
-        if '=' in part:
-            k, v = part.split('=', 1)
-            params[k] = urllib.parse.unquote(v)
-    params['full_path'] = path
-    return params
-
 def collect_records(target_dir: str) -> List[Dict[str, str]]:
     records: List[Dict[str, str]] = []
-    for name in os.listdir(target_dir):
-        if not name.lower().endswith(('.jpg', '.jpeg', '.png', '.tiff', '.bmp')):
-            continue
-        path = os.path.join(target_dir, name)
+    for path in list_files(target_dir, exts=('.jpg', '.jpeg', '.png', '.tiff', '.bmp'), recursive=False):
         try:
-            rec = parse_params_from_filename(path)
+            rec = dict(parse_params(path), full_path=path)
             # 足りないキーは空文字で補完
             for k in PARAM_KEYS_ORDER:
                 rec.setdefault(k, '')
@@ -142,9 +116,8 @@ def collect_records(target_dir: str) -> List[Dict[str, str]]:
     records.sort(key=sort_key)
     return records
 
-def write_master_csv(records: List[Dict[str, str]], pidnum_hint: str) -> str:
-    out_dir = os.path.join(OUTPUT_ROOT, pidnum_hint)
-    os.makedirs(out_dir, exist_ok=True)
+def write_master_csv(records: List[Dict[str, str]], pidnum_hint: str, out: StagedOutput) -> str:
+    out_dir = out.dir(pidnum_hint)
     out_csv = os.path.join(out_dir, f'filename_params_{pidnum_hint}.csv')
     with open(out_csv, 'w', newline='', encoding='utf-8-sig') as f:
         w = csv.DictWriter(f, fieldnames=PARAM_KEYS_ORDER)
@@ -159,12 +132,11 @@ def write_master_csv(records: List[Dict[str, str]], pidnum_hint: str) -> str:
         for r in records:
             row = [str(r.get(k, '')) for k in PARAM_KEYS_ORDER]
             f.write('\t'.join(row) + '\r\n')
-    return out_csv
+    return out.target(pidnum_hint, os.path.basename(out_csv))
 
-def write_kbn_splits(records: List[Dict[str, str]], pidnum_hint: str) -> List[str]:
+def write_kbn_splits(records: List[Dict[str, str]], pidnum_hint: str, out: StagedOutput) -> List[str]:
     out_paths: List[str] = []
-    out_dir = os.path.join(OUTPUT_ROOT, pidnum_hint, 'by_kbn')
-    os.makedirs(out_dir, exist_ok=True)
+    out_dir = out.dir(pidnum_hint, 'by_kbn')
     # kbnごとに分割
     kbn_to_records: Dict[str, List[Dict[str, str]]] = {}
     for r in records:
@@ -177,7 +149,7 @@ def write_kbn_splits(records: List[Dict[str, str]], pidnum_hint: str) -> List[st
             w.writeheader()
             for r in recs:
                 w.writerow({k: r.get(k, '') for k in PARAM_KEYS_ORDER})
-        out_paths.append(p)
+        out_paths.append(out.target(pidnum_hint, 'by_kbn', os.path.basename(p)))
         # Excel向けにUTF-16タブ区切りも出力
         pt = os.path.join(out_dir, f'{kbn}.tsv')
         with open(pt, 'w', newline='', encoding='utf-16') as f:
@@ -185,7 +157,7 @@ def write_kbn_splits(records: List[Dict[str, str]], pidnum_hint: str) -> List[st
             for r in recs:
                 row = [str(r.get(k, '')) for k in PARAM_KEYS_ORDER]
                 f.write('\t'.join(row) + '\r\n')
-        out_paths.append(pt)
+        out_paths.append(out.target(pidnum_hint, 'by_kbn', os.path.basename(pt)))
     return out_paths
 
 def main():
@@ -205,13 +177,18 @@ def main():
     # テキストメタデータで補完
     meta = load_patient_txt_metadata(target_dir, pid_hint)
     merge_patient_metadata(records, meta)
-    master = write_master_csv(records, pid_hint)
-    splits = write_kbn_splits(records, pid_hint)
+    # 作業フォルダに書いてからまとめて OUTPUT_ROOT に反映
+    out = StagedOutput(OUTPUT_ROOT)
+    master = write_master_csv(records, pid_hint, out)
+    splits = write_kbn_splits(records, pid_hint, out)
+    out.commit()
     print(f'✅ 保存: {master}')
     if splits:
         print(f'✅ kbn分割:')
         for p in splits:
             print(f'  - {p}')
+    for line in out.summary_lines():
+        print(line)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+保存済みOCRテキスト（コーパス）を全抽出器に流し、速度と精度を計測する。
+
+ - コーパス: 指定フォルダ配下の *.txt（例: debug/ の患者26147分 ocr.txt）
+ - 速度: 抽出器ごとのレイテンシ p50/p90/p99、docs/s、tracemalloc のピークメモリ
+ - 精度: 正解CSV（doc,extractor,field,value）に対する項目ごとの precision / recall
+ - 回帰判定: --baseline のJSONと比べ、閾値を超えて遅く/不正確になれば終了コード1
+
+使い方:
+  計測のみ      : python extractor_benchmark.py --corpus debug
+  正解の雛形作成: python extractor_benchmark.py --corpus debug --write-truth-template truth_26147.csv
+  基準値の保存  : python extractor_benchmark.py --corpus debug --truth truth_26147.csv --save-baseline bench_baseline.json
+  回帰チェック  : python extractor_benchmark.py --corpus debug --truth truth_26147.csv --baseline bench_baseline.json
+"""
+
+import os
+import io
+import sys
+import csv
+import json
+import time
+import argparse
+import importlib
+import tracemalloc
+import contextlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from tree_walker import list_files
+
+# (抽出器名, モジュール, 関数名)。関数は OCRテキスト -> dict を返すこと
+EXTRACTORS: List[Tuple[str, str, str]] = [
+    ('fixed.vision', 'fixed_extraction', 'extract_vision_data_fixed'),
+    ('fixed.iop', 'fixed_extraction', 'extract_all_iop_types'),
+    ('fixed.refraction', 'fixed_extraction', 'extract_refraction_data'),
+    ('fixed.surgery', 'fixed_extraction', 'extract_surgery_data'),
+    ('fixed.iol_seal', 'fixed_extraction', 'extract_iol_seal_data'),
+    ('fixed.exam_type', 'fixed_extraction', 'identify_examination_type'),
+    ('export.vision', 'patient_vision_iop_export', 'extract_vision'),
+    ('export.iop', 'patient_vision_iop_export', 'extract_iop'),
+    ('export.refraction', 'patient_vision_iop_export', 'extract_refraction'),
+    ('dump.iol', 'patient_ocr_dump', 'extract_iol_info'),
+]
+
+
+def load_extractors(names: Optional[List[str]] = None) -> Dict[str, Callable[[str], Dict[str, str]]]:
+    """抽出器を読み込む。依存ライブラリが無いモジュールは警告してスキップ"""
+    loaded: Dict[str, Callable[[str], Dict[str, str]]] = {}
+    failed_modules: Dict[str, str] = {}
+    for name, module_name, func_name in EXTRACTORS:
+        if names and name not in names:
+            continue
+        if module_name in failed_modules:
+            continue
+        try:
+            module = importlib.import_module(module_name)
+        except Exception as e:
+            failed_modules[module_name] = str(e)
+            print(f'⚠️ {module_name} を読み込めません（スキップ）: {e}')
+            continue
+        loaded[name] = getattr(module, func_name)
+    return loaded
+
+
+def load_corpus(corpus_dir: str) -> List[Tuple[str, str]]:
+    """(doc_id, text) のリスト。doc_id はコーパスルートからの相対パス"""
+    docs: List[Tuple[str, str]] = []
+    for path in list_files(corpus_dir, exts=('.txt',)):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            text = f.read()
+        doc_id = os.path.relpath(path, corpus_dir).replace('\\', '/')
+        docs.append((doc_id, text))
+    docs.sort()
+    return docs
+
+
+def load_truth(path: str) -> Dict[Tuple[str, str], Dict[str, str]]:
+    """正解CSV（doc,extractor,field,value）を {(doc, extractor): {field: value}} に変換"""
+    truth: Dict[Tuple[str, str], Dict[str, str]] = {}
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            key = (row.get('doc', ''), row.get('extractor', ''))
+            truth.setdefault(key, {})[row.get('field', '')] = (row.get('value') or '').strip()
+    return truth
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+
+def run_quiet(func: Callable[[str], Dict[str, str]], text: str) -> Dict[str, str]:
+    """抽出器の print() を捨てて実行（コンソール出力を計測に含めない）"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            return func(text) or {}
+        except Exception as e:
+            return {'__error__': str(e)}
+
+
+def benchmark_extractor(func: Callable[[str], Dict[str, str]], docs: List[Tuple[str, str]],
+                        repeat: int = 3) -> Tuple[Dict[str, float], Dict[str, Dict[str, str]]]:
+    """1抽出器の速度・メモリを計測し、(統計, doc_id -> 出力) を返す"""
+    outputs: Dict[str, Dict[str, str]] = {}
+    latencies: List[float] = []
+    total_start = time.perf_counter()
+    for _ in range(max(1, repeat)):
+        for doc_id, text in docs:
+            t0 = time.perf_counter()
+            out = run_quiet(func, text)
+            latencies.append(time.perf_counter() - t0)
+            outputs[doc_id] = out
+    total = time.perf_counter() - total_start
+
+    # メモリは計測オーバーヘッドが大きいので別パスで1回だけ
+    tracemalloc.start()
+    for _doc_id, text in docs:
+        run_quiet(func, text)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    stats = {
+        'docs': len(docs),
+        'runs': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'docs_per_s': (len(latencies) / total) if total > 0 else 0.0,
+        'peak_kib': peak / 1024.0,
+        'errors': sum(1 for o in outputs.values() if '__error__' in o),
+    }
+    return stats, outputs
+
+
+def score_fields(extractor: str, outputs: Dict[str, Dict[str, str]],
+                 truth: Dict[Tuple[str, str], Dict[str, str]]) -> Dict[str, Dict[str, float]]:
+    """項目ごとの precision / recall（正解がある doc のみ採点）"""
+    counts: Dict[str, Dict[str, int]] = {}
+    for (doc_id, ext_name), expected in truth.items():
+        if ext_name != extractor or doc_id not in outputs:
+            continue
+        predicted = outputs[doc_id]
+        for field, exp_val in expected.items():
+            c = counts.setdefault(field, {'tp': 0, 'fp': 0, 'fn': 0})
+            pred_val = str(predicted.get(field, '') or '').strip()
+            if pred_val and pred_val == exp_val:
+                c['tp'] += 1
+                continue
+            if pred_val:
+                c['fp'] += 1
+            if exp_val:
+                c['fn'] += 1
+    scores: Dict[str, Dict[str, float]] = {}
+    for field, c in counts.items():
+        tp, fp, fn = c['tp'], c['fp'], c['fn']
+        scores[field] = {
+            'precision': tp / (tp + fp) if (tp + fp) else 1.0,
+            'recall': tp / (tp + fn) if (tp + fn) else 1.0,
+            'support': tp + fn,
+        }
+    return scores
+
+
+def write_truth_template(path: str, all_outputs: Dict[str, Dict[str, Dict[str, str]]]) -> None:
+    """現在の出力を正解CSVの雛形として書き出す（人手で修正して使う）"""
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=['doc', 'extractor', 'field', 'value'])
+        w.writeheader()
+        for extractor, outputs in sorted(all_outputs.items()):
+            for doc_id, out in sorted(outputs.items()):
+                for field, value in out.items():
+                    if field == '__error__':
+                        continue
+                    w.writerow({'doc': doc_id, 'extractor': extractor, 'field': field, 'value': value})
+
+
+def check_regressions(report: Dict, baseline: Dict, max_latency_regression: float,
+                      max_accuracy_drop: float, latency_floor_ms: float = 0.05) -> List[str]:
+    """基準値と比較して回帰のリストを返す"""
+    problems: List[str] = []
+    for extractor, base in baseline.get('extractors', {}).items():
+        cur = report['extractors'].get(extractor)
+        if cur is None:
+            continue
+        base_p90 = base['latency'].get('p90_ms', 0.0)
+        cur_p90 = cur['latency'].get('p90_ms', 0.0)
+        # 数μs単位の抽出器はタイマーの揺らぎが大きいので絶対値の余裕も持たせる
+        if base_p90 > 0 and cur_p90 > base_p90 * (1.0 + max_latency_regression) + latency_floor_ms:
+            problems.append(f'{extractor}: p90 {base_p90:.3f}ms -> {cur_p90:.3f}ms')
+        for field, base_score in base.get('fields', {}).items():
+            cur_score = cur.get('fields', {}).get(field)
+            if cur_score is None:
+                continue
+            for metric in ('precision', 'recall'):
+                if cur_score[metric] < base_score[metric] - max_accuracy_drop:
+                    problems.append(f'{extractor}.{field}: {metric} {base_score[metric]:.3f} -> {cur_score[metric]:.3f}')
+    return problems
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description='抽出器のベンチマーク・精度ハーネス')
+    ap.add_argument('--corpus', default='debug', help='OCRテキスト(*.txt)のフォルダ')
+    ap.add_argument('--truth', help='正解CSV（doc,extractor,field,value）')
+    ap.add_argument('--extractor', action='append', help='対象の抽出器名（複数指定可、既定: 全部）')
+    ap.add_argument('--repeat', type=int, default=3, help='レイテンシ計測の繰り返し回数')
+    ap.add_argument('--report', help='結果JSONの保存先')
+    ap.add_argument('--baseline', help='比較する基準値JSON')
+    ap.add_argument('--save-baseline', help='今回の結果を基準値JSONとして保存')
+    ap.add_argument('--write-truth-template', help='現在の出力を正解CSVの雛形として保存')
+    ap.add_argument('--max-latency-regression', type=float, default=0.25, help='p90 の許容悪化率（0.25 = +25%%）')
+    ap.add_argument('--latency-floor-ms', type=float, default=0.05, help='p90 比較に加える絶対許容幅（ms）')
+    ap.add_argument('--max-accuracy-drop', type=float, default=0.02, help='precision/recall の許容低下幅')
+    args = ap.parse_args(argv)
+
+    docs = load_corpus(args.corpus)
+    if not docs:
+        print(f'❌ コーパスが空です: {args.corpus}')
+        return 1
+    extractors = load_extractors(args.extractor)
+    if not extractors:
+        print('❌ 実行できる抽出器がありません')
+        return 1
+    truth = load_truth(args.truth) if args.truth else {}
+
+    print(f'📚 コーパス: {len(docs)}件 ({args.corpus})')
+    report: Dict = {'corpus': args.corpus, 'docs': len(docs), 'extractors': {}}
+    all_outputs: Dict[str, Dict[str, Dict[str, str]]] = {}
+    for name, func in extractors.items():
+        stats, outputs = benchmark_extractor(func, docs, repeat=args.repeat)
+        all_outputs[name] = outputs
+        fields = score_fields(name, outputs, truth) if truth else {}
+        report['extractors'][name] = {'latency': stats, 'fields': fields}
+        print(f'  {name:<18} p50={stats["p50_ms"]:.3f}ms p90={stats["p90_ms"]:.3f}ms '
+              f'p99={stats["p99_ms"]:.3f}ms {stats["docs_per_s"]:.0f}docs/s peak={stats["peak_kib"]:.1f}KiB'
+              + (f' errors={stats["errors"]}' if stats['errors'] else ''))
+        for field, sc in sorted(fields.items()):
+            print(f'      {field:<14} P={sc["precision"]:.3f} R={sc["recall"]:.3f} (n={sc["support"]})')
+
+    if args.write_truth_template:
+        write_truth_template(args.write_truth_template, all_outputs)
+        print(f'✅ 正解CSVの雛形: {args.write_truth_template}')
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'✅ 結果: {args.report}')
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'✅ 基準値を保存: {args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        problems = check_regressions(report, baseline, args.max_latency_regression,
+                                     args.max_accuracy_drop, args.latency_floor_ms)
+        if problems:
+            print('❌ 回帰を検出:')
+            for p in problems:
+                print(f'   - {p}')
+            return 1
+        print('✅ 基準値からの回帰なし')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
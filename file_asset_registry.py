@@ -2,6 +2,8 @@ import os, sys, csv, hashlib, shutil
 from pathlib import Path
 from typing import Tuple
 
+from tree_walker import walk_files
+
 try:
 	from PIL import Image, ImageOps
 	PIL_OK = True
@@ -82,13 +84,10 @@ def scan_and_store(src_folder: str, store_root: str, recursive: bool = True, mod
 	reg_path = store / "asset_registry.csv"
 	reg = load_registry(reg_path)
 
-	files = []
-	if recursive:
-		files = [p for p in src.rglob("*") if p.is_file() and p.suffix in IMG_EXTS]
-	else:
-		files = [p for p in src.iterdir() if p.is_file() and p.suffix in IMG_EXTS]
-
-	for p in files:
+	n_files = 0
+	for entry in walk_files(src, exts=IMG_EXTS, recursive=recursive):
+		n_files += 1
+		p = Path(entry.path)
 		try:
 			h = sha256_file(p)
 			sub = h[:2]
@@ -100,7 +99,7 @@ def scan_and_store(src_folder: str, store_root: str, recursive: bool = True, mod
 				w, hgt = make_thumb(orig, thumb, max_side=max_side)
 			except Exception:
 				w = hgt = ""
-			st = p.stat()
+			st = entry.stat()
 			reg[h] = {
 				"doc_id": h,
 				"file": p.name,
@@ -118,7 +117,7 @@ def scan_and_store(src_folder: str, store_root: str, recursive: bool = True, mod
 	write_registry(reg_path, list(reg.values()))
 	with (store / "store_root.txt").open("w", encoding="utf-8") as f:
 		f.write(str(store.resolve()))
-	print(f"Indexed {len(files)} files into {store}/ (registry: {reg_path})")
+	print(f"Indexed {n_files} files into {store}/ (registry: {reg_path})")
 
 if __name__ == "__main__":
 	import argparse
@@ -135,7 +134,9 @@ if __name__ == "__main__":
 # -*- coding: utf-8 -*-
 import os, sys, csv, hashlib, shutil
 from pathlib import Path
-from typing import Tuple, Dict, List, Optional
+from typing import Tuple, Dict, Iterator, List, Optional
+
+from tree_walker import walk_files
 
 try:
     from PIL import Image, ImageOps
@@ -216,6 +217,9 @@ COLUMNS = [
     "ext",
     "thumb_rel",
     "mode",
+    "dhash",
+    "phash",
+    "near_dup_of",
 ]
 
 
@@ -243,16 +247,16 @@ def save_registry(path: Path, rows: List[Dict[str, str]]):
             w.writerow({c: row.get(c, "") for c in COLUMNS})
 
 
-def scan_images(root: Path) -> List[Path]:
-    results: List[Path] = []
-    for p in root.rglob("*"):
-        if p.is_file() and p.suffix in IMG_EXTS:
-            results.append(p)
-    return results
+def scan_images(root: Path, workers: int = 1) -> Iterator[os.DirEntry]:
+    """root 以下の画像（DirEntry。stat は走査時の情報を再利用）"""
+    return walk_files(root, exts=IMG_EXTS, workers=workers)
 
 
 def main(argv: Optional[List[str]] = None):
     import argparse, json
+    from filename_params import kbn_from_path, pid_from_path
+    from stage_profiler import PROFILER, add_profile_argument, finish_profile
+    from near_dup import ImageHashes, NearDupIndex, image_hashes_file
 
     # path_config.json から既定値
     image_root_default = None
@@ -274,7 +278,14 @@ def main(argv: Optional[List[str]] = None):
     ap.add_argument("--thumbs", action="store_true", help="Generate thumbnails")
     ap.add_argument("--thumb-subdir", required=False, default="thumbnails", help="Thumbnails subdir under dst/subdir")
     ap.add_argument("--registry", required=False, default="image_registry.csv", help="Registry CSV name (under dst/subdir)")
+    ap.add_argument("--near-dup", action="store_true", help="知覚ハッシュで撮り直し・重複スキャンを検出（near_dup_of 列）")
+    ap.add_argument("--near-dup-scope", default="visit", choices=["visit", "patient", "all"],
+                    help="近似重複とみなす範囲（既定: 同一患者・同一受診日）")
+    ap.add_argument("--scan-workers", type=int, default=1, help="患者フォルダ単位で並列に走査するスレッド数")
+    add_profile_argument(ap, "profile_registry.json")
     args = ap.parse_args(argv)
+    if args.profile:
+        PROFILER.enable()
 
     if not args.src or not args.dst:
         print("❌ --src と --dst を指定してください (path_config.json から既定値取得も可)")
@@ -292,24 +303,36 @@ def main(argv: Optional[List[str]] = None):
     # 既存レジストリ読み込み
     registry = load_registry(registry_path)
 
-    files = scan_images(src_root)
+    # 近似重複の索引（既存レジストリのハッシュから構築）
+    near_dup = None
+    if args.near_dup and PIL_OK:
+        near_dup = NearDupIndex(scope=args.near_dup_scope)
+        for row in registry.values():
+            if row.get("dhash") and row.get("phash"):
+                near_dup.add(row.get("src_path", ""), ImageHashes(int(row["dhash"], 16), int(row["phash"], 16)),
+                             sha256=row.get("sha256", ""))
+
     processed: List[Dict[str, str]] = []
+    n_files = 0
     updated = 0
     skipped = 0
 
-    for src in files:
+    for entry in scan_images(src_root, workers=args.scan_workers):
+        n_files += 1
+        src = Path(entry.path)
         try:
-            h = sha256_file(src)
+            with PROFILER.span("hash", kbn=kbn_from_path(src)):
+                h = sha256_file(src)
             src_rel = to_rel(src, src_root)
             dst_path = dst_root / src_rel
             dst_rel = to_rel(dst_path, dst_root)
 
             # 基本メタ
-            size_bytes = src.stat().st_size
+            size_bytes = entry.stat().st_size
             width = height = ""
             if PIL_OK:
                 try:
-                    with Image.open(src) as im:
+                    with PROFILER.span("decode", kbn=kbn_from_path(src)), Image.open(src) as im:
                         width, height = str(im.size[0]), str(im.size[1])
                 except Exception:
                     width = height = ""
@@ -319,17 +342,31 @@ def main(argv: Optional[List[str]] = None):
             if prev:
                 skipped += 1
                 processed.append(prev)
+                if near_dup is not None:
+                    near_dup.stats.record(pid_from_path(src), bool(prev.get("near_dup_of")))
                 continue
 
+            # 近似重複（撮り直し等）
+            dhash_hex = phash_hex = near_dup_of = ""
+            if near_dup is not None:
+                with PROFILER.span("phash", kbn=kbn_from_path(src)):
+                    hashes = image_hashes_file(src)
+                hit = near_dup.lookup(hashes, src)
+                near_dup_of = hit.get("sha256", "") if hit else ""
+                dup_entry = near_dup.add(src, hashes, sha256=h)
+                dhash_hex, phash_hex = dup_entry["dhash"], dup_entry["phash"]
+
             # コピー/リンク
-            copy_or_link(src, dst_path, args.mode)
+            with PROFILER.span("write", kbn=kbn_from_path(src)):
+                copy_or_link(src, dst_path, args.mode)
 
             # サムネ
             thumb_rel = ""
             if args.thumbs and PIL_OK:
                 thumb_path = thumbs_root / src_rel
                 thumb_path = thumb_path.with_suffix(".jpg")
-                make_thumb(dst_path, thumb_path, max_side=512)
+                with PROFILER.span("thumbnail", kbn=kbn_from_path(src)):
+                    make_thumb(dst_path, thumb_path, max_side=512)
                 thumb_rel = to_rel(thumb_path, dst_root)
 
             row = {
@@ -344,6 +381,9 @@ def main(argv: Optional[List[str]] = None):
                 "ext": normalize_ext(src.suffix),
                 "thumb_rel": thumb_rel,
                 "mode": args.mode,
+                "dhash": dhash_hex,
+                "phash": phash_hex,
+                "near_dup_of": near_dup_of,
             }
             registry[h] = row
             processed.append(row)
@@ -353,11 +393,16 @@ def main(argv: Optional[List[str]] = None):
             continue
 
     # 保存
-    save_registry(registry_path, list(registry.values()))
+    with PROFILER.span("write"):
+        save_registry(registry_path, list(registry.values()))
 
-    print(f"✅ 完了 files={len(files)} updated={updated} skipped(existed)={skipped}")
+    print(f"✅ 完了 files={n_files} updated={updated} skipped(existed)={skipped}")
+    if near_dup is not None:
+        for line in near_dup.stats.summary_lines(action="を検出（near_dup_of 列）"):
+            print(line)
     print(f"📄 レジストリ: {registry_path}")
     print(f"📁 出力: {dst_root}")
+    finish_profile(args.profile)
 
 
 if __name__ == "__main__":
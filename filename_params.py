@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+画像ファイル名のパラメータ（pidnum= / cdate= / kbn= / no=）の取り出し
+
+ファイル名は "pidnum=26147&cdate=20240101&kbn=krt2-2&no=1.jpg" の形（URL エンコードされていることもある）。
+計測・重複判定・検索・測定値DB・フォルダ走査が共通で使うので、重いライブラリに依存しないこのモジュールに置く。
+
+使い方:
+    from filename_params import kbn_from_path, parse_params, pid_from_path
+
+    parse_params(path)      # {'pidnum': '26147', 'cdate': '20240101', 'kbn': 'krt2-2', 'no': '1', ...}
+    pid_from_path(path)     # 無ければ親フォルダ名
+    kbn_from_path(path)     # 無ければ空
+"""
+
+import urllib.parse
+from typing import Dict
+
+# 最後の値から外す拡張子
+FILE_EXTS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp', '.txt')
+
+
+def parse_params(path) -> Dict[str, str]:
+    """ファイル名の &key=value を辞書にする（URLデコード・拡張子除去。同じキーは最初の値）"""
+    base = urllib.parse.unquote(str(path).replace('\\', '/').rsplit('/', 1)[-1])
+    lower = base.lower()
+    for ext in FILE_EXTS:
+        if lower.endswith(ext):
+            base = base[:-len(ext)]
+            break
+    params: Dict[str, str] = {}
+    for part in base.split('&'):
+        if '=' in part:
+            k, v = part.split('=', 1)
+            params.setdefault(k, v)
+    return params
+
+
+def kbn_from_path(path) -> str:
+    """ファイル名の &kbn=...（無ければ空）"""
+    return parse_params(path).get('kbn', '')
+
+
+def pid_from_path(path) -> str:
+    """ファイル名の &pidnum=...（無ければ親フォルダ名）"""
+    pid = parse_params(path).get('pidnum')
+    if pid is not None:
+        return pid.split('.')[0]
+    parent = urllib.parse.unquote(str(path).replace('\\', '/')).rsplit('/', 2)
+    return parent[-2] if len(parent) >= 2 else ''
+
+
+def cdate_from_path(path) -> str:
+    """ファイル名の &cdate=...（無ければ空）"""
+    return parse_params(path).get('cdate', '')
+
+
+def no_from_path(path) -> str:
+    """ファイル名の &no=...（同じ kbn の何枚目か。無ければ空）"""
+    return parse_params(path).get('no', '')
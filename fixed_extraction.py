@@ -1,10 +1,22 @@
 import re
 import csv
 import os
+import time
 from datetime import datetime
-from google.oauth2 import service_account
-from google.cloud import vision
-import glob
+
+from filename_params import kbn_from_path
+from stage_profiler import PROFILER
+from ocr_trace import DEBUG, TRACE
+from ocr_record import FinalRecord, write_final_csv
+from tree_walker import list_files
+from vision_quota import BULK, QuotaExhausted, call_with_quota
+from kbn_routing import (ALL_EXTRACTORS, DEFAULT_ROUTE, RoutingStats, extractors_for_exam_type,
+                         route_for_kbn)
+
+# select_final_iop の結果 -> FinalRecord の項目
+FINAL_IOP_RENAMES = {'眼圧右': '最終眼圧右', '眼圧左': '最終眼圧左'}
+# いずれかが取れていれば抽出成功とみなす（失敗画像だけトレースを書き出す）
+TRACE_SUCCESS_FIELDS = ('右裸眼', '左裸眼', '最終眼圧右', '最終眼圧左', 'S', '手術日', 'IOL度数_S', '検査種類')
 
 # 術前診断の事前定義リスト（追加可能）
 PREDEFINED_DIAGNOSES = {
@@ -59,8 +71,17 @@ def add_surgery(category, keywords):
     PREDEFINED_SURGERIES[category].extend(keywords)
     print(f"✅ 術式追加: {category} - {keywords}")
 
-def create_vision_client():
-    """サービスアカウント認証でVision APIクライアントを作成"""
+INBOX_FOLDER = r"C:\Projects\medical-ocr\inbox"
+
+def list_inbox_images(image_folder=INBOX_FOLDER):
+    """受信箱の JPG 画像"""
+    return list_files(image_folder, exts=(".jpg",), recursive=False)
+
+def create_vision_client(async_client=False):
+    """サービスアカウント認証でVision APIクライアントを作成（async_client=True で ImageAnnotatorAsyncClient）"""
+    # google-cloud-vision は読み込みに時間がかかるので、OCRするときだけ読む
+    from google.oauth2 import service_account
+    from google.cloud import vision
     try:
         # サービスアカウントキー情報
         service_account_info = {
@@ -78,20 +99,35 @@ def create_vision_client():
         }
         
         credentials = service_account.Credentials.from_service_account_info(service_account_info)
-        client = vision.ImageAnnotatorClient(credentials=credentials)
+        client_class = vision.ImageAnnotatorAsyncClient if async_client else vision.ImageAnnotatorClient
+        client = client_class(credentials=credentials)
         return client
     except Exception as e:
         print(f"認証エラー: {e}")
         return None
 
-def google_vision_ocr(image_path, client):
-    """Google Vision APIでOCR実行"""
+def google_vision_ocr(image_path, client, upload_prep=None, quota=None, priority=BULK, raise_errors=False):
+    """Google Vision APIでOCR実行（upload_prep: upload_prep.UploadPrep を渡すと送信前に縮小）
+    
+    quota（vision_quota.VisionQuota）を渡すとトークンを取ってから送信し、
+    クォータ不足なら空文字ではなく QuotaExhausted を送出する（呼び出し側で保留にする）。
+    raise_errors=True なら通信・API のエラーも空文字にせず送出する（ジョブキューで再試行するため）。
+    """
     try:
-        with open(image_path, 'rb') as f:
-            content = f.read()
+        with PROFILER.span('decode'):
+            with open(image_path, 'rb') as f:
+                content = f.read()
+        if upload_prep is not None:
+            with PROFILER.span('prep'):
+                content = upload_prep.prepare(content).content
         
-        image = vision.Image(content=content)
-        response = client.text_detection(image=image)
+        with PROFILER.span('ocr'):
+            from google.cloud import vision
+            image = vision.Image(content=content)
+            response = call_with_quota(quota, lambda: client.text_detection(image=image), priority)
+        error = getattr(getattr(response, 'error', None), 'message', '')
+        if error:
+            raise RuntimeError(error)
         texts = response.text_annotations
         
         if texts:
@@ -99,10 +135,67 @@ def google_vision_ocr(image_path, client):
         else:
             return ""
             
+    except QuotaExhausted:
+        raise
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"OCRエラー {image_path}: {e}")
         return ""
 
+def google_vision_layout(image_path, client, upload_prep=None, quota=None, priority=BULK):
+    """document_text_detection で OCR し、(テキスト, ocr_layout.OcrLayout) を返す（失敗時は ('', None)）
+    
+    upload_prep で縮小した場合も、単語枠は向き補正後の原寸座標に戻す。
+    quota は google_vision_ocr と同じ（不足時は QuotaExhausted）。
+    """
+    try:
+        with PROFILER.span('decode'):
+            with open(image_path, 'rb') as f:
+                content = f.read()
+        prepared = None
+        if upload_prep is not None:
+            with PROFILER.span('prep'):
+                prepared = upload_prep.prepare(content)
+            content = prepared.content
+        
+        with PROFILER.span('ocr'):
+            from google.cloud import vision
+            image = vision.Image(content=content)
+            response = call_with_quota(quota, lambda: client.document_text_detection(image=image), priority)
+        from ocr_layout import from_vision_document
+        layout = from_vision_document(response)
+        if prepared is not None and len(layout):
+            import numpy as np
+            layout.boxes = np.rint(prepared.to_original(layout.boxes.reshape(-1, 2, 2))).reshape(-1, 4).astype(np.int32)
+        return response.full_text_annotation.text or layout.text, layout
+    
+    except QuotaExhausted:
+        raise
+    except Exception as e:
+        print(f"OCRエラー {image_path}: {e}")
+        return "", None
+
+def ocr_with_template(image_path, client, aligner, templates, stats=None, quota=None, priority=BULK, template=None):
+    """登録様式（form_templates）なら位置合わせして枠だけOCR。合わなければ None（全体OCRへ）
+
+    template を渡すと kbn によらずそのテンプレートだけを試す（予備テンプレート用）。
+    """
+    from form_templates import decode_image, extract_with_template, vision_mosaic_regions
+    try:
+        with PROFILER.span('decode'):
+            img = decode_image(image_path)
+        with PROFILER.span('ocr.template'):
+            return extract_with_template(img, kbn_from_path(image_path),
+                                         lambda crops: call_with_quota(
+                                             quota, lambda: vision_mosaic_regions(client, crops), priority),
+                                         aligner, templates=templates, stats=stats, template=template)
+    except QuotaExhausted:
+        raise
+    except Exception as e:
+        print(f"テンプレートOCRエラー {image_path}: {e}")
+        return None
+
 def reconstruct_vision_line(lines, start_index):
     """V.d./V.s.の行を再構築"""
     
@@ -161,7 +254,7 @@ def extract_handwritten_iop_patterns_fixed(text):
         if any(marker in line.upper() for marker in ['AT', 'IOP', 'ＡＴ', 'ＩＯＰ']):
             # DATE行でないことを再確認
             if 'DATE' not in line.upper():
-                print(f"眼圧行候補（DATE除外後）: {line}")
+                TRACE.debug('眼圧行候補（DATE除外後）: {}', line)
                 
                 # 数字を探す（◯◯.◯形式）
                 numbers = re.findall(r'\b(\d{1,2}\.\d)\b', line)
@@ -226,7 +319,7 @@ def extract_nct_by_position_improved(text):
     for i, line in enumerate(lines):
         if 'IOP' in line and 'mmHg' in line:
             iop_start = i
-            print(f"NCT眼圧ヘッダー発見 行{i}: {line}")
+            TRACE.debug('NCT眼圧ヘッダー発見 行{}: {}', i, line)
             break
     
     if iop_start == -1:
@@ -239,20 +332,20 @@ def extract_nct_by_position_improved(text):
             line = lines[iop_start + offset]
             if 'Avg' in line or 'AVG' in line or 'avg' in line or 'Aug' in line:
                 avg_line = iop_start + offset
-                print(f"  ✅ Avg行発見 行{avg_line}: {line}")
+                TRACE.debug('  ✅ Avg行発見 行{}: {}', avg_line, line)
                 break
     
     if avg_line == -1:
-        print(f"  ❌ Avg行が見つかりませんでした")
+        TRACE.debug('  ❌ Avg行が見つかりませんでした')
         return result
     
     # Avg行から眼圧値を抽出（Avg行に並んでいる）
     avg_line_content = lines[avg_line]
-    print(f"  📊 Avg行内容: {avg_line_content}")
+    TRACE.debug('  📊 Avg行内容: {}', avg_line_content)
     
     # Avg行から◯◯.◯形式の眼圧値を直接検索
     iop_values = re.findall(r'\b(\d{1,2}\.\d)\b', avg_line_content)
-    print(f"  🔍 Avg行の眼圧値候補: {iop_values}")
+    TRACE.debug('  🔍 Avg行の眼圧値候補: {}', iop_values)
     
     # 眼圧の妥当性チェック（0-80 mmHg、◯◯.◯形式）
     valid_iop_values = []
@@ -261,9 +354,9 @@ def extract_nct_by_position_improved(text):
             val = float(num_str)
             if 0 <= val <= 80:
                 valid_iop_values.append(num_str)
-                print(f"    ✅ 有効な眼圧値: {num_str}")
+                TRACE.debug('    ✅ 有効な眼圧値: {}', num_str)
             else:
-                print(f"    ⚠️ 眼圧範囲外: {num_str} (0-80)")
+                TRACE.debug('    ⚠️ 眼圧範囲外: {} (0-80)', num_str)
         except:
             continue
     
@@ -272,7 +365,7 @@ def extract_nct_by_position_improved(text):
         result['NCT右'] = valid_iop_values[0]
         result['NCT左'] = valid_iop_values[1]
         result['眼圧備考'] = f'NCT平均値（Avg行）'
-        print(f"  ✅ NCT平均値取得成功: R={valid_iop_values[0]}, L={valid_iop_values[1]}")
+        TRACE.debug('  ✅ NCT平均値取得成功: R={}, L={}', valid_iop_values[0], valid_iop_values[1])
         return result
     
     # 1つの値しかない場合（1回計測の可能性）
@@ -280,32 +373,32 @@ def extract_nct_by_position_improved(text):
         result['NCT右'] = valid_iop_values[0]
         result['NCT左'] = ''  # 左眼は測定されていない可能性
         result['眼圧備考'] = f'NCT平均値（1回計測、右眼のみ）'
-        print(f"  ⚠️ NCT平均値（1回計測）: R={valid_iop_values[0]}, L=未測定")
+        TRACE.debug('  ⚠️ NCT平均値（1回計測）: R={}, L=未測定', valid_iop_values[0])
         return result
     
     # 次の行もチェック（2つ目の値を探す）
     if len(valid_iop_values) == 1:
-        print(f"  ⚠️ 眼圧値が1つしかありません。次の行をチェック...")
+        TRACE.debug('  ⚠️ 眼圧値が1つしかありません。次の行をチェック...')
         
         # 次の10行をチェック（1回計測対応）
         for offset in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
             check_line = avg_line + offset
             if check_line < len(lines):
                 check_line_content = lines[check_line]
-                print(f"  📊 +{offset}行目内容: {check_line_content}")
+                TRACE.debug('  📊 +{}行目内容: {}', offset, check_line_content)
                 
                 # 次の行からも◯◯.◯形式の眼圧値を検索
                 check_iop_values = re.findall(r'\b(\d{1,2}\.\d)\b', check_line_content)
-                print(f"  🔍 +{offset}行目の眼圧値候補: {check_iop_values}")
+                TRACE.debug('  🔍 +{}行目の眼圧値候補: {}', offset, check_iop_values)
                 
                 for num_str in check_iop_values:
                     try:
                         val = float(num_str)
                         if 0 <= val <= 80:
                             valid_iop_values.append(num_str)
-                            print(f"    ✅ +{offset}行目の有効な眼圧値: {num_str}")
+                            TRACE.debug('    ✅ +{}行目の有効な眼圧値: {}', offset, num_str)
                         else:
-                            print(f"    ⚠️ +{offset}行目の眼圧範囲外: {num_str} (0-80)")
+                            TRACE.debug('    ⚠️ +{}行目の眼圧範囲外: {} (0-80)', offset, num_str)
                     except:
                         continue
                 
@@ -313,10 +406,33 @@ def extract_nct_by_position_improved(text):
                     result['NCT右'] = valid_iop_values[0]
                     result['NCT左'] = valid_iop_values[1]
                     result['眼圧備考'] = f'NCT平均値（1回計測、Avg行+{offset}行目）'
-                    print(f"  ✅ NCT平均値取得成功: R={valid_iop_values[0]}, L={valid_iop_values[1]}")
+                    TRACE.debug('  ✅ NCT平均値取得成功: R={}, L={}', valid_iop_values[0], valid_iop_values[1])
                     return result
     
-    print(f"  ❌ 有効な眼圧値が見つかりませんでした")
+    TRACE.debug('  ❌ 有効な眼圧値が見つかりませんでした')
+    return result
+
+def extract_nct_from_layout(layout):
+    """単語枠から NCT 平均値を取得（Avg ラベルと同じ高さで右にある ◯◯.◯ を右・左の順に採用）"""
+    
+    result = {
+        'NCT右': '',
+        'NCT左': '',
+        '眼圧備考': ''
+    }
+    if layout is None or not len(layout):
+        return result
+    
+    values = [v for v in layout.numbers_right_of(r'^(Avg|AVG|avg|Aug)\.?$', r'^\d{1,2}\.\d$')
+              if 0 <= float(v) <= 80]
+    TRACE.debug('  📐 Avgラベル右の眼圧値候補: {}', values)
+    if len(values) >= 2:
+        result['NCT右'] = values[0]
+        result['NCT左'] = values[1]
+        result['眼圧備考'] = 'NCT平均値（Avg行・位置）'
+    elif len(values) == 1:
+        result['NCT右'] = values[0]
+        result['眼圧備考'] = 'NCT平均値（1回計測、右眼のみ・位置）'
     return result
 
 def debug_nct_detection(text):
@@ -534,7 +650,7 @@ def extract_vision_data_fixed(text):
         if 'V.d.' in line or 'Vd' in line:
             # 現在の行と次の3行を結合
             combined = ' '.join(lines[i:min(i+4, len(lines))])
-            print(f"V.d.結合テキスト: {combined}")
+            TRACE.debug('V.d.結合テキスト: {}', combined)
             
             # 裸眼視力を探す（0.01, 0.1など）
             naked = re.search(r'V\.?d\.?\s*=?\s*([\d\.]+)', combined)
@@ -545,7 +661,7 @@ def extract_vision_data_fixed(text):
             tol_pattern = re.search(r'([\d\.]+)\s*[xX×]\s*(?:TOL|IOL|FOL|EOL|1OL)', combined)
             if tol_pattern:
                 result['右TOL'] = tol_pattern.group(1)
-                print(f"  ✅ 右眼TOL発見: {result['右TOL']}")
+                TRACE.debug('  ✅ 右眼TOL発見: {}', result['右TOL'])
             
             # 矯正視力を探す
             # パターン1: (n.c.) または (n.c)
@@ -564,7 +680,7 @@ def extract_vision_data_fixed(text):
         # V.s.も同様に処理
         if 'V.s.' in line or 'Vs' in line:
             combined = ' '.join(lines[i:min(i+4, len(lines))])
-            print(f"V.s.結合テキスト: {combined}")
+            TRACE.debug('V.s.結合テキスト: {}', combined)
             
             naked = re.search(r'V\.?s\.?\s*=?\s*([\d\.]+)', combined)
             if naked:
@@ -574,7 +690,7 @@ def extract_vision_data_fixed(text):
             tol_pattern = re.search(r'([\d\.]+)\s*[xX×]\s*(?:TOL|IOL|FOL|EOL|1OL)', combined)
             if tol_pattern:
                 result['左TOL'] = tol_pattern.group(1)
-                print(f"  ✅ 左眼TOL発見: {result['左TOL']}")
+                TRACE.debug('  ✅ 左眼TOL発見: {}', result['左TOL'])
             
             if 'n.c' in combined.lower():
                 result['左矯正'] = 'n.c.'
@@ -599,8 +715,11 @@ def extract_vision_data_fixed(text):
     
     return result
 
-def extract_all_iop_types(text):
-    """NCTと手書き眼圧を両方取得（位置ベース改良版）"""
+def extract_all_iop_types(text, layout=None):
+    """NCTと手書き眼圧を両方取得（位置ベース改良版）
+    
+    layout（ocr_layout.OcrLayout）があれば NCT は単語枠から取得し、取れなければ行走査にフォールバック。
+    """
     
     import re
     
@@ -617,7 +736,9 @@ def extract_all_iop_types(text):
     # ========================================
     # 1. NCT眼圧を位置ベースで取得
     # ========================================
-    nct_result = extract_nct_by_position_improved(text)
+    nct_result = extract_nct_from_layout(layout) if layout is not None else None
+    if not nct_result or not (nct_result['NCT右'] and nct_result['NCT左']):
+        nct_result = extract_nct_by_position_improved(text)
     
     if nct_result['NCT右'] and nct_result['NCT左']:
         result['NCT右'] = nct_result['NCT右']
@@ -636,8 +757,8 @@ def extract_all_iop_types(text):
         result['手書き右'] = handwritten_result['右眼圧']
         result['手書き左'] = handwritten_result['左眼圧']
         handwritten_found = True
-        print(f"  ✅ 手書き眼圧: R={handwritten_result['右眼圧']}, L={handwritten_result['左眼圧']}")
-        print(f"     メモ: {handwritten_result['眼圧メモ']}")
+        TRACE.debug('  ✅ 手書き眼圧: R={}, L={}', handwritten_result['右眼圧'], handwritten_result['左眼圧'])
+        TRACE.debug('     メモ: {}', handwritten_result['眼圧メモ'])
     else:
         handwritten_found = False
     
@@ -681,120 +802,125 @@ def select_final_iop(iop_data):
 
 
 
-def process_image_final_comprehensive(ocr_text, filename=None):
-    """最終包括的処理（視力+眼圧+レフ値+最終選択+TOL対応+IOLシール対応+検査画像識別対応+左右判定対応+詳細検査データ対応）"""
-    
-    result = {
-        '右裸眼': '',
-        '右矯正': '',
-        '左裸眼': '',
-        '左矯正': '',
-        '右TOL': '',  # 眼内レンズ情報追加
-        '左TOL': '',  # 眼内レンズ情報追加
-        'NCT右': '',
-        'NCT左': '',
-        '手書き右': '',
-        '手書き左': '',
-        '最終眼圧右': '',
-        '最終眼圧左': '',
-        '眼圧備考': '',
-        '使用データ': '',
-        'S': '',
-        'C': '',
-        'Ax': '',
-        '手術日': '',
-        '患者名': '',
-        '術前診断': '',
-        '術式': '',
-        '対象眼': '',
-        'IOL度数_S': '',  # IOLシール情報追加
-        'IOL度数_C': '',  # IOLシール情報追加
-        'IOL度数_Ax': '',  # IOLシール情報追加
-        'IOL製品名': '',  # IOLシール情報追加
-        'IOLメーカー': '',  # IOLシール情報追加
-        'IOL備考': '',  # IOLシール情報追加
-        '検査種類': '',  # 検査画像識別追加
-        '検査詳細': '',  # 検査画像識別追加
-        '検査日': '',  # 検査画像識別追加
-        '検査対象眼': '',  # 検査対象眼追加
-        '検査備考': ''  # 検査画像識別追加
-    }
-    
-    # 視力データ抽出
-    vision = extract_vision_data_fixed(ocr_text)
-    
-    # 矯正視力の修正
-    if vision['右矯正']:
-        vision['右矯正'] = fix_corrected_vision(vision['右矯正'])
-    if vision['左矯正']:
-        vision['左矯正'] = fix_corrected_vision(vision['左矯正'])
-    
-    # 視力データを結果に追加
-    result['右裸眼'] = vision['右裸眼']
-    result['右矯正'] = vision['右矯正']
-    result['左裸眼'] = vision['左裸眼']
-    result['左矯正'] = vision['左矯正']
-    result['右TOL'] = vision['右TOL']  # TOL情報追加
-    result['左TOL'] = vision['左TOL']  # TOL情報追加
-    
-    # 包括的な眼圧データ抽出
-    iop_data = extract_all_iop_types(ocr_text)
-    result['NCT右'] = iop_data['NCT右']
-    result['NCT左'] = iop_data['NCT左']
-    result['手書き右'] = iop_data['手書き右']
-    result['手書き左'] = iop_data['手書き左']
-    result['眼圧備考'] = iop_data['眼圧備考']
+def process_image_final_comprehensive(ocr_text, filename=None, kbn=None, route_by_kbn=True, routing_stats=None,
+                                      template_match=None, layout=None):
+    """最終包括的処理（視力+眼圧+レフ値+最終選択+TOL対応+IOLシール対応+検査画像識別対応+左右判定対応+詳細検査データ対応）
+    
+    kbn（省略時は filename の &kbn=）に応じて必要な抽出器だけを実行する（kbn_routing.KBN_ROUTES）。
+    route_by_kbn=False で従来どおり全抽出器を実行。
+    template_match（form_templates.TemplateMatch）を渡すと、枠ごとの値をそのまま使い
+    テキスト走査の抽出器は実行しない（枠外はOCRしていないため）。
+    layout（ocr_layout.OcrLayout）を渡すと、位置で取れる項目（NCT平均値）は単語枠から取得する。
+    """
+    
+    result = FinalRecord()
+    
+    # kbn から実行する抽出器を決める（表に無い kbn は検査種類を先に識別して判定）
+    kbn = kbn_from_path(filename) if (filename and kbn is None) else (kbn or '')
+    route = route_for_kbn(kbn) if route_by_kbn else DEFAULT_ROUTE
+    ran = {}  # 抽出器 -> 実行時間(ms)
+    
+    def run_extractor(name, func, *args):
+        t0 = time.perf_counter()
+        with PROFILER.span('extract.' + name):
+            out = func(*args)
+        ran[name] = (time.perf_counter() - t0) * 1000.0
+        return out
+    
+    if template_match is not None:
+        return apply_template_match(result, template_match, kbn, routing_stats)
+    
+    examination_data = None
+    if route is None:
+        examination_data = run_extractor('exam_type', identify_examination_type, ocr_text)
+        extractors = extractors_for_exam_type(examination_data['検査種類'])
+    else:
+        extractors = route.extractors
     
-    # 最終的な眼圧データ選択
-    final_iop = select_final_iop(iop_data)
-    result['最終眼圧右'] = final_iop['眼圧右']
-    result['最終眼圧左'] = final_iop['眼圧左']
-    result['使用データ'] = final_iop['使用データ']
+    if 'vision' in extractors:
+        # 視力データ抽出
+        vision = run_extractor('vision', extract_vision_data_fixed, ocr_text)
+        
+        # 矯正視力の修正
+        if vision['右矯正']:
+            vision['右矯正'] = fix_corrected_vision(vision['右矯正'])
+        if vision['左矯正']:
+            vision['左矯正'] = fix_corrected_vision(vision['左矯正'])
+        
+        # 視力データを結果に追加（TOL情報を含む）
+        result.fill(vision, ('右裸眼', '右矯正', '左裸眼', '左矯正', '右TOL', '左TOL'))
     
-    # レフ値（屈折値）抽出
-    refraction_data = extract_refraction_data(ocr_text)
-    result['S'] = refraction_data['S']
-    result['C'] = refraction_data['C']
-    result['Ax'] = refraction_data['Ax']
-    
-    # 手術情報抽出（手術記録の場合）
-    surgery_data = extract_surgery_data(ocr_text)
-    result['手術日'] = surgery_data['手術日']
-    result['患者名'] = surgery_data['患者名']
-    result['術前診断'] = surgery_data['術前診断']
-    result['術式'] = surgery_data['術式']
-    result['対象眼'] = surgery_data['対象眼']
-    
-    # IOLシール情報抽出
-    iol_seal_data = extract_iol_seal_data(ocr_text)
-    result['IOL度数_S'] = iol_seal_data['IOL度数_S']
-    result['IOL度数_C'] = iol_seal_data['IOL度数_C']
-    result['IOL度数_Ax'] = iol_seal_data['IOL度数_Ax']
-    result['IOL製品名'] = iol_seal_data['IOL製品名']
-    result['IOLメーカー'] = iol_seal_data['IOLメーカー']
-    result['IOL備考'] = iol_seal_data['IOL備考']
-    
-    # 検査画像識別（OCRテキストの内容のみから左右判定）
-    examination_data = identify_examination_type(ocr_text)
-    result['検査種類'] = examination_data['検査種類']
-    result['検査詳細'] = examination_data['検査詳細']
-    result['検査日'] = examination_data['検査日']
-    result['検査対象眼'] = examination_data['対象眼']  # OCRテキストから判定した対象眼
-    result['検査備考'] = examination_data['検査備考']
-    
-    # 検査種類別の詳細データ抽出
-    if examination_data['検査種類'] == 'OCT':
-        oct_data = extract_oct_data(ocr_text, text_upper)
-        result.update(oct_data)
-    elif examination_data['検査種類'] == 'OCTA':
-        octa_data = extract_octa_data(ocr_text, text_upper)
-        result.update(octa_data)
-    elif examination_data['検査種類'] in ['ハンフリー視野', 'AIMO視野']:
-        visual_field_data = extract_visual_field_data(ocr_text, text_upper)
-        result.update(visual_field_data)
+    if 'iop' in extractors:
+        # 包括的な眼圧データ抽出
+        iop_data = run_extractor('iop', extract_all_iop_types, ocr_text, layout)
+        result.fill(iop_data, ('NCT右', 'NCT左', '手書き右', '手書き左', '眼圧備考'))
+        
+        # 最終的な眼圧データ選択
+        result.fill(select_final_iop(iop_data), ('眼圧右', '眼圧左', '使用データ'), FINAL_IOP_RENAMES)
+    
+    if 'refraction' in extractors:
+        # レフ値（屈折値）抽出
+        refraction_data = run_extractor('refraction', extract_refraction_data, ocr_text)
+        result.fill(refraction_data, ('S', 'C', 'Ax'))
+    
+    if 'surgery' in extractors:
+        # 手術情報抽出（手術記録の場合）
+        surgery_data = run_extractor('surgery', extract_surgery_data, ocr_text)
+        result.fill(surgery_data, ('手術日', '患者名', '術前診断', '術式', '対象眼'))
+    
+    if 'iol_seal' in extractors:
+        # IOLシール情報抽出
+        iol_seal_data = run_extractor('iol_seal', extract_iol_seal_data, ocr_text)
+        result.fill(iol_seal_data, ('IOL度数_S', 'IOL度数_C', 'IOL度数_Ax', 'IOL製品名', 'IOLメーカー', 'IOL備考'))
+    
+    if 'exam_type' in extractors:
+        # 検査画像識別（OCRテキストの内容のみから左右判定）
+        if examination_data is None:
+            examination_data = run_extractor('exam_type', identify_examination_type, ocr_text)
+        # 対象眼は OCRテキストから判定したもの（手術記録の対象眼とは別項目）
+        result.fill(examination_data, ('検査種類', '検査詳細', '検査日', '対象眼', '検査備考'), {'対象眼': '検査対象眼'})
+        
+        # 検査種類別の詳細データ抽出
+        text_upper = ocr_text.upper()
+        if examination_data['検査種類'] == 'OCT':
+            result.update(run_extractor('oct', extract_oct_data, ocr_text, text_upper))
+        elif examination_data['検査種類'] == 'OCTA':
+            result.update(run_extractor('octa', extract_octa_data, ocr_text, text_upper))
+        elif examination_data['検査種類'] in ['ハンフリー視野', 'AIMO視野']:
+            result.update(run_extractor('visual_field', extract_visual_field_data, ocr_text, text_upper))
+    
+    if routing_stats is not None:
+        routing_stats.record(kbn, ran, tuple(e for e in ALL_EXTRACTORS if e not in ran))
     
     return result
 
+def apply_template_match(result, template_match, kbn='', routing_stats=None):
+    """テンプレート領域OCRの値を結果に反映（眼圧は従来どおり手書き優先で最終値を選ぶ）"""
+    fields = template_match.fields
+    result.update({k: v for k, v in fields.items() if k in result})
+    if 'iop' in template_match.template.covers:
+        iop_data = {k: fields.get(k, '') for k in ('NCT右', 'NCT左', '手書き右', '手書き左')}
+        final_iop = select_final_iop(iop_data)
+        result.fill(final_iop, ('眼圧右', '眼圧左', '使用データ'), FINAL_IOP_RENAMES)
+        if not result['眼圧備考']:
+            result['眼圧備考'] = f"テンプレート({template_match.template.name})" if final_iop['使用データ'] else '検出失敗'
+    if routing_stats is not None:
+        routing_stats.record(kbn, {}, ALL_EXTRACTORS)
+    return result
+
+def fill_from_template_match(result, template_match):
+    """全体OCRで取れなかった項目だけを予備テンプレート（NCT印字など）の枠の値で埋め、埋めた項目を返す"""
+    filled = [k for k, v in template_match.fields.items()
+              if v and k in result and not result[k] and k != '眼圧備考']
+    for k in filled:
+        result[k] = template_match.fields[k]
+    if filled and 'iop' in template_match.template.covers:
+        final_iop = select_final_iop({k: result[k] for k in ('NCT右', 'NCT左', '手書き右', '手書き左')})
+        result.fill(final_iop, ('眼圧右', '眼圧左', '使用データ'), FINAL_IOP_RENAMES)
+        if final_iop['使用データ'] == 'NCT':
+            result['眼圧備考'] = f"テンプレート({template_match.template.name})"
+    return filled
+
 def process_image_two_tier_comprehensive(ocr_text):
     """2段構造対応の包括的処理"""
     
@@ -843,8 +969,20 @@ def process_image_two_tier_comprehensive(ocr_text):
     
     return result
 
-def process_all_images_final_comprehensive():
-    """最終包括的システムで全画像処理"""
+def process_all_images_final_comprehensive(route_by_kbn=True, use_templates=False, use_layout=False,
+                                          layout_dir=None, upload_prep=None, pipeline_config=None,
+                                          quota=None, priority=BULK, retry_queue=None):
+    """最終包括的システムで全画像処理（route_by_kbn=False で kbn によらず全抽出器を実行）
+    
+    use_templates=True で、登録様式（form_templates）の画像は枠だけをOCRする。
+    use_layout=True（または kbn のルートが ocr_mode='document'）で document_text_detection を使い、
+    単語枠つきの結果を抽出に渡す。layout_dir を指定すると <画像名>.npz として保存する。
+    upload_prep（upload_prep.UploadPrep）を渡すと、ページ全体のOCRは縮小してから送信する。
+    pipeline_config（async_ocr_pipeline.PipelineConfig）を渡すと、ページ全体のOCRは
+    非同期パイプラインで先にまとめて行い、読み込み・縮小・通信を重ねる。
+    quota（vision_quota.VisionQuota）を渡すと送信レートと1日の上限を守る。クォータ不足の画像は
+    OCR_FAILED にせず retry_queue（vision_quota.RetryQueue）に保留し、次回の実行で先に処理する。
+    """
     print("最終包括的医療OCRシステム")
     print("=" * 50)
     
@@ -855,149 +993,179 @@ def process_all_images_final_comprehensive():
         return []
     
     # 画像ファイルを取得
-    image_folder = r"C:\Projects\medical-ocr\inbox"
-    image_files = glob.glob(os.path.join(image_folder, "*.JPG"))
-    image_files.extend(glob.glob(os.path.join(image_folder, "*.jpg")))
+    image_files = list_inbox_images()
+    if retry_queue is not None:
+        retried = [f for f in retry_queue.drain() if os.path.exists(f)]
+        if retried:
+            print(f"⏸ 前回保留した画像を先に処理: {len(retried)}件")
+            retried_set = set(retried)
+            image_files = retried + [f for f in image_files if f not in retried_set]
     
     print(f"処理対象画像数: {len(image_files)}")
     
     results = []
+    deferred = set()
+    
+    def defer(img_file, reason):
+        deferred.add(img_file)
+        if retry_queue is not None:
+            retry_queue.add(img_file, reason, priority)
+    
+    # 様式テンプレート（numpy）はバッチ処理でだけ読む（対話のテストメニューは正規表現だけで動く）
+    from form_templates import (TemplateAligner, TemplateStats, fallback_templates, load_template_overrides,
+                                templates_for_kbn)
+    routing_stats = RoutingStats()
+    template_stats = TemplateStats()
+    aligner = TemplateAligner() if use_templates else None
+    templates = load_template_overrides() if use_templates else {}
+    # 基準画像が置かれていない予備テンプレートは試さない（画像を読み直すだけになる）
+    fallbacks = [t for t in fallback_templates(templates) if aligner.reference(t) is not None] if use_templates else []
+    
+    # ページ全体のテキストOCRになる画像は、非同期パイプラインで先に処理しておく
+    prefetched = {}
+    if pipeline_config is not None:
+        from async_ocr_pipeline import AsyncOcrPipeline
+        plain = [f for f in image_files
+                 if not (aligner is not None and templates_for_kbn(kbn_from_path(f), templates))
+                 and not (use_layout or (route_by_kbn and getattr(route_for_kbn(kbn_from_path(f)), 'ocr_mode', '') == 'document'))]
+        if plain:
+            # 非同期クライアントは asyncio.run のイベントループの中で作る
+            pipeline = AsyncOcrPipeline(client_factory=lambda: create_vision_client(async_client=True),
+                                        config=pipeline_config, upload_prep=upload_prep,
+                                        quota=quota, priority=priority)
+            try:
+                pipeline_results = pipeline.run_sync(plain)
+            except RuntimeError as e:
+                print(f"⚠️ 非同期パイプラインを使えません（1枚ずつOCRします）: {e}")
+                pipeline_results = []
+            for r in pipeline_results:
+                if r.deferred:
+                    defer(r.path, r.error)
+                elif r.error:
+                    # 失敗した画像は下のループで1枚ずつOCRし直す（空のテキストで OCR_FAILED にしない）
+                    print(f"OCRエラー {r.path}: {r.error}（再試行します）")
+                else:
+                    prefetched[r.path] = r.text
+            for line in pipeline.summary_lines():
+                print(line)
     
     for i, img_file in enumerate(image_files, 1):
-        filename = os.path.basename(img_file)
-        print(f"\n[{i}/{len(image_files)}] 処理中: {filename}")
-        
-        # Google Vision API実行
-        text = google_vision_ocr(img_file, client)
+        with PROFILER.span('image', kbn=kbn_from_path(img_file)):
+            filename = os.path.basename(img_file)
+            print(f"\n[{i}/{len(image_files)}] 処理中: {filename}")
+            TRACE.begin(filename)
         
-        if not text:
-            print(f"  ❌ OCR失敗")
-            results.append({
-                'filename': filename,
-                'status': 'OCR_FAILED',
-                '右裸眼': '',
-                '右矯正': '',
-                '左裸眼': '',
-                '左矯正': '',
-                '右TOL': '',  # TOL情報追加
-                '左TOL': '',  # TOL情報追加
-                'NCT右': '',
-                'NCT左': '',
-                '手書き右': '',
-                '手書き左': '',
-                '最終眼圧右': '',
-                '最終眼圧左': '',
-                '眼圧備考': '',
-                '使用データ': '',
-                'S': '',
-                'C': '',
-                'Ax': '',
-                '手術日': '',
-                '患者名': '',
-                '術前診断': '',
-                '術式': '',
-                '対象眼': '',
-                'IOL度数_S': '',  # IOLシール情報追加
-                'IOL度数_C': '',  # IOLシール情報追加
-                'IOL度数_Ax': '',  # IOLシール情報追加
-                'IOL製品名': '',  # IOLシール情報追加
-                'IOLメーカー': '',  # IOLシール情報追加
-                'IOL備考': '',  # IOLシール情報追加
-                '検査種類': '',  # 検査画像識別追加
-                '検査詳細': '',  # 検査画像識別追加
-                '検査日': '',  # 検査画像識別追加
-                '検査対象眼': '',  # 検査対象眼追加
-                '検査備考': '',  # 検査画像識別追加
-                'ocr_text': ''
-            })
-            continue
+            # 登録様式なら枠だけOCR、それ以外は Google Vision API でページ全体
+            match = None
+            layout = None
+            route = route_for_kbn(kbn_from_path(img_file)) if route_by_kbn else None
+            try:
+                if img_file in deferred:
+                    raise QuotaExhausted('rate', '非同期パイプラインで保留')
+                if aligner is not None and templates_for_kbn(kbn_from_path(img_file), templates):
+                    match = ocr_with_template(img_file, client, aligner, templates, template_stats, quota, priority)
+                if match is not None:
+                    text = match.text
+                elif use_layout or (route is not None and route.ocr_mode == 'document'):
+                    text, layout = google_vision_layout(img_file, client, upload_prep, quota, priority)
+                    if layout is not None and layout_dir:
+                        os.makedirs(layout_dir, exist_ok=True)
+                        layout.save(os.path.join(layout_dir, os.path.splitext(filename)[0] + '.npz'))
+                elif img_file in prefetched:
+                    text = prefetched[img_file]
+                else:
+                    text = google_vision_ocr(img_file, client, upload_prep, quota, priority)
+            except QuotaExhausted as e:
+                if img_file not in deferred:
+                    defer(img_file, str(e))
+                TRACE.warn('  ⏸ クォータ不足のため保留: {}', e)
+                TRACE.end(failed=False)
+                continue
         
-        print(f"  ✅ OCR成功 ({len(text)}文字)")
+            if not text:
+                TRACE.warn('  ❌ OCR失敗')
+                TRACE.end(failed=True)
+                results.append(FinalRecord(filename, 'OCR_FAILED'))
+                continue
         
-        # 最終包括的な処理
-        data = process_image_final_comprehensive(text, filename)
+            TRACE.info('  ✅ OCR成功 ({}文字)', len(text))
         
-        # 抽出結果の詳細表示
-        print(f"  📊 抽出結果:")
-        if data['右裸眼'] or data['左裸眼']:
-            print(f"    視力: 右裸眼={data['右裸眼'] or '未検出'}, 左裸眼={data['左裸眼'] or '未検出'}")
-        if data['右TOL'] or data['左TOL']:
-            print(f"    TOL: 右={data['右TOL'] or '未検出'}, 左={data['左TOL'] or '未検出'}")
-        if data['右矯正'] or data['左矯正']:
-            print(f"    矯正: 右={data['右矯正'] or '未検出'}, 左={data['左矯正'] or '未検出'}")
-        if data['最終眼圧右'] or data['最終眼圧左']:
-            print(f"    眼圧: 右={data['最終眼圧右'] or '未検出'}, 左={data['最終眼圧左'] or '未検出'} ({data['使用データ']})")
-        else:
-            print(f"    眼圧: 未検出")
-        if data['S'] or data['C'] or data['Ax']:
-            print(f"    レフ値: S={data['S'] or '未検出'}, C={data['C'] or '未検出'}, Ax={data['Ax'] or '未検出'}")
-        else:
-            print(f"    レフ値: 未検出")
-        if data['手術日'] or data['患者名'] or data['術前診断'] or data['術式']:
-            print(f"    手術情報: 日={data['手術日'] or '未検出'}, 患者={data['患者名'] or '未検出'}, 診断={data['術前診断'] or '未検出'}, 対象眼={data['対象眼'] or '未検出'}, 術式={data['術式'] or '未検出'}")
-        else:
-            print(f"    手術情報: 未検出")
-        if data['IOL度数_S'] or data['IOL度数_C'] or data['IOL度数_Ax'] or data['IOL製品名'] or data['IOLメーカー']:
-            print(f"    IOLシール: S={data['IOL度数_S'] or '未検出'}, C={data['IOL度数_C'] or '未検出'}, Ax={data['IOL度数_Ax'] or '未検出'}, 製品={data['IOL製品名'] or '未検出'}, メーカー={data['IOLメーカー'] or '未検出'}")
-        else:
-            print(f"    IOLシール: 未検出")
-        if data['検査種類'] or data['検査詳細']:
-            print(f"    検査画像: {data['検査種類'] or '未検出'} - {data['検査詳細'] or '未検出'} ({data['検査日'] or '未検出'}) - 対象眼: {data['検査対象眼'] or '未検出'}")
-            # 検査種類別の詳細データ表示
-            if data['検査種類'] == 'OCT':
-                if data.get('OCT_網膜厚_右') or data.get('OCT_網膜厚_左'):
-                    print(f"    OCT数値: 右網膜厚={data.get('OCT_網膜厚_右', '未検出')}, 左網膜厚={data.get('OCT_網膜厚_左', '未検出')}")
-            elif data['検査種類'] == 'OCTA':
-                if data.get('OCTA_血管密度_右') or data.get('OCTA_血管密度_左'):
-                    print(f"    OCTA数値: 右血管密度={data.get('OCTA_血管密度_右', '未検出')}, 左血管密度={data.get('OCTA_血管密度_左', '未検出')}")
-            elif data['検査種類'] in ['ハンフリー視野', 'AIMO視野']:
-                if data.get('視野_MD_右') or data.get('視野_MD_左'):
-                    print(f"    視野数値: 右MD={data.get('視野_MD_右', '未検出')}, 左MD={data.get('視野_MD_左', '未検出')}")
-        else:
-            print(f"    検査画像: 未検出")
+            # 最終包括的な処理
+            data = process_image_final_comprehensive(text, filename, route_by_kbn=route_by_kbn,
+                                                     routing_stats=routing_stats, template_match=match,
+                                                     layout=layout)
+            
+            # 眼圧ページで NCT 値が取れなければ、予備テンプレート（貼付されたNCT印字）の枠で埋める
+            if (fallbacks and match is None and not (data['NCT右'] and data['NCT左'])
+                    and (route is None or 'iop' in route.extractors)):
+                for tpl in fallbacks:
+                    try:
+                        extra = ocr_with_template(img_file, client, aligner, templates, template_stats,
+                                                  quota, priority, template=tpl)
+                    except QuotaExhausted:
+                        break           # 全体OCRの結果はそのまま使う
+                    if extra is not None:
+                        TRACE.info('  📐 予備テンプレート {}: {}', tpl.name,
+                                   ', '.join(fill_from_template_match(data, extra)) or '値なし')
+                        break
         
-        # 結果を記録
-        result = {
-            'filename': filename,
-            'status': 'SUCCESS',
-            '右裸眼': data['右裸眼'],
-            '右矯正': data['右矯正'],
-            '左裸眼': data['左裸眼'],
-            '左矯正': data['左矯正'],
-            '右TOL': data['右TOL'],  # TOL情報追加
-            '左TOL': data['左TOL'],  # TOL情報追加
-            'NCT右': data['NCT右'],
-            'NCT左': data['NCT左'],
-            '手書き右': data['手書き右'],
-            '手書き左': data['手書き左'],
-            '最終眼圧右': data['最終眼圧右'],
-            '最終眼圧左': data['最終眼圧左'],
-            '眼圧備考': data['眼圧備考'],
-            '使用データ': data['使用データ'],
-            'S': data['S'],
-            'C': data['C'],
-            'Ax': data['Ax'],
-            '手術日': data['手術日'],
-            '患者名': data['患者名'],
-            '術前診断': data['術前診断'],
-            '術式': data['術式'],
-            '対象眼': data['対象眼'],
-            'IOL度数_S': data['IOL度数_S'],  # IOLシール情報追加
-            'IOL度数_C': data['IOL度数_C'],  # IOLシール情報追加
-            'IOL度数_Ax': data['IOL度数_Ax'],  # IOLシール情報追加
-            'IOL製品名': data['IOL製品名'],  # IOLシール情報追加
-            'IOLメーカー': data['IOLメーカー'],  # IOLシール情報追加
-            'IOL備考': data['IOL備考'],  # IOLシール情報追加
-            '検査種類': data['検査種類'],  # 検査画像識別追加
-            '検査詳細': data['検査詳細'],  # 検査画像識別追加
-            '検査日': data['検査日'],  # 検査画像識別追加
-            '検査対象眼': data['検査対象眼'],  # 検査対象眼追加
-            '検査備考': data['検査備考'],  # 検査画像識別追加
-            'ocr_text': text[:200] + "..." if len(text) > 200 else text
-        }
+            # 抽出結果の詳細表示
+            TRACE.info('  📊 抽出結果:')
+            if data['右裸眼'] or data['左裸眼']:
+                TRACE.info('    視力: 右裸眼={}, 左裸眼={}', data['右裸眼'] or '未検出', data['左裸眼'] or '未検出')
+            if data['右TOL'] or data['左TOL']:
+                TRACE.info('    TOL: 右={}, 左={}', data['右TOL'] or '未検出', data['左TOL'] or '未検出')
+            if data['右矯正'] or data['左矯正']:
+                TRACE.info('    矯正: 右={}, 左={}', data['右矯正'] or '未検出', data['左矯正'] or '未検出')
+            if data['最終眼圧右'] or data['最終眼圧左']:
+                TRACE.info('    眼圧: 右={}, 左={} ({})', data['最終眼圧右'] or '未検出', data['最終眼圧左'] or '未検出', data['使用データ'])
+            else:
+                TRACE.info('    眼圧: 未検出')
+            if data['S'] or data['C'] or data['Ax']:
+                TRACE.info('    レフ値: S={}, C={}, Ax={}', data['S'] or '未検出', data['C'] or '未検出', data['Ax'] or '未検出')
+            else:
+                TRACE.info('    レフ値: 未検出')
+            if data['手術日'] or data['患者名'] or data['術前診断'] or data['術式']:
+                TRACE.info('    手術情報: 日={}, 患者={}, 診断={}, 対象眼={}, 術式={}', data['手術日'] or '未検出', data['患者名'] or '未検出', data['術前診断'] or '未検出', data['対象眼'] or '未検出', data['術式'] or '未検出')
+            else:
+                TRACE.info('    手術情報: 未検出')
+            if data['IOL度数_S'] or data['IOL度数_C'] or data['IOL度数_Ax'] or data['IOL製品名'] or data['IOLメーカー']:
+                TRACE.info('    IOLシール: S={}, C={}, Ax={}, 製品={}, メーカー={}', data['IOL度数_S'] or '未検出', data['IOL度数_C'] or '未検出', data['IOL度数_Ax'] or '未検出', data['IOL製品名'] or '未検出', data['IOLメーカー'] or '未検出')
+            else:
+                TRACE.info('    IOLシール: 未検出')
+            if data['検査種類'] or data['検査詳細']:
+                TRACE.info('    検査画像: {} - {} ({}) - 対象眼: {}', data['検査種類'] or '未検出', data['検査詳細'] or '未検出', data['検査日'] or '未検出', data['検査対象眼'] or '未検出')
+                # 検査種類別の詳細データ表示
+                if data['検査種類'] == 'OCT':
+                    if data.get('OCT_網膜厚_右') or data.get('OCT_網膜厚_左'):
+                        TRACE.info('    OCT数値: 右網膜厚={}, 左網膜厚={}', data.get('OCT_網膜厚_右', '未検出'), data.get('OCT_網膜厚_左', '未検出'))
+                elif data['検査種類'] == 'OCTA':
+                    if data.get('OCTA_血管密度_右') or data.get('OCTA_血管密度_左'):
+                        TRACE.info('    OCTA数値: 右血管密度={}, 左血管密度={}', data.get('OCTA_血管密度_右', '未検出'), data.get('OCTA_血管密度_左', '未検出'))
+                elif data['検査種類'] in ['ハンフリー視野', 'AIMO視野']:
+                    if data.get('視野_MD_右') or data.get('視野_MD_左'):
+                        TRACE.info('    視野数値: 右MD={}, 左MD={}', data.get('視野_MD_右', '未検出'), data.get('視野_MD_左', '未検出'))
+            else:
+                TRACE.info('    検査画像: 未検出')
         
-        results.append(result)
-    
+            # 結果を記録（抽出結果のレコードをそのまま使う）
+            data.filename = filename
+            data.status = 'SUCCESS'
+            data.set_ocr_text(text)
+            results.append(data)
+            TRACE.end(failed=not any(data[k] for k in TRACE_SUCCESS_FIELDS))
+    
+    if TRACE.dumped:
+        print(f"🔎 抽出失敗画像のトレース出力: {TRACE.dumped}件")
+    prep_lines = upload_prep.summary_lines() if upload_prep is not None else []
+    quota_lines = quota.summary_lines() if quota is not None else []
+    for line in routing_stats.summary_lines() + template_stats.summary_lines() + prep_lines + quota_lines:
+        print(line)
+    if quota is not None:
+        quota.flush()
+    if deferred:
+        where = f" → {retry_queue.path}" if retry_queue is not None else ""
+        print(f"⏸ クォータ不足で保留: {len(deferred)}件{where}（次回の実行で先に処理）")
     return results
 
 def process_all_images_two_tier_comprehensive():
@@ -1013,8 +1181,7 @@ def process_all_images_two_tier_comprehensive():
     
     # 画像ファイルを取得
     image_folder = r"C:\Projects\medical-ocr\inbox"
-    image_files = glob.glob(os.path.join(image_folder, "*.JPG"))
-    image_files.extend(glob.glob(os.path.join(image_folder, "*.jpg")))
+    image_files = list_inbox_images(image_folder)
     
     print(f"処理対象画像数: {len(image_files)}")
     
@@ -1089,26 +1256,6 @@ def process_all_images_two_tier_comprehensive():
     
     return results
 
-def save_results_to_csv(results):
-    """結果をCSVファイルに保存"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    csv_filename = f"fixed_vision_extraction_{timestamp}.csv"
-    
-    with open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = [
-            'filename', 'status', '右裸眼', '右矯正', '左裸眼', '左矯正', '右TOL', '左TOL',
-            'NCT右', 'NCT左', '手書き右', '手書き左', '最終眼圧右', '最終眼圧左', 
-            '眼圧備考', '使用データ', 'S', 'C', 'Ax', '手術日', '患者名', '術前診断', '対象眼', '術式',
-            'IOL度数_S', 'IOL度数_C', 'IOL度数_Ax', 'IOL製品名', 'IOLメーカー', 'IOL備考',
-            '検査種類', '検査詳細', '検査日', '検査備考', 'ocr_text'
-        ]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(results)
-    
-    print(f"\n✅ 結果を {csv_filename} に保存しました")
-    return csv_filename
-
 def print_statistics(results):
     """統計情報を表示"""
     total_images = len(results)
@@ -1213,7 +1360,7 @@ def extract_handwritten_iop_patterns_improved(text):
         if any(marker in line.upper() for marker in ['AT', 'IOP', 'ＡＴ', 'ＩＯＰ', '眼圧', 'EYE', 'PRESSURE']):
             # DATE行でないことを再確認
             if 'DATE' not in line.upper():
-                print(f"眼圧行候補（改良版）: {line}")
+                TRACE.debug('眼圧行候補（改良版）: {}', line)
                 
                 # パターン1: 数字のみ（15 18）
                 numbers = re.findall(r'\b(\d{1,2})\b', line)
@@ -1256,7 +1403,7 @@ def extract_handwritten_iop_patterns_improved(text):
                         return result
     
     # 拡張検索: 眼圧マーカーがない行でも数値ペアを探す
-    print(f"  ⚠️ 眼圧マーカーが見つかりませんでした。拡張検索...")
+    TRACE.debug('  ⚠️ 眼圧マーカーが見つかりませんでした。拡張検索...')
     
     for line in lines:
         # 数値ペアを探す（眼圧の可能性）
@@ -1269,7 +1416,7 @@ def extract_handwritten_iop_patterns_improved(text):
                 result['右眼圧'] = valid_numbers[0]
                 result['左眼圧'] = valid_numbers[1]
                 result['眼圧メモ'] = f'拡張検索: {line.strip()}'
-                print(f"  ✅ 拡張検索で発見: {line.strip()}")
+                TRACE.debug('  ✅ 拡張検索で発見: {}', line.strip())
                 return result
     
     return result
@@ -1287,7 +1434,7 @@ def extract_refraction_data(text):
     
     lines = text.split('\n')
     
-    print("🔍 レフ値抽出中...")
+    TRACE.debug('🔍 レフ値抽出中...')
     
     # レフ値関連のキーワードを含む行を探す
     refraction_keywords = ['REFRACTION', 'REFR', 'レフ', '屈折', 'SPH', 'CYL', 'AXIS', 'Ax', 'AX']
@@ -1297,7 +1444,7 @@ def extract_refraction_data(text):
         
         # レフ値関連の行かチェック
         if any(keyword in line_upper for keyword in refraction_keywords):
-            print(f"  📄 レフ値行候補 {i}: {line}")
+            TRACE.debug('  📄 レフ値行候補 {}: {}', i, line)
             
             # S（球面度数）を探す (±0.00〜±30.00、小数点以下2桁)
             s_patterns = [
@@ -1317,10 +1464,10 @@ def extract_refraction_data(text):
                         s_float = float(s_value)
                         if -30.00 <= s_float <= 30.00:
                             result['S'] = s_value
-                            print(f"    ✅ S値発見: {s_value}")
+                            TRACE.debug('    ✅ S値発見: {}', s_value)
                             break
                         else:
-                            print(f"    ⚠️ S値範囲外: {s_value} (-30.00〜+30.00)")
+                            TRACE.debug('    ⚠️ S値範囲外: {} (-30.00〜+30.00)', s_value)
                     except:
                         continue
             
@@ -1342,10 +1489,10 @@ def extract_refraction_data(text):
                         c_float = float(c_value)
                         if -30.00 <= c_float <= 30.00:
                             result['C'] = c_value
-                            print(f"    ✅ C値発見: {c_value}")
+                            TRACE.debug('    ✅ C値発見: {}', c_value)
                             break
                         else:
-                            print(f"    ⚠️ C値範囲外: {c_value} (-30.00〜+30.00)")
+                            TRACE.debug('    ⚠️ C値範囲外: {} (-30.00〜+30.00)', c_value)
                     except:
                         continue
             
@@ -1368,10 +1515,10 @@ def extract_refraction_data(text):
                         ax_int = int(ax_value)
                         if 0 <= ax_int <= 360:
                             result['Ax'] = ax_value
-                            print(f"    ✅ Ax値発見: {ax_value}°")
+                            TRACE.debug('    ✅ Ax値発見: {}°', ax_value)
                             break
                         else:
-                            print(f"    ⚠️ Ax値範囲外: {ax_value} (0-360°)")
+                            TRACE.debug('    ⚠️ Ax値範囲外: {} (0-360°)', ax_value)
                     except:
                         continue
     
@@ -1381,12 +1528,12 @@ def extract_refraction_data(text):
         
         # SPH行を見つけたら、次の数行をチェック
         if 'SPH' in line_upper and i + 1 < len(lines):
-            print(f"  📄 SPH行発見 {i}: {line}")
+            TRACE.debug('  📄 SPH行発見 {}: {}', i, line)
             
             # 次の数行をチェックして数値ペアを探す
             for j in range(i + 1, min(i + 5, len(lines))):
                 next_line = lines[j]
-                print(f"    📊 +{j-i}行目: {next_line}")
+                TRACE.debug('    📊 +{}行目: {}', j-i, next_line)
                 
                 # 数値ペアパターンをチェック (-0.75 -0.25 79)
                 pair_match = re.search(r'([+-]?\d+\.\d{2})\s+([+-]?\d+\.\d{2})\s+(\d{1,3})', next_line)
@@ -1402,22 +1549,22 @@ def extract_refraction_data(text):
                         if -30.00 <= s_float <= 30.00 and -30.00 <= c_float <= 30.00 and 0 <= ax_int <= 360:
                             if not result['S']:
                                 result['S'] = s_val
-                                print(f"      ✅ S値設定: {s_val}")
+                                TRACE.debug('      ✅ S値設定: {}', s_val)
                             if not result['C']:
                                 result['C'] = c_val
-                                print(f"      ✅ C値設定: {c_val}")
+                                TRACE.debug('      ✅ C値設定: {}', c_val)
                             if not result['Ax']:
                                 result['Ax'] = ax_val
-                                print(f"      ✅ Ax値設定: {ax_val}°")
+                                TRACE.debug('      ✅ Ax値設定: {}°', ax_val)
                             break
                     except:
                         continue
     
     # 結果を表示
-    print(f"  📊 レフ値抽出結果:")
-    print(f"    S: {result['S'] or '未検出'}")
-    print(f"    C: {result['C'] or '未検出'}")
-    print(f"    Ax: {result['Ax'] or '未検出'}")
+    TRACE.debug('  📊 レフ値抽出結果:')
+    TRACE.debug('    S: {}', result['S'] or '未検出')
+    TRACE.debug('    C: {}', result['C'] or '未検出')
+    TRACE.debug('    Ax: {}', result['Ax'] or '未検出')
     
     return result
 
@@ -1484,7 +1631,7 @@ def extract_surgery_data(text):
     
     lines = text.split('\n')
     
-    print("🔍 手術情報抽出中...")
+    TRACE.debug('🔍 手術情報抽出中...')
     
     # 手術日を探す
     date_patterns = [
@@ -1499,7 +1646,7 @@ def extract_surgery_data(text):
             match = re.search(pattern, line)
             if match:
                 result['手術日'] = match.group(1)
-                print(f"  ✅ 手術日発見: {result['手術日']}")
+                TRACE.debug('  ✅ 手術日発見: {}', result['手術日'])
                 break
         if result['手術日']:
             break
@@ -1517,7 +1664,7 @@ def extract_surgery_data(text):
             match = re.search(pattern, line)
             if match:
                 result['患者名'] = match.group(1).strip()
-                print(f"  ✅ 患者名発見: {result['患者名']}")
+                TRACE.debug('  ✅ 患者名発見: {}', result['患者名'])
                 break
         if result['患者名']:
             break
@@ -1536,7 +1683,7 @@ def extract_surgery_data(text):
             if match:
                 raw_diagnosis = match.group(1).strip()
                 result['術前診断'] = raw_diagnosis
-                print(f"  ✅ 術前診断発見: {result['術前診断']}")
+                TRACE.debug('  ✅ 術前診断発見: {}', result['術前診断'])
                 break
         if result['術前診断']:
             break
@@ -1549,7 +1696,7 @@ def extract_surgery_data(text):
             for keyword in keywords:
                 if keyword.upper() in raw_text:
                     result['術前診断'] = category
-                    print(f"  ✅ 術前診断分類: {category}")
+                    TRACE.debug('  ✅ 術前診断分類: {}', category)
                     break
             if result['術前診断'] == category:
                 break
@@ -1557,13 +1704,13 @@ def extract_surgery_data(text):
         # 対象眼を元の診断から抽出
         if '右眼' in raw_diagnosis:
             result['対象眼'] = '右眼'
-            print(f"  ✅ 対象眼抽出（術前診断）: 右眼")
+            TRACE.debug('  ✅ 対象眼抽出（術前診断）: 右眼')
         elif '左眼' in raw_diagnosis:
             result['対象眼'] = '左眼'
-            print(f"  ✅ 対象眼抽出（術前診断）: 左眼")
+            TRACE.debug('  ✅ 対象眼抽出（術前診断）: 左眼')
         elif '両眼' in raw_diagnosis:
             result['対象眼'] = '両眼'
-            print(f"  ✅ 対象眼抽出（術前診断）: 両眼")
+            TRACE.debug('  ✅ 対象眼抽出（術前診断）: 両眼')
     
     # 対象眼を抽出（右眼、左眼、両眼）- 術前診断から優先的に抽出
     if not result['対象眼']:
@@ -1585,7 +1732,7 @@ def extract_surgery_data(text):
                         result['対象眼'] = '左眼'
                     elif '両眼' in eye_info:
                         result['対象眼'] = '両眼'
-                    print(f"  ✅ 対象眼発見: {result['対象眼']}")
+                    TRACE.debug('  ✅ 対象眼発見: {}', result['対象眼'])
                     break
             if result['対象眼']:
                 break
@@ -1608,7 +1755,7 @@ def extract_surgery_data(text):
         if match:
             raw_surgery = match.group(1).strip()
             result['術式'] = raw_surgery
-            print(f"  ✅ 術式発見: {result['術式']}")
+            TRACE.debug('  ✅ 術式発見: {}', result['術式'])
             break
     
     # 事前定義リストで術式を分類・標準化
@@ -1618,7 +1765,7 @@ def extract_surgery_data(text):
             for keyword in keywords:
                 if keyword.upper() in raw_text:
                     result['術式'] = category
-                    print(f"  ✅ 術式分類: {category}")
+                    TRACE.debug('  ✅ 術式分類: {}', category)
                     break
             if result['術式'] == category:
                 break
@@ -1631,7 +1778,7 @@ def extract_surgery_data(text):
                 for keyword in keywords:
                     if keyword.upper() in line_upper:
                         result['術式'] = category
-                        print(f"  ✅ 術式（事前定義キーワード）発見: {category}")
+                        TRACE.debug('  ✅ 術式（事前定義キーワード）発見: {}', category)
                         break
                 if result['術式']:
                     break
@@ -1651,16 +1798,16 @@ def extract_surgery_data(text):
                 
                 if len(context_lines) > 1:
                     result['術式'] = ' '.join(context_lines[:3])  # 最大3行まで
-                    print(f"  ✅ 術式詳細化: {result['術式']}")
+                    TRACE.debug('  ✅ 術式詳細化: {}', result['術式'])
                 break
     
     # 結果を表示
-    print(f"  📊 手術情報抽出結果:")
-    print(f"    手術日: {result['手術日'] or '未検出'}")
-    print(f"    患者名: {result['患者名'] or '未検出'}")
-    print(f"    術前診断: {result['術前診断'] or '未検出'}")
-    print(f"    対象眼: {result['対象眼'] or '未検出'}")
-    print(f"    術式: {result['術式'] or '未検出'}")
+    TRACE.debug('  📊 手術情報抽出結果:')
+    TRACE.debug('    手術日: {}', result['手術日'] or '未検出')
+    TRACE.debug('    患者名: {}', result['患者名'] or '未検出')
+    TRACE.debug('    術前診断: {}', result['術前診断'] or '未検出')
+    TRACE.debug('    対象眼: {}', result['対象眼'] or '未検出')
+    TRACE.debug('    術式: {}', result['術式'] or '未検出')
     
     return result
 
@@ -2265,6 +2412,58 @@ def extract_visual_field_data(text, text_upper):
     return result
 
 if __name__ == "__main__":
+    import argparse
+    from stage_profiler import add_profile_argument, finish_profile
+    from ocr_trace import add_trace_arguments, configure_from_args
+    
+    def build_cli(batch):
+        """batch=True のときだけバッチ処理（縮小・非同期・クォータ・キュー・測定値DB）の引数を加える"""
+        cli = argparse.ArgumentParser(description="医療OCRシステム - 位置ベース改良版", add_help=batch)
+        add_profile_argument(cli, "profile_final.json")
+        add_trace_arguments(cli)
+        cli.add_argument("--no-kbn-routing", action="store_true", help="kbn によらず全抽出器を実行する（従来動作）")
+        cli.add_argument("--templates", action="store_true", help="登録様式（form_templates）の画像は枠だけをOCRする（基準画像を form_templates/ に置いた様式のみ）")
+        cli.add_argument("--layout", action="store_true", help="document_text_detection で単語枠つきOCRを行う")
+        cli.add_argument("--layout-dir", default=None, help="単語枠つきOCR結果（.npz）の保存先")
+        if batch:
+            from upload_prep import add_upload_prep_arguments
+            from async_ocr_pipeline import add_pipeline_arguments
+            from vision_quota import add_quota_arguments
+            from ocr_job_queue import add_enqueue_argument
+            from measure_store import add_measure_store_argument
+            add_upload_prep_arguments(cli)
+            add_pipeline_arguments(cli)
+            add_quota_arguments(cli)
+            add_enqueue_argument(cli)
+            add_measure_store_argument(cli)
+        return cli
+    
+    # 対話のテスト（1/2/5/6）は正規表現だけで動く。バッチ用の引数（-h を含む）が無ければ
+    # キュー・測定値DB・非同期パイプラインなどのモジュールは 4. を選んだときに読む
+    cli_args, batch_argv = build_cli(batch=False).parse_known_args()
+    if batch_argv:
+        cli_args = build_cli(batch=True).parse_args()
+    configure_from_args(cli_args)
+    if cli_args.profile:
+        PROFILER.enable()
+    
+    if getattr(cli_args, 'enqueue', None):
+        # 処理はワーカー（python ocr_job_queue.py work）で行う
+        from vision_quota import quota_options, priority_from_args
+        from ocr_job_queue import JobQueue
+        images = list_inbox_images()
+        job_queue = JobQueue(cli_args.enqueue)
+        added = job_queue.enqueue('final', images, {
+            'route_by_kbn': not cli_args.no_kbn_routing,
+            'upload_prep': cli_args.upload_prep, 'target_dpi': cli_args.target_dpi,
+            'priority': priority_from_args(cli_args),
+            'quota': quota_options(cli_args),
+        }, priority=priority_from_args(cli_args), force=cli_args.force)
+        print(f"✅ ジョブ登録: {added}/{len(images)}件 → {cli_args.enqueue}")
+        for line in job_queue.summary_lines():
+            print(line)
+        raise SystemExit(0)
+    
     print("医療OCRシステム - 位置ベース改良版")
     print("=" * 50)
     print("1. 眼圧抽出テスト")
@@ -2275,6 +2474,9 @@ if __name__ == "__main__":
     print("6. NCT構造詳細分析")
     
     choice = input("\n選択してください (1-6): ").strip()
+    if choice in ("1", "2", "5", "6"):
+        # テスト/デバッグメニューは候補行・棄却値などの途中経過を表示する
+        TRACE.configure(echo_level=DEBUG)
     
     if choice == "1":
         # 眼圧抽出テスト
@@ -2328,27 +2530,37 @@ if __name__ == "__main__":
             
     elif choice == "4":
         # 従来システム実行
+        from upload_prep import upload_prep_from_args
+        from async_ocr_pipeline import config_from_args
+        from vision_quota import quota_from_args, priority_from_args, retry_queue_from_args
+        from measure_store import MeasureStore
+        if not batch_argv:      # バッチ用の引数を既定値で埋める
+            cli_args = build_cli(batch=True).parse_args()
         print("\n" + "="*50)
-        results = process_all_images_final_comprehensive()
+        results = process_all_images_final_comprehensive(route_by_kbn=not cli_args.no_kbn_routing,
+                                                         use_templates=cli_args.templates,
+                                                         use_layout=cli_args.layout or bool(cli_args.layout_dir),
+                                                         layout_dir=cli_args.layout_dir,
+                                                         upload_prep=upload_prep_from_args(cli_args),
+                                                         pipeline_config=config_from_args(cli_args),
+                                                         quota=quota_from_args(cli_args),
+                                                         priority=priority_from_args(cli_args),
+                                                         retry_queue=retry_queue_from_args(cli_args))
         
         if results:
             # 結果をCSVに保存
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             csv_filename = f"final_vision_extraction_{timestamp}.csv"
             
-            with open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-                fieldnames = [
-                    'filename', 'status', '右裸眼', '右矯正', '左裸眼', '左矯正', '右TOL', '左TOL',
-                    'NCT右', 'NCT左', '手書き右', '手書き左', '最終眼圧右', '最終眼圧左', 
-                    '眼圧備考', '使用データ', 'S', 'C', 'Ax', '手術日', '患者名', '術前診断', '対象眼', '術式',
-                    'IOL度数_S', 'IOL度数_C', 'IOL度数_Ax', 'IOL製品名', 'IOLメーカー', 'IOL備考',
-                    '検査種類', '検査詳細', '検査日', '検査備考', 'ocr_text'
-                ]
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(results)
+            with PROFILER.span('write'):
+                write_final_csv(csv_filename, results)
             
             print(f"\n✅ 結果を {csv_filename} に保存しました")
+            if cli_args.measure_db:
+                with PROFILER.span('write'), MeasureStore(cli_args.measure_db) as store:
+                    store.add_records(results, origin=csv_filename)
+                    for line in store.summary_lines():
+                        print(line)
             
             # 詳細統計情報表示
             total_images = len(results)
@@ -2482,8 +2694,7 @@ if __name__ == "__main__":
         
         # 画像ファイルを取得
         image_folder = r"C:\Projects\medical-ocr\inbox"
-        image_files = glob.glob(os.path.join(image_folder, "*.JPG"))
-        image_files.extend(glob.glob(os.path.join(image_folder, "*.jpg")))
+        image_files = list_inbox_images(image_folder)
         
         print(f"処理対象画像数: {len(image_files)}")
         
@@ -2523,8 +2734,7 @@ if __name__ == "__main__":
         
         # 画像ファイルを取得
         image_folder = r"C:\Projects\medical-ocr\inbox"
-        image_files = glob.glob(os.path.join(image_folder, "*.JPG"))
-        image_files.extend(glob.glob(os.path.join(image_folder, "*.jpg")))
+        image_files = list_inbox_images(image_folder)
         
         print(f"処理対象画像数: {len(image_files)}")
         
@@ -2562,3 +2772,5 @@ if __name__ == "__main__":
     
     else:
         print("無効な選択です。")
+    
+    finish_profile(cli_args.profile)
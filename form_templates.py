@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+既知の様式（紙カルテ krt2-2・NCT印字など）のテンプレート領域OCR
+
+ページ全体をOCRしてから行順で値を探す代わりに、
+ 1. 様式ごとの基準画像と ORB 特徴点で位置合わせ（ホモグラフィ）
+ 2. テンプレートに登録した視力・眼圧・レフの枠だけを切り出してOCR
+ 3. 枠ごとのパーサで値を取り出す（Avg 行の探索や「次の4行」結合が不要）
+
+テンプレートの座標は基準画像に対する比率 (x0, y0, x1, y1)。
+基準画像は form_templates/<reference> に置く（無い様式は従来どおり全体OCR）。
+基準画像はリポジトリに含めていない。置くまでは --templates を付けても何も変わらない（list で有無を確認）。
+form_templates/templates.json があれば、同名テンプレートの領域を上書きする（現場での較正用）。
+
+NCT印字は紙カルテに貼られていて専用の kbn が無いので、fallback=True のテンプレートとして扱う:
+眼圧を抽出するページで全体OCRから NCT 値が取れなかったときだけ位置合わせを試し、空欄だけを埋める。
+
+使い方:
+    python form_templates.py list
+    python form_templates.py overlay 画像.jpg --template krt2-2 --out overlay.jpg   # 枠の確認
+    python form_templates.py extract 画像.jpg [--template krt2-2]                  # Tesseractで試行
+"""
+
+import os
+import re
+import json
+import argparse
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+TEMPLATE_DIR = Path(__file__).resolve().parent / 'form_templates'
+
+Box = Tuple[float, float, float, float]   # 基準画像に対する比率 (x0, y0, x1, y1)
+
+
+class Region(NamedTuple):
+    name: str
+    box: Box
+    parser: str        # REGION_PARSERS のキー
+
+
+class FormTemplate(NamedTuple):
+    name: str
+    kbns: Tuple[str, ...]        # このテンプレートを試す kbn
+    reference: str               # TEMPLATE_DIR からの基準画像パス
+    regions: Tuple[Region, ...]
+    covers: Tuple[str, ...]      # 置き換える抽出器（kbn_routing の抽出器名）
+    note: str = ''
+    fallback: bool = False       # kbn では選ばず、全体OCRで covers の値が取れなかったページで試す
+
+
+# 初期値は代表的なスキャンから採った概略位置。運用前に overlay で確認し templates.json で較正する
+TEMPLATES: Dict[str, FormTemplate] = {
+    'krt2-2': FormTemplate(
+        name='krt2-2',
+        kbns=('krt2-2',),
+        reference='krt2-2.jpg',
+        regions=(
+            Region('va_right', (0.04, 0.08, 0.52, 0.14), 'va_right'),
+            Region('va_left', (0.04, 0.14, 0.52, 0.20), 'va_left'),
+            Region('iop', (0.52, 0.08, 0.96, 0.20), 'iop_pair'),
+            Region('refraction', (0.04, 0.20, 0.96, 0.28), 'refraction'),
+        ),
+        covers=('vision', 'iop', 'refraction'),
+        note='紙カルテ(新) 上段の視力・眼圧・レフ欄',
+    ),
+    'nct': FormTemplate(
+        name='nct',
+        kbns=(),
+        reference='nct.jpg',
+        regions=(
+            Region('nct_avg', (0.05, 0.55, 0.95, 0.70), 'nct_avg'),
+        ),
+        covers=('iop',),
+        note='NCT印字（IOP mmHg 表の Avg 行）。紙カルテに貼付',
+        fallback=True,
+    ),
+}
+
+
+def load_template_overrides(path: Optional[Path] = None) -> Dict[str, FormTemplate]:
+    """templates.json（[{name, kbns?, reference?, covers?, fallback?, regions: [{name, box, parser}]}]）で上書き"""
+    path = path or (TEMPLATE_DIR / 'templates.json')
+    templates = dict(TEMPLATES)
+    if not path.is_file():
+        return templates
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    for item in data:
+        base = templates.get(item['name'])
+        regions = tuple(Region(r['name'], tuple(r['box']), r['parser']) for r in item.get('regions', []))
+        templates[item['name']] = FormTemplate(
+            name=item['name'],
+            kbns=tuple(item.get('kbns', base.kbns if base else ())),
+            reference=item.get('reference', base.reference if base else f'{item["name"]}.jpg'),
+            regions=regions or (base.regions if base else ()),
+            covers=tuple(item.get('covers', base.covers if base else ())),
+            note=item.get('note', base.note if base else ''),
+            fallback=bool(item.get('fallback', base.fallback if base else False)),
+        )
+    return templates
+
+
+def templates_for_kbn(kbn: str, templates: Optional[Dict[str, FormTemplate]] = None) -> List[FormTemplate]:
+    key = (kbn or '').strip().lower()
+    return [t for t in (templates or TEMPLATES).values() if key and key in t.kbns]
+
+
+def fallback_templates(templates: Optional[Dict[str, FormTemplate]] = None) -> List[FormTemplate]:
+    """全体OCRで値が取れなかったときに試すテンプレート（NCT印字など）"""
+    return [t for t in (templates or TEMPLATES).values() if t.fallback]
+
+
+# ---- 位置合わせ ----
+
+class _Reference(NamedTuple):
+    points: np.ndarray      # 特徴点（基準画像に対する比率）
+    descriptors: np.ndarray
+
+
+class TemplateAligner:
+    """基準画像との ORB 特徴点マッチングでホモグラフィを求める（基準画像の特徴量はキャッシュ）"""
+
+    def __init__(self, template_dir: Path = TEMPLATE_DIR, max_side: int = 1000,
+                 n_features: int = 1500, min_inliers: int = 25):
+        import cv2
+        self.template_dir = Path(template_dir)
+        self.max_side = max_side
+        self.min_inliers = min_inliers
+        self._orb = cv2.ORB_create(nfeatures=n_features)
+        self._matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+        self._refs: Dict[str, Optional[_Reference]] = {}
+        self._lock = threading.Lock()
+
+    def _small_gray(self, img) -> Tuple[np.ndarray, float]:
+        import cv2
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        h, w = gray.shape[:2]
+        scale = min(1.0, self.max_side / max(h, w))
+        if scale < 1.0:
+            gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        return gray, scale
+
+    def _detect(self, gray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        with self._lock:   # ORB は同時に呼び出せないため直列化
+            kps, desc = self._orb.detectAndCompute(gray, None)
+        pts = np.float32([kp.pt for kp in kps]) if kps else np.zeros((0, 2), np.float32)
+        return pts, desc
+
+    def reference(self, template: FormTemplate) -> Optional[_Reference]:
+        import cv2
+        if template.name in self._refs:
+            return self._refs[template.name]
+        ref = None
+        path = self.template_dir / template.reference
+        if path.is_file():
+            img = cv2.imdecode(np.fromfile(str(path), dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+            if img is not None:
+                gray, _scale = self._small_gray(img)
+                pts, desc = self._detect(gray)
+                if desc is not None and len(pts) >= self.min_inliers:
+                    h, w = gray.shape[:2]
+                    ref = _Reference(pts / np.float32([w, h]), desc)
+        self._refs[template.name] = ref
+        return ref
+
+    def align(self, img, template: FormTemplate) -> Optional[np.ndarray]:
+        """テンプレート座標（比率）→ 入力画像の画素座標 のホモグラフィ。合わなければ None"""
+        import cv2
+        ref = self.reference(template)
+        if ref is None or img is None:
+            return None
+        gray, scale = self._small_gray(img)
+        pts, desc = self._detect(gray)
+        if desc is None or len(pts) < self.min_inliers:
+            return None
+        pairs = self._matcher.knnMatch(ref.descriptors, desc, k=2)
+        good = [p[0] for p in pairs if len(p) == 2 and p[0].distance < 0.75 * p[1].distance]
+        if len(good) < self.min_inliers:
+            return None
+        src = np.float32([ref.points[m.queryIdx] for m in good])
+        dst = np.float32([pts[m.trainIdx] for m in good]) / scale
+        H, mask = cv2.findHomography(src, dst, cv2.RANSAC, 4.0 / scale)
+        if H is None or mask is None or int(mask.sum()) < self.min_inliers:
+            return None
+        return H
+
+
+def crop_region(img, H: np.ndarray, box: Box) -> np.ndarray:
+    """テンプレート上の枠を、傾き・拡大を補正した長方形として切り出す"""
+    import cv2
+    x0, y0, x1, y1 = box
+    corners = cv2.perspectiveTransform(np.float32([[[x0, y0], [x1, y0], [x0, y1]]]), H)[0]
+    w = max(1, int(round(np.linalg.norm(corners[1] - corners[0]))))
+    h = max(1, int(round(np.linalg.norm(corners[2] - corners[0]))))
+    # 出力画素 (u, v) → テンプレート比率 → 入力画像
+    S = np.array([[(x1 - x0) / w, 0, x0], [0, (y1 - y0) / h, y0], [0, 0, 1]], dtype=np.float64)
+    return cv2.warpPerspective(img, H @ S, (w, h), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                               borderMode=cv2.BORDER_REPLICATE)
+
+
+def decode_image(path: str):
+    """日本語パス対応の画像読み込み（読めなければ None）"""
+    import cv2
+    return cv2.imdecode(np.fromfile(str(path), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+# ---- 領域OCR ----
+
+def tesseract_regions(crops: Dict[str, np.ndarray], lang: str = 'jpn+eng') -> Dict[str, str]:
+    """枠ごとに Tesseract（1行〜数行なので --psm 6）"""
+    import pytesseract
+    from PIL import Image
+    import cv2
+    out: Dict[str, str] = {}
+    for name, crop in crops.items():
+        rgb = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB) if crop.ndim == 3 else crop
+        try:
+            out[name] = pytesseract.image_to_string(Image.fromarray(rgb), lang=lang, config='--psm 6')
+        except Exception:
+            out[name] = pytesseract.image_to_string(Image.fromarray(rgb), config='--psm 6')
+    return out
+
+
+def build_mosaic(crops: Dict[str, np.ndarray], gap: int = 24) -> Tuple[np.ndarray, List[Tuple[str, int, int]]]:
+    """枠を縦に並べた1枚の画像と、各枠の (name, y0, y1)"""
+    import cv2
+    width = max(c.shape[1] for c in crops.values())
+    parts: List[np.ndarray] = []
+    bands: List[Tuple[str, int, int]] = []
+    y = 0
+    for name, crop in crops.items():
+        c = crop if crop.ndim == 3 else cv2.cvtColor(crop, cv2.COLOR_GRAY2BGR)
+        pad = np.full((c.shape[0], width - c.shape[1], 3), 255, np.uint8)
+        parts.append(np.hstack([c, pad]))
+        bands.append((name, y, y + c.shape[0]))
+        parts.append(np.full((gap, width, 3), 255, np.uint8))
+        y += c.shape[0] + gap
+    return np.vstack(parts), bands
+
+
+def vision_mosaic_regions(client, crops: Dict[str, np.ndarray]) -> Dict[str, str]:
+    """枠をまとめた1枚を Vision に1回だけ送り、単語の位置で枠ごとのテキストに戻す"""
+    from google.cloud import vision
+    import cv2
+    mosaic, bands = build_mosaic(crops)
+    ok, buf = cv2.imencode('.png', mosaic)
+    if not ok:
+        return {}
+    response = client.text_detection(image=vision.Image(content=buf.tobytes()))
+    words: Dict[str, List[Tuple[float, float, str]]] = {name: [] for name, _y0, _y1 in bands}
+    for ann in list(response.text_annotations)[1:]:
+        vs = ann.bounding_poly.vertices
+        cx = sum(v.x for v in vs) / len(vs)
+        cy = sum(v.y for v in vs) / len(vs)
+        for name, y0, y1 in bands:
+            if y0 <= cy < y1:
+                words[name].append((cy, cx, ann.description))
+                break
+    return {name: _join_words(ws) for name, ws in words.items()}
+
+
+def _join_words(words: List[Tuple[float, float, str]], line_tol: float = 10.0) -> str:
+    """(y, x, 単語) を行ごと（y が line_tol 以内）に左から並べる"""
+    lines: List[List[Tuple[float, float, str]]] = []
+    for w in sorted(words):
+        if lines and abs(lines[-1][0][0] - w[0]) <= line_tol:
+            lines[-1].append(w)
+        else:
+            lines.append([w])
+    return '\n'.join(' '.join(t for _y, _x, t in sorted(line, key=lambda w: w[1])) for line in lines)
+
+
+# ---- 枠ごとのパーサ（戻り値のキーは fixed_extraction の結果列） ----
+
+_NUM = r'(\d(?:\.\d{1,2})?)'
+_TOL = r'(?:TOL|IOL|FOL|EOL|1OL)'
+
+
+def _parse_va(text: str, side: str) -> Dict[str, str]:
+    t = re.sub(r'V\.?\s*[ds]\.?\s*=?', ' ', text, flags=re.IGNORECASE)
+    out: Dict[str, str] = {}
+    m = re.search(_NUM, t)
+    if m:
+        out[f'{side}裸眼'] = m.group(1)
+    m = re.search(r'([\d\.]+)\s*[xX×]\s*' + _TOL, t)
+    if m:
+        out[f'{side}TOL'] = m.group(1)
+    if 'n.c' in t.lower():
+        out[f'{side}矯正'] = 'n.c.'
+    else:
+        m = re.search(r'\(\s*([\d\.]+)', t)
+        if m:
+            out[f'{side}矯正'] = m.group(1)
+    return out
+
+
+def _parse_nct_avg(text: str) -> Dict[str, str]:
+    vals = [v for v in re.findall(r'\b(\d{1,2}\.\d)\b', text) if 0 <= float(v) <= 80]
+    if not vals:
+        return {}
+    out = {'NCT右': vals[0], '眼圧備考': 'NCT平均値（テンプレート）'}
+    if len(vals) >= 2:
+        out['NCT左'] = vals[1]
+    return out
+
+
+def _parse_iop_pair(text: str) -> Dict[str, str]:
+    vals = [v for v in re.findall(r'\b(\d{1,2})(?:\.\d)?\b', text) if 5 <= int(v) <= 60]
+    out: Dict[str, str] = {}
+    if vals:
+        out['手書き右'] = vals[0]
+    if len(vals) >= 2:
+        out['手書き左'] = vals[1]
+    return out
+
+
+def _parse_refraction(text: str) -> Dict[str, str]:
+    t = text.replace('−', '-').replace('ー', '-')
+    out: Dict[str, str] = {}
+    powers = re.findall(r'([+\-]\s?\d{1,2}\.\d{2})', t)
+    if powers:
+        out['S'] = powers[0].replace(' ', '')
+    if len(powers) >= 2:
+        out['C'] = powers[1].replace(' ', '')
+    m = re.search(r'(?:A[xX]?|軸)\s*[:=]?\s*(\d{1,3})\b', t) or re.search(r'\b(\d{1,3})\s*°', t)
+    if m and 0 <= int(m.group(1)) <= 180:
+        out['Ax'] = m.group(1)
+    return out
+
+
+REGION_PARSERS: Dict[str, Callable[[str], Dict[str, str]]] = {
+    'va_right': lambda t: _parse_va(t, '右'),
+    'va_left': lambda t: _parse_va(t, '左'),
+    'nct_avg': _parse_nct_avg,
+    'iop_pair': _parse_iop_pair,
+    'refraction': _parse_refraction,
+}
+
+
+class TemplateMatch(NamedTuple):
+    template: FormTemplate
+    fields: Dict[str, str]
+    region_texts: Dict[str, str]
+    ocr_pixels: int
+    page_pixels: int
+
+    @property
+    def text(self) -> str:
+        """ocr_text 列用（枠ごとのテキストを連結）"""
+        return '\n'.join(f'[{name}]\n{t.strip()}' for name, t in self.region_texts.items())
+
+
+class TemplateStats:
+    """テンプレートの適用件数と、OCRした画素の割合"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tried: Dict[str, int] = {}
+        self.matched: Dict[str, int] = {}
+        self.ocr_pixels = 0
+        self.page_pixels = 0
+
+    def record(self, name: str, match: Optional[TemplateMatch]):
+        with self._lock:
+            self.tried[name] = self.tried.get(name, 0) + 1
+            if match is not None:
+                self.matched[name] = self.matched.get(name, 0) + 1
+                self.ocr_pixels += match.ocr_pixels
+                self.page_pixels += match.page_pixels
+
+    def summary_lines(self) -> List[str]:
+        if not self.tried:
+            return []
+        ratio = self.ocr_pixels / self.page_pixels if self.page_pixels else 0.0
+        lines = [f'📐 テンプレート領域OCR（適用ページのOCR画素 {ratio:.1%}）']
+        for name, n in sorted(self.tried.items()):
+            lines.append(f'  {name:<12} 位置合わせ成功 {self.matched.get(name, 0)}/{n}')
+        return lines
+
+
+def extract_with_template(img, kbn: str, ocr_regions: Callable[[Dict[str, np.ndarray]], Dict[str, str]],
+                          aligner: 'TemplateAligner', templates: Optional[Dict[str, FormTemplate]] = None,
+                          stats: Optional[TemplateStats] = None,
+                          template: Optional[FormTemplate] = None) -> Optional[TemplateMatch]:
+    """kbn に登録されたテンプレートで位置合わせし、枠だけOCRして値を返す。合わなければ None（全体OCRへ）"""
+    if img is None:
+        return None
+    candidates = [template] if template is not None else templates_for_kbn(kbn, templates)
+    for tpl in candidates:
+        H = aligner.align(img, tpl)
+        if H is None:
+            if stats is not None:
+                stats.record(tpl.name, None)
+            continue
+        crops = {r.name: crop_region(img, H, r.box) for r in tpl.regions}
+        texts = ocr_regions(crops)
+        fields: Dict[str, str] = {}
+        for r in tpl.regions:
+            fields.update(REGION_PARSERS[r.parser](texts.get(r.name, '')))
+        match = TemplateMatch(tpl, fields, texts,
+                              ocr_pixels=sum(c.shape[0] * c.shape[1] for c in crops.values()),
+                              page_pixels=img.shape[0] * img.shape[1])
+        if stats is not None:
+            stats.record(tpl.name, match)
+        return match
+    return None
+
+
+def main():
+    import cv2
+    ap = argparse.ArgumentParser(description='テンプレート領域OCRの確認')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    sub.add_parser('list', help='登録テンプレートと基準画像の有無')
+    ov = sub.add_parser('overlay', help='位置合わせした枠を画像に描画')
+    ov.add_argument('image')
+    ov.add_argument('--template', required=True)
+    ov.add_argument('--out', default='template_overlay.jpg')
+    ex = sub.add_parser('extract', help='Tesseract で枠だけOCRして値を表示')
+    ex.add_argument('image')
+    ex.add_argument('--template', default=None, help='省略時はファイル名の kbn から選ぶ')
+    args = ap.parse_args()
+
+    templates = load_template_overrides()
+    if args.cmd == 'list':
+        for t in templates.values():
+            ref = TEMPLATE_DIR / t.reference
+            mark = '✅' if ref.is_file() else '❌'
+            print(f'{mark} {t.name:<10} kbn={",".join(t.kbns) or ("(予備)" if t.fallback else "-")} 枠={len(t.regions)} 基準画像={ref}  {t.note}')
+        return
+
+    img = decode_image(args.image)
+    if img is None:
+        print(f'❌ 画像を読み込めません: {args.image}')
+        return
+    aligner = TemplateAligner()
+
+    if args.cmd == 'overlay':
+        tpl = templates[args.template]
+        H = aligner.align(img, tpl)
+        if H is None:
+            print(f'❌ 位置合わせできません（基準画像: {TEMPLATE_DIR / tpl.reference}）')
+            return
+        for r in tpl.regions:
+            x0, y0, x1, y1 = r.box
+            quad = cv2.perspectiveTransform(np.float32([[[x0, y0], [x1, y0], [x1, y1], [x0, y1]]]), H)
+            cv2.polylines(img, [np.int32(quad)], True, (0, 0, 255), 3)
+            cv2.putText(img, r.name, tuple(int(v) for v in quad[0][0]), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 255), 2)
+        ok, buf = cv2.imencode(os.path.splitext(args.out)[1] or '.jpg', img)
+        if ok:
+            buf.tofile(args.out)
+            print(f'✅ 保存: {args.out}')
+        return
+
+    from filename_params import kbn_from_path
+    tpl = templates[args.template] if args.template else None
+    match = extract_with_template(img, kbn_from_path(args.image), tesseract_regions, aligner,
+                                  templates=templates, template=tpl)
+    if match is None:
+        print('❌ 適用できるテンプレートがありません（全体OCRが必要）')
+        return
+    print(f'📐 {match.template.name}: OCR画素 {match.ocr_pixels / match.page_pixels:.1%}')
+    for name, text in match.region_texts.items():
+        print(f'  [{name}] {" / ".join(text.split())}')
+    for key, value in match.fields.items():
+        print(f'  {key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+kbn（ファイル名の種別）から、実行する抽出器とOCRモードを決めるルーティング表
+
+ - 紙カルテ（krt2 / krt2-2 / old）: 視力・眼圧・レフ・手術・IOLシール
+ - 検査画像（oct2 / angio / kensa / 眼底・スリット等）: 検査種類の識別（+種類別の詳細）のみ
+ - 保険証（hoken）: 臨床項目の抽出なし（OCRテキストのみ保存）
+ - 表に無い kbn: 先に検査種類を識別し、検査画像ならカルテ用抽出器を省略、それ以外は全抽出器
+
+kbn の定義は docs/FILENAME_PARAMETERS_AND_KBN.md を参照。
+"""
+
+import threading
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+# process_image_final_comprehensive の抽出器名
+ALL_EXTRACTORS: Tuple[str, ...] = ('vision', 'iop', 'refraction', 'surgery', 'iol_seal', 'exam_type')
+CHART_EXTRACTORS: Tuple[str, ...] = ('vision', 'iop', 'refraction', 'surgery', 'iol_seal')
+EXAM_EXTRACTORS: Tuple[str, ...] = ('exam_type',)
+
+# identify_examination_type が返す検査種類のうち、カルテ用抽出器が不要なもの
+EXAM_IMAGE_TYPES: FrozenSet[str] = frozenset({'OCT', 'OCTA', 'ハンフリー視野', 'AIMO視野', '眼底カメラ'})
+
+
+class Route(NamedTuple):
+    extractors: Tuple[str, ...]
+    ocr_mode: str = 'text'   # 'text'（text_detection）/ 'document'（document_text_detection）
+    note: str = ''
+
+
+KBN_ROUTES: Dict[str, Route] = {
+    'krt2': Route(CHART_EXTRACTORS, note='紙カルテ'),
+    'krt2-2': Route(CHART_EXTRACTORS, note='紙カルテ(新)'),
+    'old': Route(CHART_EXTRACTORS, note='紙カルテ(旧)'),
+    'oct2': Route(EXAM_EXTRACTORS, note='OCT'),
+    'kowaetc': Route(EXAM_EXTRACTORS, note='OCT(旧)'),
+    'angio': Route(EXAM_EXTRACTORS, note='OCTA'),
+    'kensa': Route(EXAM_EXTRACTORS, note='ハンフリー'),
+    'kowaspe': Route(EXAM_EXTRACTORS, note='スペキュラー'),
+    'kowatopo': Route(EXAM_EXTRACTORS, note='Topo'),
+    'gantei2': Route(EXAM_EXTRACTORS, note='眼底カメラ'),
+    'kowagantei': Route(EXAM_EXTRACTORS, note='眼底カメラ(旧)'),
+    'keikou': Route(EXAM_EXTRACTORS, note='FAF'),
+    'faf': Route(EXAM_EXTRACTORS, note='FAF'),
+    'kowaslit': Route(EXAM_EXTRACTORS, note='Slit'),
+    'hoken': Route((), note='保険証'),
+}
+
+# 表に無い kbn の既定（検査種類を見てから決める）
+DEFAULT_ROUTE = Route(ALL_EXTRACTORS, note='未定義kbn')
+
+
+def route_for_kbn(kbn: str) -> Optional[Route]:
+    """kbn のルート。表に無ければ None（検査種類で判定する）"""
+    return KBN_ROUTES.get((kbn or '').strip().lower())
+
+
+def extractors_for_exam_type(exam_type: str) -> Tuple[str, ...]:
+    """kbn 不明時: 検出した検査種類から残りの抽出器を決める"""
+    if exam_type in EXAM_IMAGE_TYPES:
+        return EXAM_EXTRACTORS
+    return ALL_EXTRACTORS
+
+
+class RoutingStats:
+    """kbn ごとの実行/省略回数と、省略で節約した抽出時間の推定"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images: Dict[str, int] = {}
+        self.skipped: Dict[str, Dict[str, int]] = {}
+        self.ran_ms: Dict[str, List[float]] = {}   # 抽出器 -> [合計ms, 回数]
+
+    def record(self, kbn: str, ran: Dict[str, float], skipped: Tuple[str, ...]):
+        """ran: 抽出器 -> 実行時間(ms)、skipped: 省略した抽出器"""
+        key = kbn or '(none)'
+        with self._lock:
+            self.images[key] = self.images.get(key, 0) + 1
+            for name, ms in ran.items():
+                acc = self.ran_ms.setdefault(name, [0.0, 0])
+                acc[0] += ms
+                acc[1] += 1
+            per_kbn = self.skipped.setdefault(key, {})
+            for name in skipped:
+                per_kbn[name] = per_kbn.get(name, 0) + 1
+
+    def mean_ms(self, name: str) -> float:
+        total, count = self.ran_ms.get(name, (0.0, 0))
+        return total / count if count else 0.0
+
+    def report(self) -> Dict[str, Dict]:
+        """kbn -> {images, skipped, saved_ms}（saved_ms は実行時の平均時間から推定）"""
+        with self._lock:
+            out: Dict[str, Dict] = {}
+            for key, n in sorted(self.images.items()):
+                skipped = self.skipped.get(key, {})
+                saved = sum(self.mean_ms(name) * cnt for name, cnt in skipped.items())
+                unmeasured = sorted(name for name in skipped if name not in self.ran_ms)
+                out[key] = {'images': n, 'skipped': dict(skipped), 'saved_ms': round(saved, 2),
+                            'unmeasured': unmeasured}
+            return out
+
+    def summary_lines(self) -> List[str]:
+        rep = self.report()
+        if not rep:
+            return []
+        total_saved = sum(r['saved_ms'] for r in rep.values())
+        lines = [f'🔀 kbn別ルーティング（省略による推定節約 {total_saved:.1f}ms）']
+        for key, r in rep.items():
+            skipped = ', '.join(f'{k}×{v}' for k, v in sorted(r['skipped'].items())) or '-'
+            note = f' (未計測: {", ".join(r["unmeasured"])})' if r['unmeasured'] else ''
+            lines.append(f'  {key:<12} 画像={r["images"]:<5} 省略={skipped}  節約≈{r["saved_ms"]:.1f}ms{note}')
+        return lines
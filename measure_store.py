@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+患者ごとの測定値（視力・眼圧・レフ値・IOL度数）の経時データベース（SQLite）
+
+抽出結果は実行ごとの CSV（final_vision_extraction_<ts>.csv、vision_iop_<PID>.csv、
+iol_data_<PID>.csv）に散らばっていて、ある患者の眼圧の推移を見るだけでも全部を読み直していた。
+ここに (pid, 測定項目, 眼, 受診日) で1か所にまとめる。
+
+ - measurements: 1測定値 = 1行。主キー (pid, measure, eye, cdate, file) の WITHOUT ROWID 表なので、
+   患者1人・1項目の推移はキー順に並んだ連続領域を読むだけ
+ - measure_range: (measure, cdate, eye, value) の索引。院内全体の期間指定・月別集計は
+   この索引だけで完結する（表本体を読まない）
+ - method: 値の出どころ。眼圧は select_final_iop が選んだ方（NCT / 手書き）
+ - 同じ画像を再登録すると、その画像の値をまとめて置き換える（内容が同じなら何もしない）
+
+使い方:
+    store = MeasureStore()                      # 既定: このファイルと同じフォルダの measure_store.db
+    store.add_record(record, origin='final_vision_extraction_20250101_120000.csv')
+    for m in store.series('26147', 'IOP', eye='R'):
+        print(m.cdate, m.value, m.method)
+
+    python measure_store.py import [CSV またはフォルダ ...]   # 既定: カレントの final_*.csv と output_root
+    python measure_store.py series 26147 IOP [--eye R]
+    python measure_store.py range IOP --from 20230101 --to 20231231 [--min 21]
+    python measure_store.py trend IOP [--by year] [--from 20200101]
+    python measure_store.py stats
+"""
+
+import os
+import re
+import csv
+import sys
+import time
+import sqlite3
+import argparse
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from filename_params import cdate_from_path, pid_from_path
+from tree_walker import list_files
+
+DEFAULT_DB = Path(__file__).resolve().parent / 'measure_store.db'   # OneDrive 上に置かない（WAL のため）
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS measurements (
+    pid     TEXT NOT NULL,
+    measure TEXT NOT NULL,
+    eye     TEXT NOT NULL,              -- R / L / ''（左右不明）
+    cdate   TEXT NOT NULL,              -- YYYYMMDD
+    file    TEXT NOT NULL,              -- 画像ファイル名（同じ日の複数画像を区別）
+    value   REAL,                       -- 数値に読めない値（"n.c." など）は NULL
+    raw     TEXT NOT NULL,
+    method  TEXT NOT NULL DEFAULT '',
+    origin  TEXT NOT NULL DEFAULT '',   -- 取り込み元の CSV など
+    updated REAL NOT NULL,
+    PRIMARY KEY (pid, measure, eye, cdate, file)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS measure_range ON measurements (measure, cdate, eye, value);
+CREATE INDEX IF NOT EXISTS measure_file ON measurements (file);
+'''
+
+# 測定項目
+MEASURES = ('VA_UC', 'VA_CC', 'IOP', 'NCT', 'HAND_IOP', 'S', 'C', 'Ax', 'IOL_S', 'IOL_C', 'IOL_Ax')
+MEASURE_LABELS = {
+    'VA_UC': '裸眼視力', 'VA_CC': '矯正視力', 'IOP': '眼圧（採用値）', 'NCT': '眼圧（NCT）',
+    'HAND_IOP': '眼圧（手書き）', 'S': 'レフ S', 'C': 'レフ C', 'Ax': 'レフ Ax',
+    'IOL_S': 'IOL度数 S', 'IOL_C': 'IOL度数 C', 'IOL_Ax': 'IOL度数 Ax',
+}
+
+# final_vision_extraction_*.csv（ocr_record.CSV_FIELDS）の列 -> (measure, eye)
+FINAL_COLUMNS: Tuple[Tuple[str, str, str], ...] = (
+    ('右裸眼', 'VA_UC', 'R'), ('左裸眼', 'VA_UC', 'L'),
+    ('右矯正', 'VA_CC', 'R'), ('左矯正', 'VA_CC', 'L'),
+    ('最終眼圧右', 'IOP', 'R'), ('最終眼圧左', 'IOP', 'L'),
+    ('NCT右', 'NCT', 'R'), ('NCT左', 'NCT', 'L'),
+    ('手書き右', 'HAND_IOP', 'R'), ('手書き左', 'HAND_IOP', 'L'),
+    ('S', 'S', ''), ('C', 'C', ''), ('Ax', 'Ax', ''),
+)
+IOL_COLUMNS = (('IOL度数_S', 'IOL_S'), ('IOL度数_C', 'IOL_C'), ('IOL度数_Ax', 'IOL_Ax'))
+# select_final_iop の 使用データ -> method
+IOP_METHODS = {'手書き優先': '手書き', 'NCT': 'NCT'}
+EYES = {'右': 'R', '左': 'L', 'R': 'R', 'L': 'L', 'OD': 'R', 'OS': 'L'}
+
+_NUMBER = re.compile(r'[-+]?\d+(?:\.\d+)?')
+_DIGITS = re.compile(r'\D')
+
+
+class Measurement(NamedTuple):
+    pid: str
+    measure: str
+    eye: str
+    cdate: str
+    file: str
+    value: Optional[float]
+    raw: str
+    method: str
+
+
+def parse_value(raw: str) -> Optional[float]:
+    """'1.2p' → 1.2、'-1.50' → -1.5、'n.c.' → None"""
+    m = _NUMBER.search(raw.replace('，', '.').replace('．', '.'))
+    return float(m.group()) if m else None
+
+
+def normalize_cdate(value: str) -> str:
+    """'2023/04/01' や '20230401093000' → '20230401'（8桁に満たなければ空）"""
+    digits = _DIGITS.sub('', value or '')
+    return digits[:8] if len(digits) >= 8 else ''
+
+
+def normalize_eye(value: str) -> str:
+    value = (value or '').strip().upper()
+    return EYES.get(value, EYES.get(value[:1], '')) if value else ''
+
+
+def final_measurements(record: Mapping[str, Any]) -> List[Tuple[str, str, str, str]]:
+    """最終包括処理の1行（FinalRecord / CSV の行）から (measure, eye, raw, method)"""
+    out = []
+    iop_method = IOP_METHODS.get(record.get('使用データ') or '', record.get('使用データ') or '')
+    for col, measure, eye in FINAL_COLUMNS:
+        raw = str(record.get(col) or '').strip()
+        if not raw:
+            continue
+        method = {'IOP': iop_method, 'NCT': 'NCT', 'HAND_IOP': '手書き'}.get(measure, 'OCR')
+        out.append((measure, eye, raw, method))
+    iol_eye = normalize_eye(record.get('対象眼') or '')
+    for col, measure in IOL_COLUMNS:
+        raw = str(record.get(col) or '').strip()
+        if raw:
+            out.append((measure, iol_eye, raw, 'IOLシール'))
+    return out
+
+
+def vision_iop_measurements(row: Mapping[str, Any]) -> List[Tuple[str, str, str, str]]:
+    """vision_iop_<PID>.csv の1行（IOP_R / IOP_L）"""
+    return [('IOP', eye, str(row.get(col) or '').strip(), 'Avg')
+            for col, eye in (('IOP_R', 'R'), ('IOP_L', 'L')) if str(row.get(col) or '').strip()]
+
+
+def iol_data_measurements(row: Mapping[str, Any]) -> List[Tuple[str, str, str, str]]:
+    """iol_data_<PID>.csv の1行（S / C / AX、eye）"""
+    eye = normalize_eye(row.get('eye') or '')
+    return [(measure, eye, str(row.get(col) or '').strip(), 'IOLシール')
+            for col, measure in (('S', 'IOL_S'), ('C', 'IOL_C'), ('AX', 'IOL_Ax')) if str(row.get(col) or '').strip()]
+
+
+class MeasureStore:
+    """(pid, 測定項目, 眼, 受診日) ごとの測定値"""
+
+    def __init__(self, path=DEFAULT_DB, timeout: float = 30.0):
+        self.path = str(path)
+        self.conn = sqlite3.connect(self.path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.added = 0
+        self.unchanged = 0
+        self.skipped = 0      # pid / 受診日が分からない行
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM measurements').fetchone()[0]
+
+    # ---- 登録 ----
+
+    def replace_file(self, pid: str, cdate: str, file: str, values: Sequence[Tuple[str, str, str, str]],
+                     measures: Iterable[str] = MEASURES, origin: str = '', commit: bool = True) -> bool:
+        """画像1枚分の (measure, eye, raw, method) で、その画像の measures の値を置き換える
+
+        前回と同じ内容なら何もせず False。"""
+        cdate = normalize_cdate(cdate)
+        if not pid or not cdate:
+            self.skipped += 1
+            return False
+        measures = tuple(measures)
+        marks = ','.join('?' * len(measures))
+        current = sorted(self.conn.execute(
+            f'SELECT measure, eye, raw, method FROM measurements WHERE file = ? AND pid = ? AND measure IN ({marks})',
+            (file, pid) + measures))
+        # 同じ (measure, eye) が重なったら後の値を使う
+        latest = {(m, e): (m, e, raw, method) for m, e, raw, method in values}
+        if sorted(latest.values()) == current:
+            self.unchanged += 1
+            return False
+        self.conn.execute(f'DELETE FROM measurements WHERE file = ? AND pid = ? AND measure IN ({marks})',
+                          (file, pid) + measures)
+        now = time.time()
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO measurements (pid, measure, eye, cdate, file, value, raw, method, origin, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(pid, m, e, cdate, file, parse_value(raw), raw, method, origin, now)
+             for m, e, raw, method in latest.values()])
+        if commit:
+            self.conn.commit()
+        self.added += 1
+        return True
+
+    def add_record(self, record: Mapping[str, Any], origin: str = '', commit: bool = True) -> bool:
+        """最終包括処理の結果（FinalRecord、または final_vision_extraction_*.csv の行）を登録"""
+        if record.get('status') not in ('', None, 'SUCCESS'):   # OCR_FAILED（未処理の FinalRecord は '')
+            return False
+        file = os.path.basename(record.get('filename') or '')
+        return self.replace_file(pid_from_path(file), cdate_from_path(file), file, final_measurements(record),
+                                 origin=origin, commit=commit)
+
+    def add_records(self, records: Iterable[Mapping[str, Any]], origin: str = '') -> int:
+        """まとめて登録（1トランザクション）"""
+        n = sum(1 for r in records if self.add_record(r, origin=origin, commit=False))
+        self.conn.commit()
+        return n
+
+    def import_csv(self, path: str) -> int:
+        """抽出結果の CSV を列名で見分けて登録し、更新した画像数を返す"""
+        origin = os.path.basename(path)
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            reader = csv.DictReader(f)
+            cols = set(reader.fieldnames or ())
+            if {'filename', '最終眼圧右'} <= cols:
+                return self.add_records(reader, origin=origin)
+            if {'IOP_R', 'IOP_L'} <= cols:
+                parse, measures = vision_iop_measurements, ('IOP',)
+            elif {'pidnum', 'AX'} <= cols:
+                parse, measures = iol_data_measurements, ('IOL_S', 'IOL_C', 'IOL_Ax')
+            else:
+                return 0
+            # 同じ画像の行（iol_data は1画像1行だが念のため）をまとめる
+            by_file: Dict[str, Tuple[str, str, List]] = {}
+            for row in reader:
+                file = os.path.basename(row.get('file') or '')
+                pid = row.get('ID') or row.get('pidnum') or pid_from_path(file)
+                cdate = cdate_from_path(file) or row.get('検査日') or ''
+                by_file.setdefault(file, (pid, cdate, []))[2].extend(parse(row))
+        n = sum(1 for file, (pid, cdate, values) in by_file.items()
+                if self.replace_file(pid, cdate, file, values, measures, origin=origin, commit=False))
+        self.conn.commit()
+        return n
+
+    # ---- 検索 ----
+
+    def series(self, pid: str, measure: str, eye: Optional[str] = None,
+               date_from: Optional[str] = None, date_to: Optional[str] = None) -> List[Measurement]:
+        """患者1人・1項目の推移（受診日順）"""
+        sql = ('SELECT pid, measure, eye, cdate, file, value, raw, method FROM measurements '
+               'WHERE pid = ? AND measure = ?')
+        params: List[Any] = [pid, measure]
+        if eye is not None:
+            sql += ' AND eye = ?'
+            params.append(eye)
+        sql, params = _date_filter(sql, params, date_from, date_to)
+        sql += ' ORDER BY eye, cdate, file'
+        return [Measurement(*row) for row in self.conn.execute(sql, params)]
+
+    def range(self, measure: str, date_from: Optional[str] = None, date_to: Optional[str] = None,
+              eye: Optional[str] = None, min_value: Optional[float] = None, max_value: Optional[float] = None,
+              limit: int = 1000) -> List[Measurement]:
+        """期間内の測定値（院内全体）。min_value / max_value で値も絞る（例: 眼圧 21 以上）"""
+        sql = ('SELECT pid, measure, eye, cdate, file, value, raw, method FROM measurements '
+               'WHERE measure = ?')
+        params: List[Any] = [measure]
+        sql, params = _date_filter(sql, params, date_from, date_to)
+        if eye is not None:
+            sql += ' AND eye = ?'
+            params.append(eye)
+        if min_value is not None:
+            sql += ' AND value >= ?'
+            params.append(min_value)
+        if max_value is not None:
+            sql += ' AND value <= ?'
+            params.append(max_value)
+        sql += ' ORDER BY cdate LIMIT ?'
+        params.append(limit)
+        return [Measurement(*row) for row in self.conn.execute(sql, params)]
+
+    def trend(self, measure: str, by: str = 'month', date_from: Optional[str] = None,
+              date_to: Optional[str] = None, eye: Optional[str] = None) -> List[Tuple[str, str, int, float, float, float]]:
+        """院内全体の期間別集計 (期間, 眼, 件数, 平均, 最小, 最大)。by は month / year"""
+        width = {'month': 6, 'year': 4}[by]
+        sql = (f'SELECT substr(cdate, 1, {width}) AS period, eye, COUNT(value), AVG(value), MIN(value), MAX(value) '
+               'FROM measurements WHERE measure = ?')
+        params: List[Any] = [measure]
+        sql, params = _date_filter(sql, params, date_from, date_to)
+        if eye is not None:
+            sql += ' AND eye = ?'
+            params.append(eye)
+        sql += ' AND value IS NOT NULL GROUP BY period, eye ORDER BY period, eye'
+        return list(self.conn.execute(sql, params))
+
+    def summary_lines(self) -> List[str]:
+        if not self.added and not self.unchanged and not self.skipped:
+            return []
+        return [f'📈 測定値DB: 更新 {self.added}画像 / 変更なし {self.unchanged}画像'
+                + (f' / pid・受診日不明 {self.skipped}件' if self.skipped else '')
+                + f'（全{len(self)}件、{self.path}）']
+
+
+def _date_filter(sql: str, params: List[Any], date_from: Optional[str], date_to: Optional[str]):
+    if date_from:
+        sql += ' AND cdate >= ?'
+        params.append(normalize_cdate(date_from) or date_from)
+    if date_to:
+        sql += ' AND cdate <= ?'
+        params.append(normalize_cdate(date_to) or date_to)
+    return sql, params
+
+
+# ---- 既存の CSV から作成 ----
+
+def find_result_csvs(paths: Iterable[str]) -> List[str]:
+    """取り込み対象の CSV（フォルダは配下の final_vision_extraction_* / vision_iop_* / iol_data_*）。
+    古い実行の結果を先に登録するよう名前順（final_* は日時順になる）"""
+    found = []
+    for path in paths:
+        if os.path.isfile(path):
+            found.append(path)
+            continue
+        for p in list_files(path, exts=('.csv',)):
+            name = os.path.basename(p)
+            if name.startswith(('final_vision_extraction_', 'vision_iop_', 'iol_data_')):
+                found.append(p)
+    return sorted(found, key=lambda p: (os.path.basename(p), p))
+
+
+def add_measure_store_argument(ap):
+    """argparse に --measure-db を追加する（抽出結果を測定値DBにも登録する）"""
+    ap.add_argument('--measure-db', nargs='?', const=str(DEFAULT_DB), default=None, metavar='DB',
+                    help=f'抽出結果を測定値DBにも登録（既定: {DEFAULT_DB}、照会は measure_store.py series / trend）')
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description='患者ごとの測定値の経時データベース（SQLite）')
+    ap.add_argument('--db', default=str(DEFAULT_DB))
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('import', help='抽出結果の CSV を登録（同じ画像は置き換え）')
+    p.add_argument('paths', nargs='*', help='CSV またはフォルダ（既定: カレントと output_root）')
+    p = sub.add_parser('series', help='患者1人・1項目の推移')
+    p.add_argument('pid')
+    p.add_argument('measure', choices=MEASURES)
+    p.add_argument('--eye', choices=('R', 'L'), default=None)
+    p.add_argument('--from', dest='date_from', default=None)
+    p.add_argument('--to', dest='date_to', default=None)
+    p = sub.add_parser('range', help='期間内の測定値（院内全体）')
+    p.add_argument('measure', choices=MEASURES)
+    p.add_argument('--from', dest='date_from', default=None, help='受診日の下限（例: 20230101）')
+    p.add_argument('--to', dest='date_to', default=None)
+    p.add_argument('--eye', choices=('R', 'L'), default=None)
+    p.add_argument('--min', dest='min_value', type=float, default=None)
+    p.add_argument('--max', dest='max_value', type=float, default=None)
+    p.add_argument('--limit', type=int, default=100)
+    p = sub.add_parser('trend', help='期間別の件数・平均（院内全体）')
+    p.add_argument('measure', choices=MEASURES)
+    p.add_argument('--by', choices=('month', 'year'), default='month')
+    p.add_argument('--from', dest='date_from', default=None)
+    p.add_argument('--to', dest='date_to', default=None)
+    p.add_argument('--eye', choices=('R', 'L'), default=None)
+    sub.add_parser('stats', help='登録件数')
+    args = ap.parse_args(argv)
+
+    with MeasureStore(args.db) as store:
+        t0 = time.perf_counter()
+        if args.cmd == 'import':
+            paths = args.paths
+            if not paths:
+                from patient_ocr_dump import OUTPUT_ROOT
+                paths = [os.getcwd(), OUTPUT_ROOT]
+            files = find_result_csvs(paths)
+            for path in files:
+                store.import_csv(path)
+            print(f'✅ {len(files)}ファイルを登録（{time.perf_counter() - t0:.1f}s）')
+            for line in store.summary_lines():
+                print(line)
+        elif args.cmd == 'series':
+            rows = store.series(args.pid, args.measure, args.eye, args.date_from, args.date_to)
+            ms = (time.perf_counter() - t0) * 1000
+            first: Dict[str, Optional[float]] = {}
+            for m in rows:
+                base = first.setdefault(m.eye, m.value)
+                delta = f'{m.value - base:+g}' if m.value is not None and base is not None else ''
+                print(f'  {m.eye or "-"} {m.cdate} {m.raw:<8} {delta:<7} {m.method:<8} {m.file}')
+            print(f'📈 {MEASURE_LABELS[args.measure]} {len(rows)}件 ({ms:.0f}ms)')
+        elif args.cmd == 'range':
+            rows = store.range(args.measure, args.date_from, args.date_to, args.eye,
+                               args.min_value, args.max_value, args.limit)
+            ms = (time.perf_counter() - t0) * 1000
+            for m in rows:
+                print(f'  {m.pid:<10} {m.eye or "-"} {m.cdate} {m.raw:<8} {m.method}')
+            print(f'📈 {MEASURE_LABELS[args.measure]} {len(rows)}件 ({ms:.0f}ms)')
+        elif args.cmd == 'trend':
+            rows = store.trend(args.measure, args.by, args.date_from, args.date_to, args.eye)
+            ms = (time.perf_counter() - t0) * 1000
+            for period, eye, n, avg, lo, hi in rows:
+                print(f'  {period} {eye or "-"} {n:>6}件 平均 {avg:.2f} (最小 {lo:g} / 最大 {hi:g})')
+            print(f'📈 {MEASURE_LABELS[args.measure]} {len(rows)}区間 ({ms:.0f}ms)')
+        else:
+            for measure, n, pids, lo, hi in store.conn.execute(
+                    'SELECT measure, COUNT(*), COUNT(DISTINCT pid), MIN(cdate), MAX(cdate) '
+                    'FROM measurements GROUP BY measure ORDER BY measure'):
+                print(f'  {MEASURE_LABELS.get(measure, measure):<12} {n:>8}件 / {pids}人 / {lo} 〜 {hi}')
+            print(f'📈 全{len(store)}件 ({store.path})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知覚ハッシュ（dHash / pHash）による撮り直し・重複スキャンの検出
+
+SHA-256 はバイト列が同一のファイルしか見つけられない。撮り直したスマホ写真や、
+同じ受診日に数秒違いで取り込まれたページは、画素がわずかに違っても同じ内容になる。
+
+ - dhash: 隣接画素の明暗差 16×16 = 256bit（位置ずれ・再圧縮に強い）
+ - phash: 32×32 DCT の低周波 8×8 の中央値比較 64bit（明るさ・コントラスト変化に強い）
+ - BKTree: pHash のハミング距離で近傍検索（全件比較しない）
+ - 近似重複は pHash と dHash の両方が閾値以内、かつ同じ範囲（既定: 同一患者・同一受診日・同じ kbn と no）のもの。
+   同じ様式の別ページ（krt2 と krt2-2、no=1 と no=2）は記入が少ないとハッシュが近くなるので比較しない。
+   閾値も、別ページを取り違えるより再OCRする方を選ぶ厳しさにしてある
+ - 複数プロセスで使うときは shard を指定すると、追記先がプロセスごとのファイル
+   （near_dup_index.<shard>.jsonl）になる。読み込みは本体と全ての shard。merge_shards() で本体にまとめる
+
+使い方:
+    index = NearDupIndex(Path(OUTPUT_ROOT) / 'near_dup_index.jsonl')   # 並列時は shard=f'{os.getpid()}'
+    hashes = image_hashes_array(img)                  # BGR/グレースケールの ndarray
+    hit = index.lookup(hashes, path)                  # 近似重複なら以前のエントリ（OCRテキストを再利用）
+    if hit is None:
+        text = ocr(img)
+        index.add(path, hashes, text)
+    print('\\n'.join(index.stats.summary_lines()))
+"""
+
+import os
+import glob
+import json
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from filename_params import cdate_from_path, kbn_from_path, no_from_path, pid_from_path
+
+DHASH_SIZE = 16                 # 256bit
+PHASH_SIZE = 8                  # 64bit
+MAX_PHASH_DISTANCE = 4          # /64（撮り直しは 0〜2 程度。記入の少ない同じ様式の別ページは 5 前後から）
+MAX_DHASH_DISTANCE = 12         # /256
+SCOPES = ('visit', 'patient', 'all')
+
+
+class ImageHashes(NamedTuple):
+    dhash: int
+    phash: int
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _resize_gray(gray: np.ndarray, w: int, h: int) -> np.ndarray:
+    import cv2
+    return cv2.resize(gray, (w, h), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def dhash(gray: np.ndarray, size: int = DHASH_SIZE) -> int:
+    small = _resize_gray(gray, size + 1, size)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def phash(gray: np.ndarray, size: int = PHASH_SIZE) -> int:
+    import cv2
+    small = _resize_gray(gray, size * 4, size * 4)
+    low = cv2.dct(small)[:size, :size].ravel()
+    median = np.median(low[1:])   # 直流成分は除く
+    return _bits_to_int(low > median)
+
+
+def image_hashes_array(img: np.ndarray) -> ImageHashes:
+    """BGR またはグレースケールの ndarray から"""
+    import cv2
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return ImageHashes(dhash(gray), phash(gray))
+
+
+def image_hashes_file(path) -> ImageHashes:
+    """画像ファイルから（JPEG は縮小デコードで高速に読む）"""
+    from PIL import Image, ImageOps
+    with Image.open(path) as im:
+        im.draft('L', (DHASH_SIZE * 16, DHASH_SIZE * 16))
+        im = ImageOps.exif_transpose(im).convert('L')
+        return image_hashes_array(np.asarray(im))
+
+
+def scope_key(path, scope: str) -> str:
+    """同じキーの画像どうしだけを比較する（visit / patient は kbn と no も同じもの）"""
+    if scope == 'all':
+        return ''
+    page = f'{kbn_from_path(path)}/{no_from_path(path)}'
+    pid = pid_from_path(path)
+    return f'{pid}/{page}' if scope == 'patient' else f'{pid}/{cdate_from_path(path)}/{page}'
+
+
+class BKTree:
+    """ハミング距離の BK-tree（値は任意オブジェクト）"""
+
+    def __init__(self):
+        self._root: Optional[List[Any]] = None   # [hash, [items], {距離: 子ノード}]
+        self.size = 0
+
+    def add(self, key: int, item: Any):
+        self.size += 1
+        if self._root is None:
+            self._root = [key, [item], {}]
+            return
+        node = self._root
+        while True:
+            d = hamming(key, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [key, [item], {}]
+                return
+            node = child
+
+    def remove(self, key: int, item: Any) -> bool:
+        """key のノードから item（同一オブジェクト）を外す。ノードは経路として残す"""
+        node = self._root
+        while node is not None:
+            d = hamming(key, node[0])
+            if d == 0:
+                for i, x in enumerate(node[1]):
+                    if x is item:
+                        del node[1][i]
+                        self.size -= 1
+                        return True
+                return False
+            node = node[2].get(d)
+        return False
+
+    def search(self, key: int, max_distance: int) -> Iterator[Tuple[int, Any]]:
+        """距離 max_distance 以内の (距離, item)"""
+        if self._root is None:
+            return
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = hamming(key, node[0])
+            if d <= max_distance:
+                for item in node[1]:
+                    yield d, item
+            lo, hi = d - max_distance, d + max_distance
+            stack.extend(child for dist, child in node[2].items() if lo <= dist <= hi)
+
+
+class DedupStats:
+    """患者ごとの画像数と、近似重複として再利用した件数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images: Dict[str, int] = {}
+        self.duplicates: Dict[str, int] = {}
+
+    def record(self, pid: str, duplicate: bool):
+        key = pid or '(none)'
+        with self._lock:
+            self.images[key] = self.images.get(key, 0) + 1
+            if duplicate:
+                self.duplicates[key] = self.duplicates.get(key, 0) + 1
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {pid: {'images': n, 'duplicates': self.duplicates.get(pid, 0),
+                          'ratio': round(self.duplicates.get(pid, 0) / n, 4)}
+                    for pid, n in sorted(self.images.items())}
+
+    def summary_lines(self, top: int = 20, action: str = 'を再OCRせず再利用') -> List[str]:
+        rep = self.report()
+        total = sum(r['images'] for r in rep.values())
+        if not total:
+            return []
+        dups = sum(r['duplicates'] for r in rep.values())
+        lines = [f'🪞 近似重複: {dups}/{total}件 ({dups / total:.1%}) {action}']
+        ranked = sorted(((pid, r) for pid, r in rep.items() if r['duplicates']), key=lambda kv: -kv[1]['ratio'])
+        for pid, r in ranked[:top]:
+            lines.append(f'  {pid:<10} {r["duplicates"]}/{r["images"]}件 ({r["ratio"]:.1%})')
+        return lines
+
+
+class NearDupIndex:
+    """知覚ハッシュの索引。path を指定すると JSONL に追記保存し、次回起動時に読み込む
+
+    shard を指定すると追記先は shard_path(shard)（同じ path を複数プロセスで開くときはプロセスごとに別の shard）。
+    """
+
+    def __init__(self, path: Optional[Path] = None, scope: str = 'visit',
+                 max_phash: int = MAX_PHASH_DISTANCE, max_dhash: int = MAX_DHASH_DISTANCE,
+                 shard: Optional[str] = None):
+        if scope not in SCOPES:
+            raise ValueError(f'scope は {SCOPES} のいずれか: {scope}')
+        self.path = Path(path) if path else None
+        self.write_path = self.shard_path(shard) if self.path and shard else self.path
+        self.scope = scope
+        self.max_phash = max_phash
+        self.max_dhash = max_dhash
+        self.stats = DedupStats()
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+        self._known: Dict[str, Dict[str, Any]] = {}   # file -> entry（同じファイルの再処理用）
+        if self.path:
+            for p in [self.path] + self.shard_paths():
+                if p.is_file():
+                    self._load(p)
+
+    def __len__(self) -> int:
+        return self._tree.size
+
+    def shard_path(self, shard: str) -> Path:
+        return self.path.with_name(f'{self.path.stem}.{shard}{self.path.suffix}')
+
+    def shard_paths(self, prefix: str = '') -> List[Path]:
+        pattern = f'{glob.escape(self.path.stem)}.{glob.escape(prefix)}*{self.path.suffix}'
+        return sorted(p for p in self.path.parent.glob(pattern) if p != self.path)
+
+    def _load(self, path: Path):
+        with path.open('r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self._insert(json.loads(line))
+                except ValueError:
+                    continue   # 書きかけの行
+
+    def merge_shards(self, prefix: str = '') -> int:
+        """prefix で始まる shard を本体に追記して消す（書き込み中のプロセスが無いときに呼ぶ）。まとめた行数を返す"""
+        if not self.path:
+            return 0
+        merged = 0
+        with self._lock:
+            for shard in self.shard_paths(prefix):
+                if shard == self.write_path:
+                    continue
+                with shard.open('r', encoding='utf-8') as src:
+                    lines = [line for line in src if line.endswith('\n')]   # 書きかけの行は捨てる
+                if lines:
+                    with self.path.open('a', encoding='utf-8') as dst:
+                        dst.writelines(lines)
+                for line in lines:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._insert(entry)
+                shard.unlink()
+                merged += len(lines)
+        return merged
+
+    def _insert(self, entry: Dict[str, Any]):
+        """同じファイルの古いエントリは木から外して置き換える（後から書かれた行が最新）"""
+        prev = self._known.get(entry['file'])
+        if prev is not None:
+            self._tree.remove(int(prev['phash'], 16), prev)
+        entry['_scope'] = scope_key(entry['file'], self.scope)
+        self._tree.add(int(entry['phash'], 16), entry)
+        self._known[entry['file']] = entry
+
+    def find(self, hashes: ImageHashes, path) -> Optional[Dict[str, Any]]:
+        """同じ範囲内で最も近い近似重複（無ければ None）。統計は更新しない"""
+        key = scope_key(path, self.scope)
+        best = None
+        with self._lock:
+            for d, entry in self._tree.search(hashes.phash, self.max_phash):
+                if entry['_scope'] != key or entry['file'] == str(path):
+                    continue
+                dd = hamming(hashes.dhash, int(entry['dhash'], 16))
+                if dd <= self.max_dhash and (best is None or (d, dd) < best[0]):
+                    best = ((d, dd), entry)
+        return best[1] if best else None
+
+    def lookup(self, hashes: ImageHashes, path) -> Optional[Dict[str, Any]]:
+        """find() し、患者ごとの重複率に記録する"""
+        hit = self.find(hashes, path)
+        self.stats.record(pid_from_path(path), hit is not None)
+        return hit
+
+    def add(self, path, hashes: ImageHashes, text: Optional[str] = None, **extra: Any) -> Dict[str, Any]:
+        entry: Dict[str, Any] = {'file': str(path), 'dhash': f'{hashes.dhash:064x}', 'phash': f'{hashes.phash:016x}'}
+        if text is not None:
+            entry['text'] = text
+        entry.update(extra)
+        with self._lock:
+            prev = self._known.get(entry['file'])
+            if prev is not None and all(prev.get(k) == v for k, v in entry.items()):
+                return prev   # 同じ内容で登録済み（再実行）
+            self._insert(dict(entry))
+            if self.write_path:
+                os.makedirs(self.write_path.parent, exist_ok=True)
+                with self.write_path.open('a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        return entry
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全スクリプト共通の入口（サブコマンドごとに必要なモジュールだけを読む）
+
+各スクリプトは単体でも動くが、google.cloud.vision / cv2 / pytesseract / easyocr の読み込みだけで
+数百ms〜数秒かかる。ここではサブコマンドのモジュールを実行直前に import するので、
+CSV 出力やギャラリー、DB の照会はOCR系のライブラリを読まずに始まる。
+
+ - COMMANDS: サブコマンド → (モジュール, 説明, 起動を速く保つ対象か)
+ - 引数はそのままモジュールの main() に渡す（python ocr_cli.py dump --pid 26147 = python patient_ocr_dump.py --pid 26147）
+ - startup: 各モジュールを python -X importtime で読み込み、起動時間が予算内か、
+   重いライブラリを読んでいないかを調べる（超えたら終了コード 1）
+
+使い方:
+    python ocr_cli.py                           # サブコマンドの一覧
+    python ocr_cli.py measure trend IOP
+    python ocr_cli.py startup [--budget-ms 300] [--all]
+"""
+
+import os
+import sys
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TOOLS_DIR = os.path.join(ROOT, 'tools')
+
+STARTUP_BUDGET_MS = 300
+# 起動を速く保つコマンドが読んではいけないモジュール（OCR・画像処理・表計算）
+HEAVY_MODULES = ('google.cloud.vision', 'google.oauth2', 'cv2', 'pytesseract', 'easyocr', 'torch', 'pandas')
+
+
+class Command(NamedTuple):
+    module: str
+    help: str
+    quick: bool = False      # startup の予算を守る対象
+    entry: str = 'main'      # '' なら python <module>.py と同じく __main__ として実行
+
+
+COMMANDS: Dict[str, Command] = {
+    'final': Command('fixed_extraction', '受付フォルダの最終包括処理（Vision OCR + 抽出）', entry=''),
+    'dump': Command('patient_ocr_dump', '患者フォルダのOCRテキスト・IOL抽出'),
+    'vision-iop': Command('patient_vision_iop_export', '患者1人分の視力・眼圧 CSV/TSV'),
+    'pack': Command('patient_pack_export', '患者パック（CSV + サムネイル）', quick=True),
+    'params': Command('export_filename_params', 'ファイル名パラメータの一覧 CSV', quick=True),
+    'exam-csv': Command('export_exam_csv_min', '検査画像の最小 CSV', quick=True, entry=''),
+    'gallery': Command('patient_gallery', '患者ギャラリー HTML', quick=True),
+    'registry': Command('file_asset_registry', '画像ストア・資産台帳'),
+    'search': Command('ocr_search', 'OCRテキストの全文検索', quick=True),
+    'measure': Command('measure_store', '測定値の経時DB（推移・期間集計）', quick=True),
+    'queue': Command('ocr_job_queue', 'OCRジョブキュー（登録・ワーカー・状況）', quick=True),
+    'quota': Command('vision_quota', 'Vision クォータの使用量', quick=True),
+    'templates': Command('form_templates', '様式テンプレートの確認'),
+    'upload-prep': Command('upload_prep', 'Vision 送信前縮小のレポート'),
+    'gate': Command('thumb_classifier', 'OCR前判定（サムネイル分類）の確認'),
+    'bench': Command('extractor_benchmark', '抽出器のベンチマーク'),
+    'pipeline': Command('async_ocr_pipeline', '非同期OCRパイプラインのベンチマーク'),
+    'p1': Command('p1_distribute', 'QR読取・master.csv 管理（tools/）'),
+    'p2': Command('p2_printed_ocr', '印刷系OCR（tools/）'),
+}
+
+
+def _ensure_path():
+    for d in (ROOT, TOOLS_DIR):
+        if d not in sys.path:
+            sys.path.append(d)
+
+
+def run_command(name: str, argv: Sequence[str]) -> int:
+    """サブコマンドのモジュールを読み込んで実行する（sys.argv は単体実行と同じ形にする）"""
+    import importlib
+    import runpy
+    cmd = COMMANDS[name]
+    _ensure_path()
+    sys.argv = [f'{os.path.basename(sys.argv[0])} {name}'] + list(argv)
+    if not cmd.entry:
+        runpy.run_module(cmd.module, run_name='__main__', alter_sys=True)
+        return 0
+    module = importlib.import_module(cmd.module)
+    rc = getattr(module, cmd.entry)()
+    return rc if isinstance(rc, int) else 0
+
+
+# ---- 起動時間の計測 ----
+
+class ImportProfile(NamedTuple):
+    module: str
+    total_ms: float
+    heavy: Tuple[str, ...]                 # 読み込まれた HEAVY_MODULES
+    top: Tuple[Tuple[str, float], ...]     # 直接 import したモジュールのうち重いもの (名前, ms)
+
+
+def parse_importtime(stderr: str, module: str, top: int = 5) -> Optional[ImportProfile]:
+    """python -X importtime の出力（'import time: self | cumulative | name'）を集計する"""
+    total = None
+    children: List[Tuple[str, float]] = []
+    loaded: set = set()
+    # 子は親より先に出力されるので、直前の最上位の行より後ろが module の読み込み分
+    segment: set = set()
+    direct: List[Tuple[str, float]] = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            _self, cumulative, name = line[len('import time:'):].split('|', 2)
+            us = int(cumulative)
+        except ValueError:
+            continue
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2    # 最上位は 0
+        name = name.strip()
+        if depth > 0:
+            segment.add(name)
+            if depth == 1:
+                direct.append((name, us / 1000))
+            continue
+        if name == module:
+            total, children, loaded = us / 1000, direct, segment
+        segment, direct = set(), []
+    if total is None:
+        return None
+    heavy = tuple(m for m in HEAVY_MODULES if m in loaded)
+    children.sort(key=lambda c: c[1], reverse=True)
+    return ImportProfile(module, total, heavy, tuple(children[:top]))
+
+
+def profile_import(module: str, repeat: int = 3, python: str = sys.executable) -> Optional[ImportProfile]:
+    """別プロセスで module を読み込み、その import 時間を測る（repeat 回のうち最短。初回はディスクキャッシュの影響を受ける）"""
+    import subprocess
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, TOOLS_DIR, os.environ.get('PYTHONPATH', '')]))
+    best = None
+    for _ in range(max(1, repeat)):
+        proc = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT, env=env,
+                              capture_output=True, text=True, encoding='utf-8', errors='replace')
+        if proc.returncode != 0:
+            return None
+        prof = parse_importtime(proc.stderr, module)
+        if prof is not None and (best is None or prof.total_ms < best.total_ms):
+            best = prof
+    return best
+
+
+def startup_report(names: Sequence[str], budget_ms: float = STARTUP_BUDGET_MS,
+                   repeat: int = 3) -> Tuple[List[str], int]:
+    """(表示行, 予算超過・重いライブラリを読んだコマンド数)。quick でないコマンドは参考表示のみ"""
+    lines: List[str] = []
+    failures = 0
+    for name in names:
+        cmd = COMMANDS[name]
+        prof = profile_import(cmd.module, repeat)
+        if prof is None:
+            lines.append(f'  ⚠️ {name:<12} {cmd.module}: 読み込めません（依存ライブラリ未導入）')
+            continue
+        bad = cmd.quick and (prof.total_ms > budget_ms or prof.heavy)
+        failures += bool(bad)
+        mark = '❌' if bad else ('✅' if cmd.quick else '  ')
+        heavy = f' 重い: {", ".join(prof.heavy)}' if prof.heavy else ''
+        lines.append(f'{mark} {name:<12} {prof.total_ms:7.1f}ms{heavy}')
+        if bad or not cmd.quick:
+            lines.append('      ' + ', '.join(f'{m} {ms:.0f}ms' for m, ms in prof.top))
+    return lines, failures
+
+
+def usage() -> str:
+    rows = [f'  {name:<12} {cmd.help}' for name, cmd in COMMANDS.items()]
+    return ('使い方: python ocr_cli.py <コマンド> [引数...]（引数は各スクリプトと同じ、<コマンド> -h で詳細）\n\n'
+            + '\n'.join(rows)
+            + f'\n  {"startup":<12} 各コマンドの起動時間（-X importtime）と予算の確認')
+
+
+def main(argv=None) -> int:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0
+    name, rest = argv[0], argv[1:]
+    if name == 'startup':
+        import argparse
+        ap = argparse.ArgumentParser(prog='ocr_cli.py startup', description='各コマンドの起動時間（-X importtime）')
+        ap.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS,
+                        help=f'quick コマンドの import 時間の上限（既定: {STARTUP_BUDGET_MS}ms）')
+        ap.add_argument('--all', action='store_true', help='quick 以外のコマンドも参考として測る')
+        ap.add_argument('--repeat', type=int, default=3, help='各コマンドを測る回数（最短を採用）')
+        ap.add_argument('commands', nargs='*', metavar='COMMAND', help='省略時は quick のコマンド全て')
+        args = ap.parse_args(rest)
+        unknown = [n for n in args.commands if n not in COMMANDS]
+        if unknown:
+            ap.error(f'不明なコマンド: {", ".join(unknown)}')
+        names = args.commands or [n for n, c in COMMANDS.items() if args.all or c.quick]
+        lines, failures = startup_report(names, args.budget_ms, args.repeat)
+        for line in lines:
+            print(line)
+        print(f'{"✅" if not failures else "❌"} 起動時間の予算 {args.budget_ms:g}ms: 超過 {failures}件')
+        return 1 if failures else 0
+    if name not in COMMANDS:
+        print(f'❌ 不明なコマンド: {name}\n')
+        print(usage())
+        return 2
+    return run_command(name, rest)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
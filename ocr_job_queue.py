@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite（WAL）による永続ジョブキューとワーカー
+
+各 CLI（fixed_extraction / patient_ocr_dump）は --enqueue でジョブを積むだけにし、
+実際の処理は `work` で起動したワーカーが行う。ワーカーを増やせば処理量が増え、
+途中で落ちてもリースの期限切れで別のワーカーが拾い直すため、処理が失われない。
+
+状態: pending → running（リース中）→ done / failed
+ - claim: 優先度（小さいほど先）→ 登録順に1件取り、lease 秒のリースを付ける
+ - 処理中は lease/3 ごとにリースを延長（ハートビート）
+ - 失敗は max_attempts 回まで再試行（待ち時間は回数ごとに倍）、超えたら failed
+ - Vision のクォータ不足（QuotaExhausted）は試行回数に数えず、時間をおいて pending に戻す
+
+使い方:
+    python fixed_extraction.py --enqueue ocr_jobs.db          # 受信箱の画像を kind=final で登録
+    python patient_ocr_dump.py --pid all --enqueue ocr_jobs.db # 患者ごとに kind=ocr_dump で登録
+    python ocr_job_queue.py work --db ocr_jobs.db --workers 4
+    python ocr_job_queue.py status --db ocr_jobs.db
+    python ocr_job_queue.py retry --db ocr_jobs.db             # failed を pending に戻す
+    python ocr_job_queue.py export --db ocr_jobs.db --kind final out.csv
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+DEFAULT_DB = 'ocr_jobs.db'
+LEASE_SECONDS = 300.0
+MAX_ATTEMPTS = 3
+RETRY_BASE_SECONDS = 30.0
+QUOTA_DEFER_SECONDS = 600.0
+STATES = ('pending', 'running', 'done', 'failed')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id           INTEGER PRIMARY KEY,
+    kind         TEXT NOT NULL,
+    key          TEXT NOT NULL,
+    payload      TEXT NOT NULL DEFAULT '{}',
+    priority     INTEGER NOT NULL DEFAULT 1,
+    state        TEXT NOT NULL DEFAULT 'pending',
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    not_before   REAL NOT NULL DEFAULT 0,
+    lease_until  REAL,
+    worker       TEXT,
+    result       TEXT,
+    error        TEXT,
+    created      REAL NOT NULL,
+    updated      REAL NOT NULL,
+    UNIQUE (kind, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, priority, not_before, id);
+CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (state, lease_until);
+'''
+
+
+class Job(NamedTuple):
+    id: int
+    kind: str
+    key: str                    # 画像パスや患者ID（kind 内で一意）
+    payload: Dict[str, Any]
+    attempts: int
+    worker: str
+
+
+class JobQueue:
+    """SQLite のジョブテーブル（接続はスレッド/プロセスごとに作る）"""
+
+    def __init__(self, path: str = DEFAULT_DB, timeout: float = 30.0):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(f'PRAGMA busy_timeout={int(timeout * 1000)}')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _tx(self):
+        return _Immediate(self.conn)
+
+    # ---- 登録 ----
+
+    def enqueue(self, kind: str, keys: Sequence[str], payload: Optional[Dict[str, Any]] = None,
+                priority: int = 1, max_attempts: int = MAX_ATTEMPTS, force: bool = False) -> int:
+        """ジョブを登録し、新規（または force で再実行）になった件数を返す
+
+        同じ (kind, key) が pending/running なら何もしない。done/failed は force=True のときだけ pending に戻す。
+        """
+        now = time.time()
+        body = json.dumps(payload or {}, ensure_ascii=False)
+        added = 0
+        with self._tx():
+            for key in keys:
+                cur = self.conn.execute(
+                    'INSERT INTO jobs (kind, key, payload, priority, max_attempts, created, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (kind, key) DO UPDATE SET '
+                    "payload = excluded.payload, priority = excluded.priority, state = 'pending', attempts = 0, "
+                    'max_attempts = excluded.max_attempts, not_before = 0, worker = NULL, lease_until = NULL, '
+                    "error = NULL, updated = excluded.updated WHERE ? AND jobs.state IN ('done', 'failed')",
+                    (kind, str(key), body, priority, max_attempts, now, now, 1 if force else 0))
+                added += cur.rowcount
+        return added
+
+    # ---- 取得・完了 ----
+
+    def _expire_leases(self, now: float):
+        self.conn.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END, "
+            "worker = NULL, lease_until = NULL, error = 'lease expired', updated = ? "
+            "WHERE state = 'running' AND lease_until < ?", (now, now))
+
+    def claim(self, worker: str, kinds: Optional[Sequence[str]] = None, lease: float = LEASE_SECONDS) -> Optional[Job]:
+        """実行可能なジョブを1件取ってリースを付ける（無ければ None）"""
+        now = time.time()
+        where = "state = 'pending' AND not_before <= ?"
+        params: List[Any] = [now]
+        if kinds:
+            where += f' AND kind IN ({",".join("?" * len(kinds))})'
+            params.extend(kinds)
+        with self._tx():
+            self._expire_leases(now)
+            row = self.conn.execute(f'SELECT id FROM jobs WHERE {where} ORDER BY priority, id LIMIT 1',
+                                    params).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, "
+                'updated = ? WHERE id = ?', (worker, now + lease, now, row['id']))
+            job = self.conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+        return Job(job['id'], job['kind'], job['key'], json.loads(job['payload']), job['attempts'], worker)
+
+    def heartbeat(self, job: Job, lease: float = LEASE_SECONDS) -> bool:
+        """リースを延長（既に他のワーカーに移っていれば False）"""
+        now = time.time()
+        cur = self.conn.execute(
+            "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (now + lease, now, job.id, job.worker))
+        return cur.rowcount == 1
+
+    def complete(self, job: Job, result: Optional[Dict[str, Any]] = None) -> bool:
+        now = time.time()
+        cur = self.conn.execute(
+            "UPDATE jobs SET state = 'done', result = ?, error = NULL, worker = NULL, lease_until = NULL, "
+            "updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (json.dumps(result or {}, ensure_ascii=False), now, job.id, job.worker))
+        return cur.rowcount == 1
+
+    def fail(self, job: Job, error: str) -> str:
+        """失敗を記録。再試行できれば pending（待ち時間つき）、できなければ failed。新しい状態を返す"""
+        now = time.time()
+        with self._tx():
+            row = self.conn.execute('SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker = ? '
+                                    "AND state = 'running'", (job.id, job.worker)).fetchone()
+            if row is None:
+                return ''
+            state = 'failed' if row['attempts'] >= row['max_attempts'] else 'pending'
+            delay = RETRY_BASE_SECONDS * (2 ** (row['attempts'] - 1))
+            self.conn.execute(
+                'UPDATE jobs SET state = ?, error = ?, worker = NULL, lease_until = NULL, not_before = ?, '
+                'updated = ? WHERE id = ?', (state, error[:2000], now + delay, now, job.id))
+        return state
+
+    def defer(self, job: Job, delay: float, reason: str = '') -> bool:
+        """試行回数に数えずに pending へ戻す（クォータ不足など）"""
+        now = time.time()
+        cur = self.conn.execute(
+            "UPDATE jobs SET state = 'pending', attempts = attempts - 1, error = ?, worker = NULL, "
+            "lease_until = NULL, not_before = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (reason[:2000], now + delay, now, job.id, job.worker))
+        return cur.rowcount == 1
+
+    def retry_failed(self, kind: Optional[str] = None) -> int:
+        now = time.time()
+        sql = "UPDATE jobs SET state = 'pending', attempts = 0, not_before = 0, updated = ? WHERE state = 'failed'"
+        params: List[Any] = [now]
+        if kind:
+            sql += ' AND kind = ?'
+            params.append(kind)
+        return self.conn.execute(sql, params).rowcount
+
+    # ---- 集計 ----
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        out: Dict[str, Dict[str, int]] = {}
+        for row in self.conn.execute('SELECT kind, state, COUNT(*) AS n FROM jobs GROUP BY kind, state'):
+            out.setdefault(row['kind'], {s: 0 for s in STATES})[row['state']] = row['n']
+        return out
+
+    def summary_lines(self, window: float = 600.0) -> List[str]:
+        lines = []
+        since = time.time() - window
+        for kind, c in sorted(self.counts().items()):
+            total = sum(c.values())
+            recent = self.conn.execute("SELECT COUNT(*) FROM jobs WHERE kind = ? AND state = 'done' AND updated >= ?",
+                                       (kind, since)).fetchone()[0]
+            lines.append(f'📋 {kind}: 待ち {c["pending"]} / 実行中 {c["running"]} / 完了 {c["done"]} / '
+                         f'失敗 {c["failed"]}（全{total}件、直近{window / 60:.0f}分 {recent * 60 / window:.1f}件/分）')
+        return lines
+
+    def results(self, kind: str) -> List[Dict[str, Any]]:
+        rows = self.conn.execute("SELECT key, result FROM jobs WHERE kind = ? AND state = 'done' ORDER BY id", (kind,))
+        return [dict(json.loads(r['result'] or '{}'), _key=r['key']) for r in rows]
+
+    def failures(self, kind: Optional[str] = None, limit: int = 20) -> List[sqlite3.Row]:
+        sql = "SELECT kind, key, attempts, error FROM jobs WHERE state = 'failed'"
+        params: List[Any] = []
+        if kind:
+            sql += ' AND kind = ?'
+            params.append(kind)
+        return self.conn.execute(sql + ' ORDER BY updated DESC LIMIT ?', params + [limit]).fetchall()
+
+
+class _Immediate:
+    """BEGIN IMMEDIATE … COMMIT（書き込みロックを先に取り、ワーカー間の取り合いを防ぐ）"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
+
+
+# ---- ジョブの処理内容（kind → handler） ----
+
+HANDLERS: Dict[str, Callable[[Job], Dict[str, Any]]] = {}
+_CONTEXT: Dict[str, Any] = {}   # プロセス内で使い回すもの（Vision クライアントなど）
+
+
+def _shared(name: str, options: Any, factory: Callable[[], Any]) -> Any:
+    """ジョブの options ごとに1つ作って使い回す（別の options のジョブには別のものを作る）"""
+    cache = _CONTEXT.setdefault(name, {})
+    key = json.dumps(options, sort_keys=True, ensure_ascii=False)
+    if key not in cache:
+        cache[key] = factory()
+    return cache[key]
+
+
+def handler(kind: str):
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+@handler('final')
+def _handle_final(job: Job) -> Dict[str, Any]:
+    """fixed_extraction: 1画像を Vision でOCRし、最終包括的処理の結果を返す"""
+    import fixed_extraction as fe
+    opts = job.payload
+    if _CONTEXT.get('vision') is None:
+        _CONTEXT['vision'] = fe.create_vision_client()
+    client = _CONTEXT['vision']
+    if client is None:
+        raise RuntimeError('Vision APIクライアントの作成に失敗しました')
+    upload_prep = None
+    if opts.get('upload_prep'):
+        from upload_prep import UploadPrep
+        dpi = opts.get('target_dpi', 200)
+        upload_prep = _shared('upload_prep', dpi, lambda: UploadPrep(target_dpi=dpi))
+    quota = None
+    if opts.get('quota'):
+        from vision_quota import VisionQuota
+        quota = _shared('quota', opts['quota'], lambda: VisionQuota(**opts['quota']))
+    # 通信・API のエラーは例外のまま fail() に渡し、待ち時間をおいて再試行させる
+    text = fe.google_vision_ocr(job.key, client, upload_prep, quota, opts.get('priority', 1), raise_errors=True)
+    filename = os.path.basename(job.key)
+    if not text:   # API は応答したが文字が無い（白紙など）。再試行しても変わらない
+        return {'filename': filename, 'status': 'OCR_FAILED'}
+    data = fe.process_image_final_comprehensive(text, filename, route_by_kbn=opts.get('route_by_kbn', True))
+    data.filename = filename
+    data.status = 'SUCCESS'
+    data.set_ocr_text(text)
+    return data.as_dict()
+
+
+@handler('ocr_dump')
+def _handle_ocr_dump(job: Job) -> Dict[str, Any]:
+    """patient_ocr_dump: 1患者分の Markdown / IOL CSV を作成"""
+    import patient_ocr_dump as pod
+    from thumb_classifier import gate_from_args
+    opts = job.payload
+    gate = gate_from_args(SimpleNamespace(ocr_gate=opts.get('ocr_gate', False),
+                                          ocr_gate_model=opts.get('ocr_gate_model')))
+    dedup = None
+    if opts.get('dedup'):
+        from near_dup import NearDupIndex
+        # ワーカーは複数プロセスで動くので、追記先はプロセスごとの shard にする
+        dedup = NearDupIndex(os.path.join(pod.OUTPUT_ROOT, 'near_dup_index.jsonl'),
+                             scope=opts.get('dedup_scope', 'visit'), shard=f'queue-{os.getpid()}')
+    search = None
+    if opts.get('search'):
+        from ocr_search import SearchIndex
+        search = SearchIndex(opts['search'])
+    try:
+        md_path, iol_count = pod.process_patient(job.key, gate, dedup, search, incremental=not opts.get('full'))
+    finally:
+        if search is not None:
+            search.close()
+    if not md_path:
+        raise FileNotFoundError(f'患者フォルダがありません: {os.path.join(pod.IMAGE_ROOT, job.key)}')
+    return {'pid': job.key, 'md_path': md_path, 'iol_count': iol_count}
+
+
+# ---- ワーカー ----
+
+def worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def run_worker(db: str, kinds: Optional[Sequence[str]] = None, lease: float = LEASE_SECONDS,
+               poll: float = 2.0, max_jobs: Optional[int] = None, exit_when_empty: bool = False) -> int:
+    """ジョブを取って処理し続ける。処理した件数を返す"""
+    from vision_quota import QuotaExhausted
+    from ocr_trace import TRACE
+    queue = JobQueue(db)
+    me = worker_id()
+    processed = 0
+    try:
+        while max_jobs is None or processed < max_jobs:
+            job = queue.claim(me, kinds, lease)
+            if job is None:
+                if exit_when_empty:
+                    break
+                time.sleep(poll)
+                continue
+            fn = HANDLERS.get(job.kind)
+            if fn is None:
+                queue.fail(job, f'unknown kind: {job.kind}')
+                continue
+            stop = threading.Event()
+            beat = threading.Thread(target=_heartbeat, args=(db, job, lease, stop), daemon=True)
+            beat.start()
+            TRACE.begin(job.key)        # 抽出器のトレースは失敗したジョブの分だけ書き出す
+            try:
+                result = fn(job)
+            except QuotaExhausted as e:
+                TRACE.end(failed=False)
+                queue.defer(job, QUOTA_DEFER_SECONDS, f'quota: {e}')
+                print(f'⏸ [{me}] {job.kind} {job.key}: クォータ不足のため保留')
+            except Exception as e:
+                TRACE.end(failed=True)
+                state = queue.fail(job, f'{e.__class__.__name__}: {e}')
+                print(f'❌ [{me}] {job.kind} {job.key}: {e} → {state}')
+            else:
+                TRACE.end(failed=False)
+                queue.complete(job, result)
+                print(f'✅ [{me}] {job.kind} {job.key}')
+            finally:
+                stop.set()
+                beat.join()
+            processed += 1
+    finally:
+        for quota in _CONTEXT.get('quota', {}).values():
+            quota.flush()
+        queue.close()
+    return processed
+
+
+def _heartbeat(db: str, job: Job, lease: float, stop: threading.Event):
+    queue = JobQueue(db)
+    try:
+        while not stop.wait(lease / 3.0):
+            if not queue.heartbeat(job, lease):
+                return   # リースを失った（期限切れで他のワーカーが取得）
+    finally:
+        queue.close()
+
+
+def run_workers(n: int, db: str, **kwargs) -> int:
+    """n 個のワーカープロセスを起動して終了を待つ（異常終了したプロセス数を返す）"""
+    if n <= 1:
+        run_worker(db, **kwargs)
+        return 0
+    procs = [multiprocessing.Process(target=run_worker, args=(db,), kwargs=kwargs) for _ in range(n)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    return sum(1 for p in procs if p.exitcode != 0)
+
+
+def add_enqueue_argument(ap):
+    """argparse に --enqueue を追加する（指定時は処理せずジョブ登録のみ）"""
+    ap.add_argument('--enqueue', metavar='DB', default=None,
+                    help=f'処理せずジョブキュー（SQLite）に登録する（例: {DEFAULT_DB}）。処理は ocr_job_queue.py work')
+    ap.add_argument('--force', action='store_true', help='--enqueue で完了/失敗済みのジョブも再実行する')
+
+
+# ---- CLI ----
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description='OCRジョブキュー（SQLite WAL）')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+
+    p = sub.add_parser('work', help='ワーカーを起動')
+    p.add_argument('--db', default=DEFAULT_DB)
+    p.add_argument('--workers', type=int, default=1, help='ワーカープロセス数')
+    p.add_argument('--kind', action='append', choices=sorted(HANDLERS), help='処理する種類（既定: すべて）')
+    p.add_argument('--lease', type=float, default=LEASE_SECONDS, help='リース秒数（処理中は自動延長）')
+    p.add_argument('--poll', type=float, default=2.0)
+    p.add_argument('--max-jobs', type=int, default=None, help='1ワーカーあたりの処理件数上限')
+    p.add_argument('--exit-when-empty', action='store_true', help='待ちが無くなったら終了')
+
+    p = sub.add_parser('status', help='状態別の件数')
+    p.add_argument('--db', default=DEFAULT_DB)
+    p.add_argument('--failures', type=int, default=10, help='表示する失敗ジョブ数')
+
+    p = sub.add_parser('retry', help='failed を pending に戻す')
+    p.add_argument('--db', default=DEFAULT_DB)
+    p.add_argument('--kind', default=None)
+
+    p = sub.add_parser('export', help='完了ジョブの結果をCSVに出力')
+    p.add_argument('out')
+    p.add_argument('--db', default=DEFAULT_DB)
+    p.add_argument('--kind', default='final')
+
+    args = ap.parse_args(argv)
+    if args.cmd == 'work':
+        run_workers(args.workers, args.db, kinds=args.kind, lease=args.lease, poll=args.poll,
+                    max_jobs=args.max_jobs, exit_when_empty=args.exit_when_empty)
+        queue = JobQueue(args.db)
+        for line in queue.summary_lines():
+            print(line)
+        return 0
+
+    queue = JobQueue(args.db)
+    if args.cmd == 'status':
+        lines = queue.summary_lines()
+        print('\n'.join(lines) if lines else '📋 ジョブはありません')
+        for row in queue.failures(limit=args.failures):
+            print(f'  ✗ {row["kind"]} {row["key"]} ({row["attempts"]}回): {row["error"]}')
+    elif args.cmd == 'retry':
+        print(f'🔁 pending に戻しました: {queue.retry_failed(args.kind)}件')
+    elif args.cmd == 'export':
+        rows = queue.results(args.kind)
+        cols: List[str] = []
+        for r in rows:
+            cols.extend(k for k in r if k not in cols)
+        with open(args.out, 'w', newline='', encoding='utf-8') as f:
+            w = csv.DictWriter(f, fieldnames=cols)
+            w.writeheader()
+            w.writerows(rows)
+        print(f'✅ {args.out} に保存しました ({len(rows)}件)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
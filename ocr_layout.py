@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+位置情報つきOCR結果（ページ → ブロック → 行 → 単語、枠と信頼度つき）
+
+texts[0].description だけを残すと位置が失われ、抽出器が行順から位置を推測することになる。
+OcrLayout は単語ごとの枠・信頼度・所属（page/block/line）を NumPy 配列で保持し、
+「Avg ラベルの右にある数値」のような位置による問い合わせを直接行えるようにする。
+
+作成:
+    layout = from_vision_document(client.document_text_detection(image=image))
+    layout = from_tesseract(pil_image, lang='jpn+eng')     # pytesseract.image_to_data
+
+問い合わせ:
+    layout.numbers_right_of(r'^(Avg|AVG|Aug)$', r'^\\d{1,2}\\.\\d$')   # → ['15.0', '16.3']
+    layout.text                                               # 行ごとに連結したテキスト
+
+保存: layout.save('x.npz') / OcrLayout.load('x.npz')（pickle を使わない .npz）
+"""
+
+import re
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Vision の DetectedBreak.BreakType（この後で改行とみなすもの）
+_VISION_LINE_BREAKS = {3, 4, 5}   # EOL_SURE_SPACE / HYPHEN / LINE_BREAK
+
+
+class OcrLayout:
+    """単語単位の配列で保持するOCR結果（行・ブロック・ページは単語の所属番号で表す）"""
+
+    def __init__(self, words: Sequence[str], boxes, conf, line, block, page, page_sizes=None):
+        self.words: List[str] = list(words)
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)   # x0, y0, x1, y1
+        self.conf = np.asarray(conf, dtype=np.float32)                  # 0〜1（不明は -1）
+        self.line = np.asarray(line, dtype=np.int32)                    # ページを通した通し番号
+        self.block = np.asarray(block, dtype=np.int32)
+        self.page = np.asarray(page, dtype=np.int32)
+        self.page_sizes = np.asarray(page_sizes if page_sizes is not None else np.zeros((0, 2)),
+                                     dtype=np.int32).reshape(-1, 2)     # (width, height)
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    @classmethod
+    def empty(cls) -> 'OcrLayout':
+        return cls([], np.zeros((0, 4)), [], [], [], [])
+
+    # ---- テキスト ----
+
+    def line_ids(self) -> List[int]:
+        return sorted(set(self.line.tolist()))
+
+    def line_words(self, line_id: int) -> np.ndarray:
+        """その行の単語インデックス（左から順）"""
+        idx = np.flatnonzero(self.line == line_id)
+        return idx[np.argsort(self.boxes[idx, 0], kind='stable')]
+
+    def line_text(self, line_id: int) -> str:
+        return ' '.join(self.words[i] for i in self.line_words(line_id))
+
+    @property
+    def text(self) -> str:
+        return '\n'.join(self.line_text(i) for i in self.line_ids())
+
+    # ---- 位置による問い合わせ ----
+
+    def find(self, pattern: str, flags: int = 0) -> np.ndarray:
+        """正規表現に一致する単語のインデックス（上から順）"""
+        rx = re.compile(pattern, flags)
+        idx = np.array([i for i, w in enumerate(self.words) if rx.search(w)], dtype=np.int64)
+        if not len(idx):
+            return idx
+        return idx[np.lexsort((self.boxes[idx, 0], self.boxes[idx, 1], self.page[idx]))]
+
+    def right_of(self, index: int, pattern: Optional[str] = None, band: float = 0.6) -> np.ndarray:
+        """単語 index と同じ高さ帯（高さ×band 以内）で右側にある単語（左から順）"""
+        b = self.boxes
+        x0, y0, x1, y1 = b[index]
+        cy = (y0 + y1) / 2.0
+        tol = max(1.0, (y1 - y0) * band)
+        centers = (b[:, 1] + b[:, 3]) / 2.0
+        mask = (self.page == self.page[index]) & (b[:, 0] >= x1 - 2) & (np.abs(centers - cy) <= tol)
+        mask[index] = False
+        idx = np.flatnonzero(mask)
+        idx = idx[np.argsort(b[idx, 0], kind='stable')]
+        if pattern is not None:
+            rx = re.compile(pattern)
+            idx = np.array([i for i in idx if rx.search(self.words[i])], dtype=np.int64)
+        return idx
+
+    def below(self, index: int, pattern: Optional[str] = None, max_lines: float = 3.0) -> np.ndarray:
+        """単語 index の下（横方向に重なり、高さ×max_lines 以内）にある単語（上から順）"""
+        b = self.boxes
+        x0, y0, x1, y1 = b[index]
+        h = max(1, y1 - y0)
+        mask = ((self.page == self.page[index]) & (b[:, 1] >= y1 - 2) & (b[:, 1] <= y1 + h * max_lines)
+                & (b[:, 0] < x1) & (b[:, 2] > x0))
+        mask[index] = False
+        idx = np.flatnonzero(mask)
+        idx = idx[np.argsort(b[idx, 1], kind='stable')]
+        if pattern is not None:
+            rx = re.compile(pattern)
+            idx = np.array([i for i in idx if rx.search(self.words[i])], dtype=np.int64)
+        return idx
+
+    def numbers_right_of(self, label_pattern: str, number_pattern: str = r'^[+\-]?\d+(?:\.\d+)?$',
+                         flags: int = 0) -> List[str]:
+        """最初に見つかったラベルの右側にある、number_pattern に一致する単語"""
+        for label in self.find(label_pattern, flags):
+            found = self.right_of(int(label), number_pattern)
+            if len(found):
+                return [self.words[i] for i in found]
+        return []
+
+    # ---- 保存 ----
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            'words': np.array(self.words, dtype=np.str_),
+            'boxes': self.boxes, 'conf': self.conf, 'line': self.line,
+            'block': self.block, 'page': self.page, 'page_sizes': self.page_sizes,
+        }
+
+    def save(self, path: str):
+        np.savez_compressed(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path: str) -> 'OcrLayout':
+        with np.load(path, allow_pickle=False) as z:
+            return cls(z['words'].tolist(), z['boxes'], z['conf'], z['line'], z['block'], z['page'],
+                       z['page_sizes'])
+
+    def to_dict(self) -> Dict:
+        return {k: v.tolist() for k, v in self.to_arrays().items()}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'OcrLayout':
+        return cls(data['words'], data['boxes'], data['conf'], data['line'], data['block'], data['page'],
+                   data.get('page_sizes'))
+
+
+class _Builder:
+    def __init__(self):
+        self.words: List[str] = []
+        self.boxes: List[List[int]] = []
+        self.conf: List[float] = []
+        self.line: List[int] = []
+        self.block: List[int] = []
+        self.page: List[int] = []
+        self.page_sizes: List[List[int]] = []
+
+    def add(self, word: str, box: Sequence[int], conf: float, line: int, block: int, page: int):
+        self.words.append(word)
+        self.boxes.append(list(box))
+        self.conf.append(conf)
+        self.line.append(line)
+        self.block.append(block)
+        self.page.append(page)
+
+    def build(self) -> OcrLayout:
+        if not self.words:
+            layout = OcrLayout.empty()
+            layout.page_sizes = np.asarray(self.page_sizes, dtype=np.int32).reshape(-1, 2)
+            return layout
+        return OcrLayout(self.words, self.boxes, self.conf, self.line, self.block, self.page, self.page_sizes)
+
+
+def _vertices_box(vertices) -> List[int]:
+    xs = [getattr(v, 'x', 0) or 0 for v in vertices]
+    ys = [getattr(v, 'y', 0) or 0 for v in vertices]
+    return [min(xs), min(ys), max(xs), max(ys)] if xs else [0, 0, 0, 0]
+
+
+def from_vision_document(response) -> OcrLayout:
+    """document_text_detection の full_text_annotation から作成（行は DetectedBreak で区切る）"""
+    out = _Builder()
+    annotation = getattr(response, 'full_text_annotation', None)
+    if annotation is None:
+        return out.build()
+    line_id = block_id = 0
+    for page_no, page in enumerate(annotation.pages):
+        out.page_sizes.append([page.width, page.height])
+        for block in page.blocks:
+            for paragraph in block.paragraphs:
+                pending = False   # 現在の行に単語があるか
+                for word in paragraph.words:
+                    text = ''.join(s.text for s in word.symbols)
+                    if not text:
+                        continue
+                    out.add(text, _vertices_box(word.bounding_box.vertices), float(word.confidence),
+                            line_id, block_id, page_no)
+                    pending = True
+                    brk = word.symbols[-1].property.detected_break.type_ if word.symbols else 0
+                    if int(brk) in _VISION_LINE_BREAKS:
+                        line_id += 1
+                        pending = False
+                if pending:
+                    line_id += 1
+            block_id += 1
+    return out.build()
+
+
+def from_tesseract_data(data: Dict[str, List]) -> OcrLayout:
+    """pytesseract.image_to_data(..., output_type=Output.DICT) の結果から作成"""
+    out = _Builder()
+    line_ids: Dict[tuple, int] = {}
+    block_ids: Dict[tuple, int] = {}
+    pages: Dict[int, List[int]] = {}
+    for i, level in enumerate(data.get('level', [])):
+        page_no = int(data['page_num'][i]) - 1
+        if int(level) == 1:
+            pages[page_no] = [int(data['width'][i]), int(data['height'][i])]
+        text = str(data['text'][i] or '').strip()
+        if int(level) != 5 or not text:
+            continue
+        bkey = (page_no, int(data['block_num'][i]))
+        lkey = bkey + (int(data['par_num'][i]), int(data['line_num'][i]))
+        block = block_ids.setdefault(bkey, len(block_ids))
+        line = line_ids.setdefault(lkey, len(line_ids))
+        x, y = int(data['left'][i]), int(data['top'][i])
+        w, h = int(data['width'][i]), int(data['height'][i])
+        conf = float(data['conf'][i])
+        out.add(text, (x, y, x + w, y + h), conf / 100.0 if conf >= 0 else -1.0, line, block, page_no)
+    out.page_sizes = [pages[k] for k in sorted(pages)]
+    return out.build()
+
+
+def from_tesseract(image, lang: Optional[str] = None, config: str = '--psm 6') -> OcrLayout:
+    """Tesseract で単語枠つきOCR"""
+    import pytesseract
+    data = pytesseract.image_to_data(image, lang=lang, config=config, output_type=pytesseract.Output.DICT)
+    return from_tesseract_data(data)
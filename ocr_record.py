@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+最終包括処理（fixed_extraction.process_all_images_final_comprehensive）の1画像分の結果
+
+これまでは同じ約40キーの dict を画像ごとに3回作っていた（OCR_FAILED の空 dict、
+process_image_final_comprehensive の結果、それを写した result）。40キーの dict は
+1個あたり約1.2KBあり、5万枚分の結果を溜めると入れ物だけで数十MBになる。
+
+ - FinalRecord: __slots__ の固定項目（属性名は従来のキーそのまま）。抽出器の値はここに直接入れる
+ - 従来の dict と同じ書き方（r['右裸眼'] / r.get() / update() / dict(r)）で読める
+ - 表に無い項目（OCT_網膜厚_右 など検査種類別の数値）だけ extra の dict に入る
+ - write_final_csv: レコードから直接 CSV の行を作る（DictWriter を通さない）
+
+使い方:
+    rec = FinalRecord(filename)
+    rec.fill(vision, ('右裸眼', '右矯正'))
+    write_final_csv('final.csv', records)
+    python ocr_record.py bench --n 50000      # dict との比較
+"""
+
+import csv
+from operator import attrgetter
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+# 抽出項目（process_image_final_comprehensive が返す順）
+RESULT_FIELDS: Tuple[str, ...] = (
+    '右裸眼', '右矯正', '左裸眼', '左矯正', '右TOL', '左TOL',
+    'NCT右', 'NCT左', '手書き右', '手書き左', '最終眼圧右', '最終眼圧左', '眼圧備考', '使用データ',
+    'S', 'C', 'Ax',
+    '手術日', '患者名', '術前診断', '術式', '対象眼',
+    'IOL度数_S', 'IOL度数_C', 'IOL度数_Ax', 'IOL製品名', 'IOLメーカー', 'IOL備考',
+    '検査種類', '検査詳細', '検査日', '検査対象眼', '検査備考',
+)
+FIELDS: Tuple[str, ...] = ('filename', 'status') + RESULT_FIELDS + ('ocr_text',)
+_FIELD_SET = frozenset(FIELDS)
+
+# final_vision_extraction_*.csv の列順
+CSV_FIELDS: Tuple[str, ...] = (
+    'filename', 'status', '右裸眼', '右矯正', '左裸眼', '左矯正', '右TOL', '左TOL',
+    'NCT右', 'NCT左', '手書き右', '手書き左', '最終眼圧右', '最終眼圧左',
+    '眼圧備考', '使用データ', 'S', 'C', 'Ax', '手術日', '患者名', '術前診断', '対象眼', '術式',
+    'IOL度数_S', 'IOL度数_C', 'IOL度数_Ax', 'IOL製品名', 'IOLメーカー', 'IOL備考',
+    '検査種類', '検査詳細', '検査日', '検査対象眼', '検査備考', 'ocr_text',
+)
+OCR_TEXT_PREVIEW = 200
+
+
+class FinalRecord:
+    """1画像分の抽出結果。項目は属性（__slots__）で持ち、dict と同じ添字アクセスもできる"""
+
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, filename: str = '', status: str = ''):
+        self.filename = filename
+        self.status = status
+        self.extra: Optional[Dict[str, Any]] = None
+
+    def __getattr__(self, name: str):
+        # まだ値を入れていない項目は空文字（40項目を毎回 '' で埋めない）
+        if name in _FIELD_SET:
+            return ''
+        raise AttributeError(name)
+
+    # ---- dict 互換（既存の呼び出し側・JSON 化用） ----
+
+    def __getitem__(self, key: str):
+        if key in _FIELD_SET:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key) -> bool:
+        return key in _FIELD_SET or (self.extra is not None and key in self.extra)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> List[str]:
+        return list(FIELDS) + (list(self.extra) if self.extra else [])
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        for key in self.keys():
+            yield key, self[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def update(self, other: Mapping[str, Any] = (), **kwargs):
+        for key, value in (other.items() if hasattr(other, 'items') else other):
+            self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        filled = {k: v for k, v in self.items() if v}
+        return f'FinalRecord({filled!r})'
+
+    # ---- 抽出器の結果の取り込み ----
+
+    def fill(self, source: Mapping[str, Any], names: Iterable[str], renames: Optional[Mapping[str, str]] = None):
+        """source の names を同名の項目へ（renames で {source側: 自分側} の読み替え）"""
+        for name in names:
+            setattr(self, renames.get(name, name) if renames else name, source[name])
+
+    def set_ocr_text(self, text: str, limit: int = OCR_TEXT_PREVIEW):
+        self.ocr_text = text[:limit] + '...' if len(text) > limit else text
+
+    def row(self, fields: Sequence[str] = CSV_FIELDS) -> Sequence[Any]:
+        if fields is CSV_FIELDS:
+            return _CSV_ROW(self)
+        return [getattr(self, f) if f in _FIELD_SET else (self.extra or {}).get(f, '') for f in fields]
+
+
+_CSV_ROW = attrgetter(*CSV_FIELDS)
+
+
+def write_final_csv(path: str, records: Iterable[FinalRecord], fields: Sequence[str] = CSV_FIELDS,
+                    encoding: str = 'utf-8') -> int:
+    """レコードを CSV に書き、件数を返す"""
+    n = 0
+    with open(path, 'w', newline='', encoding=encoding) as f:
+        w = csv.writer(f)
+        w.writerow(fields)
+        for rec in records:
+            w.writerow(rec.row(fields))
+            n += 1
+    return n
+
+
+# ---- dict との比較 ----
+
+def _bench(n: int) -> List[str]:
+    """従来の dict 3個 / 画像 と FinalRecord 1個 / 画像 で、n 件分の結果を作って書き出す"""
+    import io
+    import time
+    import tracemalloc
+
+    sample = {f: f'{i % 7}' if i % 3 else '' for i, f in enumerate(RESULT_FIELDS)}
+    text = 'あいうえお' * 60
+
+    def legacy():
+        results = []
+        for i in range(n):
+            data = {f: '' for f in RESULT_FIELDS}                 # process_image_final_comprehensive の初期値
+            for f in RESULT_FIELDS:
+                data[f] = sample[f]
+            result = {'filename': f'{i}.jpg', 'status': 'SUCCESS'}   # 結果の写し
+            for f in RESULT_FIELDS:
+                result[f] = data[f]
+            result['ocr_text'] = text[:200] + '...'
+            results.append(result)
+        buf = io.StringIO()
+        w = csv.DictWriter(buf, fieldnames=CSV_FIELDS)
+        w.writeheader()
+        w.writerows(results)
+        return results
+
+    def record():
+        results = []
+        for i in range(n):
+            rec = FinalRecord(f'{i}.jpg', 'SUCCESS')
+            rec.fill(sample, RESULT_FIELDS)
+            rec.set_ocr_text(text)
+            results.append(rec)
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(CSV_FIELDS)
+        for rec in results:
+            w.writerow(rec.row())
+        return results
+
+    lines = []
+    for name, fn in (('dict', legacy), ('FinalRecord', record)):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        results = fn()
+        elapsed = time.perf_counter() - t0
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del results
+        lines.append(f'{name:<12} {n}件: {elapsed:.2f}s ({n / elapsed:,.0f}件/s), '
+                     f'保持 {current / 2**20:.1f}MB, ピーク {peak / 2**20:.1f}MB')
+    return lines
+
+
+if __name__ == '__main__':
+    import argparse
+
+    ap = argparse.ArgumentParser(description='最終包括処理の結果レコード')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    b = sub.add_parser('bench', help='dict と FinalRecord のメモリ・速度比較')
+    b.add_argument('--n', type=int, default=50000)
+    args = ap.parse_args()
+    for line in _bench(args.n):
+        print(line)
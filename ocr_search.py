@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OCRテキストの全文検索索引（SQLite FTS5 + trigram トークナイザ）
+
+「ERM や 黄斑前膜 が書かれたカルテのある患者」を探すのに、患者ごとの ocr_text_<PID>.md を
+grep していたのを、画像単位の索引で置き換える。trigram は分かち書きの要らない3文字単位の索引で、
+漢字・かなの部分一致にそのまま使える。
+
+ - docs: 画像ごとの pid / kbn / cdate / テキスト（ファイル名の &pidnum= &kbn= &cdate= から）
+ - ocr_fts: docs.text の FTS5 索引（external content、トリガーで同期）
+ - 同じ画像を再登録してもテキストが同じなら何もしない（OCRのたびに add() してよい）
+ - 2文字以下の語（「黄斑」など）は trigram で引けないため、docs.text の LIKE で絞り込む
+
+使い方:
+    index = SearchIndex()                       # 既定: このファイルと同じフォルダの ocr_search.db
+    index.add(path, text)                       # OCRのたびに（patient_ocr_dump --search で自動）
+    for hit in index.search('ERM OR 黄斑前膜', kbn='krt2'):
+        print(hit.pid, hit.cdate, hit.snippet)
+
+    python ocr_search.py build                  # 既存の ocr_text_<PID>.md から作成
+    python ocr_search.py query "ERM OR 黄斑前膜" [--pid 26147] [--kbn krt2] [--from 20180101] [--patients]
+    python ocr_search.py stats
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+import hashlib
+import argparse
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from filename_params import cdate_from_path, kbn_from_path, pid_from_path
+from tree_walker import list_subdirs
+
+DEFAULT_DB = Path(__file__).resolve().parent / 'ocr_search.db'   # OneDrive 上に置かない（WAL のため）
+SNIPPET_TOKENS = 12
+HIGHLIGHT = ('【', '】')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    id      INTEGER PRIMARY KEY,
+    file    TEXT NOT NULL UNIQUE,
+    pid     TEXT NOT NULL DEFAULT '',
+    kbn     TEXT NOT NULL DEFAULT '',
+    cdate   TEXT NOT NULL DEFAULT '',
+    sha1    TEXT NOT NULL,
+    text    TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_pid ON docs (pid, cdate);
+CREATE INDEX IF NOT EXISTS docs_kbn ON docs (kbn, cdate);
+CREATE VIRTUAL TABLE IF NOT EXISTS ocr_fts USING fts5 (text, content='docs', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+    INSERT INTO ocr_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+    INSERT INTO ocr_fts (ocr_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS docs_au AFTER UPDATE OF text ON docs BEGIN
+    INSERT INTO ocr_fts (ocr_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    INSERT INTO ocr_fts (rowid, text) VALUES (new.id, new.text);
+END;
+'''
+
+
+class SearchHit(NamedTuple):
+    file: str
+    pid: str
+    kbn: str
+    cdate: str
+    snippet: str
+
+
+def parse_query(query: str) -> List[List[str]]:
+    """'A B OR C' → [['A', 'B'], ['C']]（OR で区切った AND 条件の並び）。"..." は1語として扱う"""
+    groups: List[List[str]] = [[]]
+    for quoted, word in re.findall(r'"([^"]+)"|(\S+)', query):
+        term = quoted or word
+        if not quoted and term.upper() == 'OR':
+            groups.append([])
+        elif term:
+            groups[-1].append(term)
+    return [g for g in groups if g]
+
+
+def _fts_phrase(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like_pattern(term: str) -> str:
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def make_snippet(text: str, terms: Iterable[str], width: int = 40) -> str:
+    """最初に見つかった語の前後を切り出し、語を【】で囲む（FTS の snippet が使えない短い語用）"""
+    terms = [t for t in terms if t]
+    lower = text.lower()
+    pos = min((p for p in (lower.find(t.lower()) for t in terms) if p >= 0), default=0)
+    start, end = max(0, pos - width), min(len(text), pos + width)
+    part = text[start:end].replace('\n', ' ')
+    for t in sorted(set(terms), key=len, reverse=True):
+        part = re.sub(re.escape(t), lambda m: HIGHLIGHT[0] + m.group(0) + HIGHLIGHT[1], part, flags=re.IGNORECASE)
+    return ('…' if start > 0 else '') + part + ('…' if end < len(text) else '')
+
+
+class SearchIndex:
+    """画像単位のOCRテキスト索引"""
+
+    def __init__(self, path=DEFAULT_DB, timeout: float = 30.0):
+        self.path = str(path)
+        self.conn = sqlite3.connect(self.path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.added = 0
+        self.unchanged = 0
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    # ---- 登録 ----
+
+    def add(self, path, text: str, pid: Optional[str] = None, kbn: Optional[str] = None,
+            cdate: Optional[str] = None, commit: bool = True) -> bool:
+        """画像のOCRテキストを登録・更新（テキストが前回と同じなら何もせず False）"""
+        text = text or ''
+        file = str(path)
+        sha1 = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        row = self.conn.execute('SELECT sha1 FROM docs WHERE file = ?', (file,)).fetchone()
+        if row is not None and row[0] == sha1:
+            self.unchanged += 1
+            return False
+        meta = (pid if pid is not None else pid_from_path(file),
+                kbn if kbn is not None else kbn_from_path(file),
+                cdate if cdate is not None else cdate_from_path(file))
+        if row is None:
+            self.conn.execute('INSERT INTO docs (file, pid, kbn, cdate, sha1, text, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (file,) + meta + (sha1, text, time.time()))
+        else:
+            self.conn.execute('UPDATE docs SET pid = ?, kbn = ?, cdate = ?, sha1 = ?, text = ?, updated = ? '
+                              'WHERE file = ?', meta + (sha1, text, time.time(), file))
+        if commit:
+            self.conn.commit()
+        self.added += 1
+        return True
+
+    def add_many(self, items: Iterable[Tuple[str, str]], pid: Optional[str] = None) -> int:
+        """(path, text) をまとめて登録（1トランザクション）"""
+        n = sum(1 for path, text in items if self.add(path, text, pid=pid, commit=False))
+        self.conn.commit()
+        return n
+
+    def remove(self, path):
+        self.conn.execute('DELETE FROM docs WHERE file = ?', (str(path),))
+        self.conn.commit()
+
+    def optimize(self):
+        self.conn.execute("INSERT INTO ocr_fts (ocr_fts) VALUES ('optimize')")
+        self.conn.commit()
+
+    # ---- 検索 ----
+
+    def search(self, query: str, pid: Optional[str] = None, kbn: Optional[str] = None,
+               date_from: Optional[str] = None, date_to: Optional[str] = None,
+               limit: int = 50, snippets: bool = True) -> List[SearchHit]:
+        """'ERM OR 黄斑前膜' のような検索（空白で AND、OR で OR）。新しい受診日から順"""
+        filters, fparams = [], []
+        for col, value in (('d.pid', pid), ('d.kbn', kbn)):
+            if value:
+                filters.append(f'{col} = ?')
+                fparams.append(value)
+        if date_from:
+            filters.append('d.cdate >= ?')
+            fparams.append(date_from)
+        if date_to:
+            filters.append('d.cdate <= ?')
+            fparams.append(date_to + '\uffff')
+        hits: Dict[str, SearchHit] = {}
+        for terms in parse_query(query):
+            long_terms = [t for t in terms if len(t) >= 3]
+            short_terms = [t for t in terms if len(t) < 3]
+            where = list(filters)
+            params: List = []
+            if long_terms and snippets:
+                sql = ("SELECT d.file, d.pid, d.kbn, d.cdate, "
+                       f"snippet(ocr_fts, 0, '{HIGHLIGHT[0]}', '{HIGHLIGHT[1]}', '…', {SNIPPET_TOKENS}), d.text "
+                       'FROM ocr_fts JOIN docs d ON d.id = ocr_fts.rowid')
+            elif long_terms:
+                sql = "SELECT d.file, d.pid, d.kbn, d.cdate, '', '' FROM ocr_fts JOIN docs d ON d.id = ocr_fts.rowid"
+            else:
+                sql = "SELECT d.file, d.pid, d.kbn, d.cdate, '', %s FROM docs d" % ('d.text' if snippets else "''")
+            if long_terms:
+                where.insert(0, 'ocr_fts MATCH ?')
+                params.append(' AND '.join(_fts_phrase(t) for t in long_terms))
+            params.extend(fparams)
+            for t in short_terms:
+                where.append("d.text LIKE ? ESCAPE '\\'")
+                params.append(_like_pattern(t))
+            sql += ' WHERE ' + ' AND '.join(where) + ' ORDER BY d.cdate DESC, d.file LIMIT ?'
+            params.append(limit)
+            for file, hpid, hkbn, hcdate, snip, text in self.conn.execute(sql, params):
+                if file in hits:
+                    continue
+                if short_terms and snippets:
+                    snip = make_snippet(text, terms)
+                hits[file] = SearchHit(file, hpid, hkbn, hcdate, snip.replace('\n', ' '))
+        return sorted(hits.values(), key=lambda h: (h.cdate, h.file), reverse=True)[:limit]
+
+    def patients(self, query: str, **filters) -> List[Tuple[str, int, str]]:
+        """一致した患者ごとの (pid, 画像数, 最新の受診日)"""
+        by_pid: Dict[str, List[str]] = {}
+        for hit in self.search(query, limit=filters.pop('limit', 1000000), snippets=False, **filters):
+            by_pid.setdefault(hit.pid, []).append(hit.cdate)
+        return sorted(((pid, len(d), max(d)) for pid, d in by_pid.items()), key=lambda r: r[2], reverse=True)
+
+    def summary_lines(self) -> List[str]:
+        if not self.added and not self.unchanged:
+            return []
+        return [f'🔎 検索索引: 更新 {self.added}件 / 変更なし {self.unchanged}件（全{len(self)}件、{self.path}）']
+
+
+# ---- 既存の Markdown から作成 ----
+
+_MD_SECTION = re.compile(r'^### (.+?)\n(.*?)(?=^### |\Z)', re.M | re.S)
+_MD_FENCE = re.compile(r'^````\n(.*?)\n?````', re.M | re.S)
+
+
+def iter_markdown_docs(md_path: str) -> Iterable[Tuple[str, str]]:
+    """patient_ocr_dump の ocr_text_<PID>.md から (画像ファイル名, テキスト)"""
+    with open(md_path, 'r', encoding='utf-8-sig') as f:
+        body = f.read()
+    for m in _MD_SECTION.finditer(body):
+        fence = _MD_FENCE.search(m.group(2))
+        yield m.group(1).strip(), fence.group(1).strip() if fence else ''
+
+
+def build_from_markdown(index: SearchIndex, output_root: str, image_root: Optional[str] = None) -> int:
+    """output_root/<PID>/ocr_text_<PID>.md を全て登録（画像パスは image_root/<PID>/<ファイル名>）"""
+    added = 0
+    for pid in list_subdirs(output_root):
+        md_path = os.path.join(output_root, pid, f'ocr_text_{pid}.md')
+        if not os.path.isfile(md_path):
+            continue
+        base = os.path.join(image_root, pid) if image_root else os.path.join(output_root, pid)
+        added += index.add_many((os.path.join(base, name), text) for name, text in iter_markdown_docs(md_path))
+    index.optimize()
+    return added
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description='OCRテキストの全文検索（SQLite FTS5 trigram）')
+    ap.add_argument('--db', default=str(DEFAULT_DB))
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('build', help='既存の ocr_text_<PID>.md から索引を作成・更新')
+    p.add_argument('--output-root', default=None, help='既定: path_config.json の output_root')
+    p.add_argument('--image-root', default=None, help='既定: path_config.json の image_root')
+    p = sub.add_parser('query', help='検索（空白で AND、OR で OR、"..." で語句）')
+    p.add_argument('query')
+    p.add_argument('--pid', default=None)
+    p.add_argument('--kbn', default=None)
+    p.add_argument('--from', dest='date_from', default=None, help='受診日の下限（例: 20180101）')
+    p.add_argument('--to', dest='date_to', default=None)
+    p.add_argument('--limit', type=int, default=50)
+    p.add_argument('--patients', action='store_true', help='患者ごとにまとめて表示')
+    sub.add_parser('stats', help='登録件数')
+    args = ap.parse_args(argv)
+
+    with SearchIndex(args.db) as index:
+        if args.cmd == 'build':
+            from patient_ocr_dump import IMAGE_ROOT, OUTPUT_ROOT
+            t0 = time.perf_counter()
+            added = build_from_markdown(index, args.output_root or OUTPUT_ROOT, args.image_root or IMAGE_ROOT)
+            print(f'✅ 索引を更新: {added}件（全{len(index)}件、{time.perf_counter() - t0:.1f}s） → {index.path}')
+        elif args.cmd == 'query':
+            t0 = time.perf_counter()
+            filters = dict(pid=args.pid, kbn=args.kbn, date_from=args.date_from, date_to=args.date_to)
+            if args.patients:
+                rows = index.patients(args.query, **filters)
+                ms = (time.perf_counter() - t0) * 1000
+                for pid, n, last in rows:
+                    print(f'  {pid:<10} {n}件 最新 {last}')
+                print(f'🔎 {len(rows)}人 ({ms:.0f}ms)')
+            else:
+                hits = index.search(args.query, limit=args.limit, **filters)
+                ms = (time.perf_counter() - t0) * 1000
+                for h in hits:
+                    print(f'  {h.pid:<8} {h.cdate:<16} {h.kbn:<8} {os.path.basename(h.file)}\n      {h.snippet}')
+                print(f'🔎 {len(hits)}件 ({ms:.0f}ms)')
+        else:
+            rows = index.conn.execute('SELECT COUNT(*), COUNT(DISTINCT pid), MIN(cdate), MAX(cdate) FROM docs').fetchone()
+            print(f'🔎 {rows[0]}画像 / {rows[1]}人 / 受診日 {rows[2] or "-"} 〜 {rows[3] or "-"} ({index.path})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+抽出処理の診断トレース（print() の置き換え）
+
+使い方:
+    from ocr_trace import TRACE
+
+    TRACE.debug('Avg行発見 行{}: {}', i, line)   # 書式化は出力するときだけ行う
+
+    for path in images:                          # バッチ処理
+        TRACE.begin(path)                        # 即時表示を batch_echo_level に切り替え
+        ...
+        TRACE.end(failed=not data)               # 失敗した画像だけリングバッファを書き出す
+
+ - レベル: DEBUG(候補行・棄却値) < INFO(画像ごとの結果) < WARN(失敗)
+ - 既定では即時表示なし（バッチ・キューのワーカー・ベンチマークから抽出器を呼んでも静か）。
+   対話のテスト/デバッグメニューは TRACE.configure(echo_level=DEBUG) で従来どおり表示する
+ - バッチ実行は各画像の直近 ring_size 件を保持し、失敗時のみ出力
+ - --trace-level を指定すると、そのレベル以上を常に即時表示
+ - sample_rate で一部の画像だけ DEBUG を即時表示（詳細トレースのサンプリング）
+ - --trace-dump のファイルは書き出すたびに flush し、終了時に close() する
+"""
+
+import sys
+import atexit
+import random
+import threading
+from collections import deque
+from typing import Any, Deque, Optional, TextIO, Tuple
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+OFF = 100
+
+LEVEL_NAMES = {'debug': DEBUG, 'info': INFO, 'warn': WARN, 'off': OFF}
+
+
+def level_from_name(name: str) -> int:
+    return LEVEL_NAMES[(name or 'off').lower()]
+
+
+class Trace:
+    """レベル付き・遅延書式化・画像単位リングバッファの診断トレース"""
+
+    def __init__(self, echo_level: int = OFF, batch_echo_level: int = OFF,
+                 ring_size: int = 200, sample_rate: float = 0.0, sink: Optional[TextIO] = None):
+        self.echo_level = echo_level
+        self.batch_echo_level = batch_echo_level
+        self.ring_size = ring_size
+        self.sample_rate = sample_rate
+        self.sink = sink
+        self._owned_sink: Optional[TextIO] = None   # configure_from_args で開いたファイル（close() で閉じる）
+        self.dumped = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, batch_echo_level: Optional[int] = None, sample_rate: Optional[float] = None,
+                  ring_size: Optional[int] = None, sink: Optional[TextIO] = None,
+                  echo_level: Optional[int] = None):
+        if echo_level is not None:
+            self.echo_level = echo_level
+        if batch_echo_level is not None:
+            self.batch_echo_level = batch_echo_level
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if ring_size is not None:
+            self.ring_size = ring_size
+        if sink is not None:
+            self.sink = sink
+
+    def _state(self):
+        st = self._local
+        if not hasattr(st, 'ring'):
+            st.ring = None          # 画像処理中のみ deque
+            st.item = ''
+            st.sampled = False
+            st.echo_level = None    # None のときは self.echo_level
+        return st
+
+    def begin(self, item: str):
+        """バッチ処理で1画像分のトレースを開始（即時表示は batch_echo_level）"""
+        st = self._state()
+        st.item = str(item)
+        st.ring = deque(maxlen=self.ring_size)
+        st.echo_level = self.batch_echo_level
+        st.sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def end(self, failed: bool) -> bool:
+        """1画像分のトレース終了。failed のときだけバッファを書き出す"""
+        st = self._state()
+        ring: Optional[Deque[Tuple[int, str, Tuple[Any, ...]]]] = st.ring
+        st.ring = None
+        st.echo_level = None
+        if not failed or not ring:
+            return False
+        lines = [f'--- trace: {st.item} ({len(ring)}件) ---']
+        lines.extend(_format(fmt, args) for _level, fmt, args in ring)
+        with self._lock:
+            out = self.sink or sys.stdout
+            out.write('\n'.join(lines) + '\n')
+            out.flush()             # 途中で落ちても失敗画像のトレースは残す
+            self.dumped += 1
+        return True
+
+    def close(self):
+        """開いた出力先ファイルを閉じる（以降の書き出しは標準出力）"""
+        with self._lock:
+            sink, self._owned_sink = self._owned_sink, None
+            if sink is None:
+                return
+            if self.sink is sink:
+                self.sink = None
+            sink.close()
+
+    def _log(self, level: int, fmt: str, args: Tuple[Any, ...]):
+        st = self._state()
+        if st.ring is not None:
+            st.ring.append((level, fmt, args))
+        echo = self.echo_level if st.echo_level is None else st.echo_level
+        if level >= echo or (st.sampled and st.ring is not None):
+            print(_format(fmt, args))
+
+    def debug(self, fmt: str, *args: Any):
+        self._log(DEBUG, fmt, args)
+
+    def info(self, fmt: str, *args: Any):
+        self._log(INFO, fmt, args)
+
+    def warn(self, fmt: str, *args: Any):
+        self._log(WARN, fmt, args)
+
+
+def _format(fmt: str, args: Tuple[Any, ...]) -> str:
+    try:
+        return fmt.format(*args)
+    except Exception:
+        return fmt + ' ' + ' '.join(map(repr, args))
+
+
+# プロセス全体で共有するトレース
+TRACE = Trace()
+
+
+def add_trace_arguments(ap):
+    """argparse にバッチ用トレースの引数を追加する"""
+    ap.add_argument('--trace-level', choices=sorted(LEVEL_NAMES), default='off',
+                    help='即時表示するレベル（既定: off。失敗画像のトレースは常に出力）')
+    ap.add_argument('--trace-sample', type=float, default=0.0,
+                    help='DEBUG トレースを即時表示する画像の割合（0〜1）')
+    ap.add_argument('--trace-dump', default=None, metavar='PATH',
+                    help='失敗画像のトレースの出力先ファイル（既定: 標準出力）')
+
+
+def configure_from_args(args):
+    """引数どおりに TRACE を設定する。--trace-dump のファイルは終了時に閉じる"""
+    sink = None
+    if args.trace_dump:
+        TRACE.close()
+        sink = open(args.trace_dump, 'a', encoding='utf-8')
+        TRACE._owned_sink = sink
+        atexit.unregister(TRACE.close)
+        atexit.register(TRACE.close)
+    level = level_from_name(args.trace_level)
+    TRACE.configure(echo_level=level, batch_echo_level=level, sample_rate=args.trace_sample, sink=sink)
@@ -12,13 +12,21 @@ import os
 import csv
 import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, List, Tuple, Optional
 
-import cv2
 import numpy as np
-from PIL import Image
-import pytesseract
 import shutil
+from functools import lru_cache
+
+from filename_params import kbn_from_path
+from stage_profiler import PROFILER, add_profile_argument, finish_profile
+from near_dup import NearDupIndex, image_hashes_array
+from thumb_classifier import HEADER, SKIP, add_gate_arguments, gate_from_args, header_strip, make_thumbnail
+from ocr_job_queue import JobQueue, add_enqueue_argument
+from ocr_search import DEFAULT_DB as SEARCH_DB, SearchIndex
+from staged_output import StagedOutput, summary_lines as staged_summary_lines
+from tree_walker import count_files, list_files, list_subdirs, walk_files
 
 
 def load_paths() -> Tuple[str, str]:
@@ -36,6 +44,7 @@ IMAGE_ROOT, OUTPUT_ROOT = load_paths()
 
 def setup_tesseract_cmd() -> None:
     # 優先順位: 環境変数 / PATH / 既定のインストール先
+    import pytesseract
     candidates = []
     env_cmd = os.environ.get('TESSERACT_CMD')
     if env_cmd:
@@ -52,7 +61,13 @@ def setup_tesseract_cmd() -> None:
             pytesseract.pytesseract.tesseract_cmd = c
             break
 
-setup_tesseract_cmd()
+
+@lru_cache(maxsize=None)
+def _pytesseract():
+    """pytesseract は読み込みが重いので、最初にOCRするときに読んで tesseract の場所を設定する"""
+    import pytesseract
+    setup_tesseract_cmd()
+    return pytesseract
 
 
 def find_tessdata_and_langs() -> Tuple[Optional[str], str]:
@@ -79,16 +94,15 @@ def find_tessdata_and_langs() -> Tuple[Optional[str], str]:
     return None, 'eng'
 
 
+PATIENT_IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
 def collect_images(patient_dir: str) -> List[str]:
-    images: List[str] = []
-    for name in os.listdir(patient_dir):
-        if name.lower().endswith(('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')):
-            images.append(os.path.join(patient_dir, name))
-    images.sort()
-    return images
+    return list_files(patient_dir, exts=PATIENT_IMAGE_EXTS, recursive=False)
 
 
 def load_image_jp(path: str):
+    import cv2
     data = np.fromfile(path, dtype=np.uint8)
     img = cv2.imdecode(data, cv2.IMREAD_COLOR)
     return img
@@ -97,15 +111,24 @@ def load_image_jp(path: str):
 def ocr_image_tesseract(img) -> str:
     if img is None:
         return ''
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    # 軽い二値化
-    try:
-        th = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-    except Exception:
-        th = gray
-    rgb = cv2.cvtColor(th, cv2.COLOR_GRAY2RGB)
-    pil = Image.fromarray(rgb)
+    import cv2
+    from PIL import Image
+    with PROFILER.span('preprocess'):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # 軽い二値化
+        try:
+            th = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+        except Exception:
+            th = gray
+        rgb = cv2.cvtColor(th, cv2.COLOR_GRAY2RGB)
+        pil = Image.fromarray(rgb)
+    with PROFILER.span('ocr'):
+        return _tesseract_to_string(pil)
+
+
+def _tesseract_to_string(pil) -> str:
     # tessdata パス（存在すれば利用）
+    pytesseract = _pytesseract()
     tessdata_dir, lang = find_tessdata_and_langs()
     config = '--psm 6'
     try:
@@ -157,34 +180,162 @@ def extract_iol_info(text: str) -> Dict[str, str]:
     return {}
 
 
-def process_patient(pid: str) -> Tuple[str, int]:
+MANIFEST_NAME = 'ocr_manifest.json'   # 画像ごとの (サイズ, 更新時刻) と前回のOCR結果
+SUMMARY_NAME = 'ocr_summary.json'     # OCR_INDEX.md の1行分
+
+
+class DumpStats:
+    """OCRした画像 / 前回の結果を再利用した画像 / 変更が無く書き出しを省いた患者"""
+
+    KEYS = ('patients', 'unchanged_patients', 'images', 'ocr_images', 'reused_images')
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {k: 0 for k in self.KEYS}
+
+    def add(self, key: str, n: int = 1):
+        self.counts[key] += n
+
+    def merge(self, counts: Dict[str, int]):
+        for k, n in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + n
+
+    def summary_lines(self) -> List[str]:
+        c = self.counts
+        if not c['patients']:
+            return []
+        return [f'♻️ 差分処理: {c["patients"]}人中 {c["unchanged_patients"]}人は変更なし、'
+                f'画像 {c["images"]}件中 OCR {c["ocr_images"]}件 / 前回の結果を再利用 {c["reused_images"]}件',
+                *staged_summary_lines(c)]
+
+
+def image_signature(path) -> List[int]:
+    """(サイズ, 更新時刻)。DirEntry なら走査時の stat を再利用する"""
+    st = path.stat() if isinstance(path, os.DirEntry) else os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _read_json(path: str) -> Dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path: str, data: Dict):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def options_key(gate=None, dedup: Optional[NearDupIndex] = None) -> str:
+    """OCR結果に影響する設定（変わったら前回の結果は使わない）。近似重複は範囲と閾値も含める"""
+    dedup_key = f'{dedup.scope}/p{dedup.max_phash}/d{dedup.max_dhash}' if dedup is not None else ''
+    return f'gate={int(gate is not None)};dedup={dedup_key}'
+
+
+def ocr_entry(p: str, gate=None, dedup: Optional[NearDupIndex] = None) -> Dict:
+    """1画像をOCRし、マニフェストに残す内容（text / decision / dup_of）を返す"""
+    with PROFILER.span('decode'):
+        img = load_image_jp(p)
+    decision = ''
+    hit = hashes = None
+    if dedup is not None and img is not None:
+        with PROFILER.span('hash'):
+            hashes = image_hashes_array(img)
+        hit = dedup.lookup(hashes, p)
+    if hit is None and gate is not None and img is not None:
+        with PROFILER.span('classify'):
+            decision = gate.decide(make_thumbnail(img), kbn_from_path(p))
+    if hit is not None:
+        text = hit.get('text', '')
+    elif decision == SKIP:
+        text = ''
+    elif decision == HEADER:
+        text = ocr_image_tesseract(header_strip(img))
+    else:
+        text = ocr_image_tesseract(img)
+    if hashes is not None and hit is None:
+        dedup.add(p, hashes, text)
+    return {'text': text or '', 'decision': decision, 'dup_of': os.path.basename(hit['file']) if hit else ''}
+
+
+def process_patient(pid: str, gate=None, dedup: Optional[NearDupIndex] = None,
+                    search: Optional[SearchIndex] = None, incremental: bool = False,
+                    stats: Optional[DumpStats] = None) -> Tuple[str, int]:
+    """1患者分の Markdown / IOL CSV を作成
+
+    incremental=True なら、前回からサイズ・更新時刻が変わっていない画像はOCRせずマニフェストの結果を使い、
+    画像が1枚も変わっていなければファイルを書き直さない。
+    """
     patient_dir = os.path.join(IMAGE_ROOT, pid)
     if not os.path.isdir(patient_dir):
         return '', 0
 
     out_dir = os.path.join(OUTPUT_ROOT, pid)
-    os.makedirs(out_dir, exist_ok=True)
-    md_path = os.path.join(out_dir, f'ocr_text_{pid}.md')
-    iol_csv = os.path.join(out_dir, f'iol_data_{pid}.csv')
+    md_name = f'ocr_text_{pid}.md'
+    md_path = os.path.join(out_dir, md_name)
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
 
-    images = collect_images(patient_dir)
+    files = sorted(walk_files(patient_dir, exts=PATIENT_IMAGE_EXTS, recursive=False), key=lambda e: e.path)
+    images = [e.path for e in files]
     if not images:
         return '', 0
 
+    stats = stats if stats is not None else DumpStats()
+    stats.add('patients')
+    stats.add('images', len(images))
+    options = options_key(gate, dedup)
+    prior: Dict[str, Dict] = {}
+    if incremental:
+        manifest = _read_json(manifest_path)
+        if manifest.get('options') == options:
+            prior = manifest.get('images', {})
+    sigs = {e.name: image_signature(e) for e in files}
+    if (incremental and os.path.isfile(md_path) and set(prior) == set(sigs)
+            and all(prior[b].get('sig') == s for b, s in sigs.items())):
+        stats.add('unchanged_patients')
+        stats.add('reused_images', len(images))
+        if search is not None:   # 索引は別に作り直されている場合がある（同じ内容なら何もしない）
+            search.add_many([(p, prior[os.path.basename(p)].get('text', '')) for p in images], pid=pid)
+        return md_path, int(_read_json(os.path.join(out_dir, SUMMARY_NAME)).get('iol_count', 0))
+
+    manifest_images: Dict[str, Dict] = {}
+    docs: List[Tuple[str, str]] = []   # 全文検索に登録する (path, text)。OCRの間は DB に触れない
     iol_rows: List[Dict[str, str]] = []
+    # 作業フォルダに書き、最後に Markdown / CSV / マニフェストをまとめて反映する
+    out = StagedOutput(OUTPUT_ROOT)
 
-    with open(md_path, 'w', encoding='utf-8-sig', newline='') as md:
+    with out.open(pid, md_name, encoding='utf-8-sig', newline='') as md:
         md.write(f'## OCR結果 (PID={pid})\n\n')
         for p in images:
-            img = load_image_jp(p)
-            text = ocr_image_tesseract(img)
             base = os.path.basename(p)
-            md.write(f'### {base}\n\n')
-            md.write('````\n')
-            md.write((text or '').strip() + '\n')
-            md.write('````\n\n')
-
-            iol = extract_iol_info(text or '')
+            with PROFILER.span('image', kbn=kbn_from_path(p)):
+                entry = prior.get(base)
+                if entry is not None and entry.get('sig') == sigs[base]:
+                    stats.add('reused_images')
+                else:
+                    entry = dict(ocr_entry(p, gate, dedup), sig=sigs[base])
+                    stats.add('ocr_images')
+                docs.append((p, entry['text']))
+                manifest_images[base] = entry
+                text, decision = entry['text'], entry['decision']
+                with PROFILER.span('write'):
+                    md.write(f'### {base}\n\n')
+                    if entry['dup_of']:
+                        md.write(f'（{entry["dup_of"]} の近似重複のためOCR結果を再利用）\n\n')
+                    if decision == SKIP:
+                        md.write('（写真主体のためOCR省略）\n\n')
+                        continue
+                    if decision == HEADER:
+                        md.write('（上端のみOCR）\n\n')
+                    md.write('````\n')
+                    md.write(text.strip() + '\n')
+                    md.write('````\n\n')
+
+                with PROFILER.span('extract.iol'):
+                    iol = extract_iol_info(text)
             if iol:
                 iol_row = {
                     'pidnum': pid,
@@ -193,48 +344,208 @@ def process_patient(pid: str) -> Tuple[str, int]:
                 }
                 iol_rows.append(iol_row)
 
+    if search is not None:   # 患者1人分を短い1トランザクションで
+        with PROFILER.span('index'):
+            search.add_many(docs, pid=pid)
+
     if iol_rows:
-        with open(iol_csv, 'w', encoding='utf-8-sig', newline='') as f:
+        with PROFILER.span('write'), out.open(pid, f'iol_data_{pid}.csv', encoding='utf-8-sig', newline='') as f:
             cols = ['pidnum', 'file', 'eye', 'S', 'C', 'AX', 'maker', 'product']
             w = csv.DictWriter(f, fieldnames=cols)
             w.writeheader()
             for r in iol_rows:
                 w.writerow({c: r.get(c, '') for c in cols})
 
+    _write_json(out.path(pid, MANIFEST_NAME), {'options': options, 'images': manifest_images})
+    _write_json(out.path(pid, SUMMARY_NAME),
+                {'pid': pid, 'md': md_name, 'images': len(images), 'iol_count': len(iol_rows)})
+    with PROFILER.span('write'):
+        out.commit()
+    stats.merge(out.counts)
+    for dest in out.locked:
+        print(f'⚠️ ロック中のため未反映: {dest}')
     return md_path, len(iol_rows)
 
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument('--pid', required=True, help='患者ID (例: 26147) または all')
+    add_profile_argument(ap, 'profile_ocr_dump.json')
+    add_gate_arguments(ap)
+    ap.add_argument('--dedup', action='store_true',
+                    help='撮り直し・重複スキャン（知覚ハッシュが近い画像）は前回のOCR結果を再利用')
+    ap.add_argument('--dedup-scope', choices=['visit', 'patient'], default='visit',
+                    help='近似重複とみなす範囲（既定: 同一患者・同一受診日）')
+    ap.add_argument('--search', nargs='?', const=str(SEARCH_DB), default=None, metavar='DB',
+                    help=f'OCRテキストを全文検索索引に登録（既定: {SEARCH_DB}、検索は ocr_search.py query）')
+    ap.add_argument('--jobs', type=int, default=1, help='--pid all で並列に処理する患者数（プロセス数）')
+    ap.add_argument('--full', action='store_true',
+                    help='前回から変わっていない画像もOCRし直す（既定はサイズ・更新時刻が同じ画像の結果を再利用）')
+    add_enqueue_argument(ap)
     args = ap.parse_args()
+    if args.enqueue:
+        enqueue(args)
+        return
+    if args.profile:
+        PROFILER.enable()
+    try:
+        run(args)
+    finally:
+        finish_profile(args.profile)
+
+
+def enqueue(args):
+    """患者ごとのジョブをキューに登録（処理は python ocr_job_queue.py work --kind ocr_dump）"""
+    pid = args.pid.strip()
+    if pid.lower() == 'all':
+        pids = list_subdirs(IMAGE_ROOT)
+    else:
+        pids = [pid]
+    queue = JobQueue(args.enqueue)
+    added = queue.enqueue('ocr_dump', pids, {
+        'ocr_gate': args.ocr_gate, 'ocr_gate_model': args.ocr_gate_model,
+        'dedup': args.dedup, 'dedup_scope': args.dedup_scope, 'search': args.search,
+        'full': args.full,
+    }, priority=0 if len(pids) == 1 else 1, force=args.force)
+    print(f'✅ ジョブ登録: {added}/{len(pids)}件 → {args.enqueue}')
+    for line in queue.summary_lines():
+        print(line)
+
+
+_WORKER: Dict[str, object] = {}   # プロセスごとの gate / dedup / search
+
+
+class SearchBuffer:
+    """--jobs のワーカー用。全文検索への登録を溜めておき、親プロセスが1つの接続でまとめて書く
+
+    （各ワーカーが同じ ocr_search.db に書くと、書き込みが直列になり database is locked で失敗しうる）
+    """
+
+    def __init__(self):
+        self.batches: List[Tuple[Optional[str], List[Tuple[str, str]]]] = []
+
+    def add_many(self, items, pid: Optional[str] = None) -> int:
+        items = list(items)
+        self.batches.append((pid, items))
+        return len(items)
+
+    def take(self) -> List[Tuple[Optional[str], List[Tuple[str, str]]]]:
+        batches, self.batches = self.batches, []
+        return batches
+
+
+def _init_worker(args, shard_prefix: str = ''):
+    """shard_prefix を渡すと（--jobs のワーカー）近似重複の索引はプロセスごとの shard に追記する"""
+    _WORKER['gate'] = gate_from_args(args)
+    shard = f'{shard_prefix}{os.getpid()}' if shard_prefix else None
+    _WORKER['dedup'] = (NearDupIndex(os.path.join(OUTPUT_ROOT, 'near_dup_index.jsonl'), scope=args.dedup_scope,
+                                     shard=shard) if args.dedup else None)
+    if not args.search:
+        _WORKER['search'] = None
+    elif shard_prefix:
+        _WORKER['search'] = SearchBuffer()
+    else:
+        _WORKER['search'] = SearchIndex(args.search)
+    _WORKER['incremental'] = not args.full
+
+
+def _dump_one(pid: str) -> Tuple[str, str, int, Dict[str, int], Dict, Dict, List]:
+    """ワーカーで1患者を処理（集計と全文検索への登録は親プロセスで行える形で返す）"""
+    gate, dedup = _WORKER['gate'], _WORKER['dedup']
+    stats = DumpStats()
+    if gate is not None:
+        gate.counts = {}
+    if dedup is not None:
+        dedup.stats.images, dedup.stats.duplicates = {}, {}
+    md_path, cnt = process_patient(pid, gate, dedup, _WORKER['search'], _WORKER['incremental'], stats)
+    dedup_counts = {'images': dedup.stats.images, 'duplicates': dedup.stats.duplicates} if dedup is not None else {}
+    search = _WORKER['search']
+    batches = search.take() if search is not None else []
+    return pid, md_path, cnt, stats.counts, gate.counts if gate is not None else {}, dedup_counts, batches
+
+
+def write_index(output_root: str) -> Tuple[str, int]:
+    """各患者フォルダの ocr_summary.json から OCR_INDEX.md を作り直す（今回処理していない患者も含む）"""
+    rows: List[Tuple[str, str, str]] = []
+    for name in list_subdirs(output_root):
+        md_path = os.path.join(output_root, name, f'ocr_text_{name}.md')
+        if not os.path.isfile(md_path):
+            continue
+        summary = _read_json(os.path.join(output_root, name, SUMMARY_NAME))
+        if 'iol_count' in summary:
+            cnt = summary['iol_count']
+        else:   # 差分処理より前に作られたフォルダ
+            iol_csv = os.path.join(output_root, name, f'iol_data_{name}.csv')
+            cnt = 0
+            if os.path.isfile(iol_csv):
+                with open(iol_csv, 'r', encoding='utf-8-sig') as f:
+                    cnt = max(0, sum(1 for _ in f) - 1)
+        rows.append((name, os.path.relpath(md_path, output_root), cnt))
+    with StagedOutput(output_root) as out, out.open('OCR_INDEX.md', encoding='utf-8-sig', newline='') as f:
+        f.write('# OCRテキスト インデックス\n\n')
+        for pid_val, rel, cnt in rows:
+            f.write(f'- {pid_val}: {rel} (IOL {cnt}件)\n')
+    return out.target('OCR_INDEX.md'), len(rows)
+
+
+def run(args):
     pid = args.pid.strip()
-    created: List[Tuple[str, int, str]] = []  # (md_path, iol_count, pid)
+    _init_worker(args)
+    gate, dedup, search = _WORKER['gate'], _WORKER['dedup'], _WORKER['search']
+    stats = DumpStats()
 
     if pid.lower() == 'all':
         # 直下のサブフォルダを患者IDとして処理
-        for name in sorted(os.listdir(IMAGE_ROOT)):
-            pdir = os.path.join(IMAGE_ROOT, name)
-            if os.path.isdir(pdir):
-                md_path, cnt = process_patient(name)
-                if md_path:
-                    created.append((md_path, cnt, name))
-        # インデックスを作成
-        index_md = os.path.join(OUTPUT_ROOT, 'OCR_INDEX.md')
-        with open(index_md, 'w', encoding='utf-8-sig', newline='') as f:
-            f.write('# OCRテキスト インデックス\n\n')
-            for md_path, cnt, pid_val in created:
-                rel = os.path.relpath(md_path, OUTPUT_ROOT)
-                f.write(f'- {pid_val}: {rel} (IOL {cnt}件)\n')
-        print(f'✅ 保存: {index_md} ({len(created)}件)')
+        pids = list_subdirs(IMAGE_ROOT)
+        if args.jobs > 1:
+            # 画像の多い患者から割り当てて、最後に1プロセスだけ残る時間を減らす
+            pids.sort(key=lambda n: -count_files(os.path.join(IMAGE_ROOT, n), exts=PATIENT_IMAGE_EXTS))
+            shard_prefix = f'{os.getpid()}-'
+            with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker,
+                                     initargs=(args, shard_prefix)) as pool:
+                for _pid, _md, _cnt, counts, gate_counts, dedup_counts, batches in pool.map(
+                        _dump_one, pids, chunksize=4):
+                    stats.merge(counts)
+                    for batch_pid, docs in batches:   # 索引に書くのは親プロセスだけ
+                        search.add_many(docs, pid=batch_pid)
+                    if gate is not None:
+                        for kbn, per in gate_counts.items():
+                            mine = gate.counts.setdefault(kbn, {})
+                            for decision, n in per.items():
+                                mine[decision] = mine.get(decision, 0) + n
+                    if dedup is not None:
+                        for key, per in dedup_counts.items():
+                            mine = getattr(dedup.stats, key)
+                            for p, n in per.items():
+                                mine[p] = mine.get(p, 0) + n
+            if dedup is not None:   # ワーカーが書いた shard を本体の索引にまとめる
+                dedup.merge_shards(shard_prefix)
+        else:
+            for name in pids:
+                process_patient(name, gate, dedup, search, not args.full, stats)
+        # インデックスは患者ごとの要約から作り直す
+        index_md, n = write_index(OUTPUT_ROOT)
+        print(f'✅ 保存: {index_md} ({n}件)')
     else:
-        md_path, cnt = process_patient(pid)
+        md_path, cnt = process_patient(pid, gate, dedup, search, not args.full, stats)
         if not md_path:
             print(f'❌ 患者フォルダがありません: {os.path.join(IMAGE_ROOT, pid)}')
             return
         print(f'✅ 保存: {md_path}')
         if cnt:
             print(f'✅ IOL抽出: {os.path.join(OUTPUT_ROOT, pid, f"iol_data_{pid}.csv")} ({cnt}行)')
+    for line in stats.summary_lines():
+        print(line)
+    if gate is not None:
+        for line in gate.summary_lines():
+            print(line)
+    if dedup is not None:
+        for line in dedup.stats.summary_lines():
+            print(line)
+    if search is not None:
+        for line in search.summary_lines():
+            print(line)
+        search.close()
 
 
 if __name__ == '__main__':
@@ -12,13 +12,15 @@ r"""
 """
 
 import os
-import cv2
 import csv
 import json
 import argparse
-import urllib.parse
 from typing import Dict, List
 
+from filename_params import parse_params
+from staged_output import StagedOutput
+from tree_walker import list_files
+
 CFG_PATH = os.path.join(os.getcwd(), 'path_config.json')
 
 def load_paths():
@@ -50,13 +52,7 @@ def _read_text_file(path: str) -> str:
     return ''
 
 def load_patient_txt_metadata(patient_dir: str, pid: str) -> Dict[str, str]:
-    candidates: List[str] = []
-    try:
-        for name in os.listdir(patient_dir):
-            if name.lower().endswith('.txt'):
-                candidates.append(os.path.join(patient_dir, name))
-    except Exception:
-        return {}
+    candidates = list_files(patient_dir, exts=('.txt',), recursive=False)
     preferred = [p for p in candidates if os.path.basename(p) == f'&pidnum={pid}.txt']
     path = preferred[0] if preferred else (candidates[0] if candidates else None)
     if not path:
@@ -87,31 +83,8 @@ def merge_patient_metadata(records: List[Dict[str,str]], meta: Dict[str,str]) ->
                 if val:
                     r[k] = val
 
-def parse_params_from_filename(path: str) -> Dict[str, str]:
-    base = os.path.basename(path)
-    decoded = urllib.parse.unquote(base)
-    amp = decoded.find('&')
-    query = decoded[amp+1:] if amp >= 0 else decoded
-    lower = query.lower()
-    for ext in ('.jpg','.jpeg','.png','.tif','.tiff','.bmp'):
-        if lower.endswith(ext):
-            query = query[:-(len(ext))]
-            break
-    params: Dict[str,str] = {}
-    for part in query.split('&'):
-        if '=' in part:
-            k, v = part.split('=', 1)
-            params[k] = urllib.parse.unquote(v)
-    params['full_path'] = path
-    return params
-
 def collect_images(patient_dir: str) -> List[str]:
-    files: List[str] = []
-    for name in os.listdir(patient_dir):
-        if name.lower().endswith(('.jpg','.jpeg','.png','.tif','.tiff','.bmp')):
-            files.append(os.path.join(patient_dir, name))
-    files.sort()
-    return files
+    return list_files(patient_dir, exts=('.jpg','.jpeg','.png','.tif','.tiff','.bmp'), recursive=False)
 
 def write_csv(records: List[Dict[str,str]], out_csv: str) -> None:
     os.makedirs(os.path.dirname(out_csv), exist_ok=True)
@@ -132,7 +105,8 @@ def write_csv(records: List[Dict[str,str]], out_csv: str) -> None:
 def save_thumbnail(src_path: str, out_path: str, max_width: int = 512) -> bool:
     try:
         data = None
-        # 日本語パス対応
+        # 日本語パス対応（cv2 はサムネイルを作るときだけ読む）
+        import cv2
         import numpy as np
         data = np.fromfile(src_path, dtype=np.uint8)
         img = cv2.imdecode(data, cv2.IMREAD_COLOR)
@@ -172,7 +146,7 @@ def main():
     # CSV
     records: List[Dict[str,str]] = []
     for p in images:
-        rec = parse_params_from_filename(p)
+        rec = dict(parse_params(p), full_path=p)
         for k in PARAM_KEYS:
             rec.setdefault(k, '')
         # relative_path は IMAGE_ROOT に対する相対
@@ -189,12 +163,13 @@ def main():
     meta = load_patient_txt_metadata(patient_dir, pid)
     merge_patient_metadata(records, meta)
 
-    out_dir = os.path.join(OUTPUT_ROOT, pid)
+    # 作業フォルダに書いてから患者1人分をまとめて OUTPUT_ROOT に反映
+    out = StagedOutput(OUTPUT_ROOT)
+    out_dir = out.dir(pid)
     write_csv(records, os.path.join(out_dir, f'filename_params_{pid}.csv'))
 
     # by_kbn 分割（CSV/TSV）
-    by_kbn_dir = os.path.join(out_dir, 'by_kbn')
-    os.makedirs(by_kbn_dir, exist_ok=True)
+    by_kbn_dir = out.dir(pid, 'by_kbn')
     kbn_groups: Dict[str, List[Dict[str,str]]] = {}
     for r in records:
         key = (r.get('kbn') or 'unknown') or 'unknown'
@@ -219,7 +194,10 @@ def main():
         base = os.path.splitext(os.path.basename(p))[0] + '.jpg'
         save_thumbnail(p, os.path.join(thumb_dir, base))
 
-    print(f'✅ 出力: {out_dir}')
+    out.commit()
+    print(f'✅ 出力: {out.target(pid)}')
+    for line in out.summary_lines():
+        print(line)
 
 if __name__ == '__main__':
     main()
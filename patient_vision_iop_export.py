@@ -14,14 +14,15 @@ import re
 import csv
 import json
 import argparse
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
-import cv2
 import numpy as np
-from PIL import Image
-import pytesseract
 import shutil
-import urllib.parse
+
+from filename_params import parse_params as parse_filename_params   # debug_iop_accuracy などが import する名前
+from staged_output import StagedOutput
+from tree_walker import list_files
+from thumb_classifier import HEADER, SKIP, add_gate_arguments, gate_from_args, header_strip, make_thumbnail
 
 
 def load_paths() -> Tuple[str, str]:
@@ -56,6 +57,7 @@ KBN_TO_LABEL = {
 
 
 def setup_tesseract_cmd() -> None:
+    import pytesseract
     candidates = []
     env_cmd = os.environ.get('TESSERACT_CMD')
     if env_cmd:
@@ -110,15 +112,11 @@ def find_tessdata_and_langs() -> Tuple[str, str]:
 
 
 def collect_images(patient_dir: str) -> List[str]:
-    images: List[str] = []
-    for name in os.listdir(patient_dir):
-        if name.lower().endswith(('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')):
-            images.append(os.path.join(patient_dir, name))
-    images.sort()
-    return images
+    return list_files(patient_dir, exts=('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp'), recursive=False)
 
 
 def load_image_jp(path: str):
+    import cv2
     data = np.fromfile(path, dtype=np.uint8)
     img = cv2.imdecode(data, cv2.IMREAD_COLOR)
     return img
@@ -128,6 +126,7 @@ def save_thumbnail(img, out_path: str, max_width: int = 320) -> bool:
     try:
         if img is None:
             return False
+        import cv2
         h, w = img.shape[:2]
         if w > max_width:
             scale = max_width / w
@@ -173,6 +172,10 @@ def ocr_image_google_vision(img_path: str) -> str:
 def ocr_image_tesseract(img) -> str:
     if img is None:
         return ''
+    # cv2 / PIL / pytesseract はOCRするときだけ読む（CSV だけの処理を軽くする）
+    import cv2
+    import pytesseract
+    from PIL import Image
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     try:
         th = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
@@ -191,24 +194,6 @@ def ocr_image_tesseract(img) -> str:
     return pytesseract.image_to_string(pil, lang=lang, config=config)
 
 
-def parse_filename_params(path: str) -> Dict[str, str]:
-    base = os.path.basename(path)
-    decoded = urllib.parse.unquote(base)
-    amp = decoded.find('&')
-    query = decoded[amp+1:] if amp >= 0 else decoded
-    lower = query.lower()
-    for ext in ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp'):
-        if lower.endswith(ext):
-            query = query[:-(len(ext))]
-            break
-    params: Dict[str, str] = {}
-    for part in query.split('&'):
-        if '=' in part:
-            k, v = part.split('=', 1)
-            params[k] = urllib.parse.unquote(v)
-    return params
-
-
 def load_patient_txt(pid: str) -> Dict[str, str]:
     txt_path = os.path.join(IMAGE_ROOT, pid, f'&pidnum={pid}.txt')
     if not os.path.isfile(txt_path):
@@ -260,10 +245,7 @@ def find_patient_info_from_dir(patient_dir: str) -> Dict[str, str]:
     best: Dict[str, str] = {}
     best_rank = 99
     try:
-        for name in os.listdir(patient_dir):
-            if not name.lower().endswith(('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')):
-                continue
-            p = os.path.join(patient_dir, name)
+        for p in collect_images(patient_dir):
             prm = parse_filename_params(p)
             if not prm:
                 continue
@@ -414,6 +396,8 @@ def extract_vision(text: str) -> Dict[str, str]:
 def extract_iop_avg_from_image(img) -> Dict[str, str]:
     """画像から精密なAvg抽出（TSV座標ベース）"""
     try:
+        import cv2
+        import pytesseract
         # TSVデータでOCR実行
         g = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         H, W = g.shape
@@ -511,71 +495,64 @@ def extract_iop(text: str) -> Dict[str, str]:
     return {'IOP_R': '', 'IOP_L': '', 'IOP_src': ''}
 
 
-def write_outputs(pid: str, rows: List[Dict[str, str]]):
-    out_dir = os.path.join(OUTPUT_ROOT, pid)
-    os.makedirs(out_dir, exist_ok=True)
-    out_csv = os.path.join(out_dir, f'vision_iop_{pid}.csv')
-    out_tsv = os.path.join(out_dir, f'vision_iop_{pid}.tsv')
+def write_outputs(pid: str, rows: List[Dict[str, str]], out: Optional[StagedOutput] = None):
+    """CSV / TSV を作業フォルダに書く。out を渡さなければその場で反映する
+    （Excel で開いていて置き換えられないときは再試行し、別名ファイルは作らない）"""
+    staged = out if out is not None else StagedOutput(OUTPUT_ROOT)
+    csv_name = f'vision_iop_{pid}.csv'
+    tsv_name = f'vision_iop_{pid}.tsv'
     cols = [
         'ID', '患者名', 'フリガナ', '性別', '生年月日', 'file', '検査名', '検査日', 'full_path', 'thumb_rel',
         'IOP_R', 'IOP_L'
     ]
-    from datetime import datetime
-    # CSV出力（ファイルロック時は別名で保存）
-    try:
-        with open(out_csv, 'w', encoding='utf-8-sig', newline='') as f:
-            w = csv.DictWriter(f, fieldnames=cols)
-            w.writeheader()
-            for r in rows:
-                w.writerow({c: r.get(c, '') for c in cols})
-    except PermissionError:
-        ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-        out_csv = os.path.join(out_dir, f'vision_iop_{pid}_{ts}.csv')
-        with open(out_csv, 'w', encoding='utf-8-sig', newline='') as f:
-            w = csv.DictWriter(f, fieldnames=cols)
-            w.writeheader()
-            for r in rows:
-                w.writerow({c: r.get(c, '') for c in cols})
-    
-    # TSV出力（ファイルロック時は別名で保存）
-    try:
-        with open(out_tsv, 'w', encoding='utf-16', newline='') as f:
-            f.write('\t'.join(cols) + '\r\n')
-            for r in rows:
-                f.write('\t'.join([str(r.get(c, '')) for c in cols]) + '\r\n')
-    except PermissionError:
-        ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-        out_tsv = os.path.join(out_dir, f'vision_iop_{pid}_{ts}.tsv')
-        with open(out_tsv, 'w', encoding='utf-16', newline='') as f:
-            f.write('\t'.join(cols) + '\r\n')
-            for r in rows:
-                f.write('\t'.join([str(r.get(c, '')) for c in cols]) + '\r\n')
-    return out_csv, out_tsv
-
-
-def process_patient(pid: str) -> Tuple[str, str, int]:
+    with staged.open(pid, csv_name, encoding='utf-8-sig', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=cols)
+        w.writeheader()
+        for r in rows:
+            w.writerow({c: r.get(c, '') for c in cols})
+
+    with staged.open(pid, tsv_name, encoding='utf-16', newline='') as f:
+        f.write('\t'.join(cols) + '\r\n')
+        for r in rows:
+            f.write('\t'.join([str(r.get(c, '')) for c in cols]) + '\r\n')
+    if out is None:
+        staged.commit()
+        for line in staged.summary_lines():
+            print(line)
+    return staged.target(pid, csv_name), staged.target(pid, tsv_name)
+
+
+def process_patient(pid: str, gate=None, out: Optional[StagedOutput] = None) -> Tuple[str, str, int]:
+    """out を渡すと反映（commit）は呼び出し側。渡さなければ患者1人分をまとめて反映する"""
     patient_dir = os.path.join(IMAGE_ROOT, pid)
     if not os.path.isdir(patient_dir):
         return '', '', 0
     rows: List[Dict[str, str]] = []
-    thumb_dir = os.path.join(OUTPUT_ROOT, pid, 'thumbnails')
+    staged = out if out is not None else StagedOutput(OUTPUT_ROOT)
     # テキスト/ファイル名から患者情報（患者フォルダ優先取得 + 行ごと上書き可）
     folder_guess = find_patient_info_from_dir(patient_dir)
     txt_meta = load_patient_txt(pid)
     for p in collect_images(patient_dir):
         img = load_image_jp(p)
-        text = ocr_image_tesseract(img)
         params = parse_filename_params(p)
+        base = os.path.basename(p)
+        thumb_name = os.path.splitext(base)[0] + '.jpg'
+        thumb_rel = os.path.join('thumbnails', thumb_name)
+        # サムネ生成（OCR前判定にも同じサムネを使う）
+        thumb = make_thumbnail(img)
+        save_thumbnail(thumb, staged.path(pid, 'thumbnails', thumb_name))
+        decision = gate.decide(thumb, params.get('kbn', '')) if gate is not None and img is not None else ''
+        if decision == SKIP:
+            text = ''
+        elif decision == HEADER:
+            text = ocr_image_tesseract(header_strip(img))
+        else:
+            text = ocr_image_tesseract(img)
         vision = extract_vision(text)
         
         # 眼圧抽出は一時停止（精度が低いため）
         # TODO: 将来的にAvg抽出の精度を改善してから再有効化
         iop = {'IOP_R': '', 'IOP_L': '', 'IOP_src': 'disabled'}
-        base = os.path.basename(p)
-        thumb_name = os.path.splitext(base)[0] + '.jpg'
-        thumb_rel = os.path.join('thumbnails', thumb_name)
-        # サムネ生成
-        save_thumbnail(img, os.path.join(thumb_dir, thumb_name))
         # 表示用ID
         row_id = f"{params.get('kbn','')}_{params.get('cdate','')}_{params.get('no','')}"
         # 検査名ラベル
@@ -611,7 +588,11 @@ def process_patient(pid: str) -> Tuple[str, str, int]:
             'IOP_R': iop.get('IOP_R', ''),
             'IOP_L': iop.get('IOP_L', ''),
         })
-    out_csv, out_tsv = write_outputs(pid, rows)
+    out_csv, out_tsv = write_outputs(pid, rows, staged)
+    if out is None:
+        staged.commit()
+        for line in staged.summary_lines():
+            print(line)
     return out_csv, out_tsv, len(rows)
 
 
@@ -619,14 +600,19 @@ def main():
     setup_tesseract_cmd()
     ap = argparse.ArgumentParser()
     ap.add_argument('--pid', required=True, help='患者ID (例: 26147)')
+    add_gate_arguments(ap)
     args = ap.parse_args()
     pid = args.pid.strip()
-    out_csv, out_tsv, n = process_patient(pid)
+    gate = gate_from_args(args)
+    out_csv, out_tsv, n = process_patient(pid, gate)
     if not n:
         print(f'❌ 画像が見つかりません: {os.path.join(IMAGE_ROOT, pid)}')
         return
     print(f'✅ 出力: {out_csv}')
     print(f'✅ 出力: {out_tsv}')
+    if gate is not None:
+        for line in gate.summary_lines():
+            print(line)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OCRパイプラインのステージ別計測（--profile 用）
+
+使い方:
+    from stage_profiler import PROFILER
+    from filename_params import kbn_from_path
+
+    PROFILER.enable()                      # --profile 指定時のみ
+    with PROFILER.span('decode', kbn=kbn_from_path(path)):
+        img = load_image_jp(path)
+    with PROFILER.span('ocr'):             # kbn は親スパンから引き継ぐ
+        text = ocr_image_tesseract(img)
+    PROFILER.write_report('profile.json')  # profile.json + profile.folded
+
+ - 無効時の span() は何もしない（計測コストほぼゼロ）
+ - ステージ別・ステージ×kbn 別にレイテンシのヒストグラムを集計
+ - ネストしたスパンは "a;b;c <μs>" 形式（flamegraph.pl / speedscope 互換）でも出力
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# ヒストグラムのバケット上限（ms）。最後のバケットは上限なし
+BUCKET_BOUNDS_MS: List[float] = [
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000,
+]
+
+class Histogram:
+    """固定バケットのレイテンシ・ヒストグラム（ms）"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = float('inf')
+        self.max_ms = 0.0
+
+    def add(self, ms: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.min_ms = min(self.min_ms, ms)
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> float:
+        """バケット上限による近似分位点（最終バケットは max）"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c:
+                return BUCKET_BOUNDS_MS[i] if i < len(BUCKET_BOUNDS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> Dict:
+        buckets = []
+        for i, c in enumerate(self.counts):
+            if c:
+                le = BUCKET_BOUNDS_MS[i] if i < len(BUCKET_BOUNDS_MS) else 'inf'
+                buckets.append({'le_ms': le, 'count': c})
+        return {
+            'count': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+            'min_ms': round(self.min_ms, 3) if self.count else 0.0,
+            'max_ms': round(self.max_ms, 3),
+            'p50_ms': self.quantile(0.50),
+            'p90_ms': self.quantile(0.90),
+            'p99_ms': self.quantile(0.99),
+            'buckets': buckets,
+        }
+
+
+class StageProfiler:
+    """名前付きスパンの計測器（スレッドセーフ）"""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stages: Dict[str, Histogram] = {}
+        self._by_kbn: Dict[Tuple[str, str], Histogram] = {}
+        self._folded: Dict[str, float] = {}
+        self._started = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self._started = time.perf_counter()
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._by_kbn.clear()
+            self._folded.clear()
+        self._started = time.perf_counter()
+
+    def _stack(self) -> List[Tuple[str, str, List[float]]]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name: str, kbn: Optional[str] = None) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        if kbn is None:
+            kbn = stack[-1][1] if stack else ''
+        child_ms = [0.0]  # 子スパンの合計（self time 算出用）
+        stack.append((name, kbn, child_ms))
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - t0) * 1000.0
+            stack.pop()
+            path = ';'.join([s[0] for s in stack] + [name])
+            if stack:
+                stack[-1][2][0] += ms
+            self._record(name, kbn, path, ms, max(0.0, ms - child_ms[0]))
+
+    def record(self, name: str, ms: float, kbn: str = ''):
+        """span で囲めない処理（外部計測値など）を直接記録"""
+        if not self.enabled:
+            return
+        stack = self._stack()
+        path = ';'.join([s[0] for s in stack] + [name])
+        if stack:
+            stack[-1][2][0] += ms
+        self._record(name, kbn or (stack[-1][1] if stack else ''), path, ms, ms)
+
+    def _record(self, name: str, kbn: str, path: str, ms: float, self_ms: float):
+        with self._lock:
+            hist = self._stages.get(name)
+            if hist is None:
+                hist = self._stages[name] = Histogram()
+            hist.add(ms)
+            key = (name, kbn or '(none)')
+            hist = self._by_kbn.get(key)
+            if hist is None:
+                hist = self._by_kbn[key] = Histogram()
+            hist.add(ms)
+            self._folded[path] = self._folded.get(path, 0.0) + self_ms
+
+    def report(self) -> Dict:
+        with self._lock:
+            by_kbn: Dict[str, Dict[str, Dict]] = {}
+            for (name, kbn), hist in sorted(self._by_kbn.items()):
+                by_kbn.setdefault(kbn, {})[name] = hist.to_dict()
+            return {
+                'wall_s': round(time.perf_counter() - self._started, 3),
+                'stages': {name: h.to_dict() for name, h in sorted(self._stages.items())},
+                'by_kbn': by_kbn,
+            }
+
+    def folded_lines(self) -> List[str]:
+        """flamegraph.pl / speedscope 用の collapsed stack（値は self time μs）"""
+        with self._lock:
+            return [f'{path} {int(round(ms * 1000))}' for path, ms in sorted(self._folded.items()) if ms > 0]
+
+    def write_report(self, path: str) -> Tuple[str, str]:
+        """JSONレポートと .folded を書き出し、(json_path, folded_path) を返す"""
+        json_path = str(path)
+        folded_path = os.path.splitext(json_path)[0] + '.folded'
+        out_dir = os.path.dirname(json_path)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        with open(folded_path, 'w', encoding='utf-8') as f:
+            for line in self.folded_lines():
+                f.write(line + '\n')
+        return json_path, folded_path
+
+    def summary_lines(self) -> List[str]:
+        rep = self.report()
+        lines = [f'⏱ ステージ別計測 (wall {rep["wall_s"]:.1f}s)']
+        for name, st in sorted(rep['stages'].items(), key=lambda kv: -kv[1]['total_ms']):
+            lines.append(
+                f'  {name:<22} n={st["count"]:<6} total={st["total_ms"] / 1000:8.2f}s '
+                f'mean={st["mean_ms"]:9.2f}ms p90≤{st["p90_ms"]}ms'
+            )
+        return lines
+
+
+# プロセス全体で共有する計測器（既定は無効）
+PROFILER = StageProfiler()
+
+
+def add_profile_argument(ap, default_name: str = 'profile.json'):
+    """argparse に --profile [PATH] を追加する"""
+    ap.add_argument('--profile', nargs='?', const=default_name, default=None, metavar='PATH',
+                    help=f'ステージ別計測を有効化し、レポートを PATH（既定: {default_name}）と .folded に出力')
+
+
+def finish_profile(path: Optional[str]):
+    """--profile 指定時にレポートを書き出してサマリを表示"""
+    if not path or not PROFILER.enabled:
+        return
+    for line in PROFILER.summary_lines():
+        print(line)
+    json_path, folded_path = PROFILER.write_report(path)
+    print(f'✅ 計測レポート: {json_path}')
+    print(f'✅ flamegraph用: {folded_path}')
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+output_root（OneDrive 同期フォルダ）への書き出しをローカルの作業フォルダ経由にする
+
+CSV / TSV / サムネイルを output_root に直接書くと、1ファイル書くたびに OneDrive が
+同期を始め、書きかけのファイルが同期されたり、Excel で開いているファイルに
+PermissionError で書けずに _YYYYMMDD_HHMMSS 付きの別名ファイルが増えていく。
+
+ - 患者1人分の出力をまずローカルの作業フォルダ（既定: %TEMP%/ocr_output_staging）に書く
+ - commit() でまとめて反映。内容が同じファイルは触らない（同期が走らない）
+ - 反映は同じフォルダの一時ファイル（~$ 接頭辞）にコピーしてから os.replace で置き換える
+   （読む側が書きかけのファイルを見ることはない）
+ - 置き換え先がロックされていれば間隔を空けて再試行し、それでも駄目なら作業ファイルを
+   残して報告する（別名ファイルは作らない。閉じてから commit() し直すか再実行すれば反映される）
+
+使い方:
+    out = StagedOutput(OUTPUT_ROOT)
+    with out.open(pid, f'vision_iop_{pid}.csv', encoding='utf-8-sig', newline='') as f:
+        ...
+    save_thumbnail(img, out.path(pid, 'thumbnails', name))   # 作業フォルダ内のパスに書く
+    out.commit()
+    print('\\n'.join(out.summary_lines()))
+"""
+
+import os
+import time
+import shutil
+import filecmp
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, IO, Iterator, List, Optional
+
+from tree_walker import list_files
+
+STAGING_ROOT = os.path.join(tempfile.gettempdir(), 'ocr_output_staging')
+LOCK_RETRIES = 6            # 0.5 + 1 + 2 + 4 + 8 + 16 ≒ 30秒待つ
+LOCK_RETRY_WAIT = 0.5
+TMP_PREFIX = '~$'           # Office の一時ファイルと同じ接頭辞（同期対象外）
+
+
+class StagedOutput:
+    """output_root 配下への書き出しを作業フォルダに溜めて、commit() でまとめて反映する"""
+
+    KEYS = ('written_files', 'unchanged_files', 'retried_files', 'locked_files')
+
+    def __init__(self, output_root: str, staging_root: Optional[str] = None,
+                 retries: int = LOCK_RETRIES, retry_wait: float = LOCK_RETRY_WAIT):
+        self.output_root = os.fspath(output_root)
+        self.retries = retries
+        self.retry_wait = retry_wait
+        # 出力先ごとに分け、同時に動く別プロセスとは別のフォルダを使う
+        tag = hashlib.sha1(os.path.abspath(self.output_root).encode('utf-8')).hexdigest()[:8]
+        self._staging_base = os.path.join(staging_root or STAGING_ROOT, tag)
+        self.staging_dir = ''                   # 最初の path() で作る
+        self._staged: Dict[str, None] = {}       # 相対パス（登録順を保つ）
+        self.locked: List[str] = []
+        self.counts: Dict[str, int] = {k: 0 for k in self.KEYS}
+
+    def __enter__(self) -> 'StagedOutput':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    def target(self, *parts: str) -> str:
+        """反映先（output_root 配下）のパス"""
+        return os.path.join(self.output_root, *parts)
+
+    def _rel(self, parts) -> str:
+        rel = os.path.normpath(os.path.join(*parts))
+        if rel.startswith('..') or os.path.isabs(rel):
+            raise ValueError(f'output_root の外には書けません: {rel}')
+        if not self.staging_dir:
+            os.makedirs(self._staging_base, exist_ok=True)
+            self.staging_dir = tempfile.mkdtemp(prefix='batch_', dir=self._staging_base)
+        return rel
+
+    def path(self, *parts: str) -> str:
+        """作業フォルダ内のパス。ここに書いたファイルが commit() で target(*parts) に反映される"""
+        rel = self._rel(parts)
+        self._staged[rel] = None
+        staged = os.path.join(self.staging_dir, rel)
+        os.makedirs(os.path.dirname(staged), exist_ok=True)
+        return staged
+
+    def dir(self, *parts: str) -> str:
+        """作業フォルダ内のフォルダ。中に書いたファイルは全て commit() で反映される"""
+        rel = self._rel(parts)     # 先に作業フォルダを作る（staging_dir が空のまま join しない）
+        staged = os.path.join(self.staging_dir, rel)
+        os.makedirs(staged, exist_ok=True)
+        return staged
+
+    def _pending(self) -> List[str]:
+        """反映待ちの相対パス。path() で登録した順、続いて dir() などに直接書かれたもの"""
+        order = dict(self._staged)
+        if self.staging_dir:
+            for staged in list_files(self.staging_dir, exts=None):
+                order.setdefault(os.path.relpath(staged, self.staging_dir), None)
+        return list(order)
+
+    @contextmanager
+    def open(self, *parts: str, mode: str = 'w', **kwargs) -> Iterator[IO]:
+        with open(self.path(*parts), mode, **kwargs) as f:
+            yield f
+
+    def write_bytes(self, data: bytes, *parts: str) -> str:
+        with open(self.path(*parts), 'wb') as f:
+            f.write(data)
+        return self.target(*parts)
+
+    def _replace(self, staged: str, dest: str) -> str:
+        """dest を staged の内容で置き換える。戻り値は written / unchanged / locked"""
+        if os.path.isfile(dest) and filecmp.cmp(staged, dest, shallow=False):
+            return 'unchanged'
+        dest_dir = os.path.dirname(dest)
+        os.makedirs(dest_dir, exist_ok=True)
+        tmp = os.path.join(dest_dir, TMP_PREFIX + os.path.basename(dest))
+        shutil.copyfile(staged, tmp)
+        wait = self.retry_wait
+        for attempt in range(self.retries + 1):
+            try:
+                os.replace(tmp, dest)
+                if attempt:
+                    self.counts['retried_files'] += 1
+                return 'written'
+            except PermissionError:     # Excel で開いている / 同期中
+                if attempt == self.retries:
+                    break
+                time.sleep(wait)
+                wait *= 2
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return 'locked'
+
+    def commit(self) -> List[str]:
+        """溜めたファイルを登録順に反映し、反映先のパスを返す（ロック中のものは除く）"""
+        committed: List[str] = []
+        self.locked = []
+        for rel in self._pending():
+            staged = os.path.join(self.staging_dir, rel)
+            if not os.path.isfile(staged):   # path() だけ取って書かなかった
+                self._staged.pop(rel, None)
+                continue
+            dest = self.target(rel)
+            result = self._replace(staged, dest)
+            if result == 'locked':
+                self.counts['locked_files'] += 1
+                self.locked.append(dest)
+                continue
+            self.counts[f'{result}_files'] += 1
+            committed.append(dest)
+            os.remove(staged)
+            self._staged.pop(rel, None)
+        if not self.locked and self.staging_dir:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir = ''
+        return committed
+
+    def discard(self):
+        """反映せずに作業フォルダを消す"""
+        self._staged.clear()
+        if self.staging_dir:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir = ''
+
+    def summary_lines(self) -> List[str]:
+        return summary_lines(self.counts, self.locked, self.staging_dir)
+
+
+def summary_lines(counts: Dict[str, int], locked: Optional[List[str]] = None,
+                  staging_dir: str = '') -> List[str]:
+    """StagedOutput.counts（複数をまとめたものでもよい）の要約"""
+    total = sum(counts.get(k, 0) for k in ('written_files', 'unchanged_files', 'locked_files'))
+    if not total:
+        return []
+    lines = [f'📤 出力反映: {total}件中 更新 {counts.get("written_files", 0)}件 / '
+             f'変更なし {counts.get("unchanged_files", 0)}件'
+             + (f' / ロック待ち後に更新 {counts["retried_files"]}件' if counts.get('retried_files') else '')]
+    if counts.get('locked_files'):
+        lines.append(f'⚠️ ロック中のため未反映: {counts["locked_files"]}件'
+                     + (f'（作業ファイル: {staging_dir}）' if staging_dir else ''))
+        for dest in (locked or [])[:10]:
+            lines.append(f'  {dest}')
+    return lines
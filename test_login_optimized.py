@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+tools/login_optimized のテスト（レート制限・トークン失効）
+"""
+
+import os
+import sys
+
+import jwt
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+from login_optimized import JWTManager, MemoryRevocationStore, RateLimiter, SQLiteRevocationStore
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter_sliding_window():
+    clock = FakeClock()
+    limiter = RateLimiter(max_attempts=3, window_minutes=1, clock=clock)
+    for _ in range(3):
+        assert limiter.is_allowed('doctor')
+        clock.now += 10
+    assert not limiter.is_allowed('doctor')       # 直近60秒に3回
+    assert limiter.is_allowed('nurse')            # 別ユーザーは別枠
+
+    clock.now += 31                               # 最初の試行（t=0）が窓から外れる
+    assert limiter.is_allowed('doctor')
+    assert not limiter.is_allowed('doctor')
+    limiter.reset_attempts('doctor')
+    assert limiter.is_allowed('doctor')
+
+
+def test_rate_limiter_evicts_idle_users():
+    clock = FakeClock()
+    limiter = RateLimiter(max_attempts=3, window_minutes=1, shards=4, evict_interval_seconds=30, clock=clock)
+    for i in range(100):
+        limiter.is_allowed(f'user{i}')
+    assert limiter.tracked_keys() == 100
+
+    clock.now += 61
+    limiter.is_allowed('user0')                   # 各シャードは次の試行で古いキーを捨てる
+    assert limiter.tracked_keys() < 100
+    limiter.evict_idle()                          # 残りのシャードもまとめて捨てる
+    assert limiter.tracked_keys() == 1            # 窓内に試行があるのは user0 だけ
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store_and_clock(request, tmp_path):
+    clock = FakeClock()
+    if request.param == 'memory':
+        return MemoryRevocationStore(clock=clock), clock
+    return SQLiteRevocationStore(str(tmp_path / 'revoked.db'), clock=clock, purge_interval_seconds=0), clock
+
+
+def test_jti_revocation_expires_with_token(store_and_clock):
+    store, clock = store_and_clock
+    store.revoke('a', clock.now + 60)
+    store.revoke('b', clock.now + 3600)
+    assert store.is_revoked('a') and store.is_revoked('b')
+    assert len(store) == 2
+
+    clock.now += 61
+    assert not store.is_revoked('a')     # トークン自体が期限切れなので覚えておく必要はない
+    assert store.is_revoked('b')
+    store.purge()
+    assert len(store) == 1
+
+
+def test_already_expired_token_is_not_stored(store_and_clock):
+    store, clock = store_and_clock
+    store.revoke('a', clock.now - 1)
+    assert not store.is_revoked('a')
+    assert len(store) == 0
+
+
+def test_revoked_token_without_exp_stays_revoked(store_and_clock):
+    store, clock = store_and_clock
+    manager = JWTManager(secret_key='test-secret', revocation_store=store)
+    token = jwt.encode({'username': 'doctor', 'jti': 'no-exp'}, manager.secret_key, algorithm=manager.algorithm)
+    assert manager.verify_token(token)['username'] == 'doctor'
+
+    manager.blacklist_token(token)
+    assert manager.verify_token(token) is None
+    clock.now += 25 * 3600
+    store.purge()
+    assert manager.verify_token(token) is None
+    assert len(store) == 1
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+NearDupIndex（知覚ハッシュの近似重複索引）のテスト
+"""
+
+from near_dup import ImageHashes, NearDupIndex
+
+
+def image(tmstamp: str, no: int = 1) -> str:
+    return f'26147/&pidnum=26147&cdate=20240101&tmstamp=20240101 {tmstamp}&kbn=krt2-2&no={no}.jpg'
+
+
+A, B = image('100000'), image('100500')
+OLD = ImageHashes(dhash=0, phash=0)
+NEW = ImageHashes(dhash=(1 << 200) - 1, phash=(1 << 40) - 1)
+
+
+def test_readded_file_replaces_old_entry(tmp_path):
+    path = tmp_path / 'near_dup_index.jsonl'
+    ix = NearDupIndex(path)
+    ix.add(A, OLD, text='old text')
+    assert ix.find(OLD, B)['text'] == 'old text'
+    ix.add(A, NEW, text='new text')
+    assert len(ix) == 1
+    assert ix.find(OLD, B) is None          # 古いハッシュには一致しない
+    assert ix.find(NEW, B)['text'] == 'new text'
+
+    reloaded = NearDupIndex(path)           # JSONL は後の行が最新
+    assert len(reloaded) == 1
+    assert reloaded.find(OLD, B) is None
+    assert reloaded.find(NEW, B)['text'] == 'new text'
+
+
+def test_other_page_of_same_visit_is_not_a_duplicate(tmp_path):
+    ix = NearDupIndex(tmp_path / 'near_dup_index.jsonl')
+    ix.add(A, OLD, text='page 1')
+    assert ix.find(OLD, image('100500', no=2)) is None
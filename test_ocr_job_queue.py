@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+OCRジョブキュー（取得・リース・再試行・保留）のテスト
+"""
+
+import threading
+
+import pytest
+
+import ocr_job_queue
+from ocr_job_queue import JobQueue
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(ocr_job_queue.time, 'time', fake)
+    return fake
+
+
+def state(queue, job):
+    return queue.conn.execute('SELECT state, attempts FROM jobs WHERE id = ?', (job.id,)).fetchone()
+
+
+def test_concurrent_claims_are_exclusive(tmp_path):
+    db = str(tmp_path / 'jobs.db')
+    JobQueue(db).enqueue('final', [f'img{i}.jpg' for i in range(60)])
+    claimed = []
+    lock = threading.Lock()
+
+    def worker(name):
+        queue = JobQueue(db)
+        try:
+            while True:
+                job = queue.claim(name)
+                if job is None:
+                    return
+                with lock:
+                    claimed.append(job.id)
+                queue.complete(job)
+        finally:
+            queue.close()
+
+    threads = [threading.Thread(target=worker, args=(f'w{i}',)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(claimed) == 60
+    assert len(set(claimed)) == 60          # 同じジョブを2つのワーカーが取らない
+    assert JobQueue(db).counts()['final']['done'] == 60
+
+
+def test_expired_lease_is_reclaimed(tmp_path, clock):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    queue.enqueue('final', ['a.jpg'])
+    first = queue.claim('w1', lease=60)
+    assert queue.claim('w2', lease=60) is None      # リース中は取れない
+
+    clock.now += 61                                 # w1 が落ちてハートビートが止まった
+    second = queue.claim('w2', lease=60)
+    assert second is not None and second.id == first.id and second.attempts == 2
+    assert not queue.complete(first)                # 期限切れのワーカーは完了にできない
+    assert queue.complete(second)
+
+
+def test_fail_retries_with_backoff_then_fails(tmp_path, clock):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    queue.enqueue('final', ['a.jpg'], max_attempts=3)
+    for attempt in range(1, 4):
+        job = queue.claim('w1')
+        assert job is not None and job.attempts == attempt
+        result = queue.fail(job, 'RuntimeError: 503')
+        if attempt < 3:
+            assert result == 'pending'
+            assert queue.claim('w1') is None        # 待ち時間中は取れない
+            clock.now += ocr_job_queue.RETRY_BASE_SECONDS * 2 ** (attempt - 1)
+    assert result == 'failed'
+    assert state(queue, job)['state'] == 'failed'
+    clock.now += 3600
+    assert queue.claim('w1') is None
+
+
+def test_defer_does_not_count_as_attempt(tmp_path, clock):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    queue.enqueue('final', ['a.jpg'], max_attempts=1)
+    for _ in range(3):
+        job = queue.claim('w1')
+        assert job is not None and job.attempts == 1
+        assert queue.defer(job, 600, 'quota: daily')
+        assert state(queue, job)['attempts'] == 0
+        assert queue.claim('w1') is None
+        clock.now += 600
+    job = queue.claim('w1')
+    assert queue.fail(job, 'RuntimeError') == 'failed'   # 保留の回数は max_attempts に数えない
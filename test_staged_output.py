@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+StagedOutput の反映テスト（作業フォルダ → output_root）
+"""
+
+import os
+
+from staged_output import StagedOutput
+
+
+def test_dir_first_commits_under_output_root(tmp_path, monkeypatch):
+    """最初の呼び出しが dir() でも作業フォルダに書かれ、commit() で output_root に反映される"""
+    output_root = tmp_path / 'output_root'
+    cwd = tmp_path / 'cwd'
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+
+    out = StagedOutput(str(output_root), staging_root=str(tmp_path / 'staging'))
+    out_dir = out.dir('26147')
+    assert os.path.isabs(out_dir)
+    assert out_dir.startswith(out.staging_dir)
+    with open(os.path.join(out_dir, 'filename_params_26147.csv'), 'w', encoding='utf-8') as f:
+        f.write('pidnum\n26147\n')
+    thumbs = out.dir('26147', 'thumbnails')
+    with open(os.path.join(thumbs, 'a.jpg'), 'wb') as f:
+        f.write(b'jpg')
+
+    committed = out.commit()
+    assert sorted(committed) == sorted([
+        str(output_root / '26147' / 'filename_params_26147.csv'),
+        str(output_root / '26147' / 'thumbnails' / 'a.jpg'),
+    ])
+    assert (output_root / '26147' / 'filename_params_26147.csv').read_text(encoding='utf-8') == 'pidnum\n26147\n'
+    assert not os.listdir(cwd)            # カレントフォルダには何も残らない
+    assert out.staging_dir == ''
+
+
+def test_unchanged_file_is_not_rewritten(tmp_path):
+    output_root = tmp_path / 'output_root'
+    staging = str(tmp_path / 'staging')
+    for expected in ('written_files', 'unchanged_files'):
+        out = StagedOutput(str(output_root), staging_root=staging)
+        with out.open('26147', 'x.csv', encoding='utf-8') as f:
+            f.write('a\n')
+        out.commit()
+        assert out.counts[expected] == 1
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+サムネイルによるOCR前の画像種別判定（OCRを省略できる画像の検出）
+
+眼底写真（gantei2 / kowagantei）・FAF（keikou）・スリット写真などは画素がほとんどで
+文字が少ないため、Tesseract / Vision に渡す前にサムネイル（幅320px程度）で判定する。
+
+判定結果:
+ - 'skip'   : OCRしない（写真のみ）
+ - 'header' : 上端の帯（HEADER_FRACTION）だけOCR（写真 + 撮影日/眼別などの印字）
+ - 'full'   : 画像全体をOCR（従来どおり）
+
+特徴量は NumPy のみで計算（色味・白/黒画素率・エッジ密度・文字らしいブロック率）。
+既定はしきい値ルール。ラベル付きサンプルから最近傍重心モデルを学習して置き換えることもできる。
+紙カルテ・保険証など、kbn から文字主体と分かる画像は常に 'full'。
+
+使い方:
+    python thumb_classifier.py eval labels.csv [--model thumb_model.json]
+    python thumb_classifier.py fit labels.csv --out thumb_model.json
+
+labels.csv は file,label の2列（label は skip / header / full）。
+"""
+
+import os
+import csv
+import json
+import argparse
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from kbn_routing import EXAM_EXTRACTORS, route_for_kbn
+
+SKIP = 'skip'
+HEADER = 'header'
+FULL = 'full'
+DECISIONS: Tuple[str, ...] = (SKIP, HEADER, FULL)
+
+THUMB_MAX_WIDTH = 320
+HEADER_FRACTION = 0.15      # header 判定時にOCRする上端の割合
+
+FEATURE_NAMES: Tuple[str, ...] = (
+    'colorfulness', 'mean_luma', 'white_frac', 'dark_frac', 'edge_density', 'text_density', 'header_text_density',
+)
+
+# ルール判定のしきい値（特徴量は 0〜1 に正規化済み）
+EDGE_THRESHOLD = 40.0       # 隣接画素の輝度差がこれ以上ならエッジ
+BLOCK = 8                   # 文字ブロック判定のブロック一辺(px)
+FULL_WHITE_FRAC = 0.45      # 紙の背景らしい白画素率
+FULL_TEXT_DENSITY = 0.08    # 全体の文字ブロック率
+HEADER_TEXT_DENSITY = 0.04  # 上端帯の文字ブロック率
+
+
+def make_thumbnail(img, max_width: int = THUMB_MAX_WIDTH):
+    """幅 max_width 以下に縮小した画像（既に小さければそのまま）"""
+    if img is None:
+        return None
+    h, w = img.shape[:2]
+    if w <= max_width:
+        return img
+    import cv2
+    scale = max_width / w
+    return cv2.resize(img, (int(w * scale), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def header_strip(img):
+    """上端 HEADER_FRACTION の帯（header 判定時のOCR対象）"""
+    h = img.shape[0]
+    return img[:max(1, int(np.ceil(h * HEADER_FRACTION)))]
+
+
+def _text_block_fraction(edges: np.ndarray, gray: np.ndarray) -> float:
+    """BLOCK 四方ごとに「エッジ密度が中程度かつコントラストが高い」ブロックの割合"""
+    h = (edges.shape[0] // BLOCK) * BLOCK
+    w = (edges.shape[1] // BLOCK) * BLOCK
+    if not h or not w:
+        return 0.0
+    e = edges[:h, :w].reshape(h // BLOCK, BLOCK, w // BLOCK, BLOCK).mean(axis=(1, 3))
+    g = gray[:h, :w].reshape(h // BLOCK, BLOCK, w // BLOCK, BLOCK).std(axis=(1, 3))
+    textlike = (e >= 0.08) & (e <= 0.6) & (g >= 30.0)
+    return float(textlike.mean())
+
+
+def compute_features(img) -> np.ndarray:
+    """サムネイル（BGR またはグレースケール uint8）から FEATURE_NAMES 順の特徴ベクトル"""
+    a = np.asarray(img, dtype=np.float32)
+    if a.ndim == 3 and a.shape[2] >= 3:
+        b, g, r = a[..., 0], a[..., 1], a[..., 2]
+        gray = 0.114 * b + 0.587 * g + 0.299 * r
+        # Hasler & Süsstrunk の colorfulness（0〜1 に概ね収まるよう 150 で割る）
+        rg = r - g
+        yb = 0.5 * (r + g) - b
+        colorful = (np.hypot(rg.std(), yb.std()) + 0.3 * np.hypot(rg.mean(), yb.mean())) / 150.0
+    else:
+        gray = a if a.ndim == 2 else a[..., 0]
+        colorful = 0.0
+    dx = np.abs(np.diff(gray, axis=1))[:-1, :]
+    dy = np.abs(np.diff(gray, axis=0))[:, :-1]
+    edges = (np.maximum(dx, dy) >= EDGE_THRESHOLD).astype(np.float32)
+    header_rows = max(BLOCK, int(np.ceil(edges.shape[0] * HEADER_FRACTION)))
+    return np.array([
+        min(1.0, float(colorful)),
+        float(gray.mean()) / 255.0,
+        float((gray >= 200).mean()),
+        float((gray <= 50).mean()),
+        float(edges.mean()) if edges.size else 0.0,
+        _text_block_fraction(edges, gray),
+        _text_block_fraction(edges[:header_rows], gray[:header_rows]),
+    ], dtype=np.float32)
+
+
+def rule_decision(features: Sequence[float]) -> str:
+    """しきい値ルール。迷う画像は 'full'（OCR漏れを避ける側に倒す）"""
+    f = dict(zip(FEATURE_NAMES, features))
+    if f['white_frac'] >= FULL_WHITE_FRAC or f['text_density'] >= FULL_TEXT_DENSITY:
+        return FULL
+    if f['header_text_density'] >= HEADER_TEXT_DENSITY:
+        return HEADER
+    return SKIP
+
+
+class CentroidModel:
+    """標準化した特徴空間での最近傍重心分類（ラベル付きサンプルから学習）"""
+
+    def __init__(self, labels: List[str], centroids: np.ndarray, mean: np.ndarray, scale: np.ndarray):
+        self.labels = labels
+        self.centroids = centroids
+        self.mean = mean
+        self.scale = scale
+
+    @classmethod
+    def fit(cls, X: np.ndarray, y: Sequence[str]) -> 'CentroidModel':
+        X = np.asarray(X, dtype=np.float32)
+        mean = X.mean(axis=0)
+        scale = X.std(axis=0)
+        scale[scale < 1e-6] = 1.0
+        Z = (X - mean) / scale
+        labels = [d for d in DECISIONS if d in set(y)]
+        y_arr = np.asarray(y)
+        centroids = np.stack([Z[y_arr == lab].mean(axis=0) for lab in labels])
+        return cls(labels, centroids, mean, scale)
+
+    def predict(self, features: Sequence[float]) -> str:
+        z = (np.asarray(features, dtype=np.float32) - self.mean) / self.scale
+        dist = ((self.centroids - z) ** 2).sum(axis=1)
+        return self.labels[int(dist.argmin())]
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'features': list(FEATURE_NAMES),
+                'labels': self.labels,
+                'centroids': self.centroids.tolist(),
+                'mean': self.mean.tolist(),
+                'scale': self.scale.tolist(),
+            }, f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> 'CentroidModel':
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if list(data.get('features', [])) != list(FEATURE_NAMES):
+            raise ValueError(f'特徴量の構成が異なるモデルです: {path}')
+        return cls(data['labels'], np.asarray(data['centroids'], dtype=np.float32),
+                   np.asarray(data['mean'], dtype=np.float32), np.asarray(data['scale'], dtype=np.float32))
+
+
+def gate_eligible(kbn: str) -> bool:
+    """判定の対象にする kbn か（検査画像 / 未定義 kbn のみ。紙カルテ・保険証は常に全体OCR）"""
+    route = route_for_kbn(kbn)
+    return route is None or route.extractors == EXAM_EXTRACTORS
+
+
+class OcrGate:
+    """OCR前の判定と、OCRを省略できた割合の集計"""
+
+    def __init__(self, model: Optional[CentroidModel] = None):
+        self.model = model
+        self._lock = threading.Lock()
+        self.counts: Dict[str, Dict[str, int]] = {}   # kbn -> decision -> 件数
+
+    def classify(self, thumb) -> str:
+        features = compute_features(thumb)
+        if self.model is not None:
+            return self.model.predict(features)
+        return rule_decision(features)
+
+    def decide(self, thumb, kbn: str = '') -> str:
+        decision = self.classify(thumb) if thumb is not None and gate_eligible(kbn) else FULL
+        with self._lock:
+            per_kbn = self.counts.setdefault(kbn or '(none)', {})
+            per_kbn[decision] = per_kbn.get(decision, 0) + 1
+        return decision
+
+    def report(self) -> Dict:
+        with self._lock:
+            totals = {d: sum(c.get(d, 0) for c in self.counts.values()) for d in DECISIONS}
+            by_kbn = {k: dict(v) for k, v in sorted(self.counts.items())}
+        n = sum(totals.values())
+        # header は上端の帯だけOCRするので、画素換算では (1 - HEADER_FRACTION) 分を省略
+        avoided_pixels = totals[SKIP] + totals[HEADER] * (1.0 - HEADER_FRACTION)
+        return {
+            'images': n,
+            'decisions': totals,
+            'ocr_avoided': round(totals[SKIP] / n, 4) if n else 0.0,
+            'pixels_avoided': round(avoided_pixels / n, 4) if n else 0.0,
+            'by_kbn': by_kbn,
+        }
+
+    def summary_lines(self) -> List[str]:
+        rep = self.report()
+        if not rep['images']:
+            return []
+        d = rep['decisions']
+        lines = [
+            f'🖼 OCR事前判定: {rep["images"]}件 (skip {d[SKIP]} / header {d[HEADER]} / full {d[FULL]}) '
+            f'→ OCR回避 {rep["ocr_avoided"]:.1%}, 画素換算 {rep["pixels_avoided"]:.1%}'
+        ]
+        for kbn, counts in rep['by_kbn'].items():
+            parts = ' / '.join(f'{k} {counts[k]}' for k in DECISIONS if counts.get(k))
+            lines.append(f'  {kbn:<12} {parts}')
+        return lines
+
+
+def add_gate_arguments(ap):
+    """argparse に OCR事前判定の引数を追加する"""
+    ap.add_argument('--ocr-gate', action='store_true',
+                    help='サムネイルで写真主体の画像を判定し、OCRを省略/上端のみにする')
+    ap.add_argument('--ocr-gate-model', default=None, metavar='PATH',
+                    help='thumb_classifier.py fit で作成したモデル（既定: しきい値ルール）')
+
+
+def gate_from_args(args) -> Optional[OcrGate]:
+    if not getattr(args, 'ocr_gate', False):
+        return None
+    model = CentroidModel.load(args.ocr_gate_model) if args.ocr_gate_model else None
+    return OcrGate(model)
+
+
+# ---- ラベル付きサンプルでの評価 / 学習 ----
+
+def _load_image(path: str):
+    import cv2
+    data = np.fromfile(path, dtype=np.uint8)
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+def load_labeled_sample(labels_csv: str) -> Tuple[List[str], np.ndarray, List[str]]:
+    """labels.csv（file,label）を読み、(files, 特徴量行列, ラベル) を返す。file は CSV からの相対パス可"""
+    base_dir = os.path.dirname(os.path.abspath(labels_csv))
+    files: List[str] = []
+    rows: List[np.ndarray] = []
+    labels: List[str] = []
+    with open(labels_csv, 'r', encoding='utf-8-sig', newline='') as f:
+        for rec in csv.DictReader(f):
+            label = (rec.get('label') or '').strip().lower()
+            path = (rec.get('file') or '').strip()
+            if label not in DECISIONS or not path:
+                continue
+            if not os.path.isabs(path):
+                path = os.path.join(base_dir, path)
+            img = _load_image(path)
+            if img is None:
+                print(f'⚠️ 読み込めません: {path}')
+                continue
+            files.append(path)
+            rows.append(compute_features(make_thumbnail(img)))
+            labels.append(label)
+    X = np.stack(rows) if rows else np.zeros((0, len(FEATURE_NAMES)), dtype=np.float32)
+    return files, X, labels
+
+
+def evaluate(X: np.ndarray, labels: List[str], model: Optional[CentroidModel] = None) -> Dict:
+    """誤判定率・混同行列・危険側の誤り（文字のある画像を skip）と、OCR回避率"""
+    predict = model.predict if model is not None else rule_decision
+    preds = [predict(x) for x in X]
+    confusion = {t: {p: 0 for p in DECISIONS} for t in DECISIONS}
+    for t, p in zip(labels, preds):
+        confusion[t][p] += 1
+    n = len(labels)
+    wrong = sum(1 for t, p in zip(labels, preds) if t != p)
+    # 全体に文字がある画像を skip/header、上端に文字がある画像を skip にすると情報が欠落する
+    unsafe = sum(1 for t, p in zip(labels, preds)
+                 if (t == FULL and p != FULL) or (t == HEADER and p == SKIP))
+    return {
+        'images': n,
+        'misclassification_rate': round(wrong / n, 4) if n else 0.0,
+        'unsafe_rate': round(unsafe / n, 4) if n else 0.0,
+        'ocr_avoided': round(preds.count(SKIP) / n, 4) if n else 0.0,
+        'confusion': confusion,
+        'predictions': preds,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description='サムネイルによるOCR前判定の評価/学習')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    ev = sub.add_parser('eval', help='ラベル付きサンプルで誤判定率とOCR回避率を表示')
+    ev.add_argument('labels', help='file,label の CSV')
+    ev.add_argument('--model', default=None, help='学習済みモデル（既定: しきい値ルール）')
+    ev.add_argument('--show-errors', action='store_true', help='誤判定したファイルを表示')
+    ft = sub.add_parser('fit', help='最近傍重心モデルを学習して保存')
+    ft.add_argument('labels', help='file,label の CSV')
+    ft.add_argument('--out', default='thumb_model.json')
+    args = ap.parse_args()
+
+    files, X, labels = load_labeled_sample(args.labels)
+    if not labels:
+        print(f'❌ ラベル付き画像がありません: {args.labels}')
+        return
+
+    if args.cmd == 'fit':
+        model = CentroidModel.fit(X, labels)
+        model.save(args.out)
+        res = evaluate(X, labels, model)
+        print(f'✅ モデル保存: {args.out} (学習データでの誤判定率 {res["misclassification_rate"]:.1%})')
+        return
+
+    model = CentroidModel.load(args.model) if args.model else None
+    res = evaluate(X, labels, model)
+    print(f'📊 {res["images"]}件  誤判定率 {res["misclassification_rate"]:.1%}  '
+          f'危険側の誤り {res["unsafe_rate"]:.1%}  OCR回避 {res["ocr_avoided"]:.1%}')
+    print('  正解\\判定 ' + ' '.join(f'{d:>7}' for d in DECISIONS))
+    for t in DECISIONS:
+        print(f'  {t:<9} ' + ' '.join(f'{res["confusion"][t][p]:>7}' for p in DECISIONS))
+    if args.show_errors:
+        for path, t, p in zip(files, labels, res['predictions']):
+            if t != p:
+                print(f'  ✗ {t}→{p}: {os.path.basename(path)}')
+
+
+if __name__ == '__main__':
+    main()
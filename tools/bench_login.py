@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+login_optimized のスループット計測
+- ratelimit: 多数のユーザー名に対する RateLimiter.is_allowed の並行スループット
+  （旧実装: 全体ロック + 毎回リスト再構築 との比較つき）
+- jwt: 失効済み jti を大量に抱えた状態での JWTManager.verify_token スループット
+  （メモリ / SQLite の失効ストア、旧実装: トークン文字列の set との比較つき）
+
+使い方:
+  python bench_login.py ratelimit --users 20000 --threads 8 --ops 200000
+  python bench_login.py jwt --revoked 100000 --threads 4 --ops 20000
+"""
+
+import argparse
+import os
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.append(str(Path(__file__).parent))
+from login_optimized import RateLimiter, JWTManager, MemoryRevocationStore, SQLiteRevocationStore
+
+
+class LegacyRateLimiter:
+    """比較用: 変更前の実装（全体ロック + リスト内包で毎回再構築、キーを破棄しない）"""
+
+    def __init__(self, max_attempts: int = 5, window_minutes: int = 15):
+        self.max_attempts = max_attempts
+        self.window_minutes = window_minutes
+        self.attempts = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def is_allowed(self, username: str) -> bool:
+        with self.lock:
+            now = time.time()
+            window_start = now - (self.window_minutes * 60)
+            self.attempts[username] = [t for t in self.attempts[username] if t > window_start]
+            if len(self.attempts[username]) >= self.max_attempts:
+                return False
+            self.attempts[username].append(now)
+            return True
+
+    def tracked_keys(self) -> int:
+        return len(self.attempts)
+
+
+def run_threads(check: Callable[[str], bool], usernames: List[str], threads: int, ops: int) -> Dict[str, float]:
+    """threads 本で合計 ops 回 check() を呼び、ops/s と許可率を返す"""
+    per_thread = max(1, ops // threads)
+    allowed = [0] * threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(idx: int):
+        rnd = random.Random(idx)
+        names = [rnd.choice(usernames) for _ in range(per_thread)]
+        barrier.wait()
+        ok = 0
+        for name in names:
+            if check(name):
+                ok += 1
+        allowed[idx] = ok
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    total = per_thread * threads
+    return {
+        'ops': total,
+        'seconds': elapsed,
+        'ops_per_s': total / elapsed if elapsed > 0 else 0.0,
+        'allowed_ratio': sum(allowed) / total,
+    }
+
+
+def bench_ratelimit(args):
+    usernames = [f'user{i:06d}' for i in range(args.users)]
+    print(f'=== RateLimiter: users={args.users} threads={args.threads} ops={args.ops} ===')
+
+    clock_start = time.monotonic()
+    limiter = RateLimiter(max_attempts=5, window_minutes=args.window_minutes,
+                          shards=args.shards, evict_interval_seconds=args.evict_interval)
+    legacy = LegacyRateLimiter(max_attempts=5, window_minutes=args.window_minutes)
+
+    for name, impl in (('legacy', legacy), ('sharded', limiter)):
+        stats = run_threads(impl.is_allowed, usernames, args.threads, args.ops)
+        print(f'{name:<8} {stats["ops_per_s"]:>12,.0f} ops/s  '
+              f'({stats["seconds"]:.2f}s, 許可率 {stats["allowed_ratio"]:.1%}, 保持キー {impl.tracked_keys():,})')
+
+    # 短いウィンドウ指定時は失効を待ってから破棄を確認
+    if limiter.window_seconds <= 5:
+        time.sleep(limiter.window_seconds)
+    removed = limiter.evict_idle()
+    print(f'evict_idle: {removed:,} 件破棄 / 残り {limiter.tracked_keys():,} 件 '
+          f'(経過 {time.monotonic() - clock_start:.1f}s, ウィンドウ {args.window_minutes * 60:.0f}s)')
+
+
+class LegacyJWTManager(JWTManager):
+    """比較用: 変更前の失効管理（トークン文字列の set、ロック下で毎回照合、期限切れも残る）"""
+
+    def __init__(self, secret_key: str):
+        super().__init__(secret_key)
+        self.token_blacklist = set()
+        self.lock = threading.Lock()
+
+    def verify_token(self, token: str):
+        with self.lock:
+            if token in self.token_blacklist:
+                return None
+        return super().verify_token(token)
+
+    def blacklist_token(self, token: str):
+        with self.lock:
+            self.token_blacklist.add(token)
+
+
+def bench_jwt(args):
+    warnings.simplefilter('ignore')
+    secret = secrets.token_urlsafe(32)
+    print(f'=== JWTManager.verify_token: revoked={args.revoked} threads={args.threads} ops={args.ops} ===')
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_jwt_')
+    managers = [
+        ('legacy', LegacyJWTManager(secret)),
+        ('memory', JWTManager(secret, MemoryRevocationStore())),
+        ('sqlite', JWTManager(secret, SQLiteRevocationStore(os.path.join(tmpdir, 'revoked.db')))),
+    ]
+    exp = time.time() + 3600
+    for name, manager in managers:
+        t0 = time.perf_counter()
+        if isinstance(manager, LegacyJWTManager):
+            for _ in range(args.revoked):
+                manager.token_blacklist.add(manager.generate_token('user', 'user'))
+        elif isinstance(manager.revocation_store, SQLiteRevocationStore):
+            conn = manager.revocation_store._conn()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO revoked_jti(jti, exp) VALUES (?, ?)',
+                                 ((secrets.token_urlsafe(16), exp) for _ in range(args.revoked)))
+        else:
+            for _ in range(args.revoked):
+                manager.revocation_store.revoke(secrets.token_urlsafe(16), exp)
+        setup = time.perf_counter() - t0
+
+        # 検証対象のトークン（revoked_share の割合だけ失効させる）
+        tokens = [manager.generate_token(f'user{i}', 'user') for i in range(200)]
+        for token in tokens[:int(len(tokens) * args.revoked_share)]:
+            manager.blacklist_token(token)
+        stats = run_threads(lambda tok: manager.verify_token(tok) is not None, tokens, args.threads, args.ops)
+        print(f'{name:<8} {stats["ops_per_s"]:>10,.0f} verify/s  '
+              f'(有効率 {stats["allowed_ratio"]:.1%}, 失効登録 {setup:.2f}s)')
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='login_optimized のスループット計測')
+    sub = ap.add_subparsers(dest='target', required=True)
+
+    rl = sub.add_parser('ratelimit', help='RateLimiter.is_allowed の並行スループット')
+    rl.add_argument('--users', type=int, default=20000, help='ユーザー名の種類数')
+    rl.add_argument('--threads', type=int, default=8)
+    rl.add_argument('--ops', type=int, default=200000, help='合計呼び出し回数')
+    rl.add_argument('--shards', type=int, default=64)
+    rl.add_argument('--window-minutes', type=float, default=15)
+    rl.add_argument('--evict-interval', type=float, default=60.0)
+    rl.set_defaults(func=bench_ratelimit)
+
+    jw = sub.add_parser('jwt', help='JWTManager.verify_token のスループット')
+    jw.add_argument('--revoked', type=int, default=100000, help='事前に登録する失効数')
+    jw.add_argument('--threads', type=int, default=4)
+    jw.add_argument('--ops', type=int, default=20000, help='合計検証回数')
+    jw.add_argument('--revoked-share', type=float, default=0.05, help='検証対象のうち失効済みの割合')
+    jw.set_defaults(func=bench_jwt)
+
+    args = ap.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,12 +12,15 @@ import jwt
 import hashlib
 import datetime
 import time
+import math
 import secrets
-from typing import Dict, Optional, Union, Tuple
+import heapq
+import sqlite3
+from typing import Dict, List, Optional, Union, Tuple
 from dataclasses import dataclass
 from functools import lru_cache
 import logging
-from collections import defaultdict
+from collections import deque
 import threading
 
 logger = logging.getLogger(__name__)
@@ -42,37 +45,87 @@ class User:
     locked_until: Optional[datetime.datetime] = None
 
 class RateLimiter:
-    """レート制限クラス"""
+    """レート制限クラス（スライディングウィンドウ）
+
+    - ユーザー名ごとに直近 max_attempts 件の試行時刻だけを deque に保持（償却O(1)）
+    - ロックはユーザー名のハッシュでシャード分割し、別ユーザー同士は競合しない
+    - ウィンドウを過ぎたユーザー名は定期的に破棄し、メモリを有界に保つ
+    """
     
-    def __init__(self, max_attempts: int = 5, window_minutes: int = 15):
+    def __init__(self, max_attempts: int = 5, window_minutes: int = 15,
+                 shards: int = 64, evict_interval_seconds: float = 60.0,
+                 clock=time.monotonic):
         self.max_attempts = max_attempts
         self.window_minutes = window_minutes
-        self.attempts = defaultdict(list)
-        self.lock = threading.Lock()
+        self.window_seconds = window_minutes * 60
+        self.evict_interval_seconds = evict_interval_seconds
+        self._clock = clock
+        self._shards = [_RateLimiterShard() for _ in range(max(1, shards))]
+    
+    def _shard(self, username: str) -> '_RateLimiterShard':
+        return self._shards[hash(username) % len(self._shards)]
     
     def is_allowed(self, username: str) -> bool:
         """レート制限チェック"""
-        with self.lock:
-            now = time.time()
-            window_start = now - (self.window_minutes * 60)
+        shard = self._shard(username)
+        with shard.lock:
+            now = self._clock()
+            window_start = now - self.window_seconds
+            if now - shard.last_evicted >= self.evict_interval_seconds:
+                shard.evict_idle(window_start)
+                shard.last_evicted = now
+            
+            attempts = shard.attempts.get(username)
+            if attempts is None:
+                attempts = shard.attempts[username] = deque(maxlen=max(1, self.max_attempts))
             
-            # 古い試行を削除
-            self.attempts[username] = [
-                attempt_time for attempt_time in self.attempts[username]
-                if attempt_time > window_start
-            ]
+            # 古い試行を削除（先頭から期限切れ分だけ）
+            while attempts and attempts[0] <= window_start:
+                attempts.popleft()
             
             # 制限チェック
-            if len(self.attempts[username]) >= self.max_attempts:
+            if len(attempts) >= self.max_attempts:
                 return False
             
-            self.attempts[username].append(now)
+            attempts.append(now)
             return True
     
     def reset_attempts(self, username: str):
         """試行回数をリセット"""
-        with self.lock:
-            self.attempts[username].clear()
+        shard = self._shard(username)
+        with shard.lock:
+            shard.attempts.pop(username, None)
+    
+    def evict_idle(self) -> int:
+        """ウィンドウ外のユーザー名をすべて破棄し、破棄件数を返す"""
+        removed = 0
+        now = self._clock()
+        for shard in self._shards:
+            with shard.lock:
+                removed += shard.evict_idle(now - self.window_seconds)
+                shard.last_evicted = now
+        return removed
+    
+    def tracked_keys(self) -> int:
+        """保持しているユーザー名の数"""
+        return sum(len(shard.attempts) for shard in self._shards)
+
+class _RateLimiterShard:
+    """RateLimiter のシャード（ロック + ユーザー名 -> 試行時刻）"""
+    
+    __slots__ = ('lock', 'attempts', 'last_evicted')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts: Dict[str, deque] = {}
+        self.last_evicted = 0.0
+    
+    def evict_idle(self, window_start: float) -> int:
+        """最新の試行がウィンドウ外のキーを削除（ロック取得済みで呼ぶ）"""
+        idle = [k for k, q in self.attempts.items() if not q or q[-1] <= window_start]
+        for k in idle:
+            del self.attempts[k]
+        return len(idle)
 
 class UserManager:
     """ユーザー管理クラス"""
@@ -113,14 +166,130 @@ class UserManager:
             user.failed_attempts = 0
             user.locked_until = None
 
+class MemoryRevocationStore:
+    """失効済み jti の保持（プロセス内）
+
+    jti -> exp の辞書と exp 順のヒープを持ち、期限切れのエントリはヒープの先頭から捨てる。
+    トークン自体が exp で無効になるため、exp を過ぎた jti を覚えておく必要はない。
+    exp の無いトークンは exp=inf で登録し、破棄しない。
+    """
+    
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._expires: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self.lock = threading.Lock()
+    
+    def revoke(self, jti: str, exp: float):
+        with self.lock:
+            self._purge_locked()
+            if exp <= self._clock():
+                return
+            if self._expires.get(jti, 0.0) < exp:
+                self._expires[jti] = exp
+                heapq.heappush(self._heap, (exp, jti))
+    
+    def is_revoked(self, jti: str) -> bool:
+        exp = self._expires.get(jti)
+        if exp is None:
+            return False
+        if exp > self._clock():
+            return True
+        with self.lock:
+            self._purge_locked()
+        return False
+    
+    def purge(self) -> int:
+        with self.lock:
+            return self._purge_locked()
+    
+    def _purge_locked(self) -> int:
+        now = self._clock()
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            exp, jti = heapq.heappop(self._heap)
+            # 同じ jti がより長い exp で再登録されている場合は残す
+            if self._expires.get(jti) == exp:
+                del self._expires[jti]
+                removed += 1
+        return removed
+    
+    def __len__(self) -> int:
+        return len(self._expires)
+
+class SQLiteRevocationStore:
+    """失効済み jti の保持（SQLite）
+
+    再起動後も失効が残り、同じDBファイルを指す複数のワーカープロセスで共有できる。
+    接続はスレッドごと、DBは WAL モードで読み取りと書き込みを並行させる。
+    exp=inf（exp の無いトークン）の行は purge() でも消えない。
+    """
+    
+    def __init__(self, db_path: str, clock=time.time, purge_interval_seconds: float = 300.0):
+        self.db_path = str(db_path)
+        self._clock = clock
+        self.purge_interval_seconds = purge_interval_seconds
+        self._last_purge = 0.0
+        self._local = threading.local()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS revoked_jti ('
+                ' jti TEXT PRIMARY KEY,'
+                ' exp REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_revoked_jti_exp ON revoked_jti(exp)')
+    
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    def revoke(self, jti: str, exp: float):
+        now = self._clock()
+        if exp <= now:
+            return
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'INSERT INTO revoked_jti(jti, exp) VALUES (?, ?) '
+                'ON CONFLICT(jti) DO UPDATE SET exp = MAX(exp, excluded.exp)',
+                (jti, exp),
+            )
+        if now - self._last_purge >= self.purge_interval_seconds:
+            self.purge()
+    
+    def is_revoked(self, jti: str) -> bool:
+        row = self._conn().execute(
+            'SELECT 1 FROM revoked_jti WHERE jti = ? AND exp > ?', (jti, self._clock())
+        ).fetchone()
+        return row is not None
+    
+    def purge(self) -> int:
+        now = self._clock()
+        self._last_purge = now
+        conn = self._conn()
+        with conn:
+            cur = conn.execute('DELETE FROM revoked_jti WHERE exp <= ?', (now,))
+        return cur.rowcount
+    
+    def __len__(self) -> int:
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM revoked_jti WHERE exp > ?', (self._clock(),)
+        ).fetchone()[0]
+
 class JWTManager:
     """JWT管理クラス"""
     
-    def __init__(self, secret_key: Optional[str] = None):
+    def __init__(self, secret_key: Optional[str] = None, revocation_store=None):
         self.secret_key = secret_key or secrets.token_urlsafe(32)
         self.algorithm = 'HS256'
-        self.token_blacklist = set()
-        self.lock = threading.Lock()
+        # 失効は jti 単位で管理（SQLiteRevocationStore を渡せば永続化・プロセス間共有）
+        self.revocation_store = revocation_store if revocation_store is not None else MemoryRevocationStore()
     
     def generate_token(self, username: str, role: str, expires_hours: int = 24) -> str:
         """JWTトークン生成"""
@@ -138,12 +307,11 @@ class JWTManager:
     def verify_token(self, token: str) -> Optional[Dict]:
         """JWTトークン検証"""
         try:
-            # ブラックリストチェック
-            with self.lock:
-                if token in self.token_blacklist:
-                    return None
-            
             payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+            
+            # 失効チェック（署名・期限が有効なトークンのみ）
+            if self.revocation_store.is_revoked(self._revocation_key(token, payload)):
+                return None
             return payload
             
         except jwt.ExpiredSignatureError:
@@ -154,9 +322,26 @@ class JWTManager:
             return None
     
     def blacklist_token(self, token: str):
-        """トークンをブラックリストに追加"""
-        with self.lock:
-            self.token_blacklist.add(token)
+        """トークンを失効させる（jti を exp まで保持）"""
+        try:
+            payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm],
+                                 options={'verify_exp': False})
+        except jwt.InvalidTokenError:
+            # 署名が不正なトークンはそもそも検証を通らない
+            return
+        exp = payload.get('exp')
+        if exp is None:
+            # exp の無いトークンは期限切れにならないので、失効も無期限に保持
+            exp = math.inf
+        self.revocation_store.revoke(self._revocation_key(token, payload), float(exp))
+    
+    @staticmethod
+    def _revocation_key(token: str, payload: Dict) -> str:
+        """jti が無い旧トークンはトークン文字列のハッシュで代用"""
+        jti = payload.get('jti')
+        if jti:
+            return str(jti)
+        return 'sha256:' + hashlib.sha256(token.encode()).hexdigest()
 
 class LoginService:
     """ログインサービスクラス"""
@@ -7,48 +7,70 @@ master.csv の full_text を再スキャンで埋め直すツール
 使い方:
   ドライラン: python p1_distribute.py --patients-root ".\Patients" --master-csv ".\Patients\master.csv"
   本適用 　: python p1_distribute.py --patients-root ".\Patients" --master-csv ".\Patients\master.csv" --apply
+  計測    : 上記に --profile p1_profile.json を付けるとステージ別の時間を出力
+  比較    : 上記に --qr-compare を付けると、従来の全バリアントでも読み、成功率の差を出力（遅い）
 """
 
-import argparse, csv, os, re, sys
+import argparse, csv, os, re, sys, time
 from pathlib import Path
 from datetime import datetime
 from dateutil import parser as dtparser
 from urllib.parse import parse_qsl, unquote_plus
 import unicodedata
+from functools import lru_cache
 
 import numpy as np
 import cv2
 from PIL import Image, ExifTags
 
+# ステージ計測・ファイル名パラメータはリポジトリ直下の stage_profiler / filename_params を共有
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from filename_params import kbn_from_path
+from stage_profiler import PROFILER, add_profile_argument, finish_profile
+
 IMG_EXTS = {".jpg", ".jpeg", ".png", ".heic", ".tif", ".tiff", ".webp"}
 PID_KEYS  = ["pidnum","pid","patient_id","patient","patid","mrn","id","no"]
 DATE_KEYS = ["cdate","date","visit","visit_date","day","surg","surgery_date","dt","tm","tmstamp"]
 
+_YYYYMMDD = re.compile(r"20\d{6}")
+
 def normalize_date(s: str):
     if not s: return None
     s = s.strip()
-    if re.fullmatch(r"20\d{6}", s):  # 20250809
+    if _YYYYMMDD.fullmatch(s):  # 20250809
         return f"{s[0:4]}-{s[4:6]}-{s[6:8]}"
     try:
         return dtparser.parse(s).date().isoformat()
     except Exception:
         return None
 
+# かな・カナ・CJK統合漢字が1文字でも含まれるか
+_JA_CHARS = re.compile(r"[\u3040-\u30ff\u4e00-\u9fff]")
+# 同じ患者のQRは受診ごとにほぼ同じ文字列になるので、復元・解析結果をキャッシュする
+QR_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
 def repair_mojibake(s: str) -> str:
     if not s: return s
     t = unquote_plus(s)
-    if any('\u3040' <= ch <= '\u30ff' or '\u4e00' <= ch <= '\u9fff' for ch in t):
+    if _JA_CHARS.search(t):
         return unicodedata.normalize("NFC", t)
     raw = s.encode("latin-1", errors="ignore")
     for enc in ("cp932", "shift_jis", "euc_jp"):
         try:
             fixed = raw.decode(enc)
-            if any('\u3040' <= ch <= '\u30ff' or '\u4e00' <= ch <= '\u9fff' for ch in fixed):
+            if _JA_CHARS.search(fixed):
                 return unicodedata.normalize("NFC", fixed)
         except Exception:
             pass
     return unicodedata.normalize("NFC", t)
 
+_PAYLOAD_FALLBACKS = (
+    re.compile(r"(?P<pid>[0-9]{3,})[_\-\.](?P<date>20[0-9]{2}[01][0-9][0-3][0-9])"),
+    re.compile(r"(?:PID|ID)[:=]?\s*(?P<pid>[0-9A-Za-z_-]+).*?(?:DATE|Date|cdate)[:=]?\s*(?P<date>[0-9]{4}[-/\.][0-9]{1,2}[-/\.][0-9]{1,2})", re.I|re.S),
+)
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
 def parse_qr_payload(text: str):
     qs = text.lstrip('?&')
     kv = {k.lower(): v for k, v in parse_qsl(qs, keep_blank_values=True)}
@@ -63,10 +85,7 @@ def parse_qr_payload(text: str):
             date = normalize_date(raw)
             if date: break
     if not (pid and date):
-        for pat in [
-            re.compile(r"(?P<pid>[0-9]{3,})[_\-\.](?P<date>20[0-9]{2}[01][0-9][0-3][0-9])"),
-            re.compile(r"(?:PID|ID)[:=]?\s*(?P<pid>[0-9A-Za-z_-]+).*?(?:DATE|Date|cdate)[:=]?\s*(?P<date>[0-9]{4}[-/\.][0-9]{1,2}[-/\.][0-9]{1,2})", re.I|re.S),
-        ]:
+        for pat in _PAYLOAD_FALLBACKS:
             m = pat.search(text)
             if m:
                 pid = pid or m.group("pid")
@@ -89,19 +108,148 @@ def load_gray_for_qr(path: Path):
     except Exception:
         return None
 
-def detect_qr(path: Path):
-    img = load_gray_for_qr(path)
+# 向き推定用の縮小画像の長辺（px）
+QR_PROBE_MAX_SIDE = 960
+# 見つけたQR領域を切り出すときの余白（QR一辺に対する比）
+QR_CROP_MARGIN = 0.25
+
+class QrStageStats:
+    """QR読取ステージごとの成功率と所要時間
+    orient: 縮小画像で紙面の向きを推定 / direct: 原寸を推定した回転で1回読む /
+    crop: 位置だけ取れたQR領域を切り出して全バリアントで読む /
+    alt: 2番目の回転で1回読む / rescue: 推定した回転で原寸・1.5倍の適応二値化だけ試す /
+    ladder: 従来の全バリアント（--qr-exhaustive 時のみ）"""
+
+    STAGES = ("orient", "direct", "crop", "alt", "rescue", "ladder")
+
+    def __init__(self):
+        self.calls = dict.fromkeys(self.STAGES, 0)
+        self.hits = dict.fromkeys(self.STAGES, 0)
+        self.ms = dict.fromkeys(self.STAGES, 0.0)
+        self.sideways = 0
+        # --qr-compare: (今の方式で読めたか, 従来の全バリアントで読めたか) -> 件数
+        self.compare = {}
+
+    def record(self, stage: str, ok: bool, ms: float):
+        self.calls[stage] += 1
+        self.hits[stage] += bool(ok)
+        self.ms[stage] += ms
+        PROFILER.record(f"qr.{stage}", ms)
+
+    def summary_lines(self):
+        lines = []
+        for stage in self.STAGES:
+            n = self.calls[stage]
+            if not n:
+                continue
+            if stage == "orient":
+                result = f"横向き {self.sideways}/{n}"
+            else:
+                result = f"成功 {self.hits[stage]}/{n} ({self.hits[stage] / n:.1%})"
+            lines.append(f"[QR] {stage:<6} {result}, 計 {self.ms[stage] / 1000:.1f}s, 平均 {self.ms[stage] / n:.0f}ms")
+        n = sum(self.compare.values())
+        if n:
+            new = sum(v for (ok, _), v in self.compare.items() if ok)
+            old = sum(v for (_, ok), v in self.compare.items() if ok)
+            lines.append(f"[QR] 比較: 今の方式 {new}/{n} ({new / n:.1%}) / 従来の全バリアント {old}/{n} ({old / n:.1%})"
+                         f" / 従来のみ {self.compare.get((False, True), 0)}件 / 今の方式のみ {self.compare.get((True, False), 0)}件")
+        return lines
+
+QR_STATS = QrStageStats()
+
+def detect_qr(path: Path, exhaustive: bool = False, compare: bool = False):
+    """compare=True なら従来の全バリアント（回転なし）でも読み、成功率の差を QR_STATS に記録する"""
+    with PROFILER.span("decode"):
+        img = load_gray_for_qr(path)
     if img is None: return None
-    det = cv2.QRCodeDetector()
-    variants=[]
+    with PROFILER.span("qr"):
+        found = detect_qr_rotated(img, exhaustive)
+    if compare:
+        key = (bool(found), bool(_detect_qr_variants(img)))
+        QR_STATS.compare[key] = QR_STATS.compare.get(key, 0) + 1
+    return found
+
+def _timed(stage: str, fn, *a):
+    t0 = time.perf_counter()
+    result = fn(*a)
+    QR_STATS.record(stage, isinstance(result, str), (time.perf_counter() - t0) * 1000)
+    return result
+
+def _rotate(img, code):
+    return img if code is None else cv2.rotate(img, code)
+
+def estimate_rotations(img):
+    """縮小画像の射影プロファイルから紙面の向きを推定し、試す回転を良い順に2つ返す
+    横書きの行は水平方向の投影に周期的な濃淡を作るので、垂直方向の投影の
+    分散のほうが大きければ横向きの紙面とみなす。QRは180°回転しても読めるため
+    候補は 0° と 90° の2つで足りる。"""
+    h, w = img.shape[:2]
+    scale = min(1.0, QR_PROBE_MAX_SIDE / max(h, w))
+    small = img if scale == 1.0 else cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    _, ink = cv2.threshold(small, 0, 1, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    if float(ink.mean(axis=0).var()) > float(ink.mean(axis=1).var()):
+        QR_STATS.sideways += 1
+        return [cv2.ROTATE_90_CLOCKWISE, None]
+    return [None, cv2.ROTATE_90_CLOCKWISE]
+
+def _decode_once(work):
+    """1回だけ読む。読めれば文字列、位置だけ取れれば4隅の座標、何も無ければ None"""
+    data, pts, _ = cv2.QRCodeDetector().detectAndDecode(work)
+    if data:
+        return data
+    return pts.reshape(-1, 2) if pts is not None and len(pts) else None
+
+def _crop_decode(work, pts):
+    """位置だけ取れたQR領域を切り出し、倍率・二値化のバリアントで読み直す"""
+    x0, y0 = pts.min(axis=0)
+    x1, y1 = pts.max(axis=0)
+    m = max(x1 - x0, y1 - y0) * QR_CROP_MARGIN
+    h, w = work.shape[:2]
+    crop = work[max(0, int(y0 - m)):min(h, int(y1 + m)), max(0, int(x0 - m)):min(w, int(x1 + m))]
+    return _detect_qr_variants(crop) if crop.size else None
+
+def detect_qr_rotated(img, exhaustive: bool = False):
+    """紙面の向きを推定し、良い順に最大2つの回転だけを試す。
+    QRの位置が取れたら切り出して全バリアントを試す（読めなければ次の回転へ）。
+    どちらの回転でも読めなければ、推定した回転で原寸・1.5倍の適応二値化だけを試す
+    （小さい・薄いQRはこれで読めることが多い）。全バリアントは --qr-exhaustive 時のみ。"""
+    rotations = _timed("orient", estimate_rotations, img)
+    for stage, code in zip(("direct", "alt"), rotations):
+        work = _rotate(img, code)
+        found = _timed(stage, _decode_once, work)
+        if isinstance(found, str):
+            return found
+        if found is not None:
+            data = _timed("crop", _crop_decode, work, found)
+            if data:
+                return data
+    best = _rotate(img, rotations[0])
+    data = _timed("rescue", _detect_qr_variants, best, _rescue_variants)
+    if data:
+        return data
+    if exhaustive:
+        return _timed("ladder", _detect_qr_variants, best)
+    return None
+
+def _qr_variants(img):
+    """倍率・二値化・反転・クロージングの組合せを安い順に1枚ずつ作る"""
+    k = cv2.getStructuringElement(cv2.MORPH_RECT,(3,3))
     for scale in (1.0,1.5,2.0):
         base = img if scale==1.0 else cv2.resize(img,(int(img.shape[1]*scale),int(img.shape[0]*scale)),interpolation=cv2.INTER_CUBIC)
-        variants.append(base)
-        variants.append(cv2.adaptiveThreshold(base,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY,31,5))
-        variants.append(cv2.bitwise_not(base))
-        k = cv2.getStructuringElement(cv2.MORPH_RECT,(3,3))
-        variants.append(cv2.morphologyEx(base, cv2.MORPH_CLOSE, k, iterations=1))
-    for work in variants:
+        yield base
+        yield cv2.adaptiveThreshold(base,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY,31,5)
+        yield cv2.bitwise_not(base)
+        yield cv2.morphologyEx(base, cv2.MORPH_CLOSE, k, iterations=1)
+
+def _rescue_variants(img):
+    """全バリアントのうち、小さい・低コントラストのQRで効くものだけ（原寸と 1.5倍の適応二値化）"""
+    yield cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY,31,5)
+    big = cv2.resize(img,(int(img.shape[1]*1.5),int(img.shape[0]*1.5)),interpolation=cv2.INTER_CUBIC)
+    yield cv2.adaptiveThreshold(big,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY,31,5)
+
+def _detect_qr_variants(img, variants=_qr_variants):
+    det = cv2.QRCodeDetector()
+    for work in variants(img):
         data, pts, _ = det.detectAndDecode(work)
         if data: return data
         try:
@@ -113,6 +261,127 @@ def detect_qr(path: Path):
             pass
     return None
 
+# 区切り文字の連続（/ と \ の混在も含む）を \ 1つにまとめる
+_SEP_RUN = re.compile(r"[\\/]+")
+# 例: 12345\\20250809\\raw\\IMG_0001.JPG から pid=12345, date=2025-08-09
+_PATH_PID_DATE = re.compile(r"(?P<pid>\d{3,})[\\/](?P<date>20\d{6})[\\/]")
+_FNAME_PID = re.compile(r"(\d{3,})")
+
+# 補完の優先順（先に埋めた値は後段で上書きしない）
+SOURCES = ("qr", "full_text", "override", "path", "filename")
+SOURCE_MESSAGES = {
+    "qr": "[SET] {} full_text を更新",
+    "full_text": "[SET-TEXT] {} 欠損ID/日付を補完",
+    "override": "[SET-OVR] {} override で補完",
+    "path": "[SET-PATH] {} パスから補完",
+    "filename": "[SET-FNAME] {} ファイル名から補完",
+}
+
+def normalize_relpath(rel: str) -> str:
+    if not rel:
+        return ""
+    p = _SEP_RUN.sub(r"\\", rel)
+    return p[2:] if p.startswith(".\\") else p
+
+def parse_from_path(rel: str):
+    m = _PATH_PID_DATE.search(rel)
+    if not m:
+        return None, None
+    raw = m.group("date")
+    return m.group("pid"), f"{raw[0:4]}-{raw[4:6]}-{raw[6:8]}"
+
+def pid_from_filename(rel: str):
+    m = _FNAME_PID.search(Path(rel).name)
+    return m.group(1) if m else None
+
+def load_overrides(path: Path) -> dict:
+    """上書きCSVを 正規化済み source_relpath -> (patient_id, visit_date) の辞書にする"""
+    table = {}
+    with path.open("r", encoding="utf-8") as f:
+        for orow in csv.DictReader(f):
+            key = normalize_relpath(orow.get("source_relpath", ""))
+            if not key:
+                continue
+            pid = (orow.get("patient_id") or "").strip()
+            raw = (orow.get("visit_date") or "").strip()
+            table[key] = (pid or None, (normalize_date(raw) or raw) if raw else None)
+    return table
+
+def fill_missing(row: dict, pid, date) -> bool:
+    """空欄の patient_id / visit_date だけを埋める"""
+    changed = False
+    if pid and not (row.get("patient_id") or "").strip():
+        row["patient_id"] = pid
+        changed = True
+    if date and not (row.get("visit_date") or "").strip():
+        row["visit_date"] = date
+        changed = True
+    return changed
+
+def append_note(row: dict, tag: str):
+    note_val = (row.get("note") or "").strip()
+    if note_val:
+        if tag not in note_val.split(","):
+            row["note"] = note_val + "," + tag
+    else:
+        row["note"] = tag
+
+def qr_cache_lines():
+    """repair_mojibake / parse_qr_payload のキャッシュヒット率"""
+    lines = []
+    for fn in (repair_mojibake, parse_qr_payload):
+        info = fn.cache_info()
+        calls = info.hits + info.misses
+        if calls:
+            lines.append(f"[CACHE] {fn.__name__}: hit {info.hits}/{calls} ({info.hits / calls:.1%}), size {info.currsize}/{info.maxsize}")
+    return lines
+
+def enrich_row(row: dict, root: Path, args, overrides: dict, counts: dict) -> bool:
+    """1行に QR → full_text → override → path → filename の順で補完を当てる。変更があれば True"""
+    rel = row.get("source_relpath", "") or ""
+    key = normalize_relpath(rel)
+    fix_id_date = args.also_fix_id_date
+    label = rel or "(no path)"
+    hits = []
+
+    # QR 再読取（full_text が空の画像のみ）
+    if key and not (row.get("full_text") or "").strip():
+        fpath = root / rel
+        if not fpath.exists():
+            print(f"[MISS] {rel} : ファイルが見つからない")
+        elif fpath.suffix.lower() in IMG_EXTS:
+            kbn = kbn_from_path(rel)
+            with PROFILER.span("image", kbn=kbn):
+                qr = detect_qr(fpath, args.qr_exhaustive, args.qr_compare)
+            if qr:
+                with PROFILER.span("extract.qr_payload", kbn=kbn):
+                    qr_fixed = repair_mojibake(qr)
+                    pid, date = parse_qr_payload(qr_fixed) if fix_id_date else (None, None)
+                row["full_text"] = qr_fixed
+                fill_missing(row, pid, date)
+                hits.append("qr")
+
+    if fix_id_date:
+        text = (row.get("full_text") or "").strip()
+        if text and fill_missing(row, *parse_qr_payload(text)):
+            hits.append("full_text")
+
+    if key and key in overrides and fill_missing(row, *overrides[key]):
+        hits.append("override")
+
+    if key and args.fill_from_path and fill_missing(row, *parse_from_path(key)):
+        hits.append("path")
+
+    if key and args.pid_from_filename and fill_missing(row, pid_from_filename(key), None):
+        hits.append("filename")
+
+    for src in hits:
+        counts[src] += 1
+        print(SOURCE_MESSAGES[src].format(label))
+        if args.mark_note and src != "qr":
+            append_note(row, src)
+    return bool(hits)
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--patients-root", required=True)
@@ -123,7 +392,18 @@ def main():
     ap.add_argument("--pid-from-filename", action="store_true", help="ファイル名の数値から patient_id を補完")
     ap.add_argument("--override-csv", type=str, default="", help="上書き用CSV (source_relpath,patient_id,visit_date)")
     ap.add_argument("--mark-note", action="store_true", help="補完根拠を note 列に記録")
+    ap.add_argument("--qr-exhaustive", action="store_true", help="QRが見つからない画像にも従来の全バリアント（拡大・二値化）を試す")
+    ap.add_argument("--qr-compare", action="store_true", help="従来の全バリアントでも読み、成功率の差を表示する（遅い、確認用）")
+    add_profile_argument(ap, "p1_profile.json")
     args = ap.parse_args()
+    if args.profile:
+        PROFILER.enable()
+    try:
+        run(args)
+    finally:
+        finish_profile(args.profile)
+
+def run(args):
 
     root = Path(args.patients_root)
     csv_path = Path(args.master_csv)
@@ -131,11 +411,10 @@ def main():
         print(f"[ERR] master.csv not found: {csv_path}"); sys.exit(1)
 
     # CSV読み込み
-    rows=[]
     with csv_path.open("r",encoding="utf-8") as f:
         r = csv.DictReader(f)
-        header = r.fieldnames or []
-        for row in r: rows.append(row)
+        header = list(r.fieldnames or [])
+        rows = list(r)
     # ヘッダに不足列があれば追加
     required_columns = ["full_text", "patient_id", "visit_date"]
     for col in required_columns:
@@ -144,166 +423,32 @@ def main():
     if args.mark_note and "note" not in header:
         header.append("note")
 
-    def normalize_relpath(rel: str) -> str:
-        if not rel:
-            return ""
-        p = rel.replace("/", "\\")
-        while "\\\\" in p:
-            p = p.replace("\\\\", "\\")
-        if p.startswith(".\\"):
-            p = p[2:]
-        return p
-
-    def append_note(row: dict, tag: str):
-        if not args.mark_note:
-            return
-        note_val = (row.get("note") or "").strip()
-        if note_val:
-            if tag not in note_val:
-                row["note"] = note_val + "," + tag
-        else:
-            row["note"] = tag
-
-    def parse_from_path(rel: str):
-        # 例: 12345\\20250809\\raw\\IMG_0001.JPG から pid=12345, date=2025-08-09
-        try:
-            import re as _re
-            pid = None
-            date = None
-            m = _re.search(r"(?P<pid>\\d{3,})[\\/](?P<date>20\\d{6})[\\/]", rel)
-            if m:
-                pid = m.group("pid")
-                raw = m.group("date")
-                date = f"{raw[0:4]}-{raw[4:6]}-{raw[6:8]}"
-            return pid, date
-        except Exception:
-            return None, None
-
-    def pid_from_filename(rel: str):
-        try:
-            import re as _re
-            base = Path(rel).name
-            m = _re.search(r"(\\d{3,})", base)
-            return m.group(1) if m else None
-        except Exception:
-            return None
-
-    # full_text 空の行を対象
-    targets = [row for row in rows if not (row.get("full_text") or "").strip()]
-    print(f"[INFO] full_text 空の行: {len(targets)} / 総行数: {len(rows)}")
-
-    updated = 0
-    for row in targets:
-        rel = row.get("source_relpath","")
-        if not rel: continue
-        fpath = root / rel
-        if not fpath.exists():
-            print(f"[MISS] {rel} : ファイルが見つからない"); continue
-        if fpath.suffix.lower() not in IMG_EXTS:
-            continue
-
-        qr = detect_qr(fpath)
-        if not qr:
-            # 見つからないときはスキップ
-            continue
-        qr_fixed = repair_mojibake(qr)
-        row["full_text"] = qr_fixed
-        if args.also_fix_id_date:
-            pid, date = parse_qr_payload(qr_fixed)
-            if not (row.get("patient_id") or "").strip() and pid:
-                row["patient_id"] = pid
-            if not (row.get("visit_date") or "").strip() and date:
-                row["visit_date"] = date
-        updated += 1
-        print(f"[SET] {rel} full_text を更新")
-
-    # 既存 full_text からの補完（全行対象）
-    if args.also_fix_id_date:
-        for row in rows:
-            full_text_value = (row.get("full_text") or "").strip()
-            if not full_text_value:
-                continue
-            pid, date = parse_qr_payload(full_text_value)
-            changed = False
-            if not (row.get("patient_id") or "").strip() and pid:
-                row["patient_id"] = pid
-                changed = True
-            if not (row.get("visit_date") or "").strip() and date:
-                row["visit_date"] = date
-                changed = True
-            if changed:
-                updated += 1
-                print(f"[SET-TEXT] {row.get('source_relpath','(no path)')} 欠損ID/日付を補完")
-                append_note(row, "full_text")
-
-    # override CSV による補完
+    # override CSV は正規化済みパスで引く辞書にしておく（ハッシュ結合）
+    overrides = {}
     if args.override_csv:
         ov_path = Path(args.override_csv)
         if ov_path.exists():
-            with ov_path.open("r", encoding="utf-8") as f:
-                rdr = csv.DictReader(f)
-                override_rows = list(rdr)
-            key_to_row = {}
-            for orow in override_rows:
-                key = normalize_relpath(orow.get("source_relpath", ""))
-                if key:
-                    key_to_row[key] = orow
-            for row in rows:
-                key = normalize_relpath(row.get("source_relpath", ""))
-                if not key:
-                    continue
-                orow = key_to_row.get(key)
-                if not orow:
-                    continue
-                changed = False
-                if not (row.get("patient_id") or "").strip() and (orow.get("patient_id") or "").strip():
-                    row["patient_id"] = orow["patient_id"].strip()
-                    changed = True
-                if not (row.get("visit_date") or "").strip() and (orow.get("visit_date") or "").strip():
-                    row["visit_date"] = normalize_date(orow["visit_date"].strip()) or orow["visit_date"].strip()
-                    changed = True
-                if changed:
-                    updated += 1
-                    print(f"[SET-OVR] {row.get('source_relpath','(no path)')} override で補完")
-                    append_note(row, "override")
-
-    # パスからの補完
-    if args.fill_from_path:
-        for row in rows:
-            rel = normalize_relpath(row.get("source_relpath", ""))
-            if not rel:
-                continue
-            pid_guess, date_guess = parse_from_path(rel)
-            changed = False
-            if not (row.get("patient_id") or "").strip() and pid_guess:
-                row["patient_id"] = pid_guess
-                changed = True
-            if not (row.get("visit_date") or "").strip() and date_guess:
-                row["visit_date"] = date_guess
-                changed = True
-            if changed:
-                updated += 1
-                print(f"[SET-PATH] {row.get('source_relpath','(no path)')} パスから補完")
-                append_note(row, "path")
+            overrides = load_overrides(ov_path)
+        else:
+            print(f"[WARN] override CSV が見つからない: {ov_path}")
 
-    # ファイル名からの patient_id 補完
-    if args.pid_from_filename:
+    empty_text = sum(1 for row in rows if not (row.get("full_text") or "").strip())
+    print(f"[INFO] full_text 空の行: {empty_text} / 総行数: {len(rows)}")
+
+    # 全行を1回だけ走査して補完する
+    counts = dict.fromkeys(SOURCES, 0)
+    updated = 0
+    with PROFILER.span("enrich"):
         for row in rows:
-            if (row.get("patient_id") or "").strip():
-                continue
-            rel = normalize_relpath(row.get("source_relpath", ""))
-            if not rel:
-                continue
-            pid_guess = pid_from_filename(rel)
-            if pid_guess:
-                row["patient_id"] = pid_guess
+            if enrich_row(row, root, args, overrides, counts):
                 updated += 1
-                print(f"[SET-FNAME] {row.get('source_relpath','(no path)')} ファイル名から補完")
-                append_note(row, "filename")
+    print("[INFO] 補完元: " + ", ".join(f"{src}={counts[src]}" for src in SOURCES))
+    for line in QR_STATS.summary_lines() + qr_cache_lines():
+        print(line)
 
     # 書き戻し
     if args.apply and updated:
-        with csv_path.open("w", newline="", encoding="utf-8") as f:
+        with PROFILER.span("write"), csv_path.open("w", newline="", encoding="utf-8") as f:
             w = csv.DictWriter(f, fieldnames=header)
             w.writeheader(); w.writerows(rows)
         print(f"[WRITE] master.csv を更新: {updated} 行")
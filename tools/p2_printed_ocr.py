@@ -9,6 +9,12 @@ P2: 印刷系OCR - NCT・レフ値・IOLシール抽出
 使い方:
   ドライラン: python p2_printed_ocr.py --patients-root ".\Patients" --master-csv ".\Patients\master.csv"
   本適用 　: python p2_printed_ocr.py --patients-root ".\Patients" --master-csv ".\Patients\master.csv" --apply
+  並列実行 : python p2_printed_ocr.py ... --apply --workers 4
+  計測    : python p2_printed_ocr.py ... --profile p2_profile.json
+
+中断しても完了行は <master-csv>.p2journal.jsonl に残り、再実行時はそこから再開する。
+--apply で master.csv を書き終えたら、ジャーナルはクォータ不足で保留した行だけに縮める。
+master.csv は一時ファイルへ書き出してから rename で置き換える。
 """
 
 import argparse
@@ -17,17 +23,22 @@ import os
 import re
 import sys
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional, Any
 from dataclasses import dataclass
 import logging
 
 import numpy as np
-import cv2
-from PIL import Image
-import easyocr
-from google.cloud import vision
-from google.oauth2 import service_account
+
+# ステージ計測・ファイル名パラメータはリポジトリ直下の stage_profiler / filename_params を共有
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from filename_params import kbn_from_path
+from stage_profiler import PROFILER, add_profile_argument, finish_profile
+from upload_prep import add_upload_prep_arguments, upload_prep_from_args
+from vision_quota import (BULK, QuotaExhausted, add_quota_arguments, call_with_quota, priority_from_args,
+                          quota_from_args)
 
 # ログ設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -70,17 +81,25 @@ class P2OCRResult:
 class P2PrintedOCR:
     """印刷系OCR処理クラス"""
     
-    def __init__(self, api_key: str = None, use_gpu: bool = False):
+    def __init__(self, api_key: str = None, use_gpu: bool = False, upload_prep=None, quota=None,
+                 priority: int = BULK):
         self.api_key = api_key
         self.use_gpu = use_gpu
+        self.upload_prep = upload_prep  # upload_prep.UploadPrep（Vision 送信前の縮小、None で原寸）
+        self.quota = quota              # vision_quota.VisionQuota（不足時は QuotaExhausted を送出）
+        self.priority = priority
         
-        # EasyOCR初期化
-        self.reader = easyocr.Reader(['ja', 'en'], gpu=use_gpu)
+        # EasyOCR は初回の画像処理で初期化（torch の読み込みが重いので、抽出処理だけなら読まない）。
+        # モデルは1つだけ読み、スレッド間ではロックで順番に使う（Vision の通信は並列のまま）
+        self._reader = None
+        self._reader_lock = threading.RLock()
         
         # Google Vision API初期化（APIキーがある場合）
         self.vision_client = None
         if api_key:
             try:
+                from google.cloud import vision
+                from google.oauth2 import service_account
                 credentials = service_account.Credentials.from_service_account_file(api_key)
                 self.vision_client = vision.ImageAnnotatorClient(credentials=credentials)
             except Exception as e:
@@ -113,13 +132,22 @@ class P2PrintedOCR:
             'AT TORBI', 'AT LISA', 'AT LARA', 'AT TORBI', 'AT LISA'
         ]
 
+    @property
+    def reader(self):
+        with self._reader_lock:
+            if self._reader is None:
+                import easyocr
+                self._reader = easyocr.Reader(['ja', 'en'], gpu=self.use_gpu)
+            return self._reader
+
     def extract_text_from_image(self, image_path: Path) -> List[Dict[str, Any]]:
         """画像からテキスト抽出"""
         results = []
         
         try:
             # EasyOCRでテキスト抽出
-            easyocr_results = self.reader.readtext(str(image_path))
+            with PROFILER.span('ocr.easyocr'), self._reader_lock:
+                easyocr_results = self.reader.readtext(str(image_path))
             for (bbox, text, confidence) in easyocr_results:
                 results.append({
                     'text': text,
@@ -131,24 +159,40 @@ class P2PrintedOCR:
             # Google Vision API（利用可能な場合）
             if self.vision_client:
                 try:
-                    with open(image_path, 'rb') as image_file:
-                        content = image_file.read()
+                    with PROFILER.span('decode'):
+                        with open(image_path, 'rb') as image_file:
+                            content = image_file.read()
+                    prepared = None
+                    if self.upload_prep is not None:
+                        with PROFILER.span('prep'):
+                            prepared = self.upload_prep.prepare(content)
+                        content = prepared.content
                     
-                    image = vision.Image(content=content)
-                    response = self.vision_client.text_detection(image=image)
+                    with PROFILER.span('ocr.vision'):
+                        from google.cloud import vision
+                        image = vision.Image(content=content)
+                        response = call_with_quota(self.quota, lambda: self.vision_client.text_detection(image=image),
+                                                   self.priority)
                     
                     if response.text_annotations:
                         for annotation in response.text_annotations[1:]:  # 最初は全体テキストなのでスキップ
                             vertices = [(vertex.x, vertex.y) for vertex in annotation.bounding_poly.vertices]
+                            if prepared is not None:
+                                # EasyOCR の枠と揃えるため原寸座標に戻す
+                                vertices = [tuple(int(round(v)) for v in pt) for pt in prepared.to_original(vertices)]
                             results.append({
                                 'text': annotation.description,
                                 'confidence': 0.9,  # Google Visionは信頼度を返さないので固定値
                                 'bbox': vertices,
                                 'source': 'google_vision'
                             })
+                except QuotaExhausted:
+                    raise
                 except Exception as e:
                     logger.warning(f"Google Vision API処理失敗: {e}")
                     
+        except QuotaExhausted:
+            raise
         except Exception as e:
             logger.error(f"テキスト抽出失敗 {image_path}: {e}")
         
@@ -258,9 +302,12 @@ class P2PrintedOCR:
         text_results = self.extract_text_from_image(image_path)
         
         # 各項目抽出
-        nct_result = self.extract_nct_values(text_results)
-        refraction_result = self.extract_refraction_values(text_results)
-        iol_result = self.extract_iol_seal_info(text_results)
+        with PROFILER.span('extract.nct'):
+            nct_result = self.extract_nct_values(text_results)
+        with PROFILER.span('extract.refraction'):
+            refraction_result = self.extract_refraction_values(text_results)
+        with PROFILER.span('extract.iol_seal'):
+            iol_result = self.extract_iol_seal_info(text_results)
         
         # 全体信頼度計算
         confidences = [
@@ -280,6 +327,144 @@ class P2PrintedOCR:
             processing_time=processing_time
         )
 
+JOURNAL_SUFFIX = '.p2journal.jsonl'
+
+
+def row_key(row: Dict[str, Any]) -> Tuple[str, str, str]:
+    """ジャーナルのキー（patient_id / visit_date / image_name）"""
+    return (row.get('patient_id') or '', row.get('visit_date') or '', row.get('image_name') or '')
+
+
+def build_row_updates(result: P2OCRResult) -> Dict[str, Any]:
+    """P2 OCR結果からCSV行へ反映する列を作成"""
+    updates: Dict[str, Any] = {}
+
+    if result.nct.right_eye is not None:
+        updates['nct_right'] = result.nct.right_eye
+        updates['nct_right_confidence'] = result.nct.confidence
+        updates['nct_right_qa_flag'] = result.nct.qa_flag
+
+    if result.nct.left_eye is not None:
+        updates['nct_left'] = result.nct.left_eye
+        updates['nct_left_confidence'] = result.nct.confidence
+        updates['nct_left_qa_flag'] = result.nct.qa_flag
+
+    if result.refraction.sphere is not None:
+        updates['refraction_s'] = result.refraction.sphere
+        updates['refraction_c'] = result.refraction.cylinder
+        updates['refraction_ax'] = result.refraction.axis
+        updates['refraction_confidence'] = result.refraction.confidence
+        updates['refraction_qa_flag'] = result.refraction.qa_flag
+
+    if result.iol_seal.power is not None:
+        updates['iol_power'] = result.iol_seal.power
+        updates['iol_product'] = result.iol_seal.product_name
+        updates['iol_confidence'] = result.iol_seal.confidence
+        updates['iol_qa_flag'] = result.iol_seal.qa_flag
+
+    updates['p2_processing_time'] = result.processing_time
+    updates['p2_overall_confidence'] = result.overall_confidence
+    return updates
+
+
+class RowJournal:
+    """完了行のサイドジャーナル（JSON Lines・追記のみ）
+
+    1行 = 1画像の処理結果。中断後の再実行ではここに記録済みの行をスキップし、
+    記録済みの値を master.csv の行へ再適用する。master.csv へ反映した後は retain() で
+    未反映の行（保留）だけを残す（反映済みの値を後の手修正の上に再適用しない）。
+    """
+
+    def __init__(self, path: Path, flush_every: int = 20):
+        self.path = path
+        self.flush_every = max(1, flush_every)
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[Tuple[str, str, str], Dict[str, Any]]:
+        """ジャーナルを読み込み、キーごとの最新エントリを返す"""
+        entries: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        if not self.path.exists():
+            return entries
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で中断された末尾行は無視
+                    continue
+                entries[tuple(entry.get('key', ('', '', '')))] = entry
+        return entries
+
+    def record(self, key: Tuple[str, str, str], status: str, updates: Dict[str, Any]):
+        """処理結果を追記（flush_every 件ごとにディスクへ書き出す）"""
+        line = json.dumps({'key': list(key), 'status': status, 'updates': updates}, ensure_ascii=False)
+        with self._lock:
+            self._pending.append(line)
+            if len(self._pending) >= self.flush_every:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._pending:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(self._pending) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending.clear()
+
+    def reset(self):
+        with self._lock:
+            self._pending.clear()
+            if self.path.exists():
+                self.path.unlink()
+
+    def retain(self, statuses: Tuple[str, ...] = ('deferred',)) -> int:
+        """最新の状態が statuses の行だけを残して書き直し、残した件数を返す"""
+        self.flush()
+        lines = [json.dumps(entry, ensure_ascii=False)
+                 for entry in self.load().values() if entry.get('status') in statuses]
+        with self._lock:
+            if not lines:
+                if self.path.exists():
+                    self.path.unlink()
+                return 0
+            tmp_path = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        return len(lines)
+
+
+def write_csv_atomic(path: Path, rows: List[Dict[str, Any]]):
+    """同一ディレクトリの一時ファイルへ書き出してから rename で置き換える"""
+    fieldnames: List[str] = []
+    seen = set()
+    for row in rows:
+        for k in row.keys():
+            if k not in seen:
+                seen.add(k)
+                fieldnames.append(k)
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
 def main():
     parser = argparse.ArgumentParser(description='P2: 印刷系OCR - NCT・レフ値・IOLシール抽出')
     parser.add_argument('--patients-root', required=True, help='患者データルートディレクトリ')
@@ -288,11 +473,24 @@ def main():
     parser.add_argument('--apply', action='store_true', help='実際にCSVを更新する')
     parser.add_argument('--gpu', action='store_true', help='GPU使用')
     parser.add_argument('--limit', type=int, help='処理件数制限（テスト用）')
+    parser.add_argument('--workers', type=int, default=1, help='並列ワーカー数（行単位）')
+    parser.add_argument('--journal', help=f'完了行ジャーナル（既定: <master-csv>{JOURNAL_SUFFIX}）')
+    parser.add_argument('--flush-every', type=int, default=20, help='ジャーナルを書き出す間隔（件数）')
+    parser.add_argument('--reset-journal', action='store_true', help='ジャーナルを破棄して最初から処理する')
+    add_profile_argument(parser, 'p2_profile.json')
+    add_upload_prep_arguments(parser)
+    add_quota_arguments(parser, retry_queue=False)
     
     args = parser.parse_args()
-    
-    # OCR初期化
-    ocr = P2PrintedOCR(api_key=args.api_key, use_gpu=args.gpu)
+    if args.profile:
+        PROFILER.enable()
+    try:
+        run(args)
+    finally:
+        finish_profile(args.profile)
+
+
+def run(args):
     
     # マスターCSV読み込み
     master_path = Path(args.master_csv)
@@ -305,22 +503,44 @@ def main():
         logger.error(f"患者データルートが見つかりません: {patients_root}")
         return
     
-    # CSV処理
-    processed_count = 0
-    success_count = 0
-    
     with open(master_path, 'r', encoding='utf-8') as f:
         reader = csv.DictReader(f)
         rows = list(reader)
     
+    # ジャーナル（前回までの完了行）を適用
+    journal = RowJournal(
+        Path(args.journal) if args.journal else master_path.with_name(master_path.name + JOURNAL_SUFFIX),
+        flush_every=args.flush_every,
+    )
+    if args.reset_journal:
+        journal.reset()
+    done = journal.load()
+    resumed_count = 0
     for row in rows:
-        if args.limit and processed_count >= args.limit:
+        entry = done.get(row_key(row))
+        if entry:
+            row.update(entry.get('updates') or {})
+            if entry.get('status') == 'ok':
+                resumed_count += 1
+    if resumed_count:
+        logger.info(f"ジャーナルから再開: 完了済み={resumed_count}件 ({journal.path})")
+    
+    # 処理対象の行を決定（前回クォータ不足で保留した行を先に。--limit はその後で数える）
+    ordered = sorted(rows, key=lambda r: (done.get(row_key(r)) or {}).get('status') != 'deferred')
+    targets: List[Tuple[Dict[str, Any], Path]] = []
+    for row in ordered:
+        if args.limit and len(targets) >= args.limit:
             break
             
         # P2項目が既に存在する場合はスキップ
         if row.get('nct_right') and row.get('nct_left') and row.get('refraction_s') and row.get('iol_power'):
             continue
         
+        # ジャーナルで完了済みの行はスキップ
+        entry = done.get(row_key(row))
+        if entry and entry.get('status') == 'ok':
+            continue
+        
         # 画像パス構築
         patient_id = row.get('patient_id')
         visit_date = row.get('visit_date')
@@ -333,58 +553,79 @@ def main():
         if not image_path.exists():
             continue
         
+        targets.append((row, image_path))
+    
+    # OCRエンジンは全スレッドで1つ（EasyOCR のモデルを --workers 個読まない。使うときはロックで順番）
+    upload_prep = upload_prep_from_args(args)
+    quota = quota_from_args(args) if args.api_key else None
+    priority = priority_from_args(args)
+    ocr = P2PrintedOCR(api_key=args.api_key, use_gpu=args.gpu, upload_prep=upload_prep,
+                       quota=quota, priority=priority)
+    
+    # ドライランではジャーナルに書かない（書くと本適用の実行で完了済みとして飛ばされる）
+    def record(row: Dict[str, Any], status: str, updates: Dict[str, Any]):
+        if args.apply:
+            journal.record(row_key(row), status, updates)
+    
+    def process_row(image_path: Path) -> P2OCRResult:
         logger.info(f"処理中: {image_path}")
-        
-        try:
-            # OCR処理
-            result = ocr.process_image(image_path)
-            
-            # 結果をCSV行に反映
-            if result.nct.right_eye is not None:
-                row['nct_right'] = result.nct.right_eye
-                row['nct_right_confidence'] = result.nct.confidence
-                row['nct_right_qa_flag'] = result.nct.qa_flag
-            
-            if result.nct.left_eye is not None:
-                row['nct_left'] = result.nct.left_eye
-                row['nct_left_confidence'] = result.nct.confidence
-                row['nct_left_qa_flag'] = result.nct.qa_flag
-            
-            if result.refraction.sphere is not None:
-                row['refraction_s'] = result.refraction.sphere
-                row['refraction_c'] = result.refraction.cylinder
-                row['refraction_ax'] = result.refraction.axis
-                row['refraction_confidence'] = result.refraction.confidence
-                row['refraction_qa_flag'] = result.refraction.qa_flag
-            
-            if result.iol_seal.power is not None:
-                row['iol_power'] = result.iol_seal.power
-                row['iol_product'] = result.iol_seal.product_name
-                row['iol_confidence'] = result.iol_seal.confidence
-                row['iol_qa_flag'] = result.iol_seal.qa_flag
-            
-            row['p2_processing_time'] = result.processing_time
-            row['p2_overall_confidence'] = result.overall_confidence
-            
-            success_count += 1
-            logger.info(f"成功: NCT右={result.nct.right_eye}, 左={result.nct.left_eye}, "
-                       f"レフS={result.refraction.sphere}, IOL={result.iol_seal.power}")
+        with PROFILER.span('image', kbn=kbn_from_path(image_path.name)):
+            return ocr.process_image(image_path)
+    
+    # CSV処理
+    processed_count = 0
+    success_count = 0
+    deferred_count = 0
+    
+    executor = ThreadPoolExecutor(max_workers=max(1, args.workers))
+    try:
+        futures = {executor.submit(process_row, image_path): (row, image_path) for row, image_path in targets}
+        for future in as_completed(futures):
+            row, image_path = futures[future]
+            try:
+                result = future.result()
+                updates = build_row_updates(result)
+                row.update(updates)
+                record(row, 'ok', updates)
+                
+                success_count += 1
+                logger.info(f"成功: NCT右={result.nct.right_eye}, 左={result.nct.left_eye}, "
+                           f"レフS={result.refraction.sphere}, IOL={result.iol_seal.power}")
+                
+            except QuotaExhausted as e:
+                # 失敗ではなく保留（ジャーナルの 'deferred' は次回の実行で先に処理される）
+                logger.warning(f"クォータ不足のため保留 {image_path}: {e}")
+                record(row, 'deferred', {})
+                deferred_count += 1
+            except Exception as e:
+                logger.error(f"処理失敗 {image_path}: {e}")
+                row['p2_error'] = str(e)
+                record(row, 'error', {'p2_error': str(e)})
             
-        except Exception as e:
-            logger.error(f"処理失敗 {image_path}: {e}")
-            row['p2_error'] = str(e)
-        
-        processed_count += 1
+            processed_count += 1
+    finally:
+        # 中断時は未着手の行を破棄し、完了分は必ずジャーナルに残す
+        executor.shutdown(wait=True, cancel_futures=True)
+        journal.flush()
     
     # 結果保存
     if args.apply:
-        with open(master_path, 'w', encoding='utf-8', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=rows[0].keys())
-            writer.writeheader()
-            writer.writerows(rows)
-        logger.info(f"CSV更新完了: 処理={processed_count}, 成功={success_count}")
+        with PROFILER.span('write'):
+            write_csv_atomic(master_path, rows)
+            # master.csv に反映した行はジャーナルから外す（保留行だけ次回に回す）
+            journal.retain(('deferred',))
+        logger.info(f"CSV更新完了: 処理={processed_count}, 成功={success_count}, 再開分={resumed_count}")
     else:
-        logger.info(f"ドライラン完了: 処理={processed_count}, 成功={success_count}")
+        logger.info(f"ドライラン完了: 処理={processed_count}, 成功={success_count}, 再開分={resumed_count}")
+    if upload_prep is not None:
+        for line in upload_prep.summary_lines():
+            logger.info(line)
+    if quota is not None:
+        quota.flush()
+        for line in quota.summary_lines():
+            logger.info(line)
+    if deferred_count:
+        logger.warning(f"クォータ不足で保留: {deferred_count}件（ジャーナルに記録、次回の実行で先に処理）")
 
 if __name__ == '__main__':
     main()
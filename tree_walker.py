@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+os.scandir ベースのディレクトリ走査（全スクリプト共通）
+
+Path.rglob('*') は全エントリを Path にしてから is_file() / suffix を個別に調べ、
+os.listdir はファイルごとに stat をやり直す。USB SSD 上の数十万枚ではこれが遅い。
+
+ - walk_files: DirEntry をそのまま返すジェネレータ（一覧をメモリに溜めない）
+   entry.stat() は Windows では scandir 時の情報を再利用するので追加の I/O が無い
+ - 拡張子（大文字小文字無視）と kbn（ファイル名の &kbn=...）で stat 前に絞り込む
+ - workers>1 で直下のサブフォルダ（患者フォルダ）ごとにスレッドで並列に走査
+ - list_files / list_subdirs: ソート済みパスが欲しい既存コード向け
+
+使い方:
+    for entry in walk_files(IMAGE_ROOT, exts=IMAGE_EXTS, kbns={'外来カルテ'}, workers=8):
+        size = entry.stat().st_size
+    images = list_files(patient_dir, recursive=False)
+"""
+
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+from filename_params import kbn_from_path
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp')
+# 走査しないフォルダ（出力やキャッシュ）
+SKIP_DIRS = frozenset({'.git', '__pycache__', '$RECYCLE.BIN', 'System Volume Information'})
+
+
+def _normalize_exts(exts: Optional[Iterable[str]]):
+    if exts is None:
+        return None
+    return tuple(e.lower() if e.startswith('.') else '.' + e.lower() for e in exts)
+
+
+def _scan(root: str, exts, kbns, recursive: bool, skip_dirs) -> Iterator[os.DirEntry]:
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            continue   # 権限なし・途中で消えたフォルダ
+        subdirs = []
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and entry.name not in skip_dirs:
+                            subdirs.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                name = entry.name
+                if exts is not None and not name.lower().endswith(exts):
+                    continue
+                if kbns is not None and kbn_from_path(name) not in kbns:
+                    continue
+                yield entry
+        # 名前順に近い順序で降りる（pop するので逆順に積む）
+        subdirs.sort(reverse=True)
+        stack.extend(subdirs)
+
+
+def walk_files(root, exts: Optional[Iterable[str]] = IMAGE_EXTS, kbns: Optional[Iterable[str]] = None,
+               recursive: bool = True, workers: int = 1,
+               skip_dirs: Iterable[str] = SKIP_DIRS) -> Iterator[os.DirEntry]:
+    """root 以下のファイルの DirEntry を順に返す
+
+    exts=None なら拡張子で絞らない。kbns を渡すとその kbn のファイルだけ。
+    workers>1 かつ recursive のとき、直下の各サブフォルダを別スレッドで走査する
+    （順序は保証しない。呼び出し側が止めればスレッドも止まる）。"""
+    root = os.fspath(root)
+    exts = _normalize_exts(exts)
+    kbns = frozenset(kbns) if kbns is not None else None
+    skip_dirs = frozenset(skip_dirs)
+    if workers <= 1 or not recursive:
+        yield from _scan(root, exts, kbns, recursive, skip_dirs)
+        return
+
+    # 直下のファイルはその場で返し、サブフォルダはスレッドに配る
+    tops: List[str] = []
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in skip_dirs:
+                            tops.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                if exts is not None and not entry.name.lower().endswith(exts):
+                    continue
+                if kbns is not None and kbn_from_path(entry.name) not in kbns:
+                    continue
+                yield entry
+    except OSError:
+        return
+    if not tops:
+        return
+
+    done = object()
+    out: 'queue.Queue' = queue.Queue(maxsize=workers * 256)
+    stop = threading.Event()
+
+    def scan_subtree(top: str):
+        try:
+            for entry in _scan(top, exts, kbns, True, skip_dirs):
+                if stop.is_set():
+                    return
+                out.put(entry)
+        finally:
+            out.put(done)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='walk') as pool:
+        for top in tops:
+            pool.submit(scan_subtree, top)
+        remaining = len(tops)
+        try:
+            while remaining:
+                item = out.get()
+                if item is done:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            # 途中で打ち切られたら待っているスレッドを解放する
+            stop.set()
+            while remaining:
+                if out.get() is done:
+                    remaining -= 1
+
+
+def list_files(root, exts: Optional[Iterable[str]] = IMAGE_EXTS, kbns: Optional[Iterable[str]] = None,
+               recursive: bool = True, workers: int = 1) -> List[str]:
+    """walk_files のパスをソートして返す"""
+    return sorted(e.path for e in walk_files(root, exts=exts, kbns=kbns, recursive=recursive, workers=workers))
+
+
+def list_subdirs(root, skip_dirs: Sequence[str] = SKIP_DIRS) -> List[str]:
+    """直下のフォルダ名（ソート済み）。root が無ければ空"""
+    names = []
+    try:
+        with os.scandir(os.fspath(root)) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir() and entry.name not in skip_dirs:
+                        names.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        return []
+    return sorted(names)
+
+
+def count_files(root, exts: Optional[Iterable[str]] = IMAGE_EXTS) -> int:
+    """直下のファイル数（大きい患者フォルダから処理する並べ替え用）"""
+    return sum(1 for _ in walk_files(root, exts=exts, recursive=False))
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    ap = argparse.ArgumentParser(description='scandir 走査と rglob の比較')
+    ap.add_argument('root')
+    ap.add_argument('--workers', type=int, default=8)
+    ap.add_argument('--kbn', action='append', help='この kbn のみ（複数可）')
+    args = ap.parse_args()
+
+    from pathlib import Path
+    t0 = time.perf_counter()
+    n_rglob = sum(1 for p in Path(args.root).rglob('*') if p.is_file() and p.suffix.lower() in IMAGE_EXTS
+                  and (args.kbn is None or kbn_from_path(p.name) in args.kbn))
+    t1 = time.perf_counter()
+    n_walk = sum(1 for _ in walk_files(args.root, kbns=args.kbn))
+    t2 = time.perf_counter()
+    n_par = sum(1 for _ in walk_files(args.root, kbns=args.kbn, workers=args.workers))
+    t3 = time.perf_counter()
+    print(f'rglob         : {n_rglob}件 {t1 - t0:.2f}s')
+    print(f'scandir       : {n_walk}件 {t2 - t1:.2f}s')
+    print(f'scandir x{args.workers:<3} : {n_par}件 {t3 - t2:.2f}s')
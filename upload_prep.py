@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vision API へ送る前の画像縮小（アップロード量の削減）
+
+スマホ/スキャナの原寸JPEG（IMG_70xx など数MB）をそのまま送ると、院内回線ではアップロードが
+レイテンシの大半を占める。送信前に次を行う:
+ 1. EXIF の向きを反映（auto-orient）
+ 2. 背景を除いて用紙部分に切り抜き（用紙が画像の 20〜95% を占めるときのみ）
+ 3. グレースケール化
+ 4. OCR に十分な解像度（A4 長辺 × target_dpi、既定 200dpi）まで縮小（拡大はしない）
+ 5. JPEG で再エンコード（元より大きくなる場合は元のバイト列を送る）
+
+Vision の座標は縮小後の画像基準になるため、PreparedImage.to_original() で向き補正後の原寸座標に戻す。
+
+使い方:
+    python upload_prep.py report 画像フォルダ [--target-dpi 200] [--uplink-mbps 10]
+    python upload_prep.py fidelity 画像フォルダ [--limit 20]   # Vision で原寸/縮小の抽出結果を比較
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from tree_walker import list_files
+
+TARGET_DPI = 200
+PAGE_LONG_INCH = 11.69      # A4 長辺
+JPEG_QUALITY = 85
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+class PreparedImage(NamedTuple):
+    content: bytes
+    original_bytes: int
+    scale: float                 # 縮小後の座標 = (原寸座標 - offset) * scale
+    offset: Tuple[int, int]      # 切り抜き位置（向き補正後の原寸座標）
+    size: Tuple[int, int]        # 縮小後の (width, height)
+    steps: Tuple[str, ...]       # 実施した処理（'orient', 'crop', 'gray', 'resize'）。元のまま送るときは ('original',)
+
+    @property
+    def prepared_bytes(self) -> int:
+        return len(self.content)
+
+    def to_original(self, points) -> np.ndarray:
+        """縮小後の座標（..., 2）を向き補正後の原寸座標に戻す"""
+        pts = np.asarray(points, dtype=np.float64)
+        return pts / self.scale + np.asarray(self.offset, dtype=np.float64)
+
+
+def find_document_box(gray: np.ndarray, max_side: int = 800) -> Optional[Tuple[int, int, int, int]]:
+    """背景より明るい最大の領域（用紙）の外接矩形 (x0, y0, x1, y1)。見つからなければ None"""
+    import cv2
+    h, w = gray.shape[:2]
+    scale = min(1.0, max_side / max(h, w))
+    small = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+    small = cv2.GaussianBlur(small, (5, 5), 0)
+    _t, mask = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((15, 15), np.uint8))
+    contours, _hier = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    x, y, cw, ch = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    frac = (cw * ch) / float(small.shape[0] * small.shape[1])
+    if not 0.2 <= frac <= 0.95:
+        return None
+    margin = int(round(0.01 * max(small.shape[:2])))
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(small.shape[1], x + cw + margin), min(small.shape[0], y + ch + margin)
+    return int(x0 / scale), int(y0 / scale), min(w, int(np.ceil(x1 / scale))), min(h, int(np.ceil(y1 / scale)))
+
+
+def prepare_image(content: bytes, target_dpi: int = TARGET_DPI, grayscale: bool = True, crop: bool = True,
+                  quality: int = JPEG_QUALITY) -> PreparedImage:
+    """画像のバイト列を送信用に縮小する（失敗時・縮小しても小さくならない場合は元のまま）"""
+    # cv2 / PIL は --upload-prep で実際に縮小するときだけ読む
+    import cv2
+    from PIL import Image, ImageOps
+    original = PreparedImage(content, len(content), 1.0, (0, 0), (0, 0), ('original',))
+    try:
+        pil = Image.open(io.BytesIO(content))
+        oriented = ImageOps.exif_transpose(pil)
+    except Exception:
+        return original
+    steps: List[str] = []
+    if pil.getexif().get(0x0112, 1) not in (0, 1):
+        steps.append('orient')
+    original = original._replace(size=oriented.size)
+    if grayscale:
+        img = np.asarray(oriented.convert('L'))
+        steps.append('gray')
+    else:
+        img = cv2.cvtColor(np.asarray(oriented.convert('RGB')), cv2.COLOR_RGB2BGR)
+
+    offset = (0, 0)
+    if crop:
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        box = find_document_box(gray)
+        if box is not None:
+            x0, y0, x1, y1 = box
+            img = img[y0:y1, x0:x1]
+            offset = (x0, y0)
+            steps.append('crop')
+
+    scale = 1.0
+    h, w = img.shape[:2]
+    max_long = int(round(PAGE_LONG_INCH * target_dpi))
+    if max(h, w) > max_long:
+        scale = max_long / float(max(h, w))
+        img = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+        steps.append('resize')
+
+    ok, buf = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    if not ok or len(buf) >= len(content):
+        return original
+    return PreparedImage(buf.tobytes(), len(content), scale, offset, (img.shape[1], img.shape[0]), tuple(steps))
+
+
+class UploadPrep:
+    """送信前縮小の設定と集計（スレッドセーフ）"""
+
+    def __init__(self, target_dpi: int = TARGET_DPI, grayscale: bool = True, crop: bool = True,
+                 quality: int = JPEG_QUALITY, uplink_mbps: float = 10.0):
+        self.target_dpi = target_dpi
+        self.grayscale = grayscale
+        self.crop = crop
+        self.quality = quality
+        self.uplink_mbps = uplink_mbps
+        self._lock = threading.Lock()
+        self.images = 0
+        self.original_bytes = 0
+        self.prepared_bytes = 0
+        self.prep_ms = 0.0
+
+    def prepare(self, content: bytes) -> PreparedImage:
+        t0 = time.perf_counter()
+        prepared = prepare_image(content, self.target_dpi, self.grayscale, self.crop, self.quality)
+        ms = (time.perf_counter() - t0) * 1000.0
+        with self._lock:
+            self.images += 1
+            self.original_bytes += prepared.original_bytes
+            self.prepared_bytes += prepared.prepared_bytes
+            self.prep_ms += ms
+        return prepared
+
+    def upload_seconds(self, nbytes: int) -> float:
+        return nbytes * 8 / (self.uplink_mbps * 1e6) if self.uplink_mbps > 0 else 0.0
+
+    def summary_lines(self) -> List[str]:
+        if not self.images:
+            return []
+        saved = self.original_bytes - self.prepared_bytes
+        ratio = saved / self.original_bytes if self.original_bytes else 0.0
+        per_image_s = (self.upload_seconds(saved) - self.prep_ms / 1000.0) / self.images
+        return [
+            f'📦 送信前縮小: {self.images}件 {self.original_bytes / 1e6:.1f}MB → {self.prepared_bytes / 1e6:.1f}MB '
+            f'(削減 {ratio:.1%})',
+            f'  縮小処理 平均 {self.prep_ms / self.images:.0f}ms / 件、'
+            f'{self.uplink_mbps:g}Mbps 回線での短縮見込み 平均 {per_image_s:.2f}s / 件',
+        ]
+
+
+def add_upload_prep_arguments(ap):
+    """argparse に送信前縮小の引数を追加する"""
+    ap.add_argument('--upload-prep', action='store_true', help='Vision へ送る前に向き補正・切り抜き・縮小する')
+    ap.add_argument('--target-dpi', type=int, default=TARGET_DPI, help=f'縮小後の解像度（A4換算、既定 {TARGET_DPI}）')
+    ap.add_argument('--uplink-mbps', type=float, default=10.0, help='短縮見込みの計算に使う上り回線速度')
+
+
+def upload_prep_from_args(args) -> Optional[UploadPrep]:
+    if not getattr(args, 'upload_prep', False):
+        return None
+    return UploadPrep(target_dpi=args.target_dpi, uplink_mbps=args.uplink_mbps)
+
+
+# ---- レポート / 抽出結果の比較 ----
+
+def _list_images(folder: str, limit: Optional[int] = None) -> List[str]:
+    paths = list_files(folder, exts=IMAGE_EXTS, recursive=False)
+    return paths[:limit] if limit else paths
+
+
+def report(args) -> int:
+    prep = UploadPrep(target_dpi=args.target_dpi, uplink_mbps=args.uplink_mbps)
+    for path in _list_images(args.folder, args.limit):
+        with open(path, 'rb') as f:
+            p = prep.prepare(f.read())
+        print(f'  {os.path.basename(path)}: {p.original_bytes / 1e3:.0f}KB → {p.prepared_bytes / 1e3:.0f}KB '
+              f'{"/".join(p.steps)}')
+    for line in prep.summary_lines():
+        print(line)
+    return 0
+
+
+def fidelity(args) -> int:
+    """同じ画像を原寸/縮小で Vision に送り、抽出結果と所要時間を比較（原寸で取れた値が変われば回帰）"""
+    import fixed_extraction as fe
+    client = fe.create_vision_client()
+    if not client:
+        print('❌ Vision APIクライアントの作成に失敗しました')
+        return 2
+    prep = UploadPrep(target_dpi=args.target_dpi, uplink_mbps=args.uplink_mbps)
+    timings: Dict[str, List[float]] = {'original': [], 'prepared': []}
+    regressions = 0
+    images = _list_images(args.folder, args.limit)
+    for path in images:
+        outputs = {}
+        for mode in ('original', 'prepared'):
+            t0 = time.perf_counter()
+            text = fe.google_vision_ocr(path, client, upload_prep=prep if mode == 'prepared' else None)
+            timings[mode].append(time.perf_counter() - t0)
+            outputs[mode] = fe.process_image_final_comprehensive(text, os.path.basename(path))
+        diffs = [k for k, v in outputs['original'].items() if v and outputs['prepared'].get(k) != v]
+        if diffs:
+            regressions += 1
+            print(f'  ✗ {os.path.basename(path)}: ' +
+                  ', '.join(f'{k} {outputs["original"][k]!r}→{outputs["prepared"].get(k)!r}' for k in diffs))
+    for line in prep.summary_lines():
+        print(line)
+    if images:
+        mean = {m: sum(v) / len(v) for m, v in timings.items()}
+        print(f'⏱ OCR所要時間（送信込み） 原寸 {mean["original"]:.2f}s → 縮小 {mean["prepared"]:.2f}s / 件')
+    print(f'{"✅" if not regressions else "❌"} 抽出結果が変わった画像: {regressions}/{len(images)}')
+    return 1 if regressions else 0
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description='Vision 送信前縮小のレポートと抽出結果の比較')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    for name, helptext in (('report', '削減バイト数（オフライン）'), ('fidelity', 'Vision で原寸/縮小の抽出結果を比較')):
+        p = sub.add_parser(name, help=helptext)
+        p.add_argument('folder', help='画像フォルダ')
+        p.add_argument('--limit', type=int, default=None)
+        p.add_argument('--target-dpi', type=int, default=TARGET_DPI)
+        p.add_argument('--uplink-mbps', type=float, default=10.0)
+    args = ap.parse_args(argv)
+    return report(args) if args.cmd == 'report' else fidelity(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
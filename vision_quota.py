@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vision API のクォータ管理（リクエスト/分のトークンバケット + 1日の使用ユニット上限）
+
+大量バッチで 429 が返ると、これまでは画像ごとに OCR_FAILED として記録されていた。
+VisionQuota は送信前にトークンを取り、1日のユニット使用量をファイルに保存して次回の実行に引き継ぐ。
+
+ - 優先度: INTERACTIVE（単一患者の対話的な処理）は BULK（一括の遡及処理）より先にトークンを得る。
+   さらに1日の上限のうち interactive_reserve の割合は INTERACTIVE 専用に残す
+ - 429（ResourceExhausted）を受けたら throttled() でバケットを空にして一定時間止める
+ - 上限に達した、または待ち時間が max_wait を超える場合は QuotaExhausted を送出する。
+   呼び出し側は画像を RetryQueue に積み、次回の実行で先に処理する
+ - 日付の区切りは Google のクォータと同じ太平洋時間の0時
+ - 1日の使用ユニットに数えるのは API が受け付けたリクエストだけ（429・通信エラーは release() で戻す）
+ - CLI では --rpm / --daily-units / --quota-state のどれかを指定したときだけ有効（既定では何も保存しない）
+
+使い方:
+    quota = VisionQuota(requests_per_minute=600, daily_units=20000)
+    try:
+        response = call_with_quota(quota, lambda: client.text_detection(image=image), BULK)
+    except QuotaExhausted as e:
+        retry_queue.add(path, str(e))
+
+    python vision_quota.py status [--quota-state vision_quota_state.json]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITIES = {'interactive': INTERACTIVE, 'bulk': BULK}
+
+DEFAULT_RPM = 600                 # プロジェクト既定 1800/分 に対して余裕を持たせる
+DEFAULT_STATE_PATH = Path(__file__).resolve().parent / 'vision_quota_state.json'
+DEFAULT_RETRY_QUEUE = Path(__file__).resolve().parent / 'vision_retry_queue.jsonl'
+THROTTLE_SECONDS = 30.0           # 429 を受けたときの停止時間（連続するごとに倍）
+RATE_LIMIT_NAMES = ('ResourceExhausted', 'TooManyRequests')
+
+try:
+    from zoneinfo import ZoneInfo
+    _QUOTA_TZ = ZoneInfo('America/Los_Angeles')
+except Exception:
+    _QUOTA_TZ = timezone(timedelta(hours=-8))
+
+
+def quota_day(now: Optional[float] = None) -> str:
+    return datetime.fromtimestamp(now if now is not None else time.time(), _QUOTA_TZ).strftime('%Y-%m-%d')
+
+
+class QuotaExhausted(Exception):
+    """クォータ不足で送信できない（reason: 'daily' / 'rate' / '429'）"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """Vision の 429（google.api_core.exceptions.ResourceExhausted など）か"""
+    return type(exc).__name__ in RATE_LIMIT_NAMES or getattr(exc, 'code', None) == 429
+
+
+class VisionQuota:
+    """リクエスト/分のトークンバケットと1日のユニット上限（スレッドセーフ）"""
+
+    def __init__(self, requests_per_minute: float = DEFAULT_RPM, daily_units: int = 0,
+                 state_path: Optional[Path] = DEFAULT_STATE_PATH, interactive_reserve: float = 0.1,
+                 max_wait: float = 300.0, burst: Optional[float] = None, flush_every: int = 20,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = requests_per_minute / 60.0 if requests_per_minute > 0 else 0.0   # トークン/秒（0 は無制限）
+        self.capacity = float(burst if burst is not None else max(1.0, min(requests_per_minute / 6.0, 50.0)))
+        self.daily_units = daily_units                   # 0 は無制限（使用量の記録のみ）
+        self.interactive_reserve = interactive_reserve
+        self.max_wait = max_wait
+        self.state_path = Path(state_path) if state_path else None
+        self.flush_every = flush_every
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._tokens = self.capacity
+        self._last = clock()
+        self._paused_until = 0.0
+        self._throttle_streak = 0
+        self._waiting = {INTERACTIVE: 0, BULK: 0}
+        self._day = quota_day()
+        self._used = 0          # 今日の使用ユニット（他の実行分を含む）
+        self._unflushed = 0
+        self.requests = {INTERACTIVE: 0, BULK: 0}
+        self.waited_s = 0.0
+        self.throttles = 0
+        self.exhausted = 0
+        self._load()
+
+    # ---- 使用量の保存 ----
+
+    def _read_state(self) -> Dict[str, Any]:
+        if not self.state_path or not self.state_path.is_file():
+            return {}
+        try:
+            with self.state_path.open('r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load(self):
+        state = self._read_state()
+        self._used = int(state.get('units', 0)) if state.get('day') == self._day else 0
+
+    def flush(self):
+        """未保存の使用量をファイルに加算する（他プロセスの使用分は読み直して合算）"""
+        with self._cond:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self.state_path or not self._unflushed:
+            return
+        state = self._read_state()
+        units = int(state.get('units', 0)) if state.get('day') == self._day else 0
+        units += self._unflushed
+        tmp = self.state_path.with_name(self.state_path.name + '.tmp')
+        os.makedirs(self.state_path.parent, exist_ok=True)
+        with tmp.open('w', encoding='utf-8') as f:
+            json.dump({'day': self._day, 'units': units, 'updated': datetime.now().isoformat(timespec='seconds')}, f)
+        os.replace(tmp, self.state_path)
+        self._used = max(self._used, units)
+        self._unflushed = 0
+
+    # ---- トークン ----
+
+    def _roll_day(self):
+        today = quota_day()
+        if today != self._day:
+            self._flush_locked()
+            self._day = today
+            self._used = 0
+
+    def _check_daily(self, priority: int, units: int):
+        if not self.daily_units:
+            return
+        limit = self.daily_units if priority == INTERACTIVE else self.daily_units * (1.0 - self.interactive_reserve)
+        if self._used + units > limit:
+            self.exhausted += 1
+            raise QuotaExhausted('daily', f'1日のユニット上限に到達 ({self._used}/{self.daily_units}, {self._day})')
+
+    def _wait_seconds(self, priority: int, units: int) -> float:
+        """今すぐ取れるなら 0（トークンを消費する）、取れなければ待つべき秒数"""
+        now = self._clock()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.rate <= 0:
+            return 0.0
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if priority != INTERACTIVE and self._waiting[INTERACTIVE]:
+            return 0.05   # 対話的な処理の待ちが優先
+        if self._tokens >= units:
+            self._tokens -= units
+            return 0.0
+        return (units - self._tokens) / self.rate
+
+    def _take(self, priority: int, units: int):
+        self._used += units
+        self._unflushed += units
+        self.requests[priority] = self.requests.get(priority, 0) + 1
+        if self._unflushed >= self.flush_every:
+            self._flush_locked()
+
+    def acquire(self, priority: int = BULK, units: int = 1, max_wait: Optional[float] = None):
+        """トークンを取るまで待つ。上限到達・待ち時間超過で QuotaExhausted"""
+        limit = self.max_wait if max_wait is None else max_wait
+        start = self._clock()
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    self._roll_day()
+                    self._check_daily(priority, units)
+                    wait = self._wait_seconds(priority, units)
+                    if wait <= 0:
+                        self._take(priority, units)
+                        break
+                    if self._clock() - start + wait > limit:
+                        self.exhausted += 1
+                        raise QuotaExhausted('rate', f'レート上限の待ち時間が {limit:g}秒を超えるため保留')
+                    self._cond.wait(min(wait, 1.0))
+            finally:
+                self._waiting[priority] -= 1
+                self.waited_s += self._clock() - start
+                self._cond.notify_all()
+
+    async def acquire_async(self, priority: int = BULK, units: int = 1, max_wait: Optional[float] = None):
+        """acquire() の asyncio 版（イベントループを止めない）"""
+        limit = self.max_wait if max_wait is None else max_wait
+        start = self._clock()
+        with self._cond:
+            self._waiting[priority] += 1
+        try:
+            while True:
+                with self._cond:
+                    self._roll_day()
+                    self._check_daily(priority, units)
+                    wait = self._wait_seconds(priority, units)
+                    if wait <= 0:
+                        self._take(priority, units)
+                        return
+                if self._clock() - start + wait > limit:
+                    with self._cond:
+                        self.exhausted += 1
+                    raise QuotaExhausted('rate', f'レート上限の待ち時間が {limit:g}秒を超えるため保留')
+                await asyncio.sleep(min(wait, 1.0))
+        finally:
+            with self._cond:
+                self._waiting[priority] -= 1
+                self.waited_s += self._clock() - start
+                self._cond.notify_all()
+
+    def release(self, priority: int = BULK, units: int = 1):
+        """acquire() で数えたユニットを戻す（429 や通信エラーで API が受け付けなかったリクエスト）"""
+        with self._cond:
+            self._used = max(0, self._used - units)
+            self._unflushed -= units
+            self.requests[priority] = max(0, self.requests.get(priority, 0) - 1)
+            self._cond.notify_all()
+
+    def throttled(self):
+        """429 を受けた: バケットを空にして停止（連続するほど長く）"""
+        with self._cond:
+            self._throttle_streak += 1
+            self.throttles += 1
+            self._tokens = 0.0
+            pause = THROTTLE_SECONDS * (2 ** min(self._throttle_streak - 1, 4))
+            self._paused_until = max(self._paused_until, self._clock() + pause)
+
+    def succeeded(self):
+        if self._throttle_streak:
+            with self._cond:
+                self._throttle_streak = 0
+
+    # ---- 集計 ----
+
+    @property
+    def used_today(self) -> int:
+        return self._used
+
+    def summary_lines(self) -> List[str]:
+        total = sum(self.requests.values())
+        if not total and not self.exhausted:
+            return []
+        budget = f'/{self.daily_units}' if self.daily_units else ''
+        lines = [f'🎫 Vision クォータ: 今回 {total}件（対話 {self.requests[INTERACTIVE]} / 一括 {self.requests[BULK]}）、'
+                 f'本日 {self._used}{budget}ユニット ({self._day})',
+                 f'  待ち合計 {self.waited_s:.1f}s、429 {self.throttles}回、保留 {self.exhausted}件']
+        return lines
+
+
+def call_with_quota(quota: Optional[VisionQuota], fn: Callable[[], Any], priority: int = BULK,
+                    retries: int = 3) -> Any:
+    """quota のトークンを取ってから fn() を呼ぶ。429 なら停止して再試行し、続けば QuotaExhausted"""
+    if quota is None:
+        return fn()
+    for attempt in range(retries + 1):
+        quota.acquire(priority)
+        try:
+            result = fn()
+        except Exception as e:
+            quota.release(priority)   # 受け付けられなかったリクエストは使用量に数えない
+            if not is_rate_limited(e):
+                raise
+            quota.throttled()
+            if attempt >= retries:
+                raise QuotaExhausted('429', f'429 が続くため保留: {e}') from e
+            continue
+        quota.succeeded()
+        return result
+
+
+class RetryQueue:
+    """クォータ不足で保留した画像（JSONL）。次回の実行で drain() して先に処理する"""
+
+    def __init__(self, path: Path = DEFAULT_RETRY_QUEUE):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.added = 0
+
+    def add(self, image_path, reason: str = '', priority: int = BULK):
+        entry = {'file': str(image_path), 'reason': reason, 'priority': priority,
+                 'at': datetime.now().isoformat(timespec='seconds')}
+        with self._lock:
+            os.makedirs(self.path.parent, exist_ok=True)
+            with self.path.open('a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.added += 1
+
+    def pending(self) -> List[Dict[str, Any]]:
+        """保留中の画像（同じファイルは最新の1件、優先度順）"""
+        if not self.path.is_file():
+            return []
+        latest: Dict[str, Dict[str, Any]] = {}
+        with self.path.open('r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                latest.pop(entry['file'], None)
+                latest[entry['file']] = entry
+        return sorted(latest.values(), key=lambda e: e.get('priority', BULK))
+
+    def drain(self) -> List[str]:
+        """保留中の画像パスを取り出し、キューを空にする（再び保留になれば add し直す）"""
+        with self._lock:
+            files = [e['file'] for e in self.pending()]
+            if self.path.is_file():
+                self.path.unlink()
+            return files
+
+    def __len__(self) -> int:
+        return len(self.pending())
+
+
+def add_quota_arguments(ap, default_priority: str = 'bulk', retry_queue: bool = True):
+    """argparse にクォータ管理の引数を追加する（retry_queue=False: 保留は呼び出し側のジャーナル等で管理）
+
+    --rpm / --daily-units / --quota-state のどれも指定しなければクォータ管理は行わない。"""
+    ap.add_argument('--rpm', type=float, default=None,
+                    help=f'Vision リクエスト/分の上限（指定でクォータ管理を有効化、0 で無制限。他の指定時の既定: {DEFAULT_RPM}）')
+    ap.add_argument('--daily-units', type=int, default=0,
+                    help='1日の Vision ユニット上限（指定でクォータ管理を有効化）。使用量は --quota-state に保存')
+    ap.add_argument('--quota-state', default=None,
+                    help=f'1日の使用量を保存するファイル（--daily-units 指定時の既定: {DEFAULT_STATE_PATH.name}）')
+    ap.add_argument('--quota-max-wait', type=float, default=300.0, help='トークン待ちの上限（秒、超えたら保留）')
+    ap.add_argument('--priority', choices=sorted(PRIORITIES), default=default_priority,
+                    help='interactive は bulk より先に送信し、1日の上限の予備枠も使える')
+    if retry_queue:
+        ap.add_argument('--retry-queue', default=None,
+                        help=f'クォータ不足で保留した画像の記録先（クォータ管理が有効なときの既定: {DEFAULT_RETRY_QUEUE.name}）')
+
+
+def quota_enabled(args) -> bool:
+    return (getattr(args, 'rpm', None) is not None or bool(getattr(args, 'daily_units', 0))
+            or bool(getattr(args, 'quota_state', None)))
+
+
+def quota_options(args) -> Optional[Dict[str, Any]]:
+    """VisionQuota の引数（クォータ管理を指定していなければ None）"""
+    if not quota_enabled(args):
+        return None
+    state = args.quota_state or (str(DEFAULT_STATE_PATH) if args.daily_units else None)
+    return {'requests_per_minute': DEFAULT_RPM if args.rpm is None else args.rpm,
+            'daily_units': args.daily_units, 'state_path': state, 'max_wait': args.quota_max_wait}
+
+
+def quota_from_args(args) -> Optional[VisionQuota]:
+    opts = quota_options(args)
+    return VisionQuota(**opts) if opts is not None else None
+
+
+def priority_from_args(args) -> int:
+    return PRIORITIES[getattr(args, 'priority', 'bulk')]
+
+
+def retry_queue_from_args(args) -> Optional[RetryQueue]:
+    """--retry-queue 指定時、またはクォータ管理が有効なとき（保留が起こりうる）だけ"""
+    path = getattr(args, 'retry_queue', None) or (DEFAULT_RETRY_QUEUE if quota_enabled(args) else None)
+    return RetryQueue(Path(path)) if path else None
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description='Vision クォータの使用量と保留中の画像')
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('status', help='本日の使用量と保留中の画像数')
+    p.add_argument('--quota-state', default=str(DEFAULT_STATE_PATH))
+    p.add_argument('--retry-queue', default=str(DEFAULT_RETRY_QUEUE))
+    p.add_argument('--daily-units', type=int, default=0)
+    args = ap.parse_args(argv)
+    quota = VisionQuota(daily_units=args.daily_units, state_path=Path(args.quota_state))
+    budget = f'/{args.daily_units}' if args.daily_units else ''
+    print(f'🎫 本日 ({quota_day()}) の使用量: {quota.used_today}{budget}ユニット')
+    pending = RetryQueue(Path(args.retry_queue)).pending()
+    print(f'⏸ 保留中の画像: {len(pending)}件')
+    for e in pending[:20]:
+        print(f'  {e["file"]} ({e.get("reason", "")})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())